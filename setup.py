@@ -98,6 +98,34 @@ packages = [
             "smart.util"
            ]
                     
+# defines needed to build the in-tree expat
+EXPAT_DEFINES = [
+    ("XML_STATIC", None),
+    ("XML_NS", "1"),
+    ("XML_DTD", "1"),
+    ("XML_CONTEXT_BYTES", "1024")
+    ]
+
+if "HAVE_MEMMOVE" in config_h_vars:
+    EXPAT_DEFINES.append(("HAVE_MEMMOVE", "1"))
+if "HAVE_BCOPY" in config_h_vars:
+    EXPAT_DEFINES.append(("HAVE_BCOPY", "1"))
+if sys.byteorder == "little":
+    EXPAT_DEFINES.append(("BYTEORDER", "1234"))
+else:
+    EXPAT_DEFINES.append(("BYTEORDER", "4321"))
+
+EXPAT_SOURCES = ["smart/util/celementtree/expat/xmlparse.c",
+                 "smart/util/celementtree/expat/xmlrole.c",
+                 "smart/util/celementtree/expat/xmltok.c"]
+
+ext_modules.append(
+  Extension("smart.backends.rpm.cmetadata",
+            ["smart/backends/rpm/cmetadata.c"]+EXPAT_SOURCES,
+            include_dirs=["smart/util/celementtree/expat"],
+            define_macros=EXPAT_DEFINES)
+           )
+
 try:
     import cElementTree
 except ImportError:
@@ -105,31 +133,11 @@ except ImportError:
         from xml.etree import cElementTree
     except ImportError:
         # we need to build in-tree cElementTree
-        # cElementTree needed defines
-        CET_DEFINES = [
-            ("XML_STATIC", None),
-            ("XML_NS", "1"),
-            ("XML_DTD", "1"),
-            ("XML_CONTEXT_BYTES", "1024")
-            ]
-        
-        if "HAVE_MEMMOVE" in config_h_vars:
-            CET_DEFINES.append(("HAVE_MEMMOVE", "1"))
-        if "HAVE_BCOPY" in config_h_vars:
-            CET_DEFINES.append(("HAVE_BCOPY", "1"))
-        if sys.byteorder == "little":
-            CET_DEFINES.append(("BYTEORDER", "1234"))
-        else:
-            CET_DEFINES.append(("BYTEORDER", "4321"))
-
         ext_modules.append(
           Extension("smart.util.cElementTree",
-                    ["smart/util/celementtree/cElementTree.c",
-                     "smart/util/celementtree/expat/xmlparse.c",
-                     "smart/util/celementtree/expat/xmlrole.c",
-                     "smart/util/celementtree/expat/xmltok.c"],
+                    ["smart/util/celementtree/cElementTree.c"]+EXPAT_SOURCES,
                     include_dirs=["smart/util/celementtree/expat"],
-                    define_macros=CET_DEFINES)
+                    define_macros=EXPAT_DEFINES)
                    )
         packages.append("smart.util.elementtree")
 
@@ -27,6 +27,7 @@ if sys.version_info < (2, 3):
     sys.exit("error: Python 2.3 or later required")
 
 from smart import init, initDistro, initPlugins, initPycurl, initPsyco
+from smart import initAsyncHTTP
 from smart.const import VERSION, DATADIR
 from smart.option import OptionParser
 from smart import *
@@ -178,6 +179,7 @@ def main(argv):
         initDistro(ctrl)
         initPlugins()
         initPycurl()
+        initAsyncHTTP()
         initPsyco()
         exitcode = iface.run(opts.command, opts.argv)
         if exitcode is None:
@@ -209,6 +209,10 @@ def initPycurl():
         # importing pycurl here segfaults
         hooks.call("enable-pycurl")
 
+def initAsyncHTTP():
+    if sysconf.get("async-http", False):
+        hooks.call("enable-async-http")
+
 def initPsyco():
     if sysconf.get("psyco", True):
         try:
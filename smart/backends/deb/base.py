@@ -27,6 +27,7 @@ import os
 import re
 
 from smart.backends.deb.debver import vercmp, checkdep, splitrelease
+from smart.backends.deb.cdebver import dependsmatcher, upgradesmatcher
 from smart.backends.deb.pm import DebPackageManager
 from smart.util.strtools import isGlob
 from smart.cache import *
@@ -241,4 +242,7 @@ def enablePsyco(psyco):
 
 hooks.register("enable-psyco", enablePsyco)
 
+registerMatcher(DebDepends, (DebProvides,), dependsmatcher)
+registerMatcher(DebUpgrades, (DebNameProvides,), upgradesmatcher)
+
 # vim:ts=4:sw=4:et
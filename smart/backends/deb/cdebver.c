@@ -414,21 +414,53 @@ error:
     return NULL;
 }
 
+static int
+checkdep(const char *v1, const char *rel, const char *v2)
+{
+    int rc = vercmp(v1, v2);
+    if (rc == 0)
+        return strchr(rel, '=') != NULL;
+    else if (rc < 0)
+        return rel[0] == '<';
+    else
+        return rel[0] == '>';
+}
+
+/*
+   Native versions of DebDepends.matches() and DebUpgrades.matches(),
+   registered with smart.cache.registerMatcher() by the deb backend.
+   The provide class is checked by the cache before calling them.
+*/
+static int
+dependsmatcher(const char *relation, const char *depversion,
+               const char *prvversion)
+{
+    if (!depversion)
+        return 1;
+    if (!prvversion || !relation)
+        return 0;
+    return checkdep(prvversion, relation, depversion);
+}
+
+static int
+upgradesmatcher(const char *relation, const char *depversion,
+                const char *prvversion)
+{
+    if (!depversion || !prvversion)
+        return 1;
+    if (!relation)
+        return 0;
+    return checkdep(prvversion, relation, depversion);
+}
+
 static PyObject *
 cdebver_checkdep(PyObject *self, PyObject *args)
 {
     const char *v1, *rel, *v2;
     PyObject *ret;
-    int rc;
     if (!PyArg_ParseTuple(args, "sss", &v1, &rel, &v2))
         return NULL;
-    rc = vercmp(v1, v2);
-    if (rc == 0)
-        ret = (strchr(rel, '=') != NULL) ? Py_True : Py_False;
-    else if (rc < 0)
-        ret = (rel[0] == '<') ? Py_True : Py_False;
-    else
-        ret = (rel[0] == '>') ? Py_True : Py_False;
+    ret = checkdep(v1, rel, v2) ? Py_True : Py_False;
     Py_INCREF(ret);
     return ret;
 }
@@ -479,6 +511,10 @@ initcdebver(void)
     if (m == NULL)
         return;
     _buildORDER();
+    PyModule_AddObject(m, "dependsmatcher",
+                       PyCObject_FromVoidPtr(dependsmatcher, NULL));
+    PyModule_AddObject(m, "upgradesmatcher",
+                       PyCObject_FromVoidPtr(upgradesmatcher, NULL));
 }
 
 /* vim:ts=4:sw=4:et
@@ -25,6 +25,7 @@
 import zlib
 
 from rpmver import checkdep, checkver, vercmp, splitarch, splitrelease
+from crpmver import dependsmatcher, obsoletesmatcher
 from smart.util.strtools import isGlob
 from smart.cache import *
 from smart import *
@@ -455,4 +456,7 @@ def enablePsyco(psyco):
 
 hooks.register("enable-psyco", enablePsyco)
 
+registerMatcher(RPMDepends, (RPMProvides,), dependsmatcher)
+registerMatcher(RPMObsoletes, (RPMNameProvides,), obsoletesmatcher)
+
 # vim:ts=4:sw=4:et
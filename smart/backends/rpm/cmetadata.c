@@ -0,0 +1,965 @@
+/*
+
+ Copyright (c) 2005 Canonical
+
+ Written by Gustavo Niemeyer <niemeyer@conectiva.com>
+
+ This file is part of Smart Package Manager.
+
+ Smart Package Manager is free software; you can redistribute it and/or
+ modify it under the terms of the GNU General Public License as published
+ by the Free Software Foundation; either version 2 of the License, or (at
+ your option) any later version.
+
+ Smart Package Manager is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with Smart Package Manager; if not, write to the Free Software
+ Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+*/
+
+#include <Python.h>
+
+#include <string.h>
+#include <stdlib.h>
+
+#include "expat.h"
+
+#define BLOCKSIZE 16384
+#define MAXDEPTH 64
+
+#define NS_COMMON "http://linux.duke.edu/metadata/common}"
+#define NS_RPM    "http://linux.duke.edu/metadata/rpm}"
+
+enum {
+    OTHER,
+    PACKAGE,
+    NAME,
+    ARCH,
+    VERSION,
+    SUMMARY,
+    DESCRIPTION,
+    URL,
+    TIME,
+    SIZE,
+    LOCATION,
+    CHECKSUM,
+    FILE_,
+    SOURCERPM,
+    GROUP,
+    LICENSE,
+    ENTRY,
+    REQUIRES,
+    RECOMMENDS,
+    PROVIDES,
+    CONFLICTS,
+    OBSOLETES,
+    DISTTAG,
+    DISTEPOCH
+};
+
+typedef struct {
+    const char *name;
+    int tag;
+} TagName;
+
+static TagName commontags[] = {
+    {"package", PACKAGE},
+    {"name", NAME},
+    {"arch", ARCH},
+    {"version", VERSION},
+    {"summary", SUMMARY},
+    {"description", DESCRIPTION},
+    {"url", URL},
+    {"time", TIME},
+    {"size", SIZE},
+    {"location", LOCATION},
+    {"checksum", CHECKSUM},
+    {"file", FILE_},
+    {NULL, OTHER}
+};
+
+static TagName rpmtags[] = {
+    {"entry", ENTRY},
+    {"requires", REQUIRES},
+    {"recommends", RECOMMENDS},
+    {"provides", PROVIDES},
+    {"conflicts", CONFLICTS},
+    {"obsoletes", OBSOLETES},
+    {"sourcerpm", SOURCERPM},
+    {"group", GROUP},
+    {"license", LICENSE},
+    {"disttag", DISTTAG},
+    {"distepoch", DISTEPOCH},
+    {NULL, OTHER}
+};
+
+/* Objects from the Python side, fetched on the first parse. */
+static PyObject *RPMProvides = NULL;
+static PyObject *RPMNameProvides = NULL;
+static PyObject *RPMRequires = NULL;
+static PyObject *RPMPreRequires = NULL;
+static PyObject *RPMObsoletes = NULL;
+static PyObject *RPMConflicts = NULL;
+static PyObject *getArchScore = NULL;
+static PyObject *checkver = NULL;
+
+static PyObject *RelationEQ = NULL;
+static PyObject *RelationLT = NULL;
+static PyObject *RelationLE = NULL;
+static PyObject *RelationGT = NULL;
+static PyObject *RelationGE = NULL;
+
+static PyObject *FormatEpochVersion = NULL;
+static PyObject *FormatVersion = NULL;
+static PyObject *FormatVersionArch = NULL;
+
+static PyObject *Zero = NULL;
+
+typedef struct {
+    XML_Parser parser;
+    PyObject *callback;
+    int error;
+    int skip;
+    int depth;
+    int stack[MAXDEPTH];
+    int wanttext;
+    char *text;
+    int textlen;
+    int textsize;
+    PyObject *checksumtype;
+    int checksumpkgid;
+
+    /* Package information. */
+    PyObject *name;
+    PyObject *version;
+    PyObject *arch;
+    PyObject *disttag;
+    PyObject *distepoch;
+    PyObject *pkgid;
+    PyObject *info;
+    PyObject *prvdict;
+    PyObject *reqdict;
+    PyObject *recdict;
+    PyObject *upgdict;
+    PyObject *cnfdict;
+    PyObject *filedict;
+} Parser;
+
+static PyObject *
+getAttribute(const char *module, const char *name)
+{
+    PyObject *result = NULL;
+    PyObject *mod = PyImport_ImportModule(module);
+    if (mod) {
+        result = PyObject_GetAttrString(mod, name);
+        Py_DECREF(mod);
+    }
+    return result;
+}
+
+static int
+initGlobals(void)
+{
+    const char *base = "smart.backends.rpm.base";
+    if (checkver)
+        return 1;
+    if (!(RPMProvides = getAttribute(base, "RPMProvides")) ||
+        !(RPMNameProvides = getAttribute(base, "RPMNameProvides")) ||
+        !(RPMRequires = getAttribute(base, "RPMRequires")) ||
+        !(RPMPreRequires = getAttribute(base, "RPMPreRequires")) ||
+        !(RPMObsoletes = getAttribute(base, "RPMObsoletes")) ||
+        !(RPMConflicts = getAttribute(base, "RPMConflicts")) ||
+        !(getArchScore = getAttribute(base, "getArchScore")))
+        return 0;
+    RelationEQ = PyString_InternFromString("=");
+    RelationLT = PyString_InternFromString("<");
+    RelationLE = PyString_InternFromString("<=");
+    RelationGT = PyString_InternFromString(">");
+    RelationGE = PyString_InternFromString(">=");
+    FormatEpochVersion = PyString_FromString("%s:%s-%s");
+    FormatVersion = PyString_FromString("%s-%s");
+    FormatVersionArch = PyString_FromString("%s@%s");
+    Zero = PyInt_FromLong(0);
+    if (PyErr_Occurred())
+        return 0;
+    checkver = getAttribute("smart.backends.rpm.rpmver", "checkver");
+    return checkver != NULL;
+}
+
+static int
+getTag(const char *name)
+{
+    TagName *table;
+    int i;
+    if (strncmp(name, NS_COMMON, sizeof(NS_COMMON)-1) == 0) {
+        name += sizeof(NS_COMMON)-1;
+        table = commontags;
+    } else if (strncmp(name, NS_RPM, sizeof(NS_RPM)-1) == 0) {
+        name += sizeof(NS_RPM)-1;
+        table = rpmtags;
+    } else {
+        return OTHER;
+    }
+    for (i = 0; table[i].name; i++) {
+        if (strcmp(name, table[i].name) == 0)
+            return table[i].tag;
+    }
+    return OTHER;
+}
+
+static const char *
+getAttr(const XML_Char **atts, const char *name)
+{
+    for (; *atts; atts += 2) {
+        if (strcmp(*atts, name) == 0)
+            return atts[1];
+    }
+    return NULL;
+}
+
+/* Like cElementTree, return plain strings for ASCII data. */
+static PyObject *
+makeString(const char *s, Py_ssize_t len)
+{
+    Py_ssize_t i;
+    for (i = 0; i != len; i++) {
+        if (s[i] & 0x80)
+            return PyUnicode_DecodeUTF8(s, len, "strict");
+    }
+    return PyString_FromStringAndSize(s, len);
+}
+
+static PyObject *
+makeAttr(const char *value)
+{
+    if (!value) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    return makeString(value, strlen(value));
+}
+
+static PyObject *
+makeText(Parser *p)
+{
+    if (!p->textlen) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    return makeString(p->text, p->textlen);
+}
+
+static PyObject *
+makeInt(const char *value)
+{
+    PyObject *str, *result;
+    if (!value) {
+        PyErr_SetString(PyExc_TypeError,
+                        "int() argument must be a string or a number, "
+                        "not 'NoneType'");
+        return NULL;
+    }
+    str = PyString_FromString(value);
+    if (!str)
+        return NULL;
+    result = PyNumber_Int(str);
+    Py_DECREF(str);
+    return result;
+}
+
+static PyObject *
+makeRelation(const char *flags)
+{
+    PyObject *relation = Py_None;
+    if (flags && flags[0] && flags[1] && !flags[2]) {
+        if (strcmp(flags, "EQ") == 0)
+            relation = RelationEQ;
+        else if (strcmp(flags, "LT") == 0)
+            relation = RelationLT;
+        else if (strcmp(flags, "LE") == 0)
+            relation = RelationLE;
+        else if (strcmp(flags, "GT") == 0)
+            relation = RelationGT;
+        else if (strcmp(flags, "GE") == 0)
+            relation = RelationGE;
+    }
+    Py_INCREF(relation);
+    return relation;
+}
+
+static void
+stop(Parser *p)
+{
+    p->error = 1;
+    XML_StopParser(p->parser, XML_FALSE);
+}
+
+#define SET(attr, value) \
+    do { \
+        PyObject *tmp = p->attr; \
+        p->attr = value; \
+        Py_XDECREF(tmp); \
+    } while (0)
+
+static int
+resetPackage(Parser *p)
+{
+    Py_INCREF(Py_None); SET(name, Py_None);
+    Py_INCREF(Py_None); SET(version, Py_None);
+    Py_INCREF(Py_None); SET(arch, Py_None);
+    Py_INCREF(Py_None); SET(disttag, Py_None);
+    Py_INCREF(Py_None); SET(distepoch, Py_None);
+    Py_INCREF(Py_None); SET(pkgid, Py_None);
+    SET(info, PyDict_New());
+    SET(prvdict, PyDict_New());
+    SET(reqdict, PyDict_New());
+    SET(recdict, PyDict_New());
+    SET(upgdict, PyDict_New());
+    SET(cnfdict, PyDict_New());
+    SET(filedict, PyDict_New());
+    return (p->info && p->prvdict && p->reqdict && p->recdict &&
+            p->upgdict && p->cnfdict && p->filedict);
+}
+
+static void
+clearParser(Parser *p)
+{
+    Py_CLEAR(p->checksumtype);
+    Py_CLEAR(p->name);
+    Py_CLEAR(p->version);
+    Py_CLEAR(p->arch);
+    Py_CLEAR(p->disttag);
+    Py_CLEAR(p->distepoch);
+    Py_CLEAR(p->pkgid);
+    Py_CLEAR(p->info);
+    Py_CLEAR(p->prvdict);
+    Py_CLEAR(p->reqdict);
+    Py_CLEAR(p->recdict);
+    Py_CLEAR(p->upgdict);
+    Py_CLEAR(p->cnfdict);
+    Py_CLEAR(p->filedict);
+    free(p->text);
+    p->text = NULL;
+}
+
+static int
+setItem(PyObject *dict, PyObject *key, PyObject *value)
+{
+    int result;
+    if (!key || !value) {
+        Py_XDECREF(key);
+        Py_XDECREF(value);
+        return -1;
+    }
+    result = PyDict_SetItem(dict, key, value);
+    Py_DECREF(key);
+    Py_DECREF(value);
+    return result;
+}
+
+static int
+addDepends(PyObject *dict, PyObject *cls, PyObject *name,
+           PyObject *relation, PyObject *version)
+{
+    PyObject *key = PyTuple_Pack(4, cls, name, relation, version);
+    if (!key)
+        return -1;
+    if (PyDict_SetItem(dict, key, Py_True) == -1) {
+        Py_DECREF(key);
+        return -1;
+    }
+    Py_DECREF(key);
+    return 0;
+}
+
+static int
+handleVersion(Parser *p, const XML_Char **atts)
+{
+    /*
+       e = elem.get("epoch")
+       if e and e != "0":
+           version = "%s:%s-%s" % (e, elem.get("ver"), elem.get("rel"))
+       else:
+           version = "%s-%s" % (elem.get("ver"), elem.get("rel"))
+    */
+    const char *e = getAttr(atts, "epoch");
+    PyObject *args, *version;
+    if (e && e[0] && strcmp(e, "0") != 0) {
+        args = Py_BuildValue("(NNN)", makeAttr(e),
+                             makeAttr(getAttr(atts, "ver")),
+                             makeAttr(getAttr(atts, "rel")));
+        if (!args)
+            return -1;
+        version = PyString_Format(FormatEpochVersion, args);
+    } else {
+        args = Py_BuildValue("(NN)", makeAttr(getAttr(atts, "ver")),
+                             makeAttr(getAttr(atts, "rel")));
+        if (!args)
+            return -1;
+        version = PyString_Format(FormatVersion, args);
+    }
+    Py_DECREF(args);
+    if (!version)
+        return -1;
+    SET(version, version);
+    return 0;
+}
+
+static int
+handleEntry(Parser *p, const XML_Char **atts, int parent)
+{
+    const char *ename = getAttr(atts, "name");
+    const char *v;
+    PyObject *name = NULL;
+    PyObject *relation = NULL;
+    PyObject *version = NULL;
+    PyObject *cls;
+    int result = -1;
+
+    /*
+       if (not ename or
+           ename[:7] in ("rpmlib(", "config(")):
+           continue
+    */
+    if (!ename || !ename[0] ||
+        strncmp(ename, "rpmlib(", 7) == 0 ||
+        strncmp(ename, "config(", 7) == 0)
+        return 0;
+
+    switch (parent) {
+        case REQUIRES:
+        case RECOMMENDS:
+        case PROVIDES:
+        case OBSOLETES:
+        case CONFLICTS:
+            break;
+        default:
+            return 0;
+    }
+
+    /*
+       if "ver" in elem.keys():
+           eversion = v
+           if e and e != "0":
+               eversion = "%s:%s" % (e, eversion)
+           if r:
+               eversion = "%s-%s" % (eversion, r)
+           erelation = COMPMAP.get(elem.get("flags"))
+       else:
+           eversion = None
+           erelation = None
+    */
+    v = getAttr(atts, "ver");
+    if (v) {
+        const char *e = getAttr(atts, "epoch");
+        const char *r = getAttr(atts, "rel");
+        size_t elen = 0, vlen = strlen(v), rlen = 0;
+        char *buf, *pos;
+        if (e && e[0] && strcmp(e, "0") != 0)
+            elen = strlen(e)+1;
+        if (r && r[0])
+            rlen = strlen(r)+1;
+        pos = buf = malloc(elen+vlen+rlen+1);
+        if (!buf) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        if (elen) {
+            memcpy(pos, e, elen-1);
+            pos += elen-1;
+            *pos++ = ':';
+        }
+        memcpy(pos, v, vlen);
+        pos += vlen;
+        if (rlen) {
+            *pos++ = '-';
+            memcpy(pos, r, rlen-1);
+            pos += rlen-1;
+        }
+        version = makeString(buf, pos-buf);
+        free(buf);
+        if (!version)
+            return -1;
+        relation = makeRelation(getAttr(atts, "flags"));
+    } else {
+        Py_INCREF(Py_None);
+        version = Py_None;
+        Py_INCREF(Py_None);
+        relation = Py_None;
+    }
+
+    if (parent == PROVIDES) {
+        /*
+           if ename[0] == "/":
+               filedict[ename] = True
+           else:
+               if ename == name and checkver(eversion, version):
+                   eversion = "%s@%s" % (eversion, arch)
+                   Prv = RPMNameProvides
+               else:
+                   Prv = RPMProvides
+               prvdict[(Prv, ename.encode('utf-8'), eversion)] = True
+        */
+        if (ename[0] == '/') {
+            name = makeString(ename, strlen(ename));
+            if (name)
+                result = PyDict_SetItem(p->filedict, name, Py_True);
+            goto exit;
+        }
+        cls = RPMProvides;
+        name = PyString_FromString(ename);
+        if (!name)
+            goto exit;
+        if (p->name != Py_None) {
+            PyObject *uname = makeString(ename, strlen(ename));
+            int equal;
+            if (!uname)
+                goto exit;
+            equal = PyObject_RichCompareBool(uname, p->name, Py_EQ);
+            Py_DECREF(uname);
+            if (equal == -1)
+                goto exit;
+            if (equal) {
+                PyObject *res = PyObject_CallFunctionObjArgs(checkver,
+                                                             version,
+                                                             p->version,
+                                                             NULL);
+                if (!res)
+                    goto exit;
+                equal = PyObject_IsTrue(res);
+                Py_DECREF(res);
+                if (equal == -1)
+                    goto exit;
+            }
+            if (equal) {
+                PyObject *args = PyTuple_Pack(2, version, p->arch);
+                if (!args)
+                    goto exit;
+                Py_DECREF(version);
+                version = PyString_Format(FormatVersionArch, args);
+                Py_DECREF(args);
+                if (!version)
+                    goto exit;
+                cls = RPMNameProvides;
+            }
+        }
+        {
+            PyObject *key = PyTuple_Pack(3, cls, name, version);
+            if (key) {
+                result = PyDict_SetItem(p->prvdict, key, Py_True);
+                Py_DECREF(key);
+            }
+        }
+        goto exit;
+    }
+
+    name = makeString(ename, strlen(ename));
+    if (!name)
+        goto exit;
+
+    switch (parent) {
+        case REQUIRES: {
+            /*
+               if elem.get("pre") == "1":
+                   reqdict[(RPMPreRequires, ...)] = True
+               elif (elem.get("hint") == "1" or
+                     elem.get("missingok") == "1"):
+                   recdict[(RPMRequires, ...)] = True
+               else:
+                   reqdict[(RPMRequires, ...)] = True
+            */
+            const char *pre = getAttr(atts, "pre");
+            const char *hint = getAttr(atts, "hint");
+            const char *missingok = getAttr(atts, "missingok");
+            if (pre && strcmp(pre, "1") == 0)
+                result = addDepends(p->reqdict, RPMPreRequires,
+                                    name, relation, version);
+            else if ((hint && strcmp(hint, "1") == 0) ||
+                     (missingok && strcmp(missingok, "1") == 0))
+                result = addDepends(p->recdict, RPMRequires,
+                                    name, relation, version);
+            else
+                result = addDepends(p->reqdict, RPMRequires,
+                                    name, relation, version);
+            break;
+        }
+        case RECOMMENDS:
+            result = addDepends(p->recdict, RPMRequires,
+                                name, relation, version);
+            break;
+        case OBSOLETES:
+            result = addDepends(p->upgdict, RPMObsoletes,
+                                name, relation, version);
+            if (result == 0)
+                result = addDepends(p->cnfdict, RPMObsoletes,
+                                    name, relation, version);
+            break;
+        case CONFLICTS:
+            result = addDepends(p->cnfdict, RPMConflicts,
+                                name, relation, version);
+            break;
+    }
+
+exit:
+    Py_XDECREF(name);
+    Py_XDECREF(relation);
+    Py_XDECREF(version);
+    return result;
+}
+
+static void
+startElement(void *data, const XML_Char *tagname, const XML_Char **atts)
+{
+    Parser *p = (Parser *)data;
+    int tag, parent;
+    int result = 0;
+
+    if (p->error)
+        return;
+
+    tag = getTag(tagname);
+    parent = (p->depth > 0 && p->depth <= MAXDEPTH) ?
+             p->stack[p->depth-1] : OTHER;
+    if (p->depth < MAXDEPTH)
+        p->stack[p->depth] = tag;
+    p->depth++;
+
+    p->textlen = 0;
+    p->wanttext = 0;
+
+    if (p->skip)
+        return;
+
+    switch (tag) {
+        case PACKAGE: {
+            /*
+               if not skip and tag == PACKAGE:
+                   if elem.get("type") != "rpm":
+                       skip = PACKAGE
+            */
+            const char *type = getAttr(atts, "type");
+            if (!type || strcmp(type, "rpm") != 0)
+                p->skip = 1;
+            break;
+        }
+        case VERSION:
+            result = handleVersion(p, atts);
+            break;
+        case TIME:
+            /*
+               info["time"] = int(elem.get("file"))
+               info["build_time"] = int(elem.get("build"))
+            */
+            result = setItem(p->info, PyString_FromString("time"),
+                             makeInt(getAttr(atts, "file")));
+            if (result == 0)
+                result = setItem(p->info, PyString_FromString("build_time"),
+                                 makeInt(getAttr(atts, "build")));
+            break;
+        case SIZE: {
+            /*
+               info["size"] = int(elem.get("package"))
+               if elem.get("installed"):
+                   info["installed_size"] = int(elem.get("installed"))
+            */
+            const char *installed = getAttr(atts, "installed");
+            result = setItem(p->info, PyString_FromString("size"),
+                             makeInt(getAttr(atts, "package")));
+            if (result == 0 && installed && installed[0])
+                result = setItem(p->info,
+                                 PyString_FromString("installed_size"),
+                                 makeInt(installed));
+            break;
+        }
+        case LOCATION:
+            result = setItem(p->info, PyString_FromString("location"),
+                             makeAttr(getAttr(atts, "href")));
+            break;
+        case CHECKSUM: {
+            const char *pkgid = getAttr(atts, "pkgid");
+            PyObject *type = makeAttr(getAttr(atts, "type"));
+            if (!type) {
+                result = -1;
+                break;
+            }
+            Py_XDECREF(p->checksumtype);
+            p->checksumtype = type;
+            p->checksumpkgid = (pkgid && strcmp(pkgid, "YES") == 0);
+            p->wanttext = 1;
+            break;
+        }
+        case ENTRY:
+            result = handleEntry(p, atts, parent);
+            break;
+        case NAME:
+        case ARCH:
+        case SUMMARY:
+        case DESCRIPTION:
+        case URL:
+        case FILE_:
+        case SOURCERPM:
+        case GROUP:
+        case LICENSE:
+        case DISTTAG:
+        case DISTEPOCH:
+            p->wanttext = 1;
+            break;
+    }
+
+    if (result == -1)
+        stop(p);
+}
+
+static void
+characterData(void *data, const XML_Char *s, int len)
+{
+    Parser *p = (Parser *)data;
+    if (p->error || !p->wanttext)
+        return;
+    if (p->textlen+len > p->textsize) {
+        int size = (p->textlen+len)*2;
+        char *text = realloc(p->text, size);
+        if (!text) {
+            PyErr_NoMemory();
+            stop(p);
+            return;
+        }
+        p->text = text;
+        p->textsize = size;
+    }
+    memcpy(p->text+p->textlen, s, len);
+    p->textlen += len;
+}
+
+static int
+setInfoText(Parser *p, const char *key)
+{
+    /*
+       if elem.text:
+           info[key] = elem.text
+    */
+    if (!p->textlen)
+        return 0;
+    return setItem(p->info, PyString_FromString(key), makeText(p));
+}
+
+static void
+endElement(void *data, const XML_Char *tagname)
+{
+    Parser *p = (Parser *)data;
+    PyObject *text;
+    int tag;
+    int result = 0;
+
+    if (p->error)
+        return;
+
+    p->depth--;
+    tag = (p->depth < MAXDEPTH) ? p->stack[p->depth] : OTHER;
+    p->wanttext = 0;
+
+    if (p->skip) {
+        if (tag == PACKAGE)
+            p->skip = 0;
+        return;
+    }
+
+    switch (tag) {
+        case ARCH: {
+            /*
+               if getArchScore(elem.text) == 0:
+                   skip = PACKAGE
+               else:
+                   arch = elem.text
+            */
+            PyObject *score;
+            int zero;
+            text = makeText(p);
+            if (!text) {
+                result = -1;
+                break;
+            }
+            score = PyObject_CallFunctionObjArgs(getArchScore, text, NULL);
+            if (!score) {
+                Py_DECREF(text);
+                result = -1;
+                break;
+            }
+            zero = PyObject_RichCompareBool(score, Zero, Py_EQ);
+            Py_DECREF(score);
+            if (zero == -1) {
+                Py_DECREF(text);
+                result = -1;
+            } else if (zero) {
+                Py_DECREF(text);
+                p->skip = 1;
+            } else {
+                SET(arch, text);
+            }
+            break;
+        }
+        case NAME:
+            if (!(text = makeText(p)))
+                result = -1;
+            else
+                SET(name, text);
+            break;
+        case DISTTAG:
+            if (!(text = makeText(p)))
+                result = -1;
+            else
+                SET(disttag, text);
+            break;
+        case DISTEPOCH:
+            if (!(text = makeText(p)))
+                result = -1;
+            else
+                SET(distepoch, text);
+            break;
+        case SUMMARY:
+            result = setInfoText(p, "summary");
+            break;
+        case DESCRIPTION:
+            result = setInfoText(p, "description");
+            break;
+        case URL:
+            result = setInfoText(p, "url");
+            break;
+        case SOURCERPM:
+            result = setInfoText(p, "sourcerpm");
+            break;
+        case GROUP:
+            result = setInfoText(p, "group");
+            break;
+        case LICENSE:
+            result = setInfoText(p, "license");
+            break;
+        case CHECKSUM:
+            /*
+               info[elem.get("type")] = elem.text
+               if elem.get("pkgid") == "YES":
+                   pkgid = elem.text
+            */
+            if (!(text = makeText(p))) {
+                result = -1;
+                break;
+            }
+            result = PyDict_SetItem(p->info, p->checksumtype, text);
+            if (p->checksumpkgid)
+                SET(pkgid, text);
+            else
+                Py_DECREF(text);
+            break;
+        case FILE_:
+            if (!(text = makeText(p))) {
+                result = -1;
+                break;
+            }
+            result = PyDict_SetItem(p->filedict, text, Py_True);
+            Py_DECREF(text);
+            break;
+        case PACKAGE: {
+            PyObject *res;
+            res = PyObject_CallFunctionObjArgs(p->callback, p->name,
+                                               p->version, p->arch,
+                                               p->disttag, p->distepoch,
+                                               p->pkgid, p->info,
+                                               p->prvdict, p->reqdict,
+                                               p->recdict, p->upgdict,
+                                               p->cnfdict, p->filedict,
+                                               NULL);
+            if (!res) {
+                result = -1;
+                break;
+            }
+            Py_DECREF(res);
+            if (!resetPackage(p))
+                result = -1;
+            break;
+        }
+    }
+
+    if (result == -1)
+        stop(p);
+}
+
+static PyObject *
+cmetadata_parsePrimary(PyObject *self, PyObject *args)
+{
+    PyObject *file, *callback;
+    Parser p;
+    int done = 0;
+
+    if (!PyArg_ParseTuple(args, "OO", &file, &callback))
+        return NULL;
+    if (!initGlobals())
+        return NULL;
+
+    memset(&p, 0, sizeof(p));
+    p.callback = callback;
+    if (!resetPackage(&p)) {
+        clearParser(&p);
+        return NULL;
+    }
+    p.parser = XML_ParserCreateNS(NULL, '}');
+    if (!p.parser) {
+        clearParser(&p);
+        return PyErr_NoMemory();
+    }
+    XML_SetUserData(p.parser, &p);
+    XML_SetElementHandler(p.parser, startElement, endElement);
+    XML_SetCharacterDataHandler(p.parser, characterData);
+
+    while (!done) {
+        PyObject *data;
+        int status;
+        data = PyObject_CallMethod(file, "read", "i", BLOCKSIZE);
+        if (!data)
+            break;
+        if (!PyString_Check(data)) {
+            PyErr_SetString(PyExc_TypeError, "read() must return a string");
+            Py_DECREF(data);
+            break;
+        }
+        done = (PyString_GET_SIZE(data) == 0);
+        status = XML_Parse(p.parser, PyString_AS_STRING(data),
+                           PyString_GET_SIZE(data), done);
+        Py_DECREF(data);
+        if (p.error)
+            break;
+        if (status == XML_STATUS_ERROR) {
+            PyErr_Format(PyExc_SyntaxError, "%s: line %d, column %d",
+                         XML_ErrorString(XML_GetErrorCode(p.parser)),
+                         (int)XML_GetErrorLineNumber(p.parser),
+                         (int)XML_GetErrorColumnNumber(p.parser));
+            break;
+        }
+    }
+
+    XML_ParserFree(p.parser);
+    clearParser(&p);
+
+    if (PyErr_Occurred())
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef cmetadata_methods[] = {
+    {"parsePrimary", (PyCFunction)cmetadata_parsePrimary,
+     METH_VARARGS, NULL},
+    {NULL, NULL}
+};
+
+DL_EXPORT(void)
+initcmetadata(void)
+{
+    Py_InitModule3("cmetadata", cmetadata_methods, "");
+}
+
+/* vim:ts=4:sw=4:et
+*/
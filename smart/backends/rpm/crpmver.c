@@ -279,21 +279,100 @@ crpmver_checkver(PyObject *self, PyObject *args)
     return ret;
 }
 
+static int
+checkdep(const char *v1, const char *rel, const char *v2)
+{
+    int rc = vercmp(v1, v2);
+    if (rc == 0)
+        return strchr(rel, '=') != NULL;
+    else if (rc < 0)
+        return rel[0] == '<';
+    else
+        return rel[0] == '>';
+}
+
+static const char *
+splitarch(const char *version, char *buf, int size)
+{
+    /* Copy version without its arch into buf, returning the arch. */
+    const char *at = strrchr(version, '@');
+    const char *slash = strrchr(version, '-');
+    int len;
+    if (!at || !slash || at < slash) {
+        at = NULL;
+        len = strlen(version);
+    } else {
+        len = at-version;
+    }
+    if (len > size-1)
+        len = size-1;
+    memcpy(buf, version, len);
+    buf[len] = '\0';
+    return at ? at+1 : NULL;
+}
+
+static int
+getarchcolor(const char *arch)
+{
+    /* Same as getArchColor() in base.py. */
+    if (strcmp(arch, "noarch") == 0)
+        return 0;
+    if (strcmp(arch, "x86_64") == 0 || strcmp(arch, "ppc64") == 0 ||
+        strcmp(arch, "s390x") == 0 || strcmp(arch, "sparc64") == 0)
+        return 2;
+    return 1;
+}
+
+/*
+   Native versions of RPMDepends.matches() and RPMObsoletes.matches(),
+   registered with smart.cache.registerMatcher() by the rpm backend.
+   The provide class is checked by the cache before calling them.
+*/
+static int
+dependsmatcher(const char *relation, const char *depversion,
+               const char *prvversion)
+{
+    char depbuf[64], prvbuf[64];
+    if (!depversion || !prvversion)
+        return 1;
+    if (!relation)
+        return 0;
+    splitarch(depversion, depbuf, sizeof(depbuf));
+    splitarch(prvversion, prvbuf, sizeof(prvbuf));
+    return checkdep(prvbuf, relation, depbuf);
+}
+
+static int
+obsoletesmatcher(const char *relation, const char *depversion,
+                 const char *prvversion)
+{
+    char depbuf[64], prvbuf[64];
+    const char *deparch, *prvarch;
+    if (depversion && !prvversion)
+        return 0;
+    if (!depversion)
+        return 1;
+    if (!relation)
+        return 0;
+    deparch = splitarch(depversion, depbuf, sizeof(depbuf));
+    prvarch = splitarch(prvversion, prvbuf, sizeof(prvbuf));
+    if (deparch && prvarch) {
+        int depcolor = getarchcolor(deparch);
+        int prvcolor = getarchcolor(prvarch);
+        if (depcolor && prvcolor && depcolor != prvcolor)
+            return 0;
+    }
+    return checkdep(prvbuf, relation, depbuf);
+}
+
 static PyObject *
 crpmver_checkdep(PyObject *self, PyObject *args)
 {
     const char *v1, *rel, *v2;
     PyObject *ret;
-    int rc;
     if (!PyArg_ParseTuple(args, "sss", &v1, &rel, &v2))
         return NULL;
-    rc = vercmp(v1, v2);
-    if (rc == 0)
-        ret = (strchr(rel, '=') != NULL) ? Py_True : Py_False;
-    else if (rc < 0)
-        ret = (rel[0] == '<') ? Py_True : Py_False;
-    else
-        ret = (rel[0] == '>') ? Py_True : Py_False;
+    ret = checkdep(v1, rel, v2) ? Py_True : Py_False;
     Py_INCREF(ret);
     return ret;
 }
@@ -343,6 +422,10 @@ initcrpmver(void)
     m = Py_InitModule3("crpmver", crpmver_methods, "");
     if (m == NULL)
         return;
+    PyModule_AddObject(m, "dependsmatcher",
+                       PyCObject_FromVoidPtr(dependsmatcher, NULL));
+    PyModule_AddObject(m, "obsoletesmatcher",
+                       PyCObject_FromVoidPtr(obsoletesmatcher, NULL));
 }
 
 /* vim:ts=4:sw=4:et
@@ -23,6 +23,8 @@
 from smart.backends.rpm.rpmver import checkver
 from smart.cache import PackageInfo, Loader
 from smart.backends.rpm.base import *
+from smart.uncompress import Uncompressor
+from smart.const import BLOCKSIZE
 
 try:
     from xml.etree import cElementTree        
@@ -32,9 +34,19 @@ except ImportError:
     except ImportError:     
         from smart.util import cElementTree
 
+try:
+    import sqlite3
+except ImportError:
+    try:
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        sqlite3 = None
+
 from smart import *
 import posixpath
+import marshal
 import locale
+import mmap
 import os
 
 NS_COMMON    = "http://linux.duke.edu/metadata/common"
@@ -43,6 +55,13 @@ NS_FILELISTS = "http://linux.duke.edu/metadata/filelists"
 
 BYTESPERPKG = 3000
 
+FILELISTSINDEXVERSION = 1
+
+# Fields only needed to show information about packages. They're
+# kept in a separate store, and read back when asked for.
+TEXTFIELDS = ("summary", "description", "url", "license", "group",
+              "sourcerpm")
+
 def nstag(ns, tag):
     return "{%s}%s" % (ns, tag)
 
@@ -52,6 +71,12 @@ class RPMMetaDataPackageInfo(PackageInfo):
         PackageInfo.__init__(self, package)
         self._loader = loader
         self._info = info
+        self._text = None
+
+    def _getText(self, key, default):
+        if self._text is None:
+            self._text = self._loader.getTextInfo(self._info)
+        return self._text.get(key, default)
 
     def getURLs(self):
         url = self._info.get("location")
@@ -78,45 +103,81 @@ class RPMMetaDataPackageInfo(PackageInfo):
         return self._info.get("sha256")
 
     def getDescription(self):
-        return self._info.get("description", "")
+        return self._getText("description", "")
 
     def getSummary(self):
-        return self._info.get("summary", "")
+        return self._getText("summary", "")
 
     def getReferenceURLs(self):
-        return [self._info.get("url", "")]
+        return [self._getText("url", "")]
 
     def getSource(self):
-        sourcerpm = self._info.get("sourcerpm", "")
+        sourcerpm = self._getText("sourcerpm", "")
         sourcerpm = sourcerpm.replace(".src", "")
         sourcerpm = sourcerpm.replace(".nosrc", "")
         return sourcerpm.replace(".rpm", "")
     
     def getGroup(self):
-        return self._info.get("group", "")
+        return self._getText("group", "")
 
     def getLicense(self):
-        return self._info.get("license", "")
+        return self._getText("license", "")
+
+    def getPathList(self):
+        return self._loader.getPathList(self._package)
 
 
 class RPMMetaDataLoader(Loader):
 
-    __stateversion__ = Loader.__stateversion__+3
+    __stateversion__ = Loader.__stateversion__+7
  
-    def __init__(self, filename, filelistsname, baseurl):
+    def __init__(self, filename, filelistsname, baseurl,
+                 filelistsdigest=None):
         Loader.__init__(self)
         self._filename = filename
         self._filelistsname = filelistsname
+        self._filelistsdigest = filelistsdigest
+        self._flindexname = getFileListsIndexPath(filelistsname)
+        self._textstorename = getTextStorePath(filename)
+        self._textstore = None
         self._baseurl = baseurl
         self._fileprovides = {}
-        self._parsedflist = False
+        self._flindex = None
+        self._pathlists = None
         self._pkgids = {}
 
+    def __getstate__(self):
+        state = Loader.__getstate__(self)
+        state["_flindex"] = None
+        state["_pathlists"] = None
+        state["_textstore"] = None
+        return state
+
     def reset(self):
         Loader.reset(self)
         self._fileprovides.clear()
-        self._parsedflist = False
+        self._flindex = None
+        self._pathlists = None
         self._pkgids.clear()
+        if self._textstore:
+            self._textstore.close()
+            self._textstore = None
+
+    def setTextStorePath(self, path):
+        self._textstorename = path
+
+    def getTextInfo(self, info):
+        offset = info.get("textoffset")
+        if offset is None:
+            return info
+        try:
+            if not self._textstore:
+                self._textstore = open(self._textstorename)
+            self._textstore.seek(offset)
+            return marshal.load(self._textstore)
+        except (IOError, EOFError, ValueError), e:
+            iface.debug("%s: %s" % (self._textstorename, e))
+            return {}
 
     def getInfo(self, pkg):
         return RPMMetaDataPackageInfo(pkg, self, pkg.loaders[self])
@@ -125,292 +186,415 @@ class RPMMetaDataLoader(Loader):
         return os.path.getsize(self._filename)/BYTESPERPKG
 
     def load(self):
-        METADATA    = nstag(NS_COMMON, "metadata")
-        PACKAGE     = nstag(NS_COMMON, "package")
-        NAME        = nstag(NS_COMMON, "name")
-        ARCH        = nstag(NS_COMMON, "arch")
-        VERSION     = nstag(NS_COMMON, "version")
-        SUMMARY     = nstag(NS_COMMON, "summary")
-        DESCRIPTION = nstag(NS_COMMON, "description")
-        URL         = nstag(NS_COMMON, "url")
-        TIME        = nstag(NS_COMMON, "time")
-        SIZE        = nstag(NS_COMMON, "size")
-        LOCATION    = nstag(NS_COMMON, "location")
-        FORMAT      = nstag(NS_COMMON, "format")
-        CHECKSUM    = nstag(NS_COMMON, "checksum")
-        FILE        = nstag(NS_COMMON, "file")
-        SOURCERPM   = nstag(NS_RPM, "sourcerpm")
-        GROUP       = nstag(NS_RPM, "group")
-        LICENSE     = nstag(NS_RPM, "license")
-        ENTRY       = nstag(NS_RPM, "entry")
-        REQUIRES    = nstag(NS_RPM, "requires")
-        RECOMMENDS  = nstag(NS_RPM, "recommends")
-        PROVIDES    = nstag(NS_RPM, "provides")
-        CONFLICTS   = nstag(NS_RPM, "conflicts")
-        OBSOLETES   = nstag(NS_RPM, "obsoletes")
-        DISTTAG     = nstag(NS_RPM, "disttag")
-        DISTEPOCH   = nstag(NS_RPM, "distepoch")
-
-        COMPMAP = { "EQ":"=", "LT":"<", "LE":"<=", "GT":">", "GE":">="}
-
         # Prepare progress reporting.
-        lastoffset = 0
-        mod = 0
         progress = iface.getProgress(self._cache)
+        offsets = [0, 0]
+
+        # The file may still be compressed, and is uncompressed
+        # while parsing it.
+        file = Uncompressor.open(self._filename)
+        if not file:
+            raise Error, _("Unsupported file type: %s") % self._filename
+
+        # Text fields go to a new store, replacing the current one
+        # once everything is loaded. Without it, they stay in info.
+        textstorename = "%s.%d" % (self._textstorename, os.getpid())
+        try:
+            textstore = open(textstorename, "w")
+        except IOError:
+            textstore = None
+
+        def buildPackage(name, version, arch, disttag, distepoch, pkgid,
+                         info, prvdict, reqdict, recdict, upgdict, cnfdict,
+                         filedict):
+
+            # Use all the information acquired to build the package.
+            pkg = self.buildPackage(*getPackageArgs(name, version, arch,
+                                                    disttag, distepoch,
+                                                    prvdict, reqdict,
+                                                    recdict, upgdict,
+                                                    cnfdict))
+            pkg.loaders[self] = info
+
+            if textstore:
+                text = {}
+                for key in TEXTFIELDS:
+                    if key in info:
+                        text[key] = info.pop(key)
+                info["textoffset"] = textstore.tell()
+                marshal.dump(text, textstore)
+
+            # Store the provided files for future usage.
+            if filedict:
+                for filename in filedict:
+                    lst = self._fileprovides.get(filename)
+                    if not lst:
+                        self._fileprovides[filename] = [pkg]
+                    else:
+                        lst.append(pkg)
+
+            if pkgid:
+                self._pkgids[pkgid] = pkg
+
+            # Update progress
+            lastoffset, mod = offsets
+            offset = file.tell()
+            div, mod = divmod(offset-lastoffset+mod, BYTESPERPKG)
+            offsets[:] = offset, mod
+            progress.add(div)
+            progress.show()
+
+        try:
+            try:
+                parsePrimary(file, buildPackage)
+            finally:
+                file.close()
+                if textstore:
+                    textstore.close()
+        except:
+            if textstore:
+                os.unlink(textstorename)
+            raise
+
+        if textstore:
+            if self._textstore:
+                self._textstore.close()
+                self._textstore = None
+            os.rename(textstorename, self._textstorename)
 
-        # Prepare package information.
-        name = None
-        version = None
-        arch = None
-        disttag = None
-        distepoch = None
-        info = {}
-        reqdict = {}
-        recdict = {}
-        prvdict = {}
-        upgdict = {}
-        cnfdict = {}
-        filedict = {}
-
-        # Prepare data useful for the iteration
-        skip = None
-        queue = []
+    def loadFileProvides(self, fndict):
+        bfp = self.buildFileProvides
+        index = None
+        for fn in fndict:
+            if fn not in self._fileprovides:
+                if index is None:
+                    index = self.getFileListsIndex()
+                pkgs = []
+                for pkgid in index.getPackageIds(fn):
+                    pkg = self._pkgids.get(pkgid)
+                    if pkg:
+                        pkgs.append(pkg)
+                self._fileprovides[fn] = pkgs or ()
+            else:
+                pkgs = self._fileprovides[fn]
 
-        file = open(self._filename)
-        for event, elem in cElementTree.iterparse(file, ("start", "end")):
-            tag = elem.tag
+            if pkgs:
+                for pkg in pkgs:
+                    bfp(pkg, (RPMProvides, fn, None))
 
-            if event == "start":
+    def getPathList(self, pkg):
+        if self._pathlists is None:
+            pkgids = self._pkgids
+            pathlists = self._pathlists = {}
+            for path, pkgid in self.getFileListsIndex().iterEntries():
+                owner = pkgids.get(pkgid)
+                if owner:
+                    lst = pathlists.get(owner)
+                    if not lst:
+                        pathlists[owner] = [path]
+                    else:
+                        lst.append(path)
+        return self._pathlists.get(pkg, [])
+
+    def setFileListsIndexPath(self, path):
+        self._flindexname = path
+
+    def getFileListsIndex(self):
+        # The files of every package, sorted by path, are kept on
+        # disk, so that filelists.xml is only parsed again when the
+        # repository changes it.
+        if self._flindex is None:
+            key = self._filelistsdigest
+            if not key:
+                st = os.stat(self._filelistsname)
+                key = "%d-%d" % (st.st_size, st.st_mtime)
+            header = "smart-filelists-index %d %s\n" % \
+                     (FILELISTSINDEXVERSION, key)
+            index = readFileListsIndex(self._flindexname, header)
+            if index is None:
+                entries = self.parseFilesList()
+                index = writeFileListsIndex(self._flindexname, header,
+                                            entries)
+            self._flindex = index
+        return self._flindex
+
+    def parseFilesList(self):
+        FILE    = nstag(NS_FILELISTS, "file")
+        PACKAGE = nstag(NS_FILELISTS, "package")
 
-                if not skip and tag == PACKAGE:
-                    if elem.get("type") != "rpm":
+        entries = []
+
+        pkgid = None
+        skip = None
+        file = Uncompressor.open(self._filelistsname)
+        if not file:
+            raise Error, _("Unsupported file type: %s") % self._filelistsname
+        for event, elem in cElementTree.iterparse(file, ("start", "end")):
+            if event == "start":
+                if not skip and elem.tag == PACKAGE:
+                    if elem.get("arch") == "src":
                         skip = PACKAGE
+                    else:
+                        pkgid = elem.get("pkgid")
+                        if not pkgid:
+                            skip = PACKAGE
+            elif event == "end":
+                if skip:
+                    if elem.tag == skip:
+                        skip = None
+                elif elem.tag == FILE:
+                    path = elem.text
+                    if path and "\n" not in path and "\0" not in path:
+                        if type(path) is unicode:
+                            path = path.encode("utf-8")
+                        entries.append("%s\0%s\n" % (path, pkgid))
+                elem.clear()
+        file.close()
+        return entries
 
-                queue.append(elem)
+class RPMSqliteMetaDataLoader(Loader):
 
-            elif event == "end":
+    __stateversion__ = Loader.__stateversion__
 
-                popped = queue.pop()
-                assert popped is elem
+    def __init__(self, filename, filelistsname, baseurl):
+        Loader.__init__(self)
+        self._filename = filename
+        self._filelistsname = filelistsname
+        self._baseurl = baseurl
+        self._fileprovides = {}
+        self._pkgids = {}
+        self._db = None
+        self._fldb = None
 
-                if skip:
-                    if tag == skip:
-                        skip = None
+    def __getstate__(self):
+        state = Loader.__getstate__(self)
+        state["_db"] = None
+        state["_fldb"] = None
+        return state
 
-                elif tag == ARCH:
-                    if getArchScore(elem.text) == 0:
-                        skip = PACKAGE
-                    else:
-                        arch = elem.text
+    def reset(self):
+        Loader.reset(self)
+        self._fileprovides.clear()
+        self._pkgids.clear()
+        if self._db:
+            self._db.close()
+            self._db = None
+        if self._fldb:
+            self._fldb.close()
+            self._fldb = None
+
+    def getDatabase(self):
+        if self._db is None:
+            self._db = openDatabase(self._filename)
+        return self._db
+
+    def getFileListsDatabase(self):
+        if self._fldb is None:
+            self._fldb = openDatabase(self._filelistsname)
+        return self._fldb
+
+    def getTextInfo(self, info):
+        try:
+            row = self.getDatabase().execute(
+                "SELECT summary, description, url, rpm_license, rpm_group,"
+                " rpm_sourcerpm FROM packages WHERE pkgKey=?",
+                (info["pkgkey"],)).fetchone()
+        except (Error, sqlite3.Error), e:
+            iface.debug("%s: %s" % (self._filename, e))
+            return {}
+        text = {}
+        if row:
+            for key, value in zip(TEXTFIELDS, row):
+                if value:
+                    text[key] = value
+        return text
 
-                elif tag == NAME:
-                    name = elem.text
+    def getInfo(self, pkg):
+        return RPMMetaDataPackageInfo(pkg, self, pkg.loaders[self])
 
-                elif tag == VERSION:
-                    e = elem.get("epoch")
+    def getLoadSteps(self):
+        # Steps are counted before load() may run in a worker process,
+        # which mustn't inherit an open connection, so don't keep it.
+        db = openDatabase(self._filename)
+        try:
+            return db.execute("SELECT COUNT(*) FROM packages").fetchone()[0]
+        finally:
+            db.close()
+
+    def load(self):
+        COMPMAP = { "EQ":"=", "LT":"<", "LE":"<=", "GT":">", "GE":">="}
+
+        progress = iface.getProgress(self._cache)
+
+        db = self.getDatabase()
+        tables = {}
+        for name, in db.execute("SELECT name FROM sqlite_master "
+                                "WHERE type='table'"):
+            tables[name] = True
+
+        # Read every dependency table at once, instead of querying
+        # them for each package.
+        deps = {}
+        for table in ("provides", "requires", "recommends",
+                      "conflicts", "obsoletes"):
+            pkgdeps = deps[table] = {}
+            if table not in tables:
+                continue
+            if table == "requires":
+                pre = "pre"
+            else:
+                pre = "NULL"
+            for (pkgkey, ename, flags, e, v, r, epre) in db.execute(
+                "SELECT pkgKey, name, flags, epoch, version, release, %s "
+                "FROM %s" % (pre, table)):
+                if (not ename or
+                    ename[:7] in ("rpmlib(", "config(")):
+                    continue
+                if v is not None:
+                    eversion = v
                     if e and e != "0":
-                        version = "%s:%s-%s" % \
-                                  (e, elem.get("ver"), elem.get("rel"))
-                    else:
-                        version = "%s-%s" % \
-                                  (elem.get("ver"), elem.get("rel"))
-
-                elif tag == DISTTAG:
-                    disttag = elem.text
-
-                elif tag == DISTEPOCH:
-                    distepoch = elem.text
-
-                elif tag == SUMMARY:
-                    if elem.text:
-                        info["summary"] = elem.text
-
-                elif tag == DESCRIPTION:
-                    if elem.text:
-                        info["description"] = elem.text
-
-                elif tag == URL:
-                    if elem.text:
-                        info["url"] = elem.text
-
-                elif tag == TIME:
-                    info["time"] = int(elem.get("file"))
-                    info["build_time"] = int(elem.get("build"))
-
-                elif tag == SIZE:
-                    info["size"] = int(elem.get("package"))
-                    if elem.get("installed"):
-                        info["installed_size"] = int(elem.get("installed"))
-
-                elif tag == CHECKSUM:
-                    info[elem.get("type")] = elem.text
-                    if elem.get("pkgid") == "YES":
-                        pkgid = elem.text
-
-                elif tag == LOCATION:
-                    info["location"] = elem.get("href")
-
-                elif tag == SOURCERPM:
-                    if elem.text:
-                        info["sourcerpm"] = elem.text
-
-                elif tag == GROUP:
-                    if elem.text:
-                        info["group"] = elem.text
-
-                elif tag == LICENSE:
-                    if elem.text:
-                        info["license"] = elem.text
-
-                elif tag == FILE:
-                    filedict[elem.text] = True
-
-                elif tag == ENTRY:
-                    ename = elem.get("name")
-                    if (not ename or
-                        ename[:7] in ("rpmlib(", "config(")):
-                        continue
-
-                    if "ver" in elem.keys():
-                        e = elem.get("epoch")
-                        v = elem.get("ver")
-                        r = elem.get("rel")
-                        eversion = v
-                        if e and e != "0":
-                            eversion = "%s:%s" % (e, eversion)
-                        if r:
-                            eversion = "%s-%s" % (eversion, r)
-                        if "flags" in elem.keys():
-                            erelation = COMPMAP.get(elem.get("flags"))
-                        else:
-                            erelation = None
+                        eversion = "%s:%s" % (e, eversion)
+                    if r:
+                        eversion = "%s-%s" % (eversion, r)
+                    if flags:
+                        erelation = COMPMAP.get(flags)
                     else:
-                        eversion = None
                         erelation = None
+                else:
+                    eversion = None
+                    erelation = None
+                dep = (ename, erelation, eversion,
+                       epre in ("TRUE", "1", 1))
+                lst = pkgdeps.get(pkgkey)
+                if not lst:
+                    pkgdeps[pkgkey] = [dep]
+                else:
+                    lst.append(dep)
+
+        files = {}
+        for pkgkey, filename in db.execute("SELECT pkgKey, name "
+                                           "FROM files"):
+            lst = files.get(pkgkey)
+            if not lst:
+                files[pkgkey] = [filename]
+            else:
+                lst.append(filename)
 
-                    lasttag = queue[-1].tag
-                    if lasttag == REQUIRES:
-                        if elem.get("pre") == "1":
-                            reqdict[(RPMPreRequires,
-                                     ename, erelation, eversion)] = True
-                        elif elem.get("hint") == "1" or elem.get("missingok") == "1":
-                            recdict[(RPMRequires,
-                                     ename, erelation, eversion)] = True
-                        else:
-                            reqdict[(RPMRequires,
-                                     ename, erelation, eversion)] = True
+        for (pkgkey, pkgid, name, arch, e, v, r, time, build_time,
+             size, installed_size, location, checksumtype) in db.execute(
+            "SELECT pkgKey, pkgId, name, arch, epoch, version, release, "
+            "time_file, time_build, size_package, size_installed, "
+            "location_href, checksum_type FROM packages"):
 
-                    elif lasttag == RECOMMENDS:
-                        recdict[(RPMRequires,
-                                 ename, erelation, eversion)] = True
+            if getArchScore(arch) == 0:
+                progress.add(1)
+                continue
 
-                    elif lasttag == PROVIDES:
-                        if ename[0] == "/":
-                            filedict[ename] = True
-                        else:
-                            if ename == name and checkver(eversion, version):
-                                eversion = "%s@%s" % (eversion, arch)
-                                Prv = RPMNameProvides
-                            else:
-                                Prv = RPMProvides
-                            prvdict[(Prv, ename.encode('utf-8'), eversion)] = True
-
-                    elif lasttag == OBSOLETES:
-                        tup = (RPMObsoletes, ename, erelation, eversion)
-                        upgdict[tup] = True
-                        cnfdict[tup] = True
-
-                    elif lasttag == CONFLICTS:
-                        cnfdict[(RPMConflicts,
-                                 ename, erelation, eversion)] = True
-                                    
-                elif elem.tag == PACKAGE:
-
-                    # Use all the information acquired to build the package.
-
-                    versionarch = "%s@%s" % (version, arch)
-
-                    upgdict[(RPMObsoletes,
-                             name, '<', versionarch)] = True
-
-                    reqargs = [x for x in reqdict
-                               if not ((x[2] is None or "=" in x[2]) and
-                                       (RPMProvides, x[1], x[3]) in prvdict or
-                                       system_provides.match(x[1], x[2], x[3]))]
-                    reqargs = collapse_libc_requires(reqargs)
-
-                    recargs = [x for x in recdict
-                               if not ((x[2] is None or "=" in x[2]) and
-                                       (RPMProvides, x[1], x[3]) in prvdict or
-                                       system_provides.match(x[1], x[2], x[3]))]
-
-                    prvargs = prvdict.keys()
-                    cnfargs = cnfdict.keys()
-                    upgargs = upgdict.keys()
-
-                    if disttag:
-                        distversion = "%s-%s" % (version, disttag)
-                        if distepoch:
-                            distversion += distepoch
-                        versionarch = "%s@%s" % (distversion, arch)
-
-                    pkg = self.buildPackage((RPMPackage, name, versionarch),
-                                            prvargs, reqargs, upgargs, cnfargs, recargs)
-                    pkg.loaders[self] = info
-
-                    # Store the provided files for future usage.
-                    if filedict:
-                        for filename in filedict:
-                            lst = self._fileprovides.get(filename)
-                            if not lst:
-                                self._fileprovides[filename] = [pkg]
-                            else:
-                                lst.append(pkg)
-
-                    if pkgid:
-                        self._pkgids[pkgid] = pkg
-
-                    # Reset all information.
-                    name = None
-                    version = None
-                    arch = None
-                    disttag = None
-                    distepoch = None
-                    pkgid = None
-                    reqdict.clear()
-                    recdict.clear()
-                    prvdict.clear()
-                    upgdict.clear()
-                    cnfdict.clear()
-                    filedict.clear()
-                    # Do not clear it. pkg.loaders has a reference.
-                    info = {}
-
-                    # Update progress
-                    offset = file.tell()
-                    div, mod = divmod(offset-lastoffset+mod, BYTESPERPKG)
-                    lastoffset = offset
-                    progress.add(div)
-                    progress.show()
+            if e and e != "0":
+                version = "%s:%s-%s" % (e, v, r)
+            else:
+                version = "%s-%s" % (v, r)
+
+            info = {"pkgkey": pkgkey,
+                    "time": time,
+                    "build_time": build_time,
+                    "size": size,
+                    "location": location}
+            if installed_size is not None:
+                info["installed_size"] = installed_size
+            if checksumtype:
+                info[checksumtype] = pkgid
+
+            reqdict = {}
+            recdict = {}
+            prvdict = {}
+            upgdict = {}
+            cnfdict = {}
+            filedict = {}
+
+            for filename in files.get(pkgkey, ()):
+                filedict[filename] = True
+
+            for ename, erelation, eversion, epre in \
+                    deps["provides"].get(pkgkey, ()):
+                if ename[0] == "/":
+                    filedict[ename] = True
+                else:
+                    if ename == name and checkver(eversion, version):
+                        eversion = "%s@%s" % (eversion, arch)
+                        Prv = RPMNameProvides
+                    else:
+                        Prv = RPMProvides
+                    prvdict[(Prv, ename.encode('utf-8'), eversion)] = True
 
-                elem.clear()
+            for ename, erelation, eversion, epre in \
+                    deps["requires"].get(pkgkey, ()):
+                if epre:
+                    Req = RPMPreRequires
+                else:
+                    Req = RPMRequires
+                reqdict[(Req, ename, erelation, eversion)] = True
+
+            for ename, erelation, eversion, epre in \
+                    deps["recommends"].get(pkgkey, ()):
+                recdict[(RPMRequires, ename, erelation, eversion)] = True
+
+            for ename, erelation, eversion, epre in \
+                    deps["obsoletes"].get(pkgkey, ()):
+                tup = (RPMObsoletes, ename, erelation, eversion)
+                upgdict[tup] = True
+                cnfdict[tup] = True
+
+            for ename, erelation, eversion, epre in \
+                    deps["conflicts"].get(pkgkey, ()):
+                cnfdict[(RPMConflicts, ename, erelation, eversion)] = True
+
+            pkg = self.buildPackage(*getPackageArgs(name, version, arch,
+                                                    None, None,
+                                                    prvdict, reqdict,
+                                                    recdict, upgdict,
+                                                    cnfdict))
+            pkg.loaders[self] = info
+
+            # Store the provided files for future usage.
+            for filename in filedict:
+                lst = self._fileprovides.get(filename)
+                if not lst:
+                    self._fileprovides[filename] = [pkg]
+                else:
+                    lst.append(pkg)
 
-        file.close()
+            self._pkgids[pkgid] = pkg
+
+            progress.add(1)
+            progress.show()
 
     def loadFileProvides(self, fndict):
         bfp = self.buildFileProvides
-        parsed = self._parsedflist
+        db = None
+        dirs = {}
         for fn in fndict:
             if fn not in self._fileprovides:
-                if not parsed:
-                    self._parsedflist = parsed = True
-                    self.parseFilesList(fndict)
-                    if fn not in self._fileprovides:
-                        pkgs = self._fileprovides[fn] = ()
-                    else:
-                        pkgs = self._fileprovides[fn]
-                else:
-                    pkgs = self._fileprovides[fn] = ()
+                if db is None:
+                    db = self.getFileListsDatabase()
+                # Files are kept per directory, which is indexed.
+                dirname, basename = splitPath(fn)
+                owners = dirs.get(dirname)
+                if owners is None:
+                    owners = dirs[dirname] = []
+                    if dirname is not None:
+                        for pkgid, filenames in db.execute(
+                            "SELECT packages.pkgId, filelist.filenames "
+                            "FROM filelist, packages "
+                            "WHERE filelist.dirname=? AND "
+                            "packages.pkgKey=filelist.pkgKey", (dirname,)):
+                            pkg = self._pkgids.get(pkgid)
+                            if pkg:
+                                owners.append((pkg,
+                                               filenames.split("/")))
+                pkgs = [pkg for pkg, filenames in owners
+                        if basename in filenames]
+                self._fileprovides[fn] = pkgs or ()
             else:
                 pkgs = self._fileprovides[fn]
 
@@ -418,44 +602,436 @@ class RPMMetaDataLoader(Loader):
                 for pkg in pkgs:
                     bfp(pkg, (RPMProvides, fn, None))
 
+    def getPathList(self, pkg):
+        info = pkg.loaders[self]
+        row = self.getDatabase().execute(
+            "SELECT pkgId FROM packages WHERE pkgKey=?",
+            (info["pkgkey"],)).fetchone()
+        if not row:
+            return []
+        paths = []
+        for dirname, filenames in self.getFileListsDatabase().execute(
+            "SELECT filelist.dirname, filelist.filenames "
+            "FROM filelist, packages "
+            "WHERE packages.pkgId=? AND "
+            "filelist.pkgKey=packages.pkgKey", row):
+            for filename in filenames.split("/"):
+                path = posixpath.join(dirname, filename)
+                if type(path) is unicode:
+                    path = path.encode("utf-8")
+                paths.append(path)
+        return paths
+
+class FileListsIndex(object):
+    # Lines of "<path>\0<pkgid>\n", sorted, starting at the given
+    # offset of data, which may be a string or a mmap.
+
+    def __init__(self, data, offset):
+        self._data = data
+        self._offset = offset
+
+    def getPackageIds(self, path):
+        data = self._data
+        lo = self._offset
+        hi = len(data)
+        while lo < hi:
+            mid = (lo+hi)//2
+            start = data.rfind("\n", lo, mid)
+            if start == -1:
+                start = lo
+            else:
+                start += 1
+            end = data.find("\n", start)+1
+            if data[start:data.find("\0", start)] < path:
+                lo = end
+            else:
+                hi = start
+        pkgids = []
+        prefix = path+"\0"
+        size = len(prefix)
+        while data[lo:lo+size] == prefix:
+            end = data.find("\n", lo)
+            pkgids.append(data[lo+size:end])
+            lo = end+1
+        return pkgids
+
+    def iterEntries(self):
+        data = self._data
+        pos = self._offset
+        size = len(data)
+        while pos < size:
+            end = data.find("\n", pos)
+            path, pkgid = data[pos:end].split("\0")
+            yield path, pkgid
+            pos = end+1
+
+def parsePrimary(file, callback):
+    # Parse the primary information in file, calling callback for
+    # each rpm package with its name, version, arch, disttag,
+    # distepoch, pkgid and info, and the dictionaries of provides,
+    # requires, recommends, upgrades, conflicts and files.
+    METADATA    = nstag(NS_COMMON, "metadata")
+    PACKAGE     = nstag(NS_COMMON, "package")
+    NAME        = nstag(NS_COMMON, "name")
+    ARCH        = nstag(NS_COMMON, "arch")
+    VERSION     = nstag(NS_COMMON, "version")
+    SUMMARY     = nstag(NS_COMMON, "summary")
+    DESCRIPTION = nstag(NS_COMMON, "description")
+    URL         = nstag(NS_COMMON, "url")
+    TIME        = nstag(NS_COMMON, "time")
+    SIZE        = nstag(NS_COMMON, "size")
+    LOCATION    = nstag(NS_COMMON, "location")
+    FORMAT      = nstag(NS_COMMON, "format")
+    CHECKSUM    = nstag(NS_COMMON, "checksum")
+    FILE        = nstag(NS_COMMON, "file")
+    SOURCERPM   = nstag(NS_RPM, "sourcerpm")
+    GROUP       = nstag(NS_RPM, "group")
+    LICENSE     = nstag(NS_RPM, "license")
+    ENTRY       = nstag(NS_RPM, "entry")
+    REQUIRES    = nstag(NS_RPM, "requires")
+    RECOMMENDS  = nstag(NS_RPM, "recommends")
+    PROVIDES    = nstag(NS_RPM, "provides")
+    CONFLICTS   = nstag(NS_RPM, "conflicts")
+    OBSOLETES   = nstag(NS_RPM, "obsoletes")
+    DISTTAG     = nstag(NS_RPM, "disttag")
+    DISTEPOCH   = nstag(NS_RPM, "distepoch")
+
+    COMPMAP = { "EQ":"=", "LT":"<", "LE":"<=", "GT":">", "GE":">="}
+
+    # Prepare package information.
+    name = None
+    version = None
+    arch = None
+    disttag = None
+    distepoch = None
+    pkgid = None
+    info = {}
+    reqdict = {}
+    recdict = {}
+    prvdict = {}
+    upgdict = {}
+    cnfdict = {}
+    filedict = {}
+
+    # Prepare data useful for the iteration
+    skip = None
+    queue = []
+
+    for event, elem in cElementTree.iterparse(file, ("start", "end")):
+        tag = elem.tag
+
+        if event == "start":
+
+            if not skip and tag == PACKAGE:
+                if elem.get("type") != "rpm":
+                    skip = PACKAGE
+
+            queue.append(elem)
+
+        elif event == "end":
+
+            popped = queue.pop()
+            assert popped is elem
+
+            if skip:
+                if tag == skip:
+                    skip = None
+
+            elif tag == ARCH:
+                if getArchScore(elem.text) == 0:
+                    skip = PACKAGE
+                else:
+                    arch = elem.text
 
-    def parseFilesList(self, fndict):
-        FILE    = nstag(NS_FILELISTS, "file")
-        PACKAGE = nstag(NS_FILELISTS, "package")
+            elif tag == NAME:
+                name = elem.text
 
-        pkgids = self._pkgids
-        fileprovides = self._fileprovides
+            elif tag == VERSION:
+                e = elem.get("epoch")
+                if e and e != "0":
+                    version = "%s:%s-%s" % \
+                              (e, elem.get("ver"), elem.get("rel"))
+                else:
+                    version = "%s-%s" % \
+                              (elem.get("ver"), elem.get("rel"))
 
-        pkg = None
-        skip = None
-        file = open(self._filelistsname)
-        for event, elem in cElementTree.iterparse(file, ("start", "end")):
-            if event == "start":
-                if not skip and elem.tag == PACKAGE:
-                    if elem.get("arch") == "src":
-                        skip = PACKAGE
+            elif tag == DISTTAG:
+                disttag = elem.text
+
+            elif tag == DISTEPOCH:
+                distepoch = elem.text
+
+            elif tag == SUMMARY:
+                if elem.text:
+                    info["summary"] = elem.text
+
+            elif tag == DESCRIPTION:
+                if elem.text:
+                    info["description"] = elem.text
+
+            elif tag == URL:
+                if elem.text:
+                    info["url"] = elem.text
+
+            elif tag == TIME:
+                info["time"] = int(elem.get("file"))
+                info["build_time"] = int(elem.get("build"))
+
+            elif tag == SIZE:
+                info["size"] = int(elem.get("package"))
+                if elem.get("installed"):
+                    info["installed_size"] = int(elem.get("installed"))
+
+            elif tag == CHECKSUM:
+                info[elem.get("type")] = elem.text
+                if elem.get("pkgid") == "YES":
+                    pkgid = elem.text
+
+            elif tag == LOCATION:
+                info["location"] = elem.get("href")
+
+            elif tag == SOURCERPM:
+                if elem.text:
+                    info["sourcerpm"] = elem.text
+
+            elif tag == GROUP:
+                if elem.text:
+                    info["group"] = elem.text
+
+            elif tag == LICENSE:
+                if elem.text:
+                    info["license"] = elem.text
+
+            elif tag == FILE:
+                filedict[elem.text] = True
+
+            elif tag == ENTRY:
+                ename = elem.get("name")
+                if (not ename or
+                    ename[:7] in ("rpmlib(", "config(")):
+                    continue
+
+                if "ver" in elem.keys():
+                    e = elem.get("epoch")
+                    v = elem.get("ver")
+                    r = elem.get("rel")
+                    eversion = v
+                    if e and e != "0":
+                        eversion = "%s:%s" % (e, eversion)
+                    if r:
+                        eversion = "%s-%s" % (eversion, r)
+                    if "flags" in elem.keys():
+                        erelation = COMPMAP.get(elem.get("flags"))
                     else:
-                        pkg = pkgids.get(elem.get("pkgid"))
-                        if not pkg:
-                            skip = PACKAGE
-            elif event == "end":
-                if skip:
-                    if elem.tag == skip:
-                        skip = None
-                elif elem.tag == FILE and elem.text in fndict:
-                    pkgs = fileprovides.get(elem.text)
-                    if not pkgs:
-                        fileprovides[elem.text] = [pkg]
+                        erelation = None
+                else:
+                    eversion = None
+                    erelation = None
+
+                lasttag = queue[-1].tag
+                if lasttag == REQUIRES:
+                    if elem.get("pre") == "1":
+                        reqdict[(RPMPreRequires,
+                                 ename, erelation, eversion)] = True
+                    elif (elem.get("hint") == "1" or
+                          elem.get("missingok") == "1"):
+                        recdict[(RPMRequires,
+                                 ename, erelation, eversion)] = True
                     else:
-                        pkgs.append(pkg)
-                elem.clear()
+                        reqdict[(RPMRequires,
+                                 ename, erelation, eversion)] = True
+
+                elif lasttag == RECOMMENDS:
+                    recdict[(RPMRequires,
+                             ename, erelation, eversion)] = True
+
+                elif lasttag == PROVIDES:
+                    if ename[0] == "/":
+                        filedict[ename] = True
+                    else:
+                        if ename == name and checkver(eversion, version):
+                            eversion = "%s@%s" % (eversion, arch)
+                            Prv = RPMNameProvides
+                        else:
+                            Prv = RPMProvides
+                        prvdict[(Prv, ename.encode('utf-8'), eversion)] = True
+
+                elif lasttag == OBSOLETES:
+                    tup = (RPMObsoletes, ename, erelation, eversion)
+                    upgdict[tup] = True
+                    cnfdict[tup] = True
+
+                elif lasttag == CONFLICTS:
+                    cnfdict[(RPMConflicts,
+                             ename, erelation, eversion)] = True
+                                
+            elif elem.tag == PACKAGE:
+                callback(name, version, arch, disttag, distepoch, pkgid,
+                         info, prvdict, reqdict, recdict, upgdict, cnfdict,
+                         filedict)
+
+                # Reset all information.
+                name = None
+                version = None
+                arch = None
+                disttag = None
+                distepoch = None
+                pkgid = None
+                info = {}
+                reqdict = {}
+                recdict = {}
+                prvdict = {}
+                upgdict = {}
+                cnfdict = {}
+                filedict = {}
+
+            elem.clear()
+
+def getPackageArgs(name, version, arch, disttag, distepoch,
+                   prvdict, reqdict, recdict, upgdict, cnfdict):
+    # Turn what was collected about a package into the arguments
+    # of Loader.buildPackage().
+
+    versionarch = "%s@%s" % (version, arch)
+
+    upgdict[(RPMObsoletes,
+             name, '<', versionarch)] = True
+
+    reqargs = [x for x in reqdict
+               if not ((x[2] is None or "=" in x[2]) and
+                       (RPMProvides, x[1], x[3]) in prvdict or
+                       system_provides.match(x[1], x[2], x[3]))]
+    reqargs = collapse_libc_requires(reqargs)
+
+    recargs = [x for x in recdict
+               if not ((x[2] is None or "=" in x[2]) and
+                       (RPMProvides, x[1], x[3]) in prvdict or
+                       system_provides.match(x[1], x[2], x[3]))]
+
+    prvargs = prvdict.keys()
+    cnfargs = cnfdict.keys()
+    upgargs = upgdict.keys()
+
+    if disttag:
+        distversion = "%s-%s" % (version, disttag)
+        if distepoch:
+            distversion += distepoch
+        versionarch = "%s@%s" % (distversion, arch)
+
+    return ((RPMPackage, name, versionarch),
+            prvargs, reqargs, upgargs, cnfargs, recargs)
+
+def getChecksumDigest(checksums):
+    # Pick the strongest of the given checksums, returning it along
+    # with a digest object to compute it, or None.
+    if not checksums:
+        return None
+    if checksums.get("sha256"):
+        try:
+            from hashlib import sha256
+        except ImportError:
+            from smart.util.sha256 import sha256
+        return checksums["sha256"], sha256()
+    if checksums.get("sha"):
+        try:
+            from hashlib import sha1 as sha
+        except ImportError:
+            from sha import sha
+        return checksums["sha"], sha()
+    if checksums.get("md5"):
+        try:
+            from hashlib import md5
+        except ImportError:
+            from md5 import md5
+        return checksums["md5"], md5()
+    return None
+
+def checkUncompressedFile(filename, checksums):
+    # Check the uncompressed data of filename against the strongest
+    # of the given checksums, so that nothing is built from a file
+    # which the fetcher couldn't check as it was kept compressed.
+    checksum = getChecksumDigest(checksums)
+    if not checksum:
+        return
+    file = Uncompressor.open(filename, (checksum[1],))
+    if not file:
+        raise Error, _("Unsupported file type: %s") % filename
+    try:
+        while file.read(BLOCKSIZE):
+            pass
+    finally:
         file.close()
+    if checksum[1].hexdigest() != checksum[0]:
+        raise Error, _("Invalid checksum (expected %s, got %s) "
+                       "in %s") % (checksum[0], checksum[1].hexdigest(),
+                                   filename)
+
+def openDatabase(filename):
+    # Connecting would create a missing file.
+    if not os.path.isfile(filename):
+        raise Error, _("File not found: %s") % filename
+    db = sqlite3.connect(filename)
+    db.text_factory = sqlite3.OptimizedUnicode
+    return db
+
+def splitPath(path):
+    # Split path as it's kept in filelists_db, or give None as the
+    # directory if it can't be looked up there.
+    dirname, basename = posixpath.split(path)
+    if type(path) is str:
+        try:
+            dirname = dirname.decode("utf-8")
+            basename = basename.decode("utf-8")
+        except UnicodeError:
+            return None, basename
+    return dirname, basename
+
+def getFileListsIndexPath(filelistsname):
+    return filelistsname+".idx"
+
+def getTextStorePath(filename):
+    return filename+".text"
+
+def readFileListsIndex(indexname, header):
+    try:
+        file = open(indexname, "rb")
+    except IOError:
+        return None
+    try:
+        if file.readline() != header:
+            return None
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        file.close()
+    return FileListsIndex(data, len(header))
+
+def writeFileListsIndex(indexname, header, entries):
+    entries.sort()
+    data = header+"".join(entries)
+    tmpname = "%s.%d" % (indexname, os.getpid())
+    try:
+        file = open(tmpname, "wb")
+        try:
+            file.write(data)
+        finally:
+            file.close()
+        os.rename(tmpname, indexname)
+    except (IOError, OSError):
+        # Not being able to keep it only costs parsing it again.
+        if os.path.isfile(tmpname):
+            os.unlink(tmpname)
+    return FileListsIndex(data, len(header))
 
 def enablePsyco(psyco):
     psyco.bind(RPMMetaDataLoader.load)
     psyco.bind(RPMMetaDataLoader.loadFileProvides)
     psyco.bind(RPMMetaDataLoader.parseFilesList)
+    psyco.bind(FileListsIndex.getPackageIds)
+    psyco.bind(RPMSqliteMetaDataLoader.load)
+    psyco.bind(RPMSqliteMetaDataLoader.loadFileProvides)
 
 hooks.register("enable-psyco", enablePsyco)
 
+from cmetadata import *
+
 # vim:ts=4:sw=4:et
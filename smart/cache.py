@@ -20,17 +20,56 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 from smart.util.strtools import globdistance
-from smart.const import BLOCKSIZE
 from smart import *
+import cStringIO
+import cPickle
+import struct
+import mmap
 import os
 
 class StateVersionError(Error): pass
 
+def _intern(value):
+    # Names and versions repeat a lot, so keep a single copy of each.
+    if type(value) is str:
+        return intern(value)
+    return value
+
+def _removeObject(lst, obj):
+    # Remove the given object itself, rather than anything equal to it.
+    for i in range(len(lst)-1, -1, -1):
+        if lst[i] is obj:
+            del lst[i]
+            break
+
+def _indexRemove(index, name, obj):
+    lst = index.get(name)
+    if lst:
+        _removeObject(lst, obj)
+        if not lst:
+            del index[name]
+
+def _removeObjects(objs, index, removed):
+    objs[:] = [x for x in objs if x not in removed]
+    for obj in removed:
+        _indexRemove(index, obj.name, obj)
+
+def _linkRelations(dep, prv, attr):
+    if dep.providedby:
+        dep.providedby.append(prv)
+    else:
+        dep.providedby = [prv]
+    lst = getattr(prv, attr)
+    if lst:
+        lst.append(dep)
+    else:
+        setattr(prv, attr, [dep])
+
 class Package(object):
 
     def __init__(self, name, version):
-        self.name = name
-        self.version = version
+        self.name = _intern(name)
+        self.version = _intern(version)
         self.provides = ()
         self.requires = []
         self.recommends = []
@@ -199,7 +238,10 @@ class PackageInfo(object):
     def getSHA256(self, url):
         return None
 
-    def validate(self, url, localpath, withreason=False):
+    def validate(self, url, localpath, withreason=False, digestcache=None):
+        # Digests are computed in a single read of the file, and
+        # taken from digestcache when it was checked already.
+        from smart.fetcher import getCachedFileDigests
         try:
             if not os.path.isfile(localpath):
                 raise Error, _("File not found")
@@ -211,56 +253,33 @@ class PackageInfo(object):
                     raise Error, _("Unexpected size (expected %d, got %d)") % \
                                  (size, lsize)
 
-            filemd5 = self.getMD5(url)
-            if filemd5:
-                try:
-                    from hashlib import md5
-                except ImportError:
-                    from md5 import md5
-                digest = md5()
-                file = open(localpath)
-                data = file.read(BLOCKSIZE)
-                while data:
-                    digest.update(data)
-                    data = file.read(BLOCKSIZE)
-                lfilemd5 = digest.hexdigest()
-                if lfilemd5 != filemd5:
-                    raise Error, _("Invalid MD5 (expected %s, got %s)") % \
-                                 (filemd5, lfilemd5)
-
-            filesha256 = self.getSHA256(url)
-            if filesha256:
-                try:
-                    from hashlib import sha256
-                except ImportError:
-                    from smart.util.sha256 import sha256
-                digest = sha256()
-                file = open(localpath)
-                data = file.read(BLOCKSIZE)
-                while data:
-                    digest.update(data)
-                    data = file.read(BLOCKSIZE)
-                lfilesha256 = digest.hexdigest()
-                if lfilesha256 != filesha256:
-                   raise Error, _("Invalid SHA256 (expected %s, got %s)") % \
-                                 (filesha256, lfilesha256)
-            else:
+            expected = {}
+            for kind, value in (("md5", self.getMD5(url)),
+                                ("sha256", self.getSHA256(url))):
+                if value:
+                    expected[kind] = value
+            if "sha256" not in expected:
                 filesha = self.getSHA(url)
                 if filesha:
-                    try:
-                        from hashlib import sha1 as sha
-                    except ImportError:
-                        from sha import sha
-                    digest = sha()
-                    file = open(localpath)
-                    data = file.read(BLOCKSIZE)
-                    while data:
-                        digest.update(data)
-                        data = file.read(BLOCKSIZE)
-                    lfilesha = digest.hexdigest()
-                    if lfilesha != filesha:
-                        raise Error, _("Invalid SHA (expected %s, got %s)") % \
-                                     (filesha, lfilesha)
+                    expected["sha"] = filesha
+            if expected:
+                digests = getCachedFileDigests(localpath, expected.keys(),
+                                               digestcache)
+
+            filemd5 = expected.get("md5")
+            if filemd5 and digests["md5"] != filemd5:
+                raise Error, _("Invalid MD5 (expected %s, got %s)") % \
+                             (filemd5, digests["md5"])
+
+            filesha256 = expected.get("sha256")
+            if filesha256 and digests["sha256"] != filesha256:
+                raise Error, _("Invalid SHA256 (expected %s, got %s)") % \
+                             (filesha256, digests["sha256"])
+
+            filesha = expected.get("sha")
+            if filesha and digests["sha"] != filesha:
+                raise Error, _("Invalid SHA (expected %s, got %s)") % \
+                             (filesha, digests["sha"])
         except Error, reason:
             if withreason:
                 return False, reason
@@ -275,8 +294,8 @@ class PackageInfo(object):
 
 class Provides(object):
     def __init__(self, name, version):
-        self.name = name
-        self.version = version
+        self.name = _intern(name)
+        self.version = _intern(version)
         self.packages = []
         self.requiredby = ()
         self.recommendedby = ()
@@ -320,9 +339,9 @@ class Provides(object):
 
 class Depends(object):
     def __init__(self, name, relation, version):
-        self.name = name
-        self.relation = relation
-        self.version = version
+        self.name = _intern(name)
+        self.relation = _intern(relation)
+        self.version = _intern(version)
         self.packages = []
         self.providedby = ()
 
@@ -419,6 +438,7 @@ class Loader(object):
                     prv = args[0](*args[1:])
                     cache._objmap[args] = prv
                     cache._provides.append(prv)
+                    cache._prvnames.setdefault(prv.name, []).append(prv)
                 relpkgs.append(prv.packages)
                 pkg.provides.append(prv)
 
@@ -430,6 +450,7 @@ class Loader(object):
                     req = args[0](*args[1:])
                     cache._objmap[args] = req
                     cache._requires.append(req)
+                    cache._reqnames.setdefault(req.name, []).append(req)
                 relpkgs.append(req.packages)
                 pkg.requires.append(req)
 
@@ -441,6 +462,7 @@ class Loader(object):
                     rec = args[0](*args[1:])
                     cache._objmap[args] = rec
                     cache._recommends.append(rec)
+                    cache._recnames.setdefault(rec.name, []).append(rec)
                 relpkgs.append(rec.packages)
                 pkg.recommends.append(rec)
 
@@ -452,6 +474,7 @@ class Loader(object):
                     upg = args[0](*args[1:])
                     cache._objmap[args] = upg
                     cache._upgrades.append(upg)
+                    cache._upgnames.setdefault(upg.name, []).append(upg)
                 relpkgs.append(upg.packages)
                 pkg.upgrades.append(upg)
 
@@ -463,6 +486,7 @@ class Loader(object):
                     cnf = args[0](*args[1:])
                     cache._objmap[args] = cnf
                     cache._conflicts.append(cnf)
+                    cache._cnfnames.setdefault(cnf.name, []).append(cnf)
                 relpkgs.append(cnf.packages)
                 pkg.conflicts.append(cnf)
 
@@ -481,6 +505,7 @@ class Loader(object):
 
         if not found:
             cache._packages.append(pkg)
+            cache._pkgnames.setdefault(pkg.name, []).append(pkg)
             for pkgs in relpkgs:
                 pkgs.append(pkg)
 
@@ -496,11 +521,15 @@ class Loader(object):
             prv = prvargs[0](*prvargs[1:])
             cache._objmap[prvargs] = prv
             cache._provides.append(prv)
+            cache._prvnames.setdefault(prv.name, []).append(prv)
         elif prv in pkg.provides:
             return
 
         prv.packages.append(pkg)
         pkg.provides.append(prv)
+        # Remember it, so that it can be dropped once the file isn't
+        # required anymore.
+        cache._fileprvs.setdefault(prv.name, {})[pkg] = prv
 
         for req in pkg.requires[:]:
             if req.name == prv.name:
@@ -508,6 +537,18 @@ class Loader(object):
                 req.packages.remove(pkg)
                 if not req.packages:
                     cache._requires.remove(req)
+                    lst = cache._reqnames.get(req.name)
+                    if lst:
+                        lst.remove(req)
+                        if not lst:
+                            del cache._reqnames[req.name]
+                    # Might be linked already, if loaded incrementally.
+                    for name in req.getMatchNames():
+                        _indexRemove(cache._reqmatchnames, name, req)
+                    if req.providedby:
+                        for reqprv in req.providedby:
+                            _removeObject(reqprv.requiredby, req)
+                        del req.providedby[:]
 
     def search(self, searcher):
         # Loaders are responsible for searching on PackageInfo. They
@@ -582,6 +623,120 @@ class Loader(object):
         self.__dict__.update(state)
         del self.__stateversion__
 
+def loadLoaders(loaders):
+    # Parse the given loaders, in worker processes when the
+    # "load-workers" option asks for it. Packages are still built
+    # and linked here, in the order of the loaders, so the result
+    # is the same as loading them one after the other.
+    workers = sysconf.get("load-workers", 1)
+    if workers > 1 and len(loaders) > 1 and hasattr(os, "fork"):
+        _loadInWorkers(loaders, workers)
+    else:
+        for loader in loaders:
+            loader.load()
+
+class _PendingPackage(object):
+    # Stands for a package built inside a worker process, until
+    # the parent builds the real one.
+
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+        self.loaders = {}
+        self.installed = False
+
+def _loadInWorkers(loaders, workers):
+    running = []
+    try:
+        for loader in loaders:
+            if len(running) == workers:
+                _mergeWorker(*running.pop(0))
+            running.append((loader,)+_startWorker(loader))
+        while running:
+            _mergeWorker(*running.pop(0))
+    finally:
+        for loader, pid, fd in running:
+            os.close(fd)
+            try:
+                os.kill(pid, 9)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+def _startWorker(loader):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(wfd)
+        return pid, rfd
+    status = 1
+    try:
+        try:
+            os.close(rfd)
+            from smart.interface import Interface
+            iface.object = Interface(None)
+            calls = []
+            pending = []
+            def recordPackage(pkgargs, *args):
+                calls.append((pkgargs,)+args)
+                pkg = _PendingPackage(*pkgargs[1:3])
+                pending.append(pkg)
+                return pkg
+            loader.buildPackage = recordPackage
+            loader.load()
+            del loader.buildPackage
+            # Let the loader drop what can't go to another process,
+            # such as open databases.
+            state = loader.__getstate__()
+            state.pop("__stateversion__", None)
+            for attr in ("_packages", "_cache", "_channel", "_installed"):
+                state.pop(attr, None)
+            ids = {id(loader): "l", id(loader._cache): "c"}
+            for i, pkg in enumerate(pending):
+                ids[id(pkg)] = "p%d" % i
+            file = os.fdopen(wfd, "w")
+            pickler = cPickle.Pickler(file, 2)
+            pickler.persistent_id = lambda obj: ids.get(id(obj))
+            cPickle.dump(calls, file, 2)
+            pickler.dump(([pkg.loaders for pkg in pending], state))
+            file.close()
+            status = 0
+        except:
+            # The parent loads it again by itself, but say why.
+            import traceback
+            iface.debug(_("Loading %s in a worker failed:\n%s")
+                        % (loader, traceback.format_exc().rstrip()))
+    finally:
+        os._exit(status)
+
+def _mergeWorker(loader, pid, fd):
+    file = os.fdopen(fd)
+    try:
+        data = file.read()
+    finally:
+        file.close()
+    pid, status = os.waitpid(pid, 0)
+    if status != 0:
+        loader.load()
+        return
+    file = cStringIO.StringIO(data)
+    calls = cPickle.load(file)
+    pkgs = [loader.buildPackage(*args) for args in calls]
+    objs = {"l": loader, "c": loader._cache}
+    def persistentLoad(key):
+        if key[0] == "p":
+            return pkgs[int(key[1:])]
+        return objs[key]
+    unpickler = cPickle.Unpickler(file)
+    unpickler.persistent_load = persistentLoad
+    pkgloaders, state = unpickler.load()
+    for pkg, loaders in zip(pkgs, pkgloaders):
+        pkg.loaders.update(loaders)
+    loader.__dict__.update(state)
+    prog = iface.getProgress(loader._cache)
+    prog.add(loader.getLoadSteps())
+    prog.show()
+
 class Cache(object):
 
     def __init__(self):
@@ -593,6 +748,20 @@ class Cache(object):
         self._upgrades = []
         self._conflicts = []
         self._objmap = {}
+        self._pkgnames = {}
+        self._prvnames = {}
+        self._reqnames = {}
+        self._recnames = {}
+        self._upgnames = {}
+        self._cnfnames = {}
+        self._reqmatchnames = {}
+        self._recmatchnames = {}
+        self._upgmatchnames = {}
+        self._cnfmatchnames = {}
+        self._linked = {}
+        self._removed = {}
+        self._filereqs = {}
+        self._fileprvs = {}
 
     def reset(self):
         for prv in self._provides:
@@ -628,6 +797,20 @@ class Cache(object):
         del self._upgrades[:]
         del self._conflicts[:]
         self._objmap.clear()
+        self._pkgnames.clear()
+        self._prvnames.clear()
+        self._reqnames.clear()
+        self._recnames.clear()
+        self._upgnames.clear()
+        self._cnfnames.clear()
+        self._filereqs.clear()
+        self._fileprvs.clear()
+        self._reqmatchnames.clear()
+        self._recmatchnames.clear()
+        self._upgmatchnames.clear()
+        self._cnfmatchnames.clear()
+        self._linked.clear()
+        self._removed.clear()
 
     def addLoader(self, loader):
         if loader:
@@ -639,6 +822,11 @@ class Cache(object):
         if loader:
             if loader in self._loaders:
                 self._loaders.remove(loader)
+                if loader in self._linked:
+                    # Its packages are unlinked on the next load().
+                    del self._linked[loader]
+                    for pkg in loader._packages:
+                        self._removed[pkg] = True
                 loader.setCache(None)
                 loader.unload()
 
@@ -693,48 +881,295 @@ class Cache(object):
         self._recommends[:] = recommends.keys()
         self._upgrades[:] = upgrades.keys()
         self._conflicts[:] = conflicts.keys()
+        self._buildNameIndexes()
+
+    def _buildNameIndexes(self):
+        for objs, index in ((self._packages, self._pkgnames),
+                            (self._provides, self._prvnames),
+                            (self._requires, self._reqnames),
+                            (self._recommends, self._recnames),
+                            (self._upgrades, self._upgnames),
+                            (self._conflicts, self._cnfnames)):
+            index.clear()
+            for obj in objs:
+                index.setdefault(obj.name, []).append(obj)
+
+    def _buildObjMap(self):
+        objmap = self._objmap
+        for pkg in self._packages:
+            objmap.setdefault(pkg.getInitArgs(), []).append(pkg)
+        for objs in (self._provides, self._requires, self._recommends,
+                     self._upgrades, self._conflicts):
+            for obj in objs:
+                objmap[obj.getInitArgs()] = obj
 
     def load(self):
-        self._reload()
+        linked = self._linked
+        for loader in self._loaders:
+            if loader._packages and loader not in linked:
+                # Packages we know nothing about. Start over.
+                linked = None
+                break
+        if linked:
+            self._unlinkRemoved()
+        else:
+            self.reset()
+            self._reload()
         prog = iface.getProgress(self)
         prog.start()
         prog.setTopic(_("Updating cache..."))
         prog.set(0, 1)
         prog.show()
+        loaders = [x for x in self._loaders if not x._packages]
         total = 1
-        for loader in self._loaders:
-            if not loader._packages:
-                total += loader.getLoadSteps()
+        for loader in loaders:
+            total += loader.getLoadSteps()
         prog.set(0, total)
         prog.show()
+        if linked:
+            self._loadLinked(loaders)
+        else:
+            loadLoaders(loaders)
+            self._addFileRequires(self._packages)
+            self.loadFileProvides()
+            hooks.call("cache-loaded-pre-link", self)
+            self._objmap.clear()
+            self.linkDeps()
         for loader in self._loaders:
-            if not loader._packages:
-                loader.load()
-        self.loadFileProvides()
-        hooks.call("cache-loaded-pre-link", self)
-        self._objmap.clear()
-        self.linkDeps()
+            self._linked[loader] = True
         prog.setDone()
         prog.show()
         prog.stop()
         hooks.call("cache-loaded", self)
 
+    def _loadLinked(self, loaders):
+        # Load the given loaders into a cache which is already linked,
+        # touching only what they bring in.
+        if not loaders:
+            hooks.call("cache-loaded-pre-link", self)
+            return
+        self._buildObjMap()
+        lists = (self._packages, self._provides, self._requires,
+                 self._recommends, self._upgrades, self._conflicts)
+        (self._packages, self._provides, self._requires,
+         self._recommends, self._upgrades, self._conflicts) = \
+            newlists = ([], [], [], [], [], [])
+        try:
+            loadLoaders(loaders)
+        finally:
+            (self._packages, self._provides, self._requires,
+             self._recommends, self._upgrades, self._conflicts) = lists
+            for lst, newlst in zip(lists, newlists):
+                lst.extend(newlst)
+        packages, provides, requires, recommends, upgrades, conflicts = \
+            newlists
+
+        # Loaders which were linked before only have to look for
+        # files nothing required before.
+        fndict = self._addFileRequires(packages)
+        allfndict = {}
+        for name in self._filereqs:
+            allfndict[name] = name
+        oldprovides = self._provides
+        self._provides = []
+        try:
+            for loader in self._loaders:
+                if loader not in self._linked:
+                    loader.loadFileProvides(allfndict)
+                elif fndict:
+                    loader.loadFileProvides(fndict)
+        finally:
+            provides.extend(self._provides)
+            oldprovides.extend(self._provides)
+            self._provides = oldprovides
+
+        # Drop new relations no package ended up with, as _reload()
+        # would do. File provides may also have taken some requires.
+        for objs, index, newobjs in \
+                ((self._provides, self._prvnames, provides),
+                 (self._requires, self._reqnames, requires),
+                 (self._recommends, self._recnames, recommends),
+                 (self._upgrades, self._upgnames, upgrades),
+                 (self._conflicts, self._cnfnames, conflicts)):
+            orphans = {}
+            for obj in newobjs:
+                if not obj.packages:
+                    orphans[obj] = True
+            if orphans:
+                newobjs[:] = [x for x in newobjs if x not in orphans]
+                _removeObjects(objs, index, orphans)
+
+        hooks.call("cache-loaded-pre-link", self)
+        self._objmap.clear()
+        self._linkNew(provides, requires, recommends, upgrades, conflicts)
+
+    def _unlinkRemoved(self):
+        if not self._removed:
+            return
+        loaders = dict.fromkeys(self._loaders, True)
+        packages = {}
+        provides = {}
+        requires = {}
+        recommends = {}
+        upgrades = {}
+        conflicts = {}
+        filereqs = self._filereqs
+        fileprvs = self._fileprvs
+        unrequired = {}
+        for pkg in self._removed:
+            for pkgloader in pkg.loaders.keys():
+                if pkgloader not in loaders:
+                    del pkg.loaders[pkgloader]
+            if pkg.loaders:
+                # Still available from some other loader.
+                pkg.installed = False
+                for pkgloader in pkg.loaders:
+                    pkg.installed |= pkgloader._installed
+                continue
+            packages[pkg] = True
+            for lst in (pkg.requires, pkg.provides):
+                for rel in lst:
+                    name = rel.name
+                    if name[0] != "/":
+                        continue
+                    pkgs = filereqs.get(name)
+                    if pkgs and pkg in pkgs:
+                        del pkgs[pkg]
+                        if not pkgs:
+                            del filereqs[name]
+                            unrequired[name] = True
+                    pkgs = fileprvs.get(name)
+                    if pkgs and pkg in pkgs:
+                        del pkgs[pkg]
+                        if not pkgs:
+                            del fileprvs[name]
+            for prv in pkg.provides:
+                _removeObject(prv.packages, pkg)
+                if not prv.packages:
+                    provides[prv] = True
+            for req in pkg.requires:
+                _removeObject(req.packages, pkg)
+                if not req.packages:
+                    requires[req] = True
+            for rec in pkg.recommends:
+                _removeObject(rec.packages, pkg)
+                if not rec.packages:
+                    recommends[rec] = True
+            for upg in pkg.upgrades:
+                _removeObject(upg.packages, pkg)
+                if not upg.packages:
+                    upgrades[upg] = True
+            for cnf in pkg.conflicts:
+                _removeObject(cnf.packages, pkg)
+                if not cnf.packages:
+                    conflicts[cnf] = True
+        self._removed.clear()
+        # Files nothing requires anymore wouldn't be looked for by a
+        # full load, so packages shouldn't keep providing them.
+        for name in unrequired:
+            for pkg, prv in fileprvs.pop(name, {}).items():
+                _removeObject(pkg.provides, prv)
+                _removeObject(prv.packages, pkg)
+                if not prv.packages:
+                    provides[prv] = True
+        for prv in provides:
+            if prv.requiredby:
+                for req in prv.requiredby:
+                    _removeObject(req.providedby, prv)
+                del prv.requiredby[:]
+            if prv.recommendedby:
+                for rec in prv.recommendedby:
+                    _removeObject(rec.providedby, prv)
+                del prv.recommendedby[:]
+            if prv.upgradedby:
+                for upg in prv.upgradedby:
+                    _removeObject(upg.providedby, prv)
+                del prv.upgradedby[:]
+            if prv.conflictedby:
+                for cnf in prv.conflictedby:
+                    _removeObject(cnf.providedby, prv)
+                del prv.conflictedby[:]
+        for deps, depnames, attr in \
+                ((requires, self._reqmatchnames, "requiredby"),
+                 (recommends, self._recmatchnames, "recommendedby"),
+                 (upgrades, self._upgmatchnames, "upgradedby"),
+                 (conflicts, self._cnfmatchnames, "conflictedby")):
+            for dep in deps:
+                for name in dep.getMatchNames():
+                    _indexRemove(depnames, name, dep)
+                if dep.providedby:
+                    for prv in dep.providedby:
+                        _removeObject(getattr(prv, attr), dep)
+                    del dep.providedby[:]
+        for objs, index, removed in \
+                ((self._packages, self._pkgnames, packages),
+                 (self._provides, self._prvnames, provides),
+                 (self._requires, self._reqnames, requires),
+                 (self._recommends, self._recnames, recommends),
+                 (self._upgrades, self._upgnames, upgrades),
+                 (self._conflicts, self._cnfnames, conflicts)):
+            if removed:
+                _removeObjects(objs, index, removed)
+
+    def _linkNew(self, provides, requires, recommends, upgrades, conflicts):
+        # Link the new provides with the relations which were linked
+        # before, and the new relations with everything in the cache,
+        # using the indexes kept by linkDeps().
+        prvnames = self._prvnames
+        for newdeps, depnames, attr in \
+                ((requires, self._reqmatchnames, "requiredby"),
+                 (recommends, self._recmatchnames, "recommendedby"),
+                 (upgrades, self._upgmatchnames, "upgradedby"),
+                 (conflicts, self._cnfmatchnames, "conflictedby")):
+            for prv in provides:
+                lst = depnames.get(prv.name)
+                if lst:
+                    for dep in lst:
+                        if dep.matches(prv):
+                            _linkRelations(dep, prv, attr)
+            for dep in newdeps:
+                for name in dep.getMatchNames():
+                    lst = depnames.get(name)
+                    if lst:
+                        lst.append(dep)
+                    else:
+                        depnames[name] = [dep]
+                    for prv in prvnames.get(name, ()):
+                        if dep.matches(prv):
+                            _linkRelations(dep, prv, attr)
+
     def unload(self):
         self.reset()
         for loader in self._loaders:
             loader.unload()
 
+    def _addFileRequires(self, packages):
+        # Track the packages requiring each file, as loaded, since
+        # requires satisfied by the package itself are dropped by
+        # buildFileProvides(). Return the files nothing required before.
+        filereqs = self._filereqs
+        fndict = {}
+        for pkg in packages:
+            for req in pkg.requires:
+                name = req.name
+                if name[0] == "/":
+                    pkgs = filereqs.get(name)
+                    if pkgs is None:
+                        pkgs = filereqs[name] = {}
+                        fndict[name] = name
+                    pkgs[pkg] = True
+        return fndict
+
     def loadFileProvides(self):
         fndict = {}
-        for req in self._requires:
-            name = req.name
-            if name[0] == "/":
-                fndict[name] = name
+        for name in self._filereqs:
+            fndict[name] = name
         for loader in self._loaders:
             loader.loadFileProvides(fndict)
 
     def linkDeps(self):
-        reqnames = {}
+        reqnames = self._reqmatchnames
+        reqnames.clear()
         for req in self._requires:
             for name in req.getMatchNames():
                 lst = reqnames.get(name)
@@ -742,7 +1177,8 @@ class Cache(object):
                     lst.append(req)
                 else:
                     reqnames[name] = [req]
-        recnames = {}
+        recnames = self._recmatchnames
+        recnames.clear()
         for rec in self._recommends:
             for name in rec.getMatchNames():
                 lst = recnames.get(name)
@@ -750,7 +1186,8 @@ class Cache(object):
                     lst.append(rec)
                 else:
                     recnames[name] = [rec]
-        upgnames = {}
+        upgnames = self._upgmatchnames
+        upgnames.clear()
         for upg in self._upgrades:
             for name in upg.getMatchNames():
                 lst = upgnames.get(name)
@@ -758,7 +1195,8 @@ class Cache(object):
                     lst.append(upg)
                 else:
                     upgnames[name] = [upg]
-        cnfnames = {}
+        cnfnames = self._cnfmatchnames
+        cnfnames.clear()
         for cnf in self._conflicts:
             for name in cnf.getMatchNames():
                 lst = cnfnames.get(name)
@@ -820,37 +1258,37 @@ class Cache(object):
         if not name:
             return self._packages
         else:
-            return [x for x in self._packages if x.name == name]
+            return self._pkgnames.get(name, [])[:]
 
     def getProvides(self, name=None):
         if not name:
             return self._provides
         else:
-            return [x for x in self._provides if x.name == name]
+            return self._prvnames.get(name, [])[:]
 
     def getRequires(self, name=None):
         if not name:
             return self._requires
         else:
-            return [x for x in self._requires if x.name == name]
+            return self._reqnames.get(name, [])[:]
 
     def getRecommends(self, name=None):
         if not name:
             return self._recommends
         else:
-            return [x for x in self._recommends if x.name == name]
+            return self._recnames.get(name, [])[:]
 
     def getUpgrades(self, name=None):
         if not name:
             return self._upgrades
         else:
-            return [x for x in self._upgrades if x.name == name]
+            return self._upgnames.get(name, [])[:]
 
     def getConflicts(self, name=None):
         if not name:
             return self._conflicts
         else:
-            return [x for x in self._conflicts if x.name == name]
+            return self._cnfnames.get(name, [])[:]
 
     def search(self, searcher):
         if searcher.nameversion:
@@ -894,6 +1332,18 @@ class Cache(object):
         state["__stateversion__"] = self.__stateversion__
         state["_loaders"] = self._loaders
         state["_packages"] = self._packages
+        if self._linked and not self._removed:
+            # Keep the links, so that the restored cache may still be
+            # loaded incrementally.
+            state["_linked"] = self._linked.keys()
+            state["_links"] = [[(dep, dep.providedby) for dep in deps
+                                if dep.providedby]
+                               for deps in (self._requires,
+                                            self._recommends,
+                                            self._upgrades,
+                                            self._conflicts)]
+            state["_filereqs"] = self._filereqs
+            state["_fileprvs"] = self._fileprvs
         return state
 
     def __setstate__(self, state):
@@ -928,6 +1378,312 @@ class Cache(object):
         self._upgrades = upgrades.keys()
         self._conflicts = conflicts.keys()
         self._objmap = {}
+        self._pkgnames = {}
+        self._prvnames = {}
+        self._reqnames = {}
+        self._recnames = {}
+        self._upgnames = {}
+        self._cnfnames = {}
+        self._reqmatchnames = {}
+        self._recmatchnames = {}
+        self._upgmatchnames = {}
+        self._cnfmatchnames = {}
+        self._linked = {}
+        self._removed = {}
+        self._filereqs = {}
+        self._fileprvs = {}
+        self._buildNameIndexes()
+        if "_links" in state:
+            self._restoreLinks(state)
+
+    def _restoreLinks(self, state):
+        for deps, depnames, links, attr in \
+                ((self._requires, self._reqmatchnames,
+                  state["_links"][0], "requiredby"),
+                 (self._recommends, self._recmatchnames,
+                  state["_links"][1], "recommendedby"),
+                 (self._upgrades, self._upgmatchnames,
+                  state["_links"][2], "upgradedby"),
+                 (self._conflicts, self._cnfmatchnames,
+                  state["_links"][3], "conflictedby")):
+            for dep in deps:
+                for name in dep.getMatchNames():
+                    lst = depnames.get(name)
+                    if lst:
+                        lst.append(dep)
+                    else:
+                        depnames[name] = [dep]
+            for dep, providedby in links:
+                for prv in providedby:
+                    _linkRelations(dep, prv, attr)
+        for loader in state["_linked"]:
+            self._linked[loader] = True
+        self._filereqs = state["_filereqs"]
+        self._fileprvs = state["_fileprvs"]
+
+# Binary on-disk cache format. Strings are kept in a single table, and
+# packages and their relations are stored as arrays of little-endian
+# 32-bit integers indexing that table, so that loading doesn't have to
+# go through the pickle machinery for every object. Anything else
+# (loaders, channels, package loader information, and objects which
+# can't be represented in the arrays) is pickled, referencing packages
+# and relations in the arrays by their index.
+#
+# Layout:
+#
+#   header      CACHEHEADER (magic, version, nstrings, strsize,
+#               nrelations, npackages, nrefs, preludesize, statesize)
+#   stroffsets  (nstrings+1) offsets into strdata (string 0 is None)
+#   strdata     strsize bytes, padded to a multiple of 4
+#   relations   nrelations * (kind, class, arg1, arg2, arg3)
+#   packages    npackages * (class, name, version, flags, priority,
+#                            refstart, nprv, nreq, nrec, nupg, ncnf)
+#   refs        nrefs relation indexes, used by packages
+#   prelude     pickled (classes, extras)
+#   state       pickled (pkgloaders, state)
+#
+# Relations of kind REL_PROVIDES are built with class(name, version),
+# REL_DEPENDS with class(name, relation, version), and REL_EXTRA are
+# taken from the pickled extras list, indexed by arg1.
+
+CACHEMAGIC = "SMARTBC\0"
+CACHEVERSION = 1
+CACHEHEADER = "<8s8I"
+CACHEHEADERSIZE = struct.calcsize(CACHEHEADER)
+
+REL_PROVIDES = 0
+REL_DEPENDS = 1
+REL_EXTRA = 2
+
+PKG_INSTALLED = 1
+PKG_ESSENTIAL = 2
+PKG_LISTPROVIDES = 4
+PKG_LISTREQUIRES = 8
+PKG_LISTRECOMMENDS = 16
+PKG_LISTUPGRADES = 32
+PKG_LISTCONFLICTS = 64
+
+def _align(size):
+    return (size+3)&~3
+
+def dumpCache(file, packages, state):
+    strings = {}
+    strdata = []
+    stroffsets = [0, 0]
+    classes = {}
+    classlist = []
+    extras = []
+    relations = []
+    relrecords = []
+    relindex = {}
+    pkglist = []
+    pkgrecords = []
+    pkgloaders = []
+    refs = []
+
+    def strid(s):
+        if s is None:
+            return 0
+        idx = strings.get(s)
+        if idx is None:
+            idx = strings[s] = len(stroffsets)-1
+            strdata.append(s)
+            stroffsets.append(stroffsets[-1]+len(s))
+        return idx
+
+    def classid(cls):
+        idx = classes.get(cls)
+        if idx is None:
+            idx = classes[cls] = len(classlist)
+            classlist.append(cls)
+        return idx
+
+    def relid(rel):
+        idx = relindex.get(id(rel))
+        if idx is not None:
+            return idx
+        idx = relindex[id(rel)] = len(relations)
+        relations.append(rel)
+        reduce = rel.__reduce__()
+        cls, args = reduce[:2]
+        if len(reduce) == 2 and len(args) in (2, 3):
+            for arg in args:
+                if arg is not None and type(arg) is not str:
+                    break
+            else:
+                if len(args) == 2:
+                    relrecords.append((REL_PROVIDES, classid(cls),
+                                       strid(args[0]), 0, strid(args[1])))
+                else:
+                    relrecords.append((REL_DEPENDS, classid(cls),
+                                       strid(args[0]), strid(args[1]),
+                                       strid(args[2])))
+                return idx
+        relrecords.append((REL_EXTRA, 0, len(extras), 0, 0))
+        extras.append(rel)
+        return idx
+
+    for pkg in packages:
+        initargs = pkg.getInitArgs()
+        if (len(initargs) != 3 or
+            type(initargs[1]) is not str or type(initargs[2]) is not str or
+            type(pkg.installed) is not bool or
+            type(pkg.essential) is not bool or
+            type(pkg.priority) is not int or
+            getattr(pkg, "__dict__", None)):
+            # Will be pickled as usual.
+            continue
+        flags = 0
+        if pkg.installed:
+            flags |= PKG_INSTALLED
+        if pkg.essential:
+            flags |= PKG_ESSENTIAL
+        refstart = len(refs)
+        counts = []
+        for lst, flag in ((pkg.provides, PKG_LISTPROVIDES),
+                          (pkg.requires, PKG_LISTREQUIRES),
+                          (pkg.recommends, PKG_LISTRECOMMENDS),
+                          (pkg.upgrades, PKG_LISTUPGRADES),
+                          (pkg.conflicts, PKG_LISTCONFLICTS)):
+            if type(lst) is list:
+                flags |= flag
+            for rel in lst:
+                refs.append(relid(rel))
+            counts.append(len(lst))
+        pkglist.append(pkg)
+        pkgloaders.append(pkg.loaders)
+        pkgrecords.append((classid(initargs[0]), strid(initargs[1]),
+                           strid(initargs[2]), flags,
+                           pkg.priority&0xffffffff, refstart)+tuple(counts))
+
+    pids = {}
+    for i, obj in enumerate(pkglist+relations):
+        pids[id(obj)] = i
+
+    prelude = cPickle.dumps((classlist, extras), 2)
+    statefile = cStringIO.StringIO()
+    pickler = cPickle.Pickler(statefile, 2)
+    pickler.inst_persistent_id = lambda obj: pids.get(id(obj))
+    pickler.dump((pkgloaders, state))
+    state = statefile.getvalue()
+
+    strsize = stroffsets[-1]
+    file.write(struct.pack(CACHEHEADER, CACHEMAGIC, CACHEVERSION,
+                           len(stroffsets)-1, strsize, len(relrecords),
+                           len(pkgrecords), len(refs), len(prelude),
+                           len(state)))
+    file.write(struct.pack("<%dI" % len(stroffsets), *stroffsets))
+    file.write("".join(strdata))
+    file.write("\0"*(_align(strsize)-strsize))
+    for record in relrecords:
+        file.write(struct.pack("<5I", *record))
+    for record in pkgrecords:
+        file.write(struct.pack("<11I", *record))
+    file.write(struct.pack("<%dI" % len(refs), *refs))
+    file.write(prelude)
+    file.write(state)
+
+def _getCacheHeader(buffer):
+    if len(buffer) < CACHEHEADERSIZE:
+        raise ValueError, "Truncated cache file"
+    header = struct.unpack(CACHEHEADER, buffer[:CACHEHEADERSIZE])
+    if header[0] != CACHEMAGIC:
+        raise ValueError, "Invalid cache file"
+    if header[1] != CACHEVERSION:
+        raise StateVersionError
+    (magic, version, nstrings, strsize, nrelations,
+     npackages, nrefs, preludesize, statesize) = header
+    offset = (CACHEHEADERSIZE+(nstrings+1)*4+_align(strsize)+
+              (nrelations*5+npackages*11+nrefs)*4)
+    if offset+preludesize+statesize > len(buffer):
+        raise ValueError, "Truncated cache file"
+    return header, offset
+
+def unpackObjects(buffer, classes, extras):
+    header, _ = _getCacheHeader(buffer)
+    (magic, version, nstrings, strsize, nrelations,
+     npackages, nrefs, preludesize, statesize) = header
+
+    offset = CACHEHEADERSIZE
+    size = (nstrings+1)*4
+    stroffsets = struct.unpack("<%dI" % (nstrings+1),
+                               buffer[offset:offset+size])
+    offset += size
+    strdata = buffer[offset:offset+strsize]
+    offset += _align(strsize)
+    strings = [None]
+    for i in range(1, nstrings):
+        strings.append(strdata[stroffsets[i]:stroffsets[i+1]])
+
+    size = nrelations*5*4
+    relrecords = struct.unpack("<%dI" % (nrelations*5),
+                               buffer[offset:offset+size])
+    offset += size
+    relations = []
+    for i in range(0, nrelations*5, 5):
+        kind, cls, arg1, arg2, arg3 = relrecords[i:i+5]
+        if kind == REL_PROVIDES:
+            rel = classes[cls](strings[arg1], strings[arg3])
+        elif kind == REL_DEPENDS:
+            rel = classes[cls](strings[arg1], strings[arg2], strings[arg3])
+        elif kind == REL_EXTRA:
+            rel = extras[arg1]
+        else:
+            raise ValueError, "Invalid relation kind"
+        relations.append(rel)
+
+    size = npackages*11*4
+    pkgrecords = struct.unpack("<%dI" % (npackages*11),
+                               buffer[offset:offset+size])
+    offset += size
+    refs = struct.unpack("<%dI" % nrefs, buffer[offset:offset+nrefs*4])
+    packages = []
+    for i in range(0, npackages*11, 11):
+        (cls, name, version, flags, priority, refstart,
+         nprv, nreq, nrec, nupg, ncnf) = pkgrecords[i:i+11]
+        pkg = classes[cls](strings[name], strings[version])
+        pkg.installed = bool(flags&PKG_INSTALLED)
+        pkg.essential = bool(flags&PKG_ESSENTIAL)
+        if priority&0x80000000:
+            priority -= 0x100000000
+        pkg.priority = int(priority)
+        for attr, count, flag in (("provides", nprv, PKG_LISTPROVIDES),
+                                  ("requires", nreq, PKG_LISTREQUIRES),
+                                  ("recommends", nrec, PKG_LISTRECOMMENDS),
+                                  ("upgrades", nupg, PKG_LISTUPGRADES),
+                                  ("conflicts", ncnf, PKG_LISTCONFLICTS)):
+            lst = [relations[x] for x in refs[refstart:refstart+count]]
+            if not flags&flag:
+                lst = tuple(lst)
+            setattr(pkg, attr, lst)
+            refstart += count
+        packages.append(pkg)
+
+    return packages, relations
+
+def loadCache(file):
+    buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        header, offset = _getCacheHeader(buffer)
+        preludesize, statesize = header[-2:]
+        classes, extras = cPickle.loads(buffer[offset:offset+preludesize])
+        packages, relations = unpackObjects(buffer, classes, extras)
+        offset += preludesize
+        statefile = cStringIO.StringIO(buffer[offset:offset+statesize])
+    finally:
+        buffer.close()
+    objects = packages+relations
+    unpickler = cPickle.Unpickler(statefile)
+    unpickler.persistent_load = objects.__getitem__
+    pkgloaders, state = unpickler.load()
+    for pkg, loaders in zip(packages, pkgloaders):
+        pkg.loaders = loaders
+    return state
+
+def registerMatcher(depclass, prvclasses, matcher):
+    # Native matchers registered by the backends are only used by
+    # the C implementation of the cache, which replaces this one.
+    pass
 
 from ccache import *
 
@@ -44,6 +44,13 @@
 
 #define STR(obj) PyString_AS_STRING(obj)
 
+/* Names and versions repeat a lot, so keep a single copy of each. */
+#define INTERN(obj) \
+    do { \
+        if (PyString_CheckExact(obj)) \
+            PyString_InternInPlace(&(obj)); \
+    } while (0)
+
 
 #ifndef Py_VISIT
 #define Py_VISIT(op)					\
@@ -129,6 +136,20 @@ typedef struct {
     PyObject *_upgrades;
     PyObject *_conflicts;
     PyObject *_objmap;
+    PyObject *_pkgnames;
+    PyObject *_prvnames;
+    PyObject *_reqnames;
+    PyObject *_recnames;
+    PyObject *_upgnames;
+    PyObject *_cnfnames;
+    PyObject *_reqmatchnames;
+    PyObject *_recmatchnames;
+    PyObject *_upgmatchnames;
+    PyObject *_cnfmatchnames;
+    PyObject *_linked;
+    PyObject *_removed;
+    PyObject *_filereqs;
+    PyObject *_fileprvs;
 } CacheObject;
 
 static PyObject *
@@ -173,6 +194,20 @@ getIface(void)
     return iface;
 }
 
+static PyObject *
+getLoadLoaders(void)
+{
+    static PyObject *loadloaders = NULL;
+    if (loadloaders == NULL) {
+        PyObject *module = PyImport_ImportModule("smart.cache");
+        if (module) {
+            loadloaders = PyObject_GetAttrString(module, "loadLoaders");
+            Py_DECREF(module);
+        }
+    }
+    return loadloaders;
+}
+
 static PyObject *
 getGlobDistance(void)
 {
@@ -213,6 +248,8 @@ Package_init(PackageObject *self, PyObject *args)
         return -1;
     Py_INCREF(self->name);
     Py_INCREF(self->version);
+    INTERN(self->name);
+    INTERN(self->version);
     self->provides = PyTuple_New(0);
     self->requires = PyList_New(0);
     self->recommends = PyList_New(0);
@@ -840,6 +877,8 @@ Provides_init(ProvidesObject *self, PyObject *args)
         return -1;
     Py_INCREF(self->name);
     Py_INCREF(self->version);
+    INTERN(self->name);
+    INTERN(self->version);
     self->packages = PyList_New(0);
     self->requiredby = PyTuple_New(0);
     self->recommendedby = PyTuple_New(0);
@@ -1116,6 +1155,9 @@ Depends_init(DependsObject *self, PyObject *args)
     Py_INCREF(self->name);
     Py_INCREF(self->relation);
     Py_INCREF(self->version);
+    INTERN(self->name);
+    INTERN(self->relation);
+    INTERN(self->version);
     self->packages = PyList_New(0);
     self->providedby = PyTuple_New(0);
     return 0;
@@ -1486,6 +1528,168 @@ statichere PyTypeObject Conflicts_Type = {
     0,                      /*tp_is_gc*/
 };
 
+/*
+   Backends may register native functions matching their relations
+   with registerMatcher(), so that linking doesn't have to go through
+   the matches() method of each relation.  The function is passed the
+   relation and version of the dependency and the version of the
+   provide, as NULL when not set, and returns non-zero if they match.
+   Before calling it, the provide is checked to be an instance of one
+   of the classes given at registration time, or a plain Provides.
+*/
+typedef int (*MatcherFunc)(const char *relation, const char *depversion,
+                           const char *prvversion);
+
+typedef struct {
+    MatcherFunc matcher;
+    PyObject *prvclasses;
+    int plainnames;
+    PyCFunction getinitargs;
+} TypeInfo;
+
+/* Class defining matches() => (prvclasses, matcher) */
+static PyObject *matchers = NULL;
+
+/* Type => TypeInfo, as a CObject */
+static PyObject *typeinfos = NULL;
+
+static void
+TypeInfo_free(void *ptr)
+{
+    TypeInfo *info = (TypeInfo *)ptr;
+    Py_XDECREF(info->prvclasses);
+    free(info);
+}
+
+static PyObject *
+definingClass(PyTypeObject *type, const char *attr)
+{
+    PyObject *mro = type->tp_mro;
+    int i, len;
+    if (!mro || !PyTuple_Check(mro))
+        return NULL;
+    len = PyTuple_GET_SIZE(mro);
+    for (i = 0; i != len; i++) {
+        PyObject *base = PyTuple_GET_ITEM(mro, i);
+        if (PyType_Check(base) &&
+            PyDict_GetItemString(((PyTypeObject *)base)->tp_dict, attr))
+            return base;
+    }
+    return NULL;
+}
+
+static TypeInfo *
+getTypeInfo(PyTypeObject *type)
+{
+    /*
+       Find out which of the methods used while loading and linking
+       weren't overloaded by the type, so that the cache may handle
+       them natively.
+    */
+    PyObject *obj;
+    TypeInfo *info;
+    if (!typeinfos) {
+        typeinfos = PyDict_New();
+        if (!typeinfos) return NULL;
+    }
+    obj = PyDict_GetItem(typeinfos, (PyObject *)type);
+    if (obj)
+        return (TypeInfo *)PyCObject_AsVoidPtr(obj);
+    info = (TypeInfo *)calloc(1, sizeof(TypeInfo));
+    if (!info) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    obj = definingClass(type, "matches");
+    if (obj && matchers) {
+        PyObject *entry = PyDict_GetItem(matchers, obj);
+        if (entry) {
+            info->prvclasses = PyTuple_GET_ITEM(entry, 0);
+            Py_INCREF(info->prvclasses);
+            info->matcher = (MatcherFunc)
+                PyCObject_AsVoidPtr(PyTuple_GET_ITEM(entry, 1));
+        }
+    }
+    info->plainnames = (definingClass(type, "getMatchNames") ==
+                        (PyObject *)&Depends_Type);
+    obj = definingClass(type, "getInitArgs");
+    if (obj == (PyObject *)&Package_Type)
+        info->getinitargs = (PyCFunction)Package_getInitArgs;
+    else if (obj == (PyObject *)&Provides_Type)
+        info->getinitargs = (PyCFunction)Provides_getInitArgs;
+    else if (obj == (PyObject *)&Depends_Type)
+        info->getinitargs = (PyCFunction)Depends_getInitArgs;
+    obj = PyCObject_FromVoidPtr(info, TypeInfo_free);
+    if (!obj) {
+        TypeInfo_free(info);
+        return NULL;
+    }
+    if (PyDict_SetItem(typeinfos, (PyObject *)type, obj) == -1) {
+        Py_DECREF(obj);
+        return NULL;
+    }
+    Py_DECREF(obj);
+    return info;
+}
+
+static PyObject *
+getInitArgs(PyObject *obj)
+{
+    /* return obj.getInitArgs() */
+    TypeInfo *info = getTypeInfo(obj->ob_type);
+    if (!info) return NULL;
+    if (info->getinitargs)
+        return info->getinitargs(obj, NULL);
+    return PyObject_CallMethod(obj, "getInitArgs", NULL);
+}
+
+static PyObject *
+getMatchNames(PyObject *dep)
+{
+    /* return dep.getMatchNames() */
+    TypeInfo *info = getTypeInfo(dep->ob_type);
+    if (!info) return NULL;
+    if (info->plainnames)
+        return Depends_getMatchNames((DependsObject *)dep);
+    return PyObject_CallMethod(dep, "getMatchNames", NULL);
+}
+
+static const char *
+optionalString(PyObject *obj)
+{
+    if (PyString_Check(obj) && PyString_GET_SIZE(obj) != 0)
+        return PyString_AS_STRING(obj);
+    return NULL;
+}
+
+static PyObject *
+dependsMatches(PyObject *dep, PyObject *prv)
+{
+    /* return dep.matches(prv) */
+    TypeInfo *info = getTypeInfo(dep->ob_type);
+    if (!info) return NULL;
+    if (info->matcher && PyObject_TypeCheck(prv, &Provides_Type)) {
+        DependsObject *depobj = (DependsObject *)dep;
+        ProvidesObject *prvobj = (ProvidesObject *)prv;
+        PyObject *ret = Py_False;
+        if (prv->ob_type != &Provides_Type) {
+            int rc = PyObject_IsInstance(prv, info->prvclasses);
+            if (rc == -1) return NULL;
+            if (!rc) {
+                Py_INCREF(ret);
+                return ret;
+            }
+        }
+        if (info->matcher(optionalString(depobj->relation),
+                          optionalString(depobj->version),
+                          optionalString(prvobj->version)))
+            ret = Py_True;
+        Py_INCREF(ret);
+        return ret;
+    }
+    return PyObject_CallMethod(dep, "matches", "O", prv);
+}
+
 static int
 Loader_init(LoaderObject *self, PyObject *args)
 {
@@ -1555,6 +1759,8 @@ Loader_setChannel(LoaderObject *self, PyObject *channel)
 PyObject *
 Loader_getCache(LoaderObject *self, PyObject *args)
 {
+    if (!self->_cache)
+        Py_RETURN_NONE;
     Py_INCREF(self->_cache);
     return self->_cache;
 }
@@ -1644,6 +1850,149 @@ mylist(PyObject *obj, PyObject **ret)
     return 1;
 }
 
+static int
+nameIndexAdd(PyObject *index, PyObject *name, PyObject *obj)
+{
+    /*
+       lst = index.get(name)
+       if lst:
+           lst.append(obj)
+       else:
+           index[name] = [obj]
+    */
+    PyObject *lst = PyDict_GetItem(index, name);
+    if (lst)
+        return PyList_Append(lst, obj);
+    lst = PyList_New(1);
+    if (!lst) return -1;
+    Py_INCREF(obj);
+    PyList_SET_ITEM(lst, 0, obj);
+    if (PyDict_SetItem(index, name, lst) == -1) {
+        Py_DECREF(lst);
+        return -1;
+    }
+    Py_DECREF(lst);
+    return 0;
+}
+
+static void
+nameIndexRemove(PyObject *index, PyObject *name, PyObject *obj)
+{
+    /*
+       lst = index.get(name)
+       if lst:
+           lst.remove(obj)
+           if not lst:
+               del index[name]
+    */
+    PyObject *lst = PyDict_GetItem(index, name);
+    if (lst) {
+        int i;
+        for (i = PyList_GET_SIZE(lst)-1; i != -1; i--) {
+            if (PyList_GET_ITEM(lst, i) == obj) {
+                PyList_SetSlice(lst, i, i+1, NULL);
+                break;
+            }
+        }
+        if (PyList_GET_SIZE(lst) == 0)
+            PyDict_DelItem(index, name);
+    }
+}
+
+static void
+listRemoveObject(PyObject *lst, PyObject *obj)
+{
+    /* Remove obj itself, rather than anything equal to it. */
+    int i;
+    for (i = PyList_GET_SIZE(lst)-1; i != -1; i--) {
+        if (PyList_GET_ITEM(lst, i) == obj) {
+            PyList_SetSlice(lst, i, i+1, NULL);
+            break;
+        }
+    }
+}
+
+static int
+matchNamesRemove(PyObject *index, PyObject *dep)
+{
+    /*
+       for name in dep.getMatchNames():
+           _indexRemove(index, name, dep)
+    */
+    PyObject *names, *seq;
+    int i, len;
+    names = getMatchNames(dep);
+    if (!names) return -1;
+    seq = PySequence_Fast(names, "getMatchNames() returned "
+                                 "non-sequence object");
+    Py_DECREF(names);
+    if (!seq) return -1;
+    len = PySequence_Fast_GET_SIZE(seq);
+    for (i = 0; i != len; i++)
+        nameIndexRemove(index, PySequence_Fast_GET_ITEM(seq, i), dep);
+    Py_DECREF(seq);
+    return 0;
+}
+
+static void
+linkRelations(DependsObject *dep, ProvidesObject *prv, PyObject **prvlst)
+{
+    /*
+       if dep.providedby:
+           dep.providedby.append(prv)
+       else:
+           dep.providedby = [prv]
+    */
+    if (PyList_Check(dep->providedby)) {
+        PyList_Append(dep->providedby, (PyObject *)prv);
+    } else {
+        PyObject *_lst = PyList_New(1);
+        Py_INCREF(prv);
+        PyList_SET_ITEM(_lst, 0, (PyObject *)prv);
+        Py_DECREF(dep->providedby);
+        dep->providedby = _lst;
+    }
+
+    /*
+       lst = getattr(prv, attr)
+       if lst:
+           lst.append(dep)
+       else:
+           setattr(prv, attr, [dep])
+    */
+    if (PyList_Check(*prvlst)) {
+        PyList_Append(*prvlst, (PyObject *)dep);
+    } else {
+        PyObject *_lst = PyList_New(1);
+        Py_INCREF(dep);
+        PyList_SET_ITEM(_lst, 0, (PyObject *)dep);
+        Py_DECREF(*prvlst);
+        *prvlst = _lst;
+    }
+}
+
+/* Packages, Provides and Depends all keep their name at the same place. */
+#define OBJNAME(obj) (((PackageObject *)(obj))->name)
+
+static int
+nameIndexBuild(PyObject *index, PyObject *objs)
+{
+    /*
+       index.clear()
+       for obj in objs:
+           index.setdefault(obj.name, []).append(obj)
+    */
+    int i, len;
+    PyDict_Clear(index);
+    len = PyList_GET_SIZE(objs);
+    for (i = 0; i != len; i++) {
+        PyObject *obj = PyList_GET_ITEM(objs, i);
+        if (nameIndexAdd(index, OBJNAME(obj), obj) == -1)
+            return -1;
+    }
+    return 0;
+}
+
 PyObject *
 Loader_buildPackage(LoaderObject *self, PyObject *args)
 {
@@ -1736,6 +2085,9 @@ Loader_buildPackage(LoaderObject *self, PyObject *args)
 
                 /* cache._provides.append(prv) */
                 PyList_Append(cache->_provides, prv);
+
+                /* cache._prvnames.setdefault(prv.name, []).append(prv) */
+                nameIndexAdd(cache->_prvnames, prvobj->name, prv);
             }
 
             /* relpkgs.append(prv.packages) */
@@ -1789,6 +2141,9 @@ Loader_buildPackage(LoaderObject *self, PyObject *args)
 
                 /* cache._requires.append(req) */
                 PyList_Append(cache->_requires, req);
+
+                /* cache._reqnames.setdefault(req.name, []).append(req) */
+                nameIndexAdd(cache->_reqnames, reqobj->name, req);
             }
 
             /* relpkgs.append(req.packages) */
@@ -1842,6 +2197,9 @@ Loader_buildPackage(LoaderObject *self, PyObject *args)
 
                 /* cache._recommends.append(rec) */
                 PyList_Append(cache->_recommends, rec);
+
+                /* cache._recnames.setdefault(rec.name, []).append(rec) */
+                nameIndexAdd(cache->_recnames, recobj->name, rec);
             }
 
             /* relpkgs.append(rec.packages) */
@@ -1895,6 +2253,9 @@ Loader_buildPackage(LoaderObject *self, PyObject *args)
 
                 /* cache._recommends.append(rec) */
                 PyList_Append(cache->_recommends, rec);
+
+                /* cache._recnames.setdefault(rec.name, []).append(rec) */
+                nameIndexAdd(cache->_recnames, recobj->name, rec);
             }
 
             /* relpkgs.append(rec.packages) */
@@ -1948,6 +2309,9 @@ Loader_buildPackage(LoaderObject *self, PyObject *args)
 
                 /* cache._upgrades.append(upg) */
                 PyList_Append(cache->_upgrades, upg);
+
+                /* cache._upgnames.setdefault(upg.name, []).append(upg) */
+                nameIndexAdd(cache->_upgnames, upgobj->name, upg);
             }
 
             /* relpkgs.append(upg.packages) */
@@ -2001,6 +2365,9 @@ Loader_buildPackage(LoaderObject *self, PyObject *args)
 
                 /* cache._conflicts.append(cnf) */
                 PyList_Append(cache->_conflicts, cnf);
+
+                /* cache._cnfnames.setdefault(cnf.name, []).append(cnf) */
+                nameIndexAdd(cache->_cnfnames, cnfobj->name, cnf);
             }
 
             /* relpkgs.append(cnf.packages) */
@@ -2061,6 +2428,9 @@ Loader_buildPackage(LoaderObject *self, PyObject *args)
         /* cache._packages.append(pkg) */
         PyList_Append(cache->_packages, pkg);
 
+        /* cache._pkgnames.setdefault(pkg.name, []).append(pkg) */
+        nameIndexAdd(cache->_pkgnames, pkgobj->name, pkg);
+
         /* for pkgs in relpkgs: */
         len = PyList_GET_SIZE(relpkgs);
         for (i = 0; i != len; i++) {
@@ -2150,6 +2520,9 @@ Loader_buildFileProvides(LoaderObject *self, PyObject *args)
 
         /* cache._provides.append(prv) */
         PyList_Append(cache->_provides, prv);
+
+        /* cache._prvnames.setdefault(prv.name, []).append(prv) */
+        nameIndexAdd(cache->_prvnames, prvobj->name, prv);
     /*
        elif prv in pkg.provides:
            return
@@ -2169,6 +2542,23 @@ Loader_buildFileProvides(LoaderObject *self, PyObject *args)
     /* pkg.provides.append(prv) */
     PyList_Append(pkgobj->provides, prv);
 
+    /*
+       Remember it, so that it can be dropped once the file isn't
+       required anymore.
+
+       cache._fileprvs.setdefault(prv.name, {})[pkg] = prv
+    */
+    {
+        PyObject *pkgs = PyDict_GetItem(cache->_fileprvs, prvobj->name);
+        if (!pkgs) {
+            pkgs = PyDict_New();
+            if (!pkgs) return NULL;
+            PyDict_SetItem(cache->_fileprvs, prvobj->name, pkgs);
+            Py_DECREF(pkgs);
+        }
+        PyDict_SetItem(pkgs, pkg, prv);
+    }
+
     /* for req in pkg.requires[:]: */
     for (i = PyList_GET_SIZE(pkgobj->requires)-1; i != -1; i--) {
         DependsObject *reqobj;
@@ -2187,11 +2577,35 @@ Loader_buildFileProvides(LoaderObject *self, PyObject *args)
             }
             /* if not req.packages: */
             if (PyList_GET_SIZE(reqobj->packages) == 0) {
+                /*
+                   if req.providedby:
+                       for reqprv in req.providedby:
+                           reqprv.requiredby.remove(req)
+                       del req.providedby[:]
+                */
+                if (PyList_Check(reqobj->providedby)) {
+                    int k, klen = PyList_GET_SIZE(reqobj->providedby);
+                    for (k = 0; k != klen; k++) {
+                        ProvidesObject *reqprv = (ProvidesObject *)
+                            PyList_GET_ITEM(reqobj->providedby, k);
+                        if (PyList_Check(reqprv->requiredby))
+                            listRemoveObject(reqprv->requiredby, req);
+                    }
+                    LIST_CLEAR(reqobj->providedby);
+                }
+                /*
+                   for name in req.getMatchNames():
+                       _indexRemove(cache._reqmatchnames, name, req)
+                */
+                if (matchNamesRemove(cache->_reqmatchnames, req) == -1)
+                    return NULL;
                 /* cache._requires.remove(req) */
                 for (j = PyList_GET_SIZE(cache->_requires)-1; j != -1; j--) {
                     if (PyList_GET_ITEM(cache->_requires, j) == req)
                         PyList_SetSlice(cache->_requires, j, j+1, NULL);
                 }
+                /* cache._reqnames[req.name].remove(req) */
+                nameIndexRemove(cache->_reqnames, reqobj->name, req);
             }
         }
     }
@@ -2600,6 +3014,20 @@ Cache_init(CacheObject *self, PyObject *args)
     self->_upgrades = PyList_New(0);
     self->_conflicts = PyList_New(0);
     self->_objmap = PyDict_New();
+    self->_pkgnames = PyDict_New();
+    self->_prvnames = PyDict_New();
+    self->_reqnames = PyDict_New();
+    self->_recnames = PyDict_New();
+    self->_upgnames = PyDict_New();
+    self->_cnfnames = PyDict_New();
+    self->_reqmatchnames = PyDict_New();
+    self->_recmatchnames = PyDict_New();
+    self->_upgmatchnames = PyDict_New();
+    self->_cnfmatchnames = PyDict_New();
+    self->_linked = PyDict_New();
+    self->_removed = PyDict_New();
+    self->_filereqs = PyDict_New();
+    self->_fileprvs = PyDict_New();
     return 0;
 }
 
@@ -2614,6 +3042,20 @@ Cache_traverse(CacheObject *self, visitproc visit, void *arg)
     Py_VISIT(self->_upgrades);
     Py_VISIT(self->_conflicts);
     Py_VISIT(self->_objmap);
+    Py_VISIT(self->_pkgnames);
+    Py_VISIT(self->_prvnames);
+    Py_VISIT(self->_reqnames);
+    Py_VISIT(self->_recnames);
+    Py_VISIT(self->_upgnames);
+    Py_VISIT(self->_cnfnames);
+    Py_VISIT(self->_reqmatchnames);
+    Py_VISIT(self->_recmatchnames);
+    Py_VISIT(self->_upgmatchnames);
+    Py_VISIT(self->_cnfmatchnames);
+    Py_VISIT(self->_linked);
+    Py_VISIT(self->_removed);
+    Py_VISIT(self->_filereqs);
+    Py_VISIT(self->_fileprvs);
     return 0;
 }
 
@@ -2628,6 +3070,20 @@ Cache_clear(CacheObject *self)
     Py_CLEAR(self->_upgrades);
     Py_CLEAR(self->_conflicts);
     Py_CLEAR(self->_objmap);
+    Py_CLEAR(self->_pkgnames);
+    Py_CLEAR(self->_prvnames);
+    Py_CLEAR(self->_reqnames);
+    Py_CLEAR(self->_recnames);
+    Py_CLEAR(self->_upgnames);
+    Py_CLEAR(self->_cnfnames);
+    Py_CLEAR(self->_reqmatchnames);
+    Py_CLEAR(self->_recmatchnames);
+    Py_CLEAR(self->_upgmatchnames);
+    Py_CLEAR(self->_cnfmatchnames);
+    Py_CLEAR(self->_linked);
+    Py_CLEAR(self->_removed);
+    Py_CLEAR(self->_filereqs);
+    Py_CLEAR(self->_fileprvs);
     return 0;
 }
 
@@ -2642,6 +3098,20 @@ Cache_dealloc(CacheObject *self)
     Py_XDECREF(self->_upgrades);
     Py_XDECREF(self->_conflicts);
     Py_XDECREF(self->_objmap);
+    Py_XDECREF(self->_pkgnames);
+    Py_XDECREF(self->_prvnames);
+    Py_XDECREF(self->_reqnames);
+    Py_XDECREF(self->_recnames);
+    Py_XDECREF(self->_upgnames);
+    Py_XDECREF(self->_cnfnames);
+    Py_XDECREF(self->_reqmatchnames);
+    Py_XDECREF(self->_recmatchnames);
+    Py_XDECREF(self->_upgmatchnames);
+    Py_XDECREF(self->_cnfmatchnames);
+    Py_XDECREF(self->_linked);
+    Py_XDECREF(self->_removed);
+    Py_XDECREF(self->_filereqs);
+    Py_XDECREF(self->_fileprvs);
     self->ob_type->tp_free((PyObject *)self);
 }
 
@@ -2722,6 +3192,20 @@ Cache_reset(CacheObject *self, PyObject *args)
     LIST_CLEAR(self->_upgrades);
     LIST_CLEAR(self->_conflicts);
     PyDict_Clear(self->_objmap);
+    PyDict_Clear(self->_pkgnames);
+    PyDict_Clear(self->_prvnames);
+    PyDict_Clear(self->_reqnames);
+    PyDict_Clear(self->_recnames);
+    PyDict_Clear(self->_upgnames);
+    PyDict_Clear(self->_cnfnames);
+    PyDict_Clear(self->_reqmatchnames);
+    PyDict_Clear(self->_recmatchnames);
+    PyDict_Clear(self->_upgmatchnames);
+    PyDict_Clear(self->_cnfmatchnames);
+    PyDict_Clear(self->_linked);
+    PyDict_Clear(self->_removed);
+    PyDict_Clear(self->_filereqs);
+    PyDict_Clear(self->_fileprvs);
     Py_RETURN_NONE;
 }
 
@@ -2747,11 +3231,30 @@ Cache_removeLoader(CacheObject *self, PyObject *loader)
 {
     if (loader != Py_None) {
         int i, len;
+        int found = 0;
         len = PyList_GET_SIZE(self->_loaders);
-        for (i = len-1; i >= 0; i--)
-            if (PyList_GET_ITEM(self->_loaders, i) == loader)
+        for (i = len-1; i >= 0; i--) {
+            if (PyList_GET_ITEM(self->_loaders, i) == loader) {
                 PyList_SetSlice(self->_loaders, i, i+1, (PyObject *)NULL);
-        if (i >= 0) {
+                found = 1;
+            }
+        }
+        if (found) {
+            /*
+               if loader in self._linked:
+                   del self._linked[loader]
+                   for pkg in loader._packages:
+                       self._removed[pkg] = True
+            */
+            if (PyDict_GetItem(self->_linked, loader) &&
+                PyObject_IsInstance(loader, (PyObject *)&Loader_Type)) {
+                PyObject *packages = ((LoaderObject *)loader)->_packages;
+                PyDict_DelItem(self->_linked, loader);
+                len = PyList_GET_SIZE(packages);
+                for (i = 0; i != len; i++)
+                    PyDict_SetItem(self->_removed,
+                                   PyList_GET_ITEM(packages, i), Py_True);
+            }
             CALLMETHOD(loader, "setCache", "O", Py_None);
             CALLMETHOD(loader, "unload", NULL);
         }
@@ -2759,6 +3262,19 @@ Cache_removeLoader(CacheObject *self, PyObject *loader)
     Py_RETURN_NONE;
 }
 
+static int
+Cache__buildNameIndexes(CacheObject *self)
+{
+    if (nameIndexBuild(self->_pkgnames, self->_packages) == -1 ||
+        nameIndexBuild(self->_prvnames, self->_provides) == -1 ||
+        nameIndexBuild(self->_reqnames, self->_requires) == -1 ||
+        nameIndexBuild(self->_recnames, self->_recommends) == -1 ||
+        nameIndexBuild(self->_upgnames, self->_upgrades) == -1 ||
+        nameIndexBuild(self->_cnfnames, self->_conflicts) == -1)
+        return -1;
+    return 0;
+}
+
 PyObject *
 Cache__reload(CacheObject *self, PyObject *args)
 {
@@ -2833,8 +3349,7 @@ Cache__reload(CacheObject *self, PyObject *args)
                 PyDict_SetItem(packages, (PyObject *)pkg, Py_True);
                 
                 /* objmap.setdefault(pkg.getInitArgs(), []).append(pkg) */
-                args = PyObject_CallMethod((PyObject *)pkg, "getInitArgs",
-                                           NULL);
+                args = getInitArgs((PyObject *)pkg);
                 if (!args) return NULL;
                 lst = PyDict_GetItem(objmap, args);
                 if (!lst) {
@@ -2879,8 +3394,7 @@ Cache__reload(CacheObject *self, PyObject *args)
                                       (PyObject *)pkg);
                         if (!PyDict_GetItem(provides, prv)) {
                             PyDict_SetItem(provides, prv, Py_True);
-                            args = PyObject_CallMethod(prv, "getInitArgs",
-                                                       NULL);
+                            args = getInitArgs(prv);
                             if (!args) return NULL;
                             PyDict_SetItem(objmap, args, prv);
                             Py_DECREF(args);
@@ -2903,8 +3417,7 @@ Cache__reload(CacheObject *self, PyObject *args)
                                       (PyObject *)pkg);
                         if (!PyDict_GetItem(requires, req)) {
                             PyDict_SetItem(requires, req, Py_True);
-                            args = PyObject_CallMethod(req, "getInitArgs",
-                                                       NULL);
+                            args = getInitArgs(req);
                             if (!args) return NULL;
                             PyDict_SetItem(objmap, args, req);
                             Py_DECREF(args);
@@ -2927,8 +3440,7 @@ Cache__reload(CacheObject *self, PyObject *args)
                                       (PyObject *)pkg);
                         if (!PyDict_GetItem(recommends, rec)) {
                             PyDict_SetItem(recommends, rec, Py_True);
-                            args = PyObject_CallMethod(rec, "getInitArgs",
-                                                       NULL);
+                            args = getInitArgs(rec);
                             if (!args) return NULL;
                             PyDict_SetItem(objmap, args, rec);
                             Py_DECREF(args);
@@ -2951,8 +3463,7 @@ Cache__reload(CacheObject *self, PyObject *args)
                                       (PyObject *)pkg);
                         if (!PyDict_GetItem(recommends, rec)) {
                             PyDict_SetItem(recommends, rec, Py_True);
-                            args = PyObject_CallMethod(rec, "getInitArgs",
-                                                       NULL);
+                            args = getInitArgs(rec);
                             if (!args) return NULL;
                             PyDict_SetItem(objmap, args, rec);
                             Py_DECREF(args);
@@ -2975,8 +3486,7 @@ Cache__reload(CacheObject *self, PyObject *args)
                                       (PyObject *)pkg);
                         if (!PyDict_GetItem(upgrades, upg)) {
                             PyDict_SetItem(upgrades, upg, Py_True);
-                            args = PyObject_CallMethod(upg, "getInitArgs",
-                                                       NULL);
+                            args = getInitArgs(upg);
                             if (!args) return NULL;
                             PyDict_SetItem(objmap, args, upg);
                             Py_DECREF(args);
@@ -2999,8 +3509,7 @@ Cache__reload(CacheObject *self, PyObject *args)
                                       (PyObject *)pkg);
                         if (!PyDict_GetItem(conflicts, cnf)) {
                             PyDict_SetItem(conflicts, cnf, Py_True);
-                            args = PyObject_CallMethod(cnf, "getInitArgs",
-                                                       NULL);
+                            args = getInitArgs(cnf);
                             if (!args) return NULL;
                             PyDict_SetItem(objmap, args, cnf);
                             Py_DECREF(args);
@@ -3044,113 +3553,1001 @@ Cache__reload(CacheObject *self, PyObject *args)
     self->_conflicts = PyDict_Keys(conflicts);
     Py_DECREF(conflicts);
 
+    /* self._buildNameIndexes() */
+    if (Cache__buildNameIndexes(self) == -1)
+        return NULL;
+
     Py_INCREF(Py_None);
     return Py_None;
 }
 
-PyObject *
-Cache_load(CacheObject *self, PyObject *args)
+static int
+Cache__buildObjMap(CacheObject *self)
 {
-    int i, len;
-    int total = 1;
-    PyObject *hooks;
-    PyObject *prog;
-    PyObject *ret;
-
-    ret = Cache__reload(self, NULL);
-    if (ret == NULL)
-        return NULL;
-    Py_DECREF(ret);
+    PyObject *objmap = self->_objmap;
+    PyObject *lists[5];
+    int i, j, len;
 
-    prog = PyObject_CallMethod(getIface(), "getProgress", "OO",
-                               self, Py_False);
-    CALLMETHOD(prog, "start", NULL);
-    CALLMETHOD(prog, "setTopic", "O", _("Updating cache..."));
-    CALLMETHOD(prog, "set", "ii", 0, 1);
-    CALLMETHOD(prog, "show", NULL);
-    len = PyList_GET_SIZE(self->_loaders);
+    /*
+       for pkg in self._packages:
+           objmap.setdefault(pkg.getInitArgs(), []).append(pkg)
+    */
+    len = PyList_GET_SIZE(self->_packages);
     for (i = 0; i != len; i++) {
-        PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
-        if (PyList_GET_SIZE(((LoaderObject *)loader)->_packages) == 0) {
-            PyObject *res = PyObject_CallMethod(loader, "getLoadSteps", NULL);
-            if (!res) {
-                Py_DECREF(prog);
-                return NULL;
-            }
-            total += PyInt_AsLong(res);
-            Py_DECREF(res);
+        PyObject *pkg = PyList_GET_ITEM(self->_packages, i);
+        PyObject *lst;
+        PyObject *args = getInitArgs(pkg);
+        if (!args) return -1;
+        lst = PyDict_GetItem(objmap, args);
+        if (!lst) {
+            lst = PyList_New(0);
+            PyDict_SetItem(objmap, args, lst);
+            Py_DECREF(lst);
         }
+        PyList_Append(lst, pkg);
+        Py_DECREF(args);
     }
-    CALLMETHOD(prog, "set", "ii", 0, total);
-    CALLMETHOD(prog, "show", NULL);
-    len = PyList_GET_SIZE(self->_loaders);
-    for (i = 0; i != len; i++) {
-        PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
-        if (PyList_GET_SIZE(((LoaderObject *)loader)->_packages) == 0)
-            CALLMETHOD(loader, "load", NULL);
+
+    /*
+       for objs in (self._provides, self._requires, self._recommends,
+                    self._upgrades, self._conflicts):
+           for obj in objs:
+               objmap[obj.getInitArgs()] = obj
+    */
+    lists[0] = self->_provides;
+    lists[1] = self->_requires;
+    lists[2] = self->_recommends;
+    lists[3] = self->_upgrades;
+    lists[4] = self->_conflicts;
+    for (j = 0; j != 5; j++) {
+        len = PyList_GET_SIZE(lists[j]);
+        for (i = 0; i != len; i++) {
+            PyObject *obj = PyList_GET_ITEM(lists[j], i);
+            PyObject *args = getInitArgs(obj);
+            if (!args) return -1;
+            PyDict_SetItem(objmap, args, obj);
+            Py_DECREF(args);
+        }
     }
-    CALLMETHOD(self, "loadFileProvides", NULL);
-    hooks = getHooks();
-    CALLMETHOD(hooks, "call", "sO", "cache-loaded-pre-link", self);
-    PyDict_Clear(self->_objmap);
-    CALLMETHOD(self, "linkDeps", NULL);
-    CALLMETHOD(prog, "setDone", NULL);
-    CALLMETHOD(prog, "show", NULL);
-    CALLMETHOD(prog, "stop", NULL);
-    Py_DECREF(prog);
-    CALLMETHOD(hooks, "call", "sO", "cache-loaded", self);
-    Py_RETURN_NONE;
+    return 0;
 }
 
-PyObject *
-Cache_unload(CacheObject *self, PyObject *args)
+static void
+removeObjects(PyObject *objs, PyObject *index, PyObject *removed)
 {
-    int i, len;
-    CALLMETHOD(self, "reset", NULL);
-    len = PyList_GET_SIZE(self->_loaders);
-    for (i = 0; i != len; i++) {
-        PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
-        CALLMETHOD(loader, "unload", NULL);
+    /*
+       if removed:
+           objs[:] = [x for x in objs if x not in removed]
+           for obj in removed:
+               lst = index.get(obj.name)
+               if lst:
+                   lst.remove(obj)
+                   if not lst:
+                       del index[obj.name]
+    */
+    PyObject *obj, *value;
+    Py_ssize_t pos = 0;
+    int i, j, len;
+    if (PyDict_Size(removed) == 0)
+        return;
+    len = PyList_GET_SIZE(objs);
+    for (i = 0, j = 0; i != len; i++) {
+        obj = PyList_GET_ITEM(objs, i);
+        if (!PyDict_GetItem(removed, obj)) {
+            if (i != j) {
+                Py_INCREF(obj);
+                PyList_SetItem(objs, j, obj);
+            }
+            j++;
+        }
     }
-    Py_RETURN_NONE;
+    PyList_SetSlice(objs, j, len, NULL);
+    while (PyDict_Next(removed, &pos, &obj, &value))
+        nameIndexRemove(index, OBJNAME(obj), obj);
 }
 
-PyObject *
-Cache_loadFileProvides(CacheObject *self, PyObject *args)
+static void
+dropOrphans(PyObject *objs, PyObject *index, PyObject *newobjs, int provides)
 {
-    PyObject *fndict = PyDict_New();
-    int i, len;
-    len = PyList_GET_SIZE(self->_requires);
-    for (i = 0; i != len; i++) {
-        DependsObject *req =
-            (DependsObject *)PyList_GET_ITEM(self->_requires, i);
-        if (STR(req->name)[0] == '/')
-            PyDict_SetItem(fndict, req->name, req->name);
-    }
-    len = PyList_GET_SIZE(self->_loaders);
+    /*
+       orphans = {}
+       for obj in newobjs:
+           if not obj.packages:
+               orphans[obj] = True
+       if orphans:
+           newobjs[:] = [x for x in newobjs if x not in orphans]
+           _removeObjects(objs, index, orphans)
+    */
+    PyObject *orphans = PyDict_New();
+    int i, len = PyList_GET_SIZE(newobjs);
     for (i = 0; i != len; i++) {
-        PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
-        CALLMETHOD(loader, "loadFileProvides", "O", fndict);
+        PyObject *obj = PyList_GET_ITEM(newobjs, i);
+        PyObject *packages = provides ? ((ProvidesObject *)obj)->packages
+                                      : ((DependsObject *)obj)->packages;
+        if (PyList_GET_SIZE(packages) == 0)
+            PyDict_SetItem(orphans, obj, Py_True);
     }
-    Py_RETURN_NONE;
+    removeObjects(newobjs, index, orphans);
+    removeObjects(objs, index, orphans);
+    Py_DECREF(orphans);
 }
 
-PyObject *
-Cache_linkDeps(CacheObject *self, PyObject *args)
+static int
+unlinkDepends(PyObject *deps, PyObject *depnames, int byoffset)
 {
-    int i, j, len;
-    PyObject *reqnames, *recnames, *upgnames, *cnfnames;
-    PyObject *lst;
+    /*
+       for dep in deps:
+           for name in dep.getMatchNames():
+               _indexRemove(depnames, name, dep)
+           if dep.providedby:
+               for prv in dep.providedby:
+                   getattr(prv, attr).remove(dep)
+               del dep.providedby[:]
+    */
+    PyObject *dep, *value;
+    Py_ssize_t pos = 0;
+    while (PyDict_Next(deps, &pos, &dep, &value)) {
+        DependsObject *depobj = (DependsObject *)dep;
+        if (matchNamesRemove(depnames, dep) == -1)
+            return -1;
+        if (PyList_Check(depobj->providedby)) {
+            int i, len = PyList_GET_SIZE(depobj->providedby);
+            for (i = 0; i != len; i++) {
+                PyObject *prv = PyList_GET_ITEM(depobj->providedby, i);
+                PyObject *prvlst = *(PyObject **)((char *)prv+byoffset);
+                if (PyList_Check(prvlst))
+                    listRemoveObject(prvlst, dep);
+            }
+            LIST_CLEAR(depobj->providedby);
+        }
+    }
+    return 0;
+}
 
-    /* reqnames = {} */
-    reqnames = PyDict_New();
+static void
+unlinkProvides(PyObject *prvlst, PyObject *prv)
+{
+    /*
+       if prv.requiredby:
+           for req in prv.requiredby:
+               req.providedby.remove(prv)
+           del prv.requiredby[:]
+    */
+    if (PyList_Check(prvlst)) {
+        int i, len = PyList_GET_SIZE(prvlst);
+        for (i = 0; i != len; i++) {
+            DependsObject *dep = (DependsObject *)PyList_GET_ITEM(prvlst, i);
+            if (PyList_Check(dep->providedby))
+                listRemoveObject(dep->providedby, prv);
+        }
+        LIST_CLEAR(prvlst);
+    }
+}
+
+static PyObject *
+Cache__addFileRequires(CacheObject *self, PyObject *packages)
+{
+    /*
+       Track the packages requiring each file, as loaded, since
+       requires satisfied by the package itself are dropped by
+       buildFileProvides(). Return the files nothing required before.
+    */
+    PyObject *fndict;
+    int i, j, len;
+
+    fndict = PyDict_New();
+    if (!fndict)
+        return NULL;
+    /* for pkg in packages: */
+    len = PyList_GET_SIZE(packages);
+    for (i = 0; i != len; i++) {
+        PyObject *pkg = PyList_GET_ITEM(packages, i);
+        PyObject *requires = ((PackageObject *)pkg)->requires;
+        int reqlen;
+        if (!PyList_Check(requires))
+            continue;
+        /* for req in pkg.requires: */
+        reqlen = PyList_GET_SIZE(requires);
+        for (j = 0; j != reqlen; j++) {
+            PyObject *name = OBJNAME(PyList_GET_ITEM(requires, j));
+            PyObject *pkgs;
+            if (STR(name)[0] != '/')
+                continue;
+            /*
+               pkgs = filereqs.get(name)
+               if pkgs is None:
+                   pkgs = filereqs[name] = {}
+                   fndict[name] = name
+               pkgs[pkg] = True
+            */
+            pkgs = PyDict_GetItem(self->_filereqs, name);
+            if (!pkgs) {
+                pkgs = PyDict_New();
+                if (!pkgs) {
+                    Py_DECREF(fndict);
+                    return NULL;
+                }
+                PyDict_SetItem(self->_filereqs, name, pkgs);
+                Py_DECREF(pkgs);
+                PyDict_SetItem(fndict, name, name);
+            }
+            PyDict_SetItem(pkgs, pkg, Py_True);
+        }
+    }
+    return fndict;
+}
+
+static void
+forgetFiles(CacheObject *self, PyObject *rels, PyObject *pkg,
+            PyObject *unrequired)
+{
+    /*
+       for rel in rels:
+           name = rel.name
+           if name[0] != "/":
+               continue
+           pkgs = filereqs.get(name)
+           if pkgs and pkg in pkgs:
+               del pkgs[pkg]
+               if not pkgs:
+                   del filereqs[name]
+                   unrequired[name] = True
+           pkgs = fileprvs.get(name)
+           if pkgs and pkg in pkgs:
+               del pkgs[pkg]
+               if not pkgs:
+                   del fileprvs[name]
+    */
+    int i, len;
+    if (!PyList_Check(rels))
+        return;
+    len = PyList_GET_SIZE(rels);
+    for (i = 0; i != len; i++) {
+        PyObject *name = OBJNAME(PyList_GET_ITEM(rels, i));
+        PyObject *pkgs;
+        if (STR(name)[0] != '/')
+            continue;
+        pkgs = PyDict_GetItem(self->_filereqs, name);
+        if (pkgs && PyDict_GetItem(pkgs, pkg)) {
+            PyDict_DelItem(pkgs, pkg);
+            if (PyDict_Size(pkgs) == 0) {
+                PyDict_SetItem(unrequired, name, Py_True);
+                PyDict_DelItem(self->_filereqs, name);
+            }
+        }
+        pkgs = PyDict_GetItem(self->_fileprvs, name);
+        if (pkgs && PyDict_GetItem(pkgs, pkg)) {
+            PyDict_DelItem(pkgs, pkg);
+            if (PyDict_Size(pkgs) == 0)
+                PyDict_DelItem(self->_fileprvs, name);
+        }
+    }
+}
+
+static void
+dropPackage(PyObject *rels, PyObject *pkg, PyObject *removed, int provides)
+{
+    /*
+       for rel in rels:
+           rel.packages.remove(pkg)
+           if not rel.packages:
+               removed[rel] = True
+    */
+    int i, len;
+    if (!PyList_Check(rels))
+        return;
+    len = PyList_GET_SIZE(rels);
+    for (i = 0; i != len; i++) {
+        PyObject *rel = PyList_GET_ITEM(rels, i);
+        PyObject *packages = provides ? ((ProvidesObject *)rel)->packages
+                                      : ((DependsObject *)rel)->packages;
+        listRemoveObject(packages, pkg);
+        if (PyList_GET_SIZE(packages) == 0)
+            PyDict_SetItem(removed, rel, Py_True);
+    }
+}
+
+static int
+Cache__unlinkRemoved(CacheObject *self)
+{
+    PyObject *loaders, *packages, *provides, *requires;
+    PyObject *recommends, *upgrades, *conflicts;
+    PyObject *unrequired;
+    PyObject *obj, *value;
+    Py_ssize_t pos;
+    int i, len;
+    int result = 0;
+
+    /*
+       if not self._removed:
+           return
+    */
+    if (PyDict_Size(self->_removed) == 0)
+        return 0;
+
+    /* loaders = dict.fromkeys(self._loaders, True) */
+    loaders = PyDict_New();
+    len = PyList_GET_SIZE(self->_loaders);
+    for (i = 0; i != len; i++)
+        PyDict_SetItem(loaders, PyList_GET_ITEM(self->_loaders, i), Py_True);
+
+    packages = PyDict_New();
+    provides = PyDict_New();
+    requires = PyDict_New();
+    recommends = PyDict_New();
+    upgrades = PyDict_New();
+    conflicts = PyDict_New();
+    unrequired = PyDict_New();
+
+    /* for pkg in self._removed: */
+    pos = 0;
+    while (PyDict_Next(self->_removed, &pos, &obj, &value)) {
+        PackageObject *pkg = (PackageObject *)obj;
+        PyObject *lst;
+        int k, klen;
+
+        /*
+           for pkgloader in pkg.loaders.keys():
+               if pkgloader not in loaders:
+                   del pkg.loaders[pkgloader]
+        */
+        lst = PyDict_Keys(pkg->loaders);
+        klen = PyList_GET_SIZE(lst);
+        for (k = 0; k != klen; k++) {
+            PyObject *pkgloader = PyList_GET_ITEM(lst, k);
+            if (!PyDict_GetItem(loaders, pkgloader))
+                PyDict_DelItem(pkg->loaders, pkgloader);
+        }
+        Py_DECREF(lst);
+
+        /*
+           if pkg.loaders:
+               pkg.installed = False
+               for pkgloader in pkg.loaders:
+                   pkg.installed |= pkgloader._installed
+               continue
+        */
+        if (PyDict_Size(pkg->loaders) != 0) {
+            PyObject *installed = Py_False;
+            PyObject *pkgloader;
+            Py_ssize_t lpos = 0;
+            while (PyDict_Next(pkg->loaders, &lpos, &pkgloader, &value)) {
+                if (PyObject_IsInstance(pkgloader,
+                                        (PyObject *)&Loader_Type) &&
+                    ((LoaderObject *)pkgloader)->_installed == Py_True)
+                    installed = Py_True;
+            }
+            Py_DECREF(pkg->installed);
+            pkg->installed = installed;
+            Py_INCREF(pkg->installed);
+            continue;
+        }
+
+        /* packages[pkg] = True */
+        PyDict_SetItem(packages, obj, Py_True);
+
+        /* for lst in (pkg.requires, pkg.provides): ... */
+        forgetFiles(self, pkg->requires, obj, unrequired);
+        forgetFiles(self, pkg->provides, obj, unrequired);
+
+        /*
+           for prv in pkg.provides:
+               prv.packages.remove(pkg)
+               if not prv.packages:
+                   provides[prv] = True
+           (and the same for the other relations)
+        */
+        dropPackage(pkg->provides, obj, provides, 1);
+        dropPackage(pkg->requires, obj, requires, 0);
+        dropPackage(pkg->recommends, obj, recommends, 0);
+        dropPackage(pkg->upgrades, obj, upgrades, 0);
+        dropPackage(pkg->conflicts, obj, conflicts, 0);
+    }
+    Py_DECREF(loaders);
+
+    /* self._removed.clear() */
+    PyDict_Clear(self->_removed);
+
+    /*
+       Files nothing requires anymore wouldn't be looked for by a
+       full load, so packages shouldn't keep providing them.
+
+       for name in unrequired:
+           for pkg, prv in fileprvs.pop(name, {}).items():
+               pkg.provides.remove(prv)
+               prv.packages.remove(pkg)
+               if not prv.packages:
+                   provides[prv] = True
+    */
+    pos = 0;
+    while (PyDict_Next(unrequired, &pos, &obj, &value)) {
+        PyObject *pkgs = PyDict_GetItem(self->_fileprvs, obj);
+        PyObject *pkg, *prv;
+        Py_ssize_t ppos = 0;
+        if (!pkgs)
+            continue;
+        Py_INCREF(pkgs);
+        PyDict_DelItem(self->_fileprvs, obj);
+        while (PyDict_Next(pkgs, &ppos, &pkg, &prv)) {
+            PyObject *prvpackages = ((ProvidesObject *)prv)->packages;
+            listRemoveObject(((PackageObject *)pkg)->provides, prv);
+            listRemoveObject(prvpackages, pkg);
+            if (PyList_GET_SIZE(prvpackages) == 0)
+                PyDict_SetItem(provides, prv, Py_True);
+        }
+        Py_DECREF(pkgs);
+    }
+    Py_DECREF(unrequired);
+
+    /* for prv in provides: */
+    pos = 0;
+    while (PyDict_Next(provides, &pos, &obj, &value)) {
+        ProvidesObject *prv = (ProvidesObject *)obj;
+        unlinkProvides(prv->requiredby, obj);
+        unlinkProvides(prv->recommendedby, obj);
+        unlinkProvides(prv->upgradedby, obj);
+        unlinkProvides(prv->conflictedby, obj);
+    }
+
+    if (unlinkDepends(requires, self->_reqmatchnames,
+                      offsetof(ProvidesObject, requiredby)) == -1 ||
+        unlinkDepends(recommends, self->_recmatchnames,
+                      offsetof(ProvidesObject, recommendedby)) == -1 ||
+        unlinkDepends(upgrades, self->_upgmatchnames,
+                      offsetof(ProvidesObject, upgradedby)) == -1 ||
+        unlinkDepends(conflicts, self->_cnfmatchnames,
+                      offsetof(ProvidesObject, conflictedby)) == -1)
+        result = -1;
+
+    removeObjects(self->_packages, self->_pkgnames, packages);
+    removeObjects(self->_provides, self->_prvnames, provides);
+    removeObjects(self->_requires, self->_reqnames, requires);
+    removeObjects(self->_recommends, self->_recnames, recommends);
+    removeObjects(self->_upgrades, self->_upgnames, upgrades);
+    removeObjects(self->_conflicts, self->_cnfnames, conflicts);
+
+    Py_DECREF(packages);
+    Py_DECREF(provides);
+    Py_DECREF(requires);
+    Py_DECREF(recommends);
+    Py_DECREF(upgrades);
+    Py_DECREF(conflicts);
+    return result;
+}
+
+static int
+linkNewDepends(CacheObject *self, PyObject *provides, PyObject *newdeps,
+               PyObject *depnames, int byoffset)
+{
+    int i, j, k, len;
+
+    /*
+       for prv in provides:
+           lst = depnames.get(prv.name)
+           if lst:
+               for dep in lst:
+                   if dep.matches(prv):
+                       _linkRelations(dep, prv, attr)
+    */
+    len = PyList_GET_SIZE(provides);
+    for (i = 0; i != len; i++) {
+        PyObject *prv = PyList_GET_ITEM(provides, i);
+        PyObject *lst = PyDict_GetItem(depnames, OBJNAME(prv));
+        int lstlen;
+        if (!lst)
+            continue;
+        lstlen = PyList_GET_SIZE(lst);
+        for (k = 0; k != lstlen; k++) {
+            PyObject *dep = PyList_GET_ITEM(lst, k);
+            PyObject *ret = dependsMatches(dep, prv);
+            if (!ret) return -1;
+            if (PyObject_IsTrue(ret))
+                linkRelations((DependsObject *)dep, (ProvidesObject *)prv,
+                              (PyObject **)((char *)prv+byoffset));
+            Py_DECREF(ret);
+        }
+    }
+
+    /*
+       for dep in newdeps:
+           for name in dep.getMatchNames():
+               depnames.setdefault(name, []).append(dep)
+               for prv in prvnames.get(name, ()):
+                   if dep.matches(prv):
+                       _linkRelations(dep, prv, attr)
+    */
+    len = PyList_GET_SIZE(newdeps);
+    for (i = 0; i != len; i++) {
+        PyObject *dep = PyList_GET_ITEM(newdeps, i);
+        PyObject *names = getMatchNames(dep);
+        PyObject *seq;
+        int nameslen;
+        if (!names) return -1;
+        seq = PySequence_Fast(names, "getMatchNames() returned "
+                                     "non-sequence object");
+        Py_DECREF(names);
+        if (!seq) return -1;
+        nameslen = PySequence_Fast_GET_SIZE(seq);
+        for (j = 0; j != nameslen; j++) {
+            PyObject *name = PySequence_Fast_GET_ITEM(seq, j);
+            PyObject *lst;
+            int lstlen;
+            if (nameIndexAdd(depnames, name, dep) == -1) {
+                Py_DECREF(seq);
+                return -1;
+            }
+            lst = PyDict_GetItem(self->_prvnames, name);
+            if (!lst)
+                continue;
+            lstlen = PyList_GET_SIZE(lst);
+            for (k = 0; k != lstlen; k++) {
+                PyObject *prv = PyList_GET_ITEM(lst, k);
+                PyObject *ret = dependsMatches(dep, prv);
+                if (!ret) {
+                    Py_DECREF(seq);
+                    return -1;
+                }
+                if (PyObject_IsTrue(ret))
+                    linkRelations((DependsObject *)dep, (ProvidesObject *)prv,
+                                  (PyObject **)((char *)prv+byoffset));
+                Py_DECREF(ret);
+            }
+        }
+        Py_DECREF(seq);
+    }
+
+    return 0;
+}
+
+static int
+Cache__linkNew(CacheObject *self, PyObject *provides, PyObject *requires,
+               PyObject *recommends, PyObject *upgrades, PyObject *conflicts)
+{
+    /*
+       Link the new provides with the relations which were linked
+       before, and the new relations with everything in the cache,
+       using the indexes kept by linkDeps().
+    */
+    if (linkNewDepends(self, provides, requires, self->_reqmatchnames,
+                       offsetof(ProvidesObject, requiredby)) == -1 ||
+        linkNewDepends(self, provides, recommends, self->_recmatchnames,
+                       offsetof(ProvidesObject, recommendedby)) == -1 ||
+        linkNewDepends(self, provides, upgrades, self->_upgmatchnames,
+                       offsetof(ProvidesObject, upgradedby)) == -1 ||
+        linkNewDepends(self, provides, conflicts, self->_cnfmatchnames,
+                       offsetof(ProvidesObject, conflictedby)) == -1)
+        return -1;
+    return 0;
+}
+
+static int
+Cache__loadLinked(CacheObject *self, PyObject *loaders)
+{
+    /*
+       Load the given loaders into a cache which is already linked,
+       touching only what they bring in.
+    */
+    PyObject **attrs[6];
+    PyObject *lists[6];
+    PyObject *newlists[6];
+    PyObject *fndict, *allfndict;
+    PyObject *oldprovides, *fileprovides;
+    PyObject *hooks = getHooks();
+    PyObject *key, *value;
+    PyObject *loadloaders;
+    PyObject *ret = Py_None;
+    Py_ssize_t pos;
+    int i, len;
+    int result = -1;
+
+    /*
+       if not loaders:
+           hooks.call("cache-loaded-pre-link", self)
+           return
+    */
+    if (PyList_GET_SIZE(loaders) == 0) {
+        ret = PyObject_CallMethod(hooks, "call", "sO",
+                                  "cache-loaded-pre-link", self);
+        if (!ret) return -1;
+        Py_DECREF(ret);
+        return 0;
+    }
+
+    /* self._buildObjMap() */
+    if (Cache__buildObjMap(self) == -1)
+        return -1;
+
+    /*
+       lists = (self._packages, self._provides, ...)
+       (self._packages, self._provides, ...) = newlists = ([], [], ...)
+    */
+    attrs[0] = &self->_packages;
+    attrs[1] = &self->_provides;
+    attrs[2] = &self->_requires;
+    attrs[3] = &self->_recommends;
+    attrs[4] = &self->_upgrades;
+    attrs[5] = &self->_conflicts;
+    for (i = 0; i != 6; i++) {
+        lists[i] = *attrs[i];
+        newlists[i] = *attrs[i] = PyList_New(0);
+    }
+
+    /*
+       loadLoaders(loaders)
+    */
+    loadloaders = getLoadLoaders();
+    if (loadloaders)
+        ret = PyObject_CallFunctionObjArgs(loadloaders, loaders, NULL);
+    else
+        ret = NULL;
+    Py_XDECREF(ret);
+
+    /*
+       (self._packages, self._provides, ...) = lists
+       for lst, newlst in zip(lists, newlists):
+           lst.extend(newlst)
+    */
+    for (i = 0; i != 6; i++) {
+        int lstlen = PyList_GET_SIZE(lists[i]);
+        *attrs[i] = lists[i];
+        PyList_SetSlice(lists[i], lstlen, lstlen, newlists[i]);
+    }
+    if (!ret)
+        goto exit;
+
+    /*
+       Loaders which were linked before only have to look for
+       files nothing required before.
+
+       fndict = self._addFileRequires(packages)
+       allfndict = {}
+       for name in self._filereqs:
+           allfndict[name] = name
+    */
+    fndict = Cache__addFileRequires(self, newlists[0]);
+    if (!fndict)
+        goto exit;
+    allfndict = PyDict_New();
+    pos = 0;
+    while (PyDict_Next(self->_filereqs, &pos, &key, &value))
+        PyDict_SetItem(allfndict, key, key);
+
+    /*
+       oldprovides = self._provides
+       self._provides = []
+       for loader in self._loaders:
+           if loader not in self._linked:
+               loader.loadFileProvides(allfndict)
+           elif fndict:
+               loader.loadFileProvides(fndict)
+       provides.extend(self._provides)
+       oldprovides.extend(self._provides)
+       self._provides = oldprovides
+    */
+    oldprovides = self->_provides;
+    fileprovides = self->_provides = PyList_New(0);
+    len = PyList_GET_SIZE(self->_loaders);
+    for (i = 0; i != len; i++) {
+        PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
+        if (!PyDict_GetItem(self->_linked, loader))
+            ret = PyObject_CallMethod(loader, "loadFileProvides", "O",
+                                      allfndict);
+        else if (PyDict_Size(fndict) != 0)
+            ret = PyObject_CallMethod(loader, "loadFileProvides", "O",
+                                      fndict);
+        else
+            continue;
+        if (!ret) break;
+        Py_DECREF(ret);
+    }
+    self->_provides = oldprovides;
+    len = PyList_GET_SIZE(fileprovides);
+    PyList_SetSlice(newlists[1], PyList_GET_SIZE(newlists[1]),
+                    PyList_GET_SIZE(newlists[1]), fileprovides);
+    PyList_SetSlice(oldprovides, PyList_GET_SIZE(oldprovides),
+                    PyList_GET_SIZE(oldprovides), fileprovides);
+    Py_DECREF(fileprovides);
+    Py_DECREF(fndict);
+    Py_DECREF(allfndict);
+    if (!ret)
+        goto exit;
+
+    /*
+       Drop new relations no package ended up with, as _reload()
+       would do. File provides may also have taken some requires.
+    */
+    dropOrphans(self->_provides, self->_prvnames, newlists[1], 1);
+    dropOrphans(self->_requires, self->_reqnames, newlists[2], 0);
+    dropOrphans(self->_recommends, self->_recnames, newlists[3], 0);
+    dropOrphans(self->_upgrades, self->_upgnames, newlists[4], 0);
+    dropOrphans(self->_conflicts, self->_cnfnames, newlists[5], 0);
+
+    /* hooks.call("cache-loaded-pre-link", self) */
+    ret = PyObject_CallMethod(hooks, "call", "sO",
+                              "cache-loaded-pre-link", self);
+    if (!ret)
+        goto exit;
+    Py_DECREF(ret);
+
+    /* self._objmap.clear() */
+    PyDict_Clear(self->_objmap);
+
+    /*
+       self._linkNew(provides, requires, recommends, upgrades, conflicts)
+    */
+    result = Cache__linkNew(self, newlists[1], newlists[2], newlists[3],
+                            newlists[4], newlists[5]);
+
+exit:
+    for (i = 0; i != 6; i++)
+        Py_DECREF(newlists[i]);
+    return result;
+}
+
+static void
+trimList(PyObject *obj)
+{
+    /*
+       Lists built by appending keep spare slots around for further
+       appends. Release them, keeping the list itself, since the
+       Python version can't do it. Nothing breaks if the list grows
+       again afterwards.
+
+       These must stay real lists, rather than tuples or indexes into
+       a packed table, since callers sort them in place, append to
+       them while linking, and concatenate pkg.requires with
+       pkg.recommends.
+    */
+#if PY_VERSION_HEX >= 0x02040000
+    PyListObject *lst = (PyListObject *)obj;
+    if (!PyList_CheckExact(obj) || lst->allocated == PyList_GET_SIZE(obj))
+        return;
+    if (PyList_GET_SIZE(obj) == 0) {
+        PyMem_FREE(lst->ob_item);
+        lst->ob_item = NULL;
+    } else {
+        PyObject **items = lst->ob_item;
+        PyMem_RESIZE(items, PyObject *, PyList_GET_SIZE(obj));
+        if (!items)
+            return;
+        lst->ob_item = items;
+    }
+    lst->allocated = PyList_GET_SIZE(obj);
+#endif
+}
+
+static void
+Cache__trimLists(CacheObject *self)
+{
+    PyObject *lists[4];
+    int i, j, len;
+
+    len = PyList_GET_SIZE(self->_packages);
+    for (i = 0; i != len; i++) {
+        PackageObject *pkg =
+            (PackageObject *)PyList_GET_ITEM(self->_packages, i);
+        trimList(pkg->provides);
+        trimList(pkg->requires);
+        trimList(pkg->recommends);
+        trimList(pkg->upgrades);
+        trimList(pkg->conflicts);
+    }
+
+    len = PyList_GET_SIZE(self->_provides);
+    for (i = 0; i != len; i++) {
+        ProvidesObject *prv =
+            (ProvidesObject *)PyList_GET_ITEM(self->_provides, i);
+        trimList(prv->packages);
+        trimList(prv->requiredby);
+        trimList(prv->recommendedby);
+        trimList(prv->upgradedby);
+        trimList(prv->conflictedby);
+    }
+
+    lists[0] = self->_requires;
+    lists[1] = self->_recommends;
+    lists[2] = self->_upgrades;
+    lists[3] = self->_conflicts;
+    for (j = 0; j != 4; j++) {
+        len = PyList_GET_SIZE(lists[j]);
+        for (i = 0; i != len; i++) {
+            DependsObject *dep =
+                (DependsObject *)PyList_GET_ITEM(lists[j], i);
+            trimList(dep->packages);
+            trimList(dep->providedby);
+        }
+    }
+}
+
+PyObject *
+Cache_load(CacheObject *self, PyObject *args)
+{
+    int i, len;
+    int total = 1;
+    int linked;
+    PyObject *loaders;
+    PyObject *hooks;
+    PyObject *prog;
+    PyObject *ret;
+
+    /*
+       linked = self._linked
+       for loader in self._loaders:
+           if loader._packages and loader not in linked:
+               linked = None
+               break
+    */
+    linked = PyDict_Size(self->_linked) != 0;
+    len = PyList_GET_SIZE(self->_loaders);
+    for (i = 0; linked && i != len; i++) {
+        PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
+        if (!PyObject_IsInstance(loader, (PyObject *)&Loader_Type)) {
+            PyErr_SetString(PyExc_TypeError,
+                            "Loader is not a Loader instance");
+            return NULL;
+        }
+        if (PyList_GET_SIZE(((LoaderObject *)loader)->_packages) != 0 &&
+            !PyDict_GetItem(self->_linked, loader))
+            linked = 0;
+    }
+
+    /*
+       if linked:
+           self._unlinkRemoved()
+       else:
+           self.reset()
+           self._reload()
+    */
+    if (linked) {
+        if (Cache__unlinkRemoved(self) == -1)
+            return NULL;
+    } else {
+        ret = Cache_reset(self, NULL);
+        if (ret == NULL)
+            return NULL;
+        Py_DECREF(ret);
+        ret = Cache__reload(self, NULL);
+        if (ret == NULL)
+            return NULL;
+        Py_DECREF(ret);
+    }
+
+    prog = PyObject_CallMethod(getIface(), "getProgress", "OO",
+                               self, Py_False);
+    CALLMETHOD(prog, "start", NULL);
+    CALLMETHOD(prog, "setTopic", "O", _("Updating cache..."));
+    CALLMETHOD(prog, "set", "ii", 0, 1);
+    CALLMETHOD(prog, "show", NULL);
+
+    /*
+       loaders = [x for x in self._loaders if not x._packages]
+       for loader in loaders:
+           total += loader.getLoadSteps()
+    */
+    loaders = PyList_New(0);
+    len = PyList_GET_SIZE(self->_loaders);
+    for (i = 0; i != len; i++) {
+        PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
+        if (PyList_GET_SIZE(((LoaderObject *)loader)->_packages) == 0) {
+            PyObject *res = PyObject_CallMethod(loader, "getLoadSteps", NULL);
+            if (!res) {
+                Py_DECREF(loaders);
+                Py_DECREF(prog);
+                return NULL;
+            }
+            total += PyInt_AsLong(res);
+            Py_DECREF(res);
+            PyList_Append(loaders, loader);
+        }
+    }
+    CALLMETHOD(prog, "set", "ii", 0, total);
+    CALLMETHOD(prog, "show", NULL);
+    if (linked) {
+        if (Cache__loadLinked(self, loaders) == -1) {
+            Py_DECREF(loaders);
+            Py_DECREF(prog);
+            return NULL;
+        }
+        hooks = getHooks();
+    } else {
+        PyObject *loadloaders = getLoadLoaders();
+        if (!loadloaders) {
+            Py_DECREF(loaders);
+            Py_DECREF(prog);
+            return NULL;
+        }
+        ret = PyObject_CallFunctionObjArgs(loadloaders, loaders, NULL);
+        if (!ret) {
+            Py_DECREF(loaders);
+            Py_DECREF(prog);
+            return NULL;
+        }
+        Py_DECREF(ret);
+        /* self._addFileRequires(self._packages) */
+        ret = Cache__addFileRequires(self, self->_packages);
+        if (!ret) {
+            Py_DECREF(loaders);
+            Py_DECREF(prog);
+            return NULL;
+        }
+        Py_DECREF(ret);
+        CALLMETHOD(self, "loadFileProvides", NULL);
+        hooks = getHooks();
+        CALLMETHOD(hooks, "call", "sO", "cache-loaded-pre-link", self);
+        PyDict_Clear(self->_objmap);
+        CALLMETHOD(self, "linkDeps", NULL);
+        Cache__trimLists(self);
+    }
+    Py_DECREF(loaders);
+
+    /*
+       for loader in self._loaders:
+           self._linked[loader] = True
+    */
+    len = PyList_GET_SIZE(self->_loaders);
+    for (i = 0; i != len; i++)
+        PyDict_SetItem(self->_linked, PyList_GET_ITEM(self->_loaders, i),
+                       Py_True);
+
+    CALLMETHOD(prog, "setDone", NULL);
+    CALLMETHOD(prog, "show", NULL);
+    CALLMETHOD(prog, "stop", NULL);
+    Py_DECREF(prog);
+    CALLMETHOD(hooks, "call", "sO", "cache-loaded", self);
+    Py_RETURN_NONE;
+}
+
+PyObject *
+Cache_unload(CacheObject *self, PyObject *args)
+{
+    int i, len;
+    CALLMETHOD(self, "reset", NULL);
+    len = PyList_GET_SIZE(self->_loaders);
+    for (i = 0; i != len; i++) {
+        PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
+        CALLMETHOD(loader, "unload", NULL);
+    }
+    Py_RETURN_NONE;
+}
+
+PyObject *
+Cache_loadFileProvides(CacheObject *self, PyObject *args)
+{
+    PyObject *fndict = PyDict_New();
+    PyObject *key, *value;
+    Py_ssize_t pos = 0;
+    int i, len;
+    while (PyDict_Next(self->_filereqs, &pos, &key, &value))
+        PyDict_SetItem(fndict, key, key);
+    len = PyList_GET_SIZE(self->_loaders);
+    for (i = 0; i != len; i++) {
+        PyObject *loader = PyList_GET_ITEM(self->_loaders, i);
+        CALLMETHOD(loader, "loadFileProvides", "O", fndict);
+    }
+    Py_DECREF(fndict);
+    Py_RETURN_NONE;
+}
+
+PyObject *
+Cache_linkDeps(CacheObject *self, PyObject *args)
+{
+    int i, j, len;
+    PyObject *reqnames, *recnames, *upgnames, *cnfnames;
+    PyObject *lst;
+
+    /*
+       reqnames = self._reqmatchnames
+       reqnames.clear()
+    */
+    reqnames = self->_reqmatchnames;
+    PyDict_Clear(reqnames);
     /* for req in self._requires: */
     len = PyList_GET_SIZE(self->_requires);
     for (i = 0; i != len; i++) {
         PyObject *req = PyList_GET_ITEM(self->_requires, i);
 
         /* for name in req.getMatchNames(): */
-        PyObject *names = PyObject_CallMethod(req, "getMatchNames", NULL);
+        PyObject *names = getMatchNames(req);
         PyObject *seq = PySequence_Fast(names, "getMatchNames() returned "
                                                "non-sequence object");
         int nameslen;
@@ -3183,15 +4580,19 @@ Cache_linkDeps(CacheObject *self, PyObject *args)
         Py_DECREF(seq);
     }
 
-    /* recnames = {} */
-    recnames = PyDict_New();
+    /*
+       recnames = self._recmatchnames
+       recnames.clear()
+    */
+    recnames = self->_recmatchnames;
+    PyDict_Clear(recnames);
     /* for rec in self._recommends: */
     len = PyList_GET_SIZE(self->_recommends);
     for (i = 0; i != len; i++) {
         PyObject *rec = PyList_GET_ITEM(self->_recommends, i);
 
         /* for name in rec.getMatchNames(): */
-        PyObject *names = PyObject_CallMethod(rec, "getMatchNames", NULL);
+        PyObject *names = getMatchNames(rec);
         PyObject *seq = PySequence_Fast(names, "getMatchNames() returned "
                                                "non-sequence object");
         int nameslen;
@@ -3224,15 +4625,19 @@ Cache_linkDeps(CacheObject *self, PyObject *args)
         Py_DECREF(seq);
     }
 
-    /* recnames = {} */
-    recnames = PyDict_New();
+    /*
+       recnames = self._recmatchnames
+       recnames.clear()
+    */
+    recnames = self->_recmatchnames;
+    PyDict_Clear(recnames);
     /* for rec in self._recommends: */
     len = PyList_GET_SIZE(self->_recommends);
     for (i = 0; i != len; i++) {
         PyObject *rec = PyList_GET_ITEM(self->_recommends, i);
 
         /* for name in rec.getMatchNames(): */
-        PyObject *names = PyObject_CallMethod(rec, "getMatchNames", NULL);
+        PyObject *names = getMatchNames(rec);
         PyObject *seq = PySequence_Fast(names, "getMatchNames() returned "
                                                "non-sequence object");
         int nameslen;
@@ -3265,15 +4670,19 @@ Cache_linkDeps(CacheObject *self, PyObject *args)
         Py_DECREF(seq);
     }
 
-    /* upgnames = {} */
-    upgnames = PyDict_New();
+    /*
+       upgnames = self._upgmatchnames
+       upgnames.clear()
+    */
+    upgnames = self->_upgmatchnames;
+    PyDict_Clear(upgnames);
     /* for upg in self._upgrades: */
     len = PyList_GET_SIZE(self->_upgrades);
     for (i = 0; i != len; i++) {
         PyObject *upg = PyList_GET_ITEM(self->_upgrades, i);
 
         /* for name in upg.getMatchNames(): */
-        PyObject *names = PyObject_CallMethod(upg, "getMatchNames", NULL);
+        PyObject *names = getMatchNames(upg);
         PyObject *seq = PySequence_Fast(names, "getMatchNames() returned "
                                                "non-sequence object");
         int nameslen;
@@ -3306,15 +4715,19 @@ Cache_linkDeps(CacheObject *self, PyObject *args)
         Py_DECREF(seq);
     }
 
-    /* cnfnames = {} */
-    cnfnames = PyDict_New();
+    /*
+       cnfnames = self._cnfmatchnames
+       cnfnames.clear()
+    */
+    cnfnames = self->_cnfmatchnames;
+    PyDict_Clear(cnfnames);
     /* for cnf in self._conflicts: */
     len = PyList_GET_SIZE(self->_conflicts);
     for (i = 0; i != len; i++) {
         PyObject *cnf = PyList_GET_ITEM(self->_conflicts, i);
 
         /* for name in cnf.getMatchNames(): */
-        PyObject *names = PyObject_CallMethod(cnf, "getMatchNames", NULL);
+        PyObject *names = getMatchNames(cnf);
         PyObject *seq = PySequence_Fast(names, "getMatchNames() returned "
                                                "non-sequence object");
         int nameslen;
@@ -3364,8 +4777,8 @@ Cache_linkDeps(CacheObject *self, PyObject *args)
             for (j = 0; j != reqlen; j++) {
                 DependsObject *req = (DependsObject *)PyList_GET_ITEM(lst, j);
                 /* if req.matches(prv): */
-                PyObject *ret = PyObject_CallMethod((PyObject *)req, "matches",
-                                                    "O", (PyObject *)prv);
+                PyObject *ret = dependsMatches((PyObject *)req,
+                                               (PyObject *)prv);
                 if (!ret) return NULL;
                 if (PyObject_IsTrue(ret)) {
                     /*
@@ -3414,8 +4827,8 @@ Cache_linkDeps(CacheObject *self, PyObject *args)
             for (j = 0; j != reclen; j++) {
                 DependsObject *rec = (DependsObject *)PyList_GET_ITEM(lst, j);
                 /* if rec.matches(prv): */
-                PyObject *ret = PyObject_CallMethod((PyObject *)rec, "matches",
-                                                    "O", (PyObject *)prv);
+                PyObject *ret = dependsMatches((PyObject *)rec,
+                                               (PyObject *)prv);
                 if (!ret) return NULL;
                 if (PyObject_IsTrue(ret)) {
                     /*
@@ -3464,8 +4877,8 @@ Cache_linkDeps(CacheObject *self, PyObject *args)
             for (j = 0; j != reclen; j++) {
                 DependsObject *rec = (DependsObject *)PyList_GET_ITEM(lst, j);
                 /* if rec.matches(prv): */
-                PyObject *ret = PyObject_CallMethod((PyObject *)rec, "matches",
-                                                    "O", (PyObject *)prv);
+                PyObject *ret = dependsMatches((PyObject *)rec,
+                                               (PyObject *)prv);
                 if (!ret) return NULL;
                 if (PyObject_IsTrue(ret)) {
                     /*
@@ -3515,8 +4928,8 @@ Cache_linkDeps(CacheObject *self, PyObject *args)
             for (j = 0; j != upglen; j++) {
                 DependsObject *upg = (DependsObject *)PyList_GET_ITEM(lst, j);
                 /* if upg.matches(prv): */
-                PyObject *ret = PyObject_CallMethod((PyObject *)upg, "matches",
-                                                    "O", (PyObject *)prv);
+                PyObject *ret = dependsMatches((PyObject *)upg,
+                                               (PyObject *)prv);
                 if (!ret) return NULL;
                 if (PyObject_IsTrue(ret)) {
                     /*
@@ -3566,8 +4979,8 @@ Cache_linkDeps(CacheObject *self, PyObject *args)
             for (j = 0; j != cnflen; j++) {
                 DependsObject *cnf = (DependsObject *)PyList_GET_ITEM(lst, j);
                 /* if cnf.matches(prv): */
-                PyObject *ret = PyObject_CallMethod((PyObject *)cnf, "matches",
-                                                    "O", (PyObject *)prv);
+                PyObject *ret = dependsMatches((PyObject *)cnf,
+                                               (PyObject *)prv);
                 if (!ret) return NULL;
                 if (PyObject_IsTrue(ret)) {
                     /*
@@ -3607,150 +5020,115 @@ Cache_linkDeps(CacheObject *self, PyObject *args)
         }
     }
 
-    Py_DECREF(reqnames);
-    Py_DECREF(recnames);
-    Py_DECREF(upgnames);
-    Py_DECREF(cnfnames);
-
     Py_RETURN_NONE;
 }
 
 PyObject *
 Cache_getPackages(CacheObject *self, PyObject *args)
 {
-    const char *name = NULL;
+    PyObject *name = NULL;
     PyObject *lst;
-    int i, len;
-    if (!PyArg_ParseTuple(args, "|s", &name))
+    if (!PyArg_ParseTuple(args, "|O", &name))
         return NULL;
-    if (!name) {
+    if (!name || !PyObject_IsTrue(name)) {
         Py_INCREF(self->_packages);
         return self->_packages;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_packages);
-    for (i = 0; i != len; i++) {
-        PackageObject *pkg =
-            (PackageObject*)PyList_GET_ITEM(self->_packages, i);
-        if (strcmp(STR(pkg->name), name) == 0)
-            PyList_Append(lst, (PyObject *)pkg);
-    }
-    return lst;
+    /* return self._pkgnames.get(name, [])[:] */
+    lst = PyDict_GetItem(self->_pkgnames, name);
+    if (!lst)
+        return PyList_New(0);
+    return PyList_GetSlice(lst, 0, PyList_GET_SIZE(lst));
 }
 
 PyObject *
 Cache_getProvides(CacheObject *self, PyObject *args)
 {
-    const char *name = NULL;
+    PyObject *name = NULL;
     PyObject *lst;
-    int i, len;
-    if (!PyArg_ParseTuple(args, "|s", &name))
+    if (!PyArg_ParseTuple(args, "|O", &name))
         return NULL;
-    if (!name) {
+    if (!name || !PyObject_IsTrue(name)) {
         Py_INCREF(self->_provides);
         return self->_provides;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_provides);
-    for (i = 0; i != len; i++) {
-        ProvidesObject *prv =
-            (ProvidesObject*)PyList_GET_ITEM(self->_provides, i);
-        if (strcmp(STR(prv->name), name) == 0)
-            PyList_Append(lst, (PyObject *)prv);
-    }
-    return lst;
+    /* return self._prvnames.get(name, [])[:] */
+    lst = PyDict_GetItem(self->_prvnames, name);
+    if (!lst)
+        return PyList_New(0);
+    return PyList_GetSlice(lst, 0, PyList_GET_SIZE(lst));
 }
 
 PyObject *
 Cache_getRequires(CacheObject *self, PyObject *args)
 {
-    const char *name = NULL;
+    PyObject *name = NULL;
     PyObject *lst;
-    int i, len;
-    if (!PyArg_ParseTuple(args, "|s", &name))
+    if (!PyArg_ParseTuple(args, "|O", &name))
         return NULL;
-    if (!name) {
+    if (!name || !PyObject_IsTrue(name)) {
         Py_INCREF(self->_requires);
         return self->_requires;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_requires);
-    for (i = 0; i != len; i++) {
-        DependsObject *req =
-            (DependsObject*)PyList_GET_ITEM(self->_requires, i);
-        if (strcmp(STR(req->name), name) == 0)
-            PyList_Append(lst, (PyObject *)req);
-    }
-    return lst;
+    /* return self._reqnames.get(name, [])[:] */
+    lst = PyDict_GetItem(self->_reqnames, name);
+    if (!lst)
+        return PyList_New(0);
+    return PyList_GetSlice(lst, 0, PyList_GET_SIZE(lst));
 }
 
 PyObject *
 Cache_getRecommends(CacheObject *self, PyObject *args)
 {
-    const char *name = NULL;
+    PyObject *name = NULL;
     PyObject *lst;
-    int i, len;
-    if (!PyArg_ParseTuple(args, "|s", &name))
+    if (!PyArg_ParseTuple(args, "|O", &name))
         return NULL;
-    if (!name) {
+    if (!name || !PyObject_IsTrue(name)) {
         Py_INCREF(self->_recommends);
         return self->_recommends;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_recommends);
-    for (i = 0; i != len; i++) {
-        DependsObject *rec =
-            (DependsObject*)PyList_GET_ITEM(self->_recommends, i);
-        if (strcmp(STR(rec->name), name) == 0)
-            PyList_Append(lst, (PyObject *)rec);
-    }
-    return lst;
+    /* return self._recnames.get(name, [])[:] */
+    lst = PyDict_GetItem(self->_recnames, name);
+    if (!lst)
+        return PyList_New(0);
+    return PyList_GetSlice(lst, 0, PyList_GET_SIZE(lst));
 }
 
 PyObject *
 Cache_getUpgrades(CacheObject *self, PyObject *args)
 {
-    const char *name = NULL;
+    PyObject *name = NULL;
     PyObject *lst;
-    int i, len;
-    if (!PyArg_ParseTuple(args, "|s", &name))
+    if (!PyArg_ParseTuple(args, "|O", &name))
         return NULL;
-    if (!name) {
+    if (!name || !PyObject_IsTrue(name)) {
         Py_INCREF(self->_upgrades);
         return self->_upgrades;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_upgrades);
-    for (i = 0; i != len; i++) {
-        DependsObject *upg =
-            (DependsObject*)PyList_GET_ITEM(self->_upgrades, i);
-        if (strcmp(STR(upg->name), name) == 0)
-            PyList_Append(lst, (PyObject *)upg);
-    }
-    return lst;
+    /* return self._upgnames.get(name, [])[:] */
+    lst = PyDict_GetItem(self->_upgnames, name);
+    if (!lst)
+        return PyList_New(0);
+    return PyList_GetSlice(lst, 0, PyList_GET_SIZE(lst));
 }
 
 PyObject *
 Cache_getConflicts(CacheObject *self, PyObject *args)
 {
-    const char *name = NULL;
+    PyObject *name = NULL;
     PyObject *lst;
-    int i, len;
-    if (!PyArg_ParseTuple(args, "|s", &name))
+    if (!PyArg_ParseTuple(args, "|O", &name))
         return NULL;
-    if (!name) {
+    if (!name || !PyObject_IsTrue(name)) {
         Py_INCREF(self->_conflicts);
         return self->_conflicts;
     }
-    lst = PyList_New(0);
-    len = PyList_GET_SIZE(self->_conflicts);
-    for (i = 0; i != len; i++) {
-        DependsObject *cnf =
-            (DependsObject*)PyList_GET_ITEM(self->_conflicts, i);
-        if (strcmp(STR(cnf->name), name) == 0)
-            PyList_Append(lst, (PyObject *)cnf);
-    }
-    return lst;
+    /* return self._cnfnames.get(name, [])[:] */
+    lst = PyDict_GetItem(self->_cnfnames, name);
+    if (!lst)
+        return PyList_New(0);
+    return PyList_GetSlice(lst, 0, PyList_GET_SIZE(lst));
 }
 
 PyObject *
@@ -3794,14 +5172,14 @@ Cache_search(CacheObject *self, PyObject *searcher)
         ProvidesObject *prv = (ProvidesObject *)PyList_GET_ITEM(lst, i);
         for (j = 0; j != PyList_GET_SIZE(self->_requires); j++) {
             PyObject *req = PyList_GET_ITEM(self->_requires, j);
-            PyObject *names = PyObject_CallMethod(req, "getMatchNames", NULL);
+            PyObject *names = getMatchNames(req);
             PyObject *seq = PySequence_Fast(names, "getMatchNames() returned "
                                                    "non-sequence object");
             if (seq == NULL) return NULL;
             for (k = 0; k != PySequence_Fast_GET_SIZE(seq); k++) {
                 if (strcmp(PyString_AS_STRING(PySequence_Fast_GET_ITEM(seq, k)),
                            PyString_AS_STRING(prv->name)) == 0) {
-                    res = PyObject_CallMethod(req, "matches", "O", prv);
+                    res = dependsMatches(req, (PyObject *)prv);
                     if (res == NULL)
                         return NULL;
                     if (PyObject_IsTrue(res))
@@ -3826,14 +5204,14 @@ Cache_search(CacheObject *self, PyObject *searcher)
         ProvidesObject *prv = (ProvidesObject *)PyList_GET_ITEM(lst, i);
         for (j = 0; j != PyList_GET_SIZE(self->_recommends); j++) {
             PyObject *rec = PyList_GET_ITEM(self->_recommends, j);
-            PyObject *names = PyObject_CallMethod(rec, "getMatchNames", NULL);
+            PyObject *names = getMatchNames(rec);
             PyObject *seq = PySequence_Fast(names, "getMatchNames() returned "
                                                    "non-sequence object");
             if (seq == NULL) return NULL;
             for (k = 0; k != PySequence_Fast_GET_SIZE(seq); k++) {
                 if (strcmp(PyString_AS_STRING(PySequence_Fast_GET_ITEM(seq, k)),
                            PyString_AS_STRING(prv->name)) == 0) {
-                    res = PyObject_CallMethod(rec, "matches", "O", prv);
+                    res = dependsMatches(rec, (PyObject *)prv);
                     if (res == NULL)
                         return NULL;
                     if (PyObject_IsTrue(res))
@@ -3858,14 +5236,14 @@ Cache_search(CacheObject *self, PyObject *searcher)
         ProvidesObject *prv = (ProvidesObject *)PyList_GET_ITEM(lst, i);
         for (j = 0; j != PyList_GET_SIZE(self->_upgrades); j++) {
             PyObject *upg = PyList_GET_ITEM(self->_upgrades, j);
-            PyObject *names = PyObject_CallMethod(upg, "getMatchNames", NULL);
+            PyObject *names = getMatchNames(upg);
             PyObject *seq = PySequence_Fast(names, "getMatchNames() returned "
                                                    "non-sequence object");
             if (seq == NULL) return NULL;
             for (k = 0; k != PySequence_Fast_GET_SIZE(seq); k++) {
                 if (strcmp(PyString_AS_STRING(PySequence_Fast_GET_ITEM(seq, k)),
                            PyString_AS_STRING(prv->name)) == 0) {
-                    res = PyObject_CallMethod(upg, "matches", "O", prv);
+                    res = dependsMatches(upg, (PyObject *)prv);
                     if (res == NULL)
                         return NULL;
                     if (PyObject_IsTrue(res))
@@ -3890,14 +5268,14 @@ Cache_search(CacheObject *self, PyObject *searcher)
         ProvidesObject *prv = (ProvidesObject *)PyList_GET_ITEM(lst, i);
         for (j = 0; j != PyList_GET_SIZE(self->_conflicts); j++) {
             PyObject *cnf = PyList_GET_ITEM(self->_conflicts, j);
-            PyObject *names = PyObject_CallMethod(cnf, "getMatchNames", NULL);
+            PyObject *names = getMatchNames(cnf);
             PyObject *seq = PySequence_Fast(names, "getMatchNames() returned "
                                                    "non-sequence object");
             if (seq == NULL) return NULL;
             for (k = 0; k != PySequence_Fast_GET_SIZE(seq); k++) {
                 if (strcmp(PyString_AS_STRING(PySequence_Fast_GET_ITEM(seq, k)),
                            PyString_AS_STRING(prv->name)) == 0) {
-                    res = PyObject_CallMethod(cnf, "matches", "O", prv);
+                    res = dependsMatches(cnf, (PyObject *)prv);
                     if (res == NULL)
                         return NULL;
                     if (PyObject_IsTrue(res))
@@ -3939,9 +5317,190 @@ Cache__getstate__(CacheObject *self, PyObject *args)
                          PyInt_FromLong(Cache__stateversion__));
     PyDict_SetItemString(state, "_loaders", self->_loaders);
     PyDict_SetItemString(state, "_packages", self->_packages);
+
+    /*
+       Keep the links, so that the restored cache may still be
+       loaded incrementally.
+
+       if self._linked and not self._removed:
+           state["_linked"] = self._linked.keys()
+           state["_links"] = [[(dep, dep.providedby) for dep in deps
+                               if dep.providedby]
+                              for deps in (self._requires, ...)]
+           state["_filereqs"] = self._filereqs
+           state["_fileprvs"] = self._fileprvs
+    */
+    if (PyDict_Size(self->_linked) != 0 &&
+        PyDict_Size(self->_removed) == 0) {
+        PyObject *lists[4];
+        PyObject *links, *linked;
+        int i, j, len;
+
+        linked = PyDict_Keys(self->_linked);
+        if (!linked) {
+            Py_DECREF(state);
+            return NULL;
+        }
+        PyDict_SetItemString(state, "_linked", linked);
+        Py_DECREF(linked);
+
+        lists[0] = self->_requires;
+        lists[1] = self->_recommends;
+        lists[2] = self->_upgrades;
+        lists[3] = self->_conflicts;
+        links = PyList_New(4);
+        if (!links) {
+            Py_DECREF(state);
+            return NULL;
+        }
+        for (i = 0; i != 4; i++) {
+            PyObject *deplinks = PyList_New(0);
+            if (!deplinks) {
+                Py_DECREF(links);
+                Py_DECREF(state);
+                return NULL;
+            }
+            PyList_SET_ITEM(links, i, deplinks);
+            len = PyList_GET_SIZE(lists[i]);
+            for (j = 0; j != len; j++) {
+                PyObject *dep = PyList_GET_ITEM(lists[i], j);
+                PyObject *providedby = ((DependsObject *)dep)->providedby;
+                PyObject *item;
+                if (!PyList_Check(providedby) ||
+                    PyList_GET_SIZE(providedby) == 0)
+                    continue;
+                item = Py_BuildValue("(OO)", dep, providedby);
+                if (!item) {
+                    Py_DECREF(links);
+                    Py_DECREF(state);
+                    return NULL;
+                }
+                PyList_Append(deplinks, item);
+                Py_DECREF(item);
+            }
+        }
+        PyDict_SetItemString(state, "_links", links);
+        Py_DECREF(links);
+
+        PyDict_SetItemString(state, "_filereqs", self->_filereqs);
+        PyDict_SetItemString(state, "_fileprvs", self->_fileprvs);
+    }
     return state;
 }
 
+static int
+matchIndexBuild(PyObject *index, PyObject *deps)
+{
+    /*
+       for dep in deps:
+           for name in dep.getMatchNames():
+               index.setdefault(name, []).append(dep)
+    */
+    int i, j, len;
+    len = PyList_GET_SIZE(deps);
+    for (i = 0; i != len; i++) {
+        PyObject *dep = PyList_GET_ITEM(deps, i);
+        PyObject *names = getMatchNames(dep);
+        PyObject *seq;
+        int nameslen;
+        if (!names) return -1;
+        seq = PySequence_Fast(names, "getMatchNames() returned "
+                                     "non-sequence object");
+        Py_DECREF(names);
+        if (!seq) return -1;
+        nameslen = PySequence_Fast_GET_SIZE(seq);
+        for (j = 0; j != nameslen; j++) {
+            if (nameIndexAdd(index, PySequence_Fast_GET_ITEM(seq, j),
+                             dep) == -1) {
+                Py_DECREF(seq);
+                return -1;
+            }
+        }
+        Py_DECREF(seq);
+    }
+    return 0;
+}
+
+static int
+Cache__restoreLinks(CacheObject *self, PyObject *state)
+{
+    PyObject *links, *linked, *filereqs, *fileprvs;
+    PyObject *deps[4];
+    PyObject *depnames[4];
+    int offsets[4];
+    int i, j, k, len;
+
+    links = PyDict_GetItemString(state, "_links");
+    linked = PyDict_GetItemString(state, "_linked");
+    filereqs = PyDict_GetItemString(state, "_filereqs");
+    fileprvs = PyDict_GetItemString(state, "_fileprvs");
+    if (!PyList_Check(links) || PyList_GET_SIZE(links) != 4 ||
+        !linked || !PyList_Check(linked) ||
+        !filereqs || !PyDict_Check(filereqs) ||
+        !fileprvs || !PyDict_Check(fileprvs)) {
+        PyErr_SetString(StateVersionError, "");
+        return -1;
+    }
+
+    deps[0] = self->_requires;
+    deps[1] = self->_recommends;
+    deps[2] = self->_upgrades;
+    deps[3] = self->_conflicts;
+    depnames[0] = self->_reqmatchnames;
+    depnames[1] = self->_recmatchnames;
+    depnames[2] = self->_upgmatchnames;
+    depnames[3] = self->_cnfmatchnames;
+    offsets[0] = offsetof(ProvidesObject, requiredby);
+    offsets[1] = offsetof(ProvidesObject, recommendedby);
+    offsets[2] = offsetof(ProvidesObject, upgradedby);
+    offsets[3] = offsetof(ProvidesObject, conflictedby);
+
+    for (i = 0; i != 4; i++) {
+        PyObject *lst = PyList_GET_ITEM(links, i);
+        if (matchIndexBuild(depnames[i], deps[i]) == -1)
+            return -1;
+        if (!PyList_Check(lst)) {
+            PyErr_SetString(StateVersionError, "");
+            return -1;
+        }
+        /*
+           for dep, providedby in links:
+               for prv in providedby:
+                   _linkRelations(dep, prv, attr)
+        */
+        len = PyList_GET_SIZE(lst);
+        for (j = 0; j != len; j++) {
+            PyObject *dep, *providedby;
+            if (!PyArg_ParseTuple(PyList_GET_ITEM(lst, j), "O!O!",
+                                  &Depends_Type, &dep,
+                                  &PyList_Type, &providedby))
+                return -1;
+            for (k = 0; k != PyList_GET_SIZE(providedby); k++) {
+                PyObject *prv = PyList_GET_ITEM(providedby, k);
+                linkRelations((DependsObject *)dep, (ProvidesObject *)prv,
+                              (PyObject **)((char *)prv+offsets[i]));
+            }
+        }
+    }
+
+    /*
+       for loader in state["_linked"]:
+           self._linked[loader] = True
+       self._filereqs = state["_filereqs"]
+       self._fileprvs = state["_fileprvs"]
+    */
+    len = PyList_GET_SIZE(linked);
+    for (i = 0; i != len; i++)
+        PyDict_SetItem(self->_linked, PyList_GET_ITEM(linked, i), Py_True);
+    Py_INCREF(filereqs);
+    Py_DECREF(self->_filereqs);
+    self->_filereqs = filereqs;
+    Py_INCREF(fileprvs);
+    Py_DECREF(self->_fileprvs);
+    self->_fileprvs = fileprvs;
+    return 0;
+}
+
 static PyObject *
 Cache__setstate__(CacheObject *self, PyObject *state)
 {
@@ -4107,7 +5666,45 @@ Cache__setstate__(CacheObject *self, PyObject *state)
 
     /* self._objmap = {} */
     self->_objmap = PyDict_New();
-    
+
+    self->_pkgnames = PyDict_New();
+    self->_prvnames = PyDict_New();
+    self->_reqnames = PyDict_New();
+    self->_recnames = PyDict_New();
+    self->_upgnames = PyDict_New();
+    self->_cnfnames = PyDict_New();
+
+    /*
+       self._reqmatchnames = {}
+       self._recmatchnames = {}
+       self._upgmatchnames = {}
+       self._cnfmatchnames = {}
+       self._linked = {}
+       self._removed = {}
+       self._filereqs = {}
+       self._fileprvs = {}
+    */
+    self->_reqmatchnames = PyDict_New();
+    self->_recmatchnames = PyDict_New();
+    self->_upgmatchnames = PyDict_New();
+    self->_cnfmatchnames = PyDict_New();
+    self->_linked = PyDict_New();
+    self->_removed = PyDict_New();
+    self->_filereqs = PyDict_New();
+    self->_fileprvs = PyDict_New();
+
+    /* self._buildNameIndexes() */
+    if (Cache__buildNameIndexes(self) == -1)
+        return NULL;
+
+    /*
+       if "_links" in state:
+           self._restoreLinks(state)
+    */
+    if (PyDict_GetItemString(state, "_links") &&
+        Cache__restoreLinks(self, state) == -1)
+        return NULL;
+
     Py_INCREF(Py_None);
     return Py_None;
 }
@@ -4143,6 +5740,20 @@ static PyMemberDef Cache_members[] = {
     {"_upgrades", T_OBJECT, OFF(_upgrades), RO, 0},
     {"_conflicts", T_OBJECT, OFF(_conflicts), RO, 0},
     {"_objmap", T_OBJECT, OFF(_objmap), RO, 0},
+    {"_pkgnames", T_OBJECT, OFF(_pkgnames), RO, 0},
+    {"_prvnames", T_OBJECT, OFF(_prvnames), RO, 0},
+    {"_reqnames", T_OBJECT, OFF(_reqnames), RO, 0},
+    {"_recnames", T_OBJECT, OFF(_recnames), RO, 0},
+    {"_upgnames", T_OBJECT, OFF(_upgnames), RO, 0},
+    {"_cnfnames", T_OBJECT, OFF(_cnfnames), RO, 0},
+    {"_reqmatchnames", T_OBJECT, OFF(_reqmatchnames), RO, 0},
+    {"_recmatchnames", T_OBJECT, OFF(_recmatchnames), RO, 0},
+    {"_upgmatchnames", T_OBJECT, OFF(_upgmatchnames), RO, 0},
+    {"_cnfmatchnames", T_OBJECT, OFF(_cnfmatchnames), RO, 0},
+    {"_linked", T_OBJECT, OFF(_linked), RO, 0},
+    {"_removed", T_OBJECT, OFF(_removed), RO, 0},
+    {"_filereqs", T_OBJECT, OFF(_filereqs), RO, 0},
+    {"_fileprvs", T_OBJECT, OFF(_fileprvs), RO, 0},
     {NULL}
 };
 #undef OFF
@@ -4192,7 +5803,285 @@ statichere PyTypeObject Cache_Type = {
 };
 
 
+/* Must be kept in sync with the binary cache format in cache.py. */
+#define CACHEMAGIC "SMARTBC\0"
+#define CACHEVERSION 1
+#define CACHEHEADERSIZE 40
+
+#define REL_PROVIDES 0
+#define REL_DEPENDS 1
+#define REL_EXTRA 2
+
+#define PKG_INSTALLED 1
+#define PKG_ESSENTIAL 2
+#define PKG_LISTPROVIDES 4
+#define PKG_LISTREQUIRES 8
+#define PKG_LISTRECOMMENDS 16
+#define PKG_LISTUPGRADES 32
+#define PKG_LISTCONFLICTS 64
+
+#define GETUINT32(p) \
+    ((unsigned long)(p)[0] | ((unsigned long)(p)[1] << 8) | \
+     ((unsigned long)(p)[2] << 16) | ((unsigned long)(p)[3] << 24))
+
+typedef struct {
+    const unsigned char *offsets;
+    const char *data;
+    unsigned long count;
+    unsigned long size;
+    PyObject **objects;
+} StringTable;
+
+/* Strings are only built when first used, and shared afterwards. */
+static PyObject *
+StringTable_get(StringTable *table, unsigned long i)
+{
+    unsigned long start, end;
+    if (i == 0)
+        return Py_None;
+    if (i >= table->count) {
+        PyErr_SetString(PyExc_ValueError, "Invalid string index");
+        return NULL;
+    }
+    if (!table->objects[i]) {
+        start = GETUINT32(table->offsets+i*4);
+        end = GETUINT32(table->offsets+(i+1)*4);
+        if (start > end || end > table->size) {
+            PyErr_SetString(PyExc_ValueError, "Invalid string offset");
+            return NULL;
+        }
+        table->objects[i] = PyString_FromStringAndSize(table->data+start,
+                                                       end-start);
+        if (!table->objects[i])
+            return NULL;
+        PyString_InternInPlace(&table->objects[i]);
+    }
+    return table->objects[i];
+}
+
+static PyObject *
+unpackRelations(const unsigned char *refs, unsigned long count,
+                PyObject *relations, int aslist)
+{
+    PyObject *lst;
+    unsigned long i, nrelations = PyList_GET_SIZE(relations);
+    if (aslist)
+        lst = PyList_New(count);
+    else
+        lst = PyTuple_New(count);
+    if (!lst) return NULL;
+    for (i = 0; i != count; i++) {
+        unsigned long ref = GETUINT32(refs+i*4);
+        PyObject *rel;
+        if (ref >= nrelations) {
+            Py_DECREF(lst);
+            PyErr_SetString(PyExc_ValueError, "Invalid relation index");
+            return NULL;
+        }
+        rel = PyList_GET_ITEM(relations, ref);
+        Py_INCREF(rel);
+        if (aslist)
+            PyList_SET_ITEM(lst, i, rel);
+        else
+            PyTuple_SET_ITEM(lst, i, rel);
+    }
+    return lst;
+}
+
+static PyObject *
+ccache_unpackObjects(PyObject *self, PyObject *args)
+{
+    PyObject *buffer, *classes, *extras;
+    PyObject *packages = NULL, *relations = NULL, *ret = NULL;
+    const unsigned char *buf, *relbuf, *pkgbuf, *refbuf;
+    Py_ssize_t buflen;
+    unsigned long nrelations, npackages, nrefs, i;
+    size_t offset;
+    StringTable strings;
+
+    if (!PyArg_ParseTuple(args, "OO!O!", &buffer, &PyList_Type, &classes,
+                          &PyList_Type, &extras))
+        return NULL;
+    if (PyObject_AsReadBuffer(buffer, (const void **)&buf, &buflen) == -1)
+        return NULL;
+
+    if (buflen < CACHEHEADERSIZE || memcmp(buf, CACHEMAGIC, 8) != 0) {
+        PyErr_SetString(PyExc_ValueError, "Invalid cache file");
+        return NULL;
+    }
+    if (GETUINT32(buf+8) != CACHEVERSION) {
+        PyErr_SetString(StateVersionError, "");
+        return NULL;
+    }
+    strings.count = GETUINT32(buf+12);
+    strings.size = GETUINT32(buf+16);
+    nrelations = GETUINT32(buf+20);
+    npackages = GETUINT32(buf+24);
+    nrefs = GETUINT32(buf+28);
+
+    offset = CACHEHEADERSIZE;
+    strings.offsets = buf+offset;
+    offset += ((size_t)strings.count+1)*4;
+    strings.data = (const char *)buf+offset;
+    offset += ((size_t)strings.size+3)&~(size_t)3;
+    relbuf = buf+offset;
+    offset += (size_t)nrelations*5*4;
+    pkgbuf = buf+offset;
+    offset += (size_t)npackages*11*4;
+    refbuf = buf+offset;
+    offset += (size_t)nrefs*4;
+    if (offset > (size_t)buflen) {
+        PyErr_SetString(PyExc_ValueError, "Truncated cache file");
+        return NULL;
+    }
+
+    strings.objects = (PyObject **)calloc(strings.count+1,
+                                          sizeof(PyObject *));
+    if (!strings.objects)
+        return PyErr_NoMemory();
+
+    relations = PyList_New(nrelations);
+    if (!relations) goto error;
+    for (i = 0; i != nrelations; i++) {
+        const unsigned char *rec = relbuf+i*5*4;
+        unsigned long kind = GETUINT32(rec);
+        unsigned long cls = GETUINT32(rec+4);
+        PyObject *rel, *arg1, *arg2, *arg3;
+        if (kind == REL_EXTRA) {
+            unsigned long extra = GETUINT32(rec+8);
+            if (extra >= PyList_GET_SIZE(extras)) {
+                PyErr_SetString(PyExc_ValueError, "Invalid extra index");
+                goto error;
+            }
+            rel = PyList_GET_ITEM(extras, extra);
+            Py_INCREF(rel);
+        } else {
+            if (cls >= PyList_GET_SIZE(classes) ||
+                (kind != REL_PROVIDES && kind != REL_DEPENDS)) {
+                PyErr_SetString(PyExc_ValueError, "Invalid relation");
+                goto error;
+            }
+            arg1 = StringTable_get(&strings, GETUINT32(rec+8));
+            arg2 = StringTable_get(&strings, GETUINT32(rec+12));
+            arg3 = StringTable_get(&strings, GETUINT32(rec+16));
+            if (!arg1 || !arg2 || !arg3) goto error;
+            if (kind == REL_PROVIDES)
+                rel = PyObject_CallFunctionObjArgs(
+                        PyList_GET_ITEM(classes, cls), arg1, arg3, NULL);
+            else
+                rel = PyObject_CallFunctionObjArgs(
+                        PyList_GET_ITEM(classes, cls), arg1, arg2, arg3,
+                        NULL);
+            if (!rel) goto error;
+        }
+        PyList_SET_ITEM(relations, i, rel);
+    }
+
+    packages = PyList_New(npackages);
+    if (!packages) goto error;
+    for (i = 0; i != npackages; i++) {
+        const unsigned char *rec = pkgbuf+i*11*4;
+        unsigned long cls = GETUINT32(rec);
+        unsigned long flags = GETUINT32(rec+12);
+        long priority = (long)(int)GETUINT32(rec+16);
+        unsigned long refstart = GETUINT32(rec+20);
+        static const int listflags[] = {PKG_LISTPROVIDES, PKG_LISTREQUIRES,
+                                        PKG_LISTRECOMMENDS, PKG_LISTUPGRADES,
+                                        PKG_LISTCONFLICTS};
+        PyObject **fields[5];
+        PyObject *pkg, *name, *version;
+        PackageObject *pkgobj;
+        int j;
+        if (cls >= PyList_GET_SIZE(classes)) {
+            PyErr_SetString(PyExc_ValueError, "Invalid package class");
+            goto error;
+        }
+        name = StringTable_get(&strings, GETUINT32(rec+4));
+        version = StringTable_get(&strings, GETUINT32(rec+8));
+        if (!name || !version) goto error;
+        pkg = PyObject_CallFunctionObjArgs(PyList_GET_ITEM(classes, cls),
+                                           name, version, NULL);
+        if (!pkg) goto error;
+        PyList_SET_ITEM(packages, i, pkg);
+        if (!PyObject_IsInstance(pkg, (PyObject *)&Package_Type)) {
+            PyErr_SetString(PyExc_TypeError,
+                            "Package is not a Package instance");
+            goto error;
+        }
+        pkgobj = (PackageObject *)pkg;
+
+        Py_DECREF(pkgobj->installed);
+        pkgobj->installed = (flags & PKG_INSTALLED) ? Py_True : Py_False;
+        Py_INCREF(pkgobj->installed);
+        Py_DECREF(pkgobj->essential);
+        pkgobj->essential = (flags & PKG_ESSENTIAL) ? Py_True : Py_False;
+        Py_INCREF(pkgobj->essential);
+        Py_DECREF(pkgobj->priority);
+        pkgobj->priority = PyInt_FromLong(priority);
+
+        fields[0] = &pkgobj->provides;
+        fields[1] = &pkgobj->requires;
+        fields[2] = &pkgobj->recommends;
+        fields[3] = &pkgobj->upgrades;
+        fields[4] = &pkgobj->conflicts;
+        for (j = 0; j != 5; j++) {
+            unsigned long count = GETUINT32(rec+24+j*4);
+            PyObject *lst;
+            if (refstart > nrefs || count > nrefs-refstart) {
+                PyErr_SetString(PyExc_ValueError, "Invalid package refs");
+                goto error;
+            }
+            lst = unpackRelations(refbuf+refstart*4, count, relations,
+                                  flags & listflags[j]);
+            if (!lst) goto error;
+            Py_DECREF(*fields[j]);
+            *fields[j] = lst;
+            refstart += count;
+        }
+    }
+
+    ret = PyTuple_Pack(2, packages, relations);
+
+error:
+    for (i = 0; i != strings.count; i++)
+        Py_XDECREF(strings.objects[i]);
+    free(strings.objects);
+    Py_XDECREF(packages);
+    Py_XDECREF(relations);
+    return ret;
+}
+
+static PyObject *
+ccache_registerMatcher(PyObject *self, PyObject *args)
+{
+    PyObject *depclass, *prvclasses, *matcher, *entry;
+    if (!PyArg_ParseTuple(args, "O!O!O", &PyType_Type, &depclass,
+                          &PyTuple_Type, &prvclasses, &matcher))
+        return NULL;
+    if (!PyCObject_Check(matcher)) {
+        PyErr_SetString(PyExc_TypeError, "matcher must be a CObject");
+        return NULL;
+    }
+    if (!matchers) {
+        matchers = PyDict_New();
+        if (!matchers) return NULL;
+    }
+    entry = PyTuple_Pack(2, prvclasses, matcher);
+    if (!entry) return NULL;
+    if (PyDict_SetItem(matchers, depclass, entry) == -1) {
+        Py_DECREF(entry);
+        return NULL;
+    }
+    Py_DECREF(entry);
+    if (typeinfos)
+        PyDict_Clear(typeinfos);
+    Py_RETURN_NONE;
+}
+
 static PyMethodDef ccache_methods[] = {
+    {"unpackObjects", (PyCFunction)ccache_unpackObjects, METH_VARARGS, NULL},
+    {"registerMatcher", (PyCFunction)ccache_registerMatcher,
+     METH_VARARGS, NULL},
     {NULL, NULL}
 };
 
@@ -76,6 +76,15 @@ class Channel(object):
         """
         return True
 
+    def fetchStages(self, fetcher, progress):
+        """
+        Same as fetch(), but instead of running the fetcher, None is
+        yielded, and the caller is expected to run it before going
+        on. This allows the files of several channels to be fetched
+        at once. The last value yielded is the result of fetch().
+        """
+        yield self.fetch(fetcher, progress)
+
     def __str__(self):
         return self._name or self._alias
 
@@ -154,6 +163,15 @@ KINDFIELDS = {"package":
                   "the exact same package is available in more "
                   "than one channel, the highest priority is used."))]}
 
+def runFetchStages(stages, fetcher, progress):
+    # Run the stages of a single channel, for its fetch() method.
+    for result in stages:
+        if result is None:
+            fetcher.run(progress=progress)
+        else:
+            return result
+    return True
+
 def createChannel(alias, data):
     data = parseChannelData(data)
     type = data.get("type", "").replace('-', '_').lower()
@@ -26,7 +26,7 @@ import os
 from smart.backends.deb.loader import DebTagFileLoader
 from smart.util.filetools import getFileDigest
 from smart.backends.deb.base import getArchitecture
-from smart.channel import PackageChannel
+from smart.channel import PackageChannel, runFetchStages
 from smart.const import SUCCEEDED, NEVER
 from smart import *
 
@@ -234,13 +234,17 @@ class APTDEBChannel(PackageChannel):
         return fetcher.enqueue(url, **info)
 
     def fetch(self, fetcher, progress):
+        return runFetchStages(self.fetchStages(fetcher, progress),
+                              fetcher, progress)
+
+    def fetchStages(self, fetcher, progress):
 
         fetcher.reset()
 
         # Fetch release file
         release_item = fetcher.enqueue(self._getURL("Release"))
         release_gpg_item = fetcher.enqueue(self._getURL("Release.gpg"))
-        fetcher.run(progress=progress)
+        yield None
 
         try:
             self._checkRelease(release_item, release_gpg_item)
@@ -250,14 +254,16 @@ class APTDEBChannel(PackageChannel):
             if fetcher.getCaching() is NEVER:
                 raise
             else:
-                return False
+                yield False
+                return
 
         if not release_item.getFailedReason():
             digest = getFileDigest(release_item.getTargetPath())
             if digest == self._digest:
                 progress.add(self.getFetchSteps()-2)
                 progress.show()
-                return True
+                yield True
+                return
             self.removeLoaders()
             checksum = self._parseRelease(release_item)
         else:
@@ -278,7 +284,7 @@ class APTDEBChannel(PackageChannel):
                     iface.warning(_("Component '%s' is not in Release file "
                                     "for channel '%s'") % (component, self))
 
-        fetcher.run(progress=progress)
+        yield None
 
         errorlines = []
         for item in packages_items:
@@ -296,12 +302,13 @@ class APTDEBChannel(PackageChannel):
                 errorlines.insert(0, _("Failed acquiring information for '%s':")
                                      % self)
                 raise Error, "\n".join(errorlines)
-            return False
+            yield False
+            return
 
         if digest:
             self._digest = digest
 
-        return True
+        yield True
 
 
 def create(alias, data):
@@ -19,7 +19,11 @@
 # along with Smart Package Manager; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
-from smart.backends.rpm.metadata import RPMMetaDataLoader
+from smart.backends.rpm.metadata import RPMMetaDataLoader, \
+                                        RPMSqliteMetaDataLoader, \
+                                        getFileListsIndexPath, \
+                                        getTextStorePath, sqlite3, \
+                                        checkUncompressedFile
 from smart.backends.rpm.updateinfo import RPMUpdateInfo
 from smart.util.filetools import getFileDigest
 
@@ -32,7 +36,7 @@ except ImportError:
         from smart.util.elementtree import ElementTree
 
 from smart.const import SUCCEEDED, FAILED, NEVER, ALWAYS
-from smart.channel import PackageChannel, MirrorsChannel
+from smart.channel import PackageChannel, MirrorsChannel, runFetchStages
 from smart import *
 import posixpath
 import commands
@@ -59,6 +63,7 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
     _mirrors = {}
     _mirrorlist = ""
     _fingerprint = None
+    _loaderinfo = None
 
     def __init__(self, baseurl, mirrorlist=None, fingerprint=None, *args):
         super(RPMMetaDataChannel, self).__init__(*args)
@@ -166,14 +171,37 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
         item = FetchItem(fetcher, url, mirror)
         return fetcher.getLocalPath(item)
 
+    def enqueueUpdateInfo(self, fetcher, info):
+        return fetcher.enqueue(info["updateinfo"]["url"],
+                               md5=info["updateinfo"].get("md5"),
+                               uncomp_md5=info["updateinfo"].get("uncomp_md5"),
+                               sha=info["updateinfo"].get("sha"),
+                               uncomp_sha=info["updateinfo"].get("uncomp_sha"),
+                               uncomp=True)
+
+    def loadUpdateInfo(self, uiitem):
+        if uiitem.getStatus() == SUCCEEDED:
+            localpath = uiitem.getTargetPath()
+            errata = RPMUpdateInfo(localpath)
+            errata.load()
+            errata.setErrataFlags()
+        else:
+            iface.warning(_("Failed to download. You must fetch channel "
+                "information to acquire needed update information.\n"
+                "%s: %s") % (uiitem.getURL(), uiitem.getFailedReason()))
+
     def fetch(self, fetcher, progress):
+        return runFetchStages(self.fetchStages(fetcher, progress),
+                              fetcher, progress)
+
+    def fetchStages(self, fetcher, progress):
         
         fetcher.reset()
 
         if self._mirrorlist:
             mirrorlist = self._mirrorlist
             item = fetcher.enqueue(mirrorlist)
-            fetcher.run(progress=progress)
+            yield None
 
             if item.getStatus() is FAILED:
                 progress.add(self.getFetchSteps()-1)
@@ -200,7 +228,7 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
         item = fetcher.enqueue(repomd)
         if self._fingerprint:
             gpgitem = fetcher.enqueue(reposig)
-        fetcher.run(progress=progress)
+        yield None
 
         if item.getStatus() is FAILED:
             progress.add(self.getFetchSteps()-1)
@@ -208,7 +236,8 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
                 lines = [_("Failed acquiring release file for '%s':") % self,
                          u"%s: %s" % (item.getURL(), item.getFailedReason())]
                 raise Error, "\n".join(lines)
-            return False
+            yield False
+            return
 
         if self._fingerprint:
             if gpgitem.getStatus() is FAILED:
@@ -242,8 +271,8 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
         digest = getFileDigest(item.getTargetPath())
         if digest == self._digest:
             progress.add(1)
-            return True
-        self.removeLoaders()
+            yield True
+            return
 
         info = self.loadMetadata(item.getTargetPath())
 
@@ -251,14 +280,50 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
             raise Error, _("Primary information not found in repository "
                            "metadata for '%s'") % self
 
-        if "primary_lzma" in info:
-            primary = info["primary_lzma"]
-        else:
-            primary = info["primary"]
-        if "filelists_lzma" in info:
-            filelists = info["filelists_lzma"]
+        # The sqlite databases are preferred, since packages and
+        # files may be queried from them without parsing any XML.
+        usesqlite = (sqlite3 and sysconf.get("rpm-md-sqlite", True) and
+                     "primary_db" in info and "filelists_db" in info)
+        if usesqlite:
+            primary = info["primary_db"]
+            filelists = info["filelists_db"]
         else:
-            filelists = info["filelists"]
+            if "primary_lzma" in info:
+                primary = info["primary_lzma"]
+            else:
+                primary = info["primary"]
+            if "filelists_lzma" in info:
+                filelists = info["filelists_lzma"]
+            else:
+                filelists = info["filelists"]
+
+        # When only auxiliary data such as updateinfo was regenerated,
+        # the packages already loaded are still good.
+        if (self._loaders and self._loaderinfo and
+            self._loaderinfo[:2] == (primary, filelists) and
+            os.path.isfile(self._loaderinfo[2]) and
+            os.path.isfile(self._loaderinfo[3])):
+            fetcher.reset()
+            if "updateinfo" in info:
+                uiitem = self.enqueueUpdateInfo(fetcher, info)
+                yield None
+                self.loadUpdateInfo(uiitem)
+            else:
+                progress.add(1)
+            self._digest = digest
+            yield True
+            return
+
+        self.removeLoaders()
+
+        # Compressed files which can be read as a stream are parsed
+        # straight from the download, without an uncompressed copy.
+        uncompressor = fetcher.getUncompressor()
+        stream = {}
+        for url in (primary["url"], filelists["url"]):
+            handler = uncompressor.getHandler(url)
+            stream[url] = bool(not usesqlite and
+                               handler and handler.getDecompressor())
 
         fetcher.reset()
         item = fetcher.enqueue(primary["url"],
@@ -268,7 +333,7 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
                                uncomp_sha=primary.get("uncomp_sha"),
                                sha256=primary.get("sha256"),
                                uncomp_sha256=primary.get("uncomp_sha256"),
-                               uncomp=True)
+                               uncomp=not stream[primary["url"]])
         flitem = fetcher.enqueue(filelists["url"],
                                  md5=filelists.get("md5"),
                                  uncomp_md5=filelists.get("uncomp_md5"),
@@ -276,33 +341,45 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
                                  uncomp_sha=filelists.get("uncomp_sha"),
                                  sha256=filelists.get("sha256"),
                                  uncomp_sha256=filelists.get("uncomp_sha256"),
-                                 uncomp=True)
+                                 uncomp=not stream[filelists["url"]])
         if "updateinfo" in info:
-            uiitem = fetcher.enqueue(info["updateinfo"]["url"],
-                                   md5=info["updateinfo"].get("md5"),
-                                   uncomp_md5=info["updateinfo"].get("uncomp_md5"),
-                                   sha=info["updateinfo"].get("sha"),
-                                   uncomp_sha=info["updateinfo"].get("uncomp_sha"),
-                                   uncomp=True)
-        fetcher.run(progress=progress)
+            uiitem = self.enqueueUpdateInfo(fetcher, info)
+        yield None
  
         if item.getStatus() == SUCCEEDED and flitem.getStatus() == SUCCEEDED:
             localpath = item.getTargetPath()
             filelistspath = flitem.getTargetPath()
-            loader = RPMMetaDataLoader(localpath, filelistspath,
-                                       self._baseurl)
+            if usesqlite:
+                loader = RPMSqliteMetaDataLoader(localpath, filelistspath,
+                                                 self._baseurl)
+            else:
+                for type in ("sha256", "sha", "sha1", "md5"):
+                    fldigest = (filelists.get("uncomp_"+type) or
+                                filelists.get(type))
+                    if fldigest:
+                        break
+                # Files read as a stream were only checked compressed,
+                # so the data is checked before any package is built.
+                for data, path in ((primary, localpath),
+                                   (filelists, filelistspath)):
+                    if stream[data["url"]]:
+                        checkUncompressedFile(path,
+                            {"md5": data.get("uncomp_md5"),
+                             "sha": data.get("uncomp_sha"),
+                             "sha256": data.get("uncomp_sha256")})
+                loader = RPMMetaDataLoader(localpath, filelistspath,
+                                           self._baseurl, fldigest)
+                # Local channels are read in place, but these files
+                # are ours.
+                path = self.getLocalPath(fetcher, primary["url"])
+                loader.setTextStorePath(getTextStorePath(path))
+                path = self.getLocalPath(fetcher, filelists["url"])
+                loader.setFileListsIndexPath(getFileListsIndexPath(path))
             loader.setChannel(self)
             self._loaders.append(loader)
+            self._loaderinfo = (primary, filelists, localpath, filelistspath)
             if "updateinfo" in info:
-                if uiitem.getStatus() == SUCCEEDED:
-                    localpath = uiitem.getTargetPath()
-                    errata = RPMUpdateInfo(localpath)
-                    errata.load()
-                    errata.setErrataFlags()
-                else:
-                    iface.warning(_("Failed to download. You must fetch channel "
-                        "information to acquire needed update information.\n"
-                        "%s: %s") % (uiitem.getURL(), uiitem.getFailedReason()))
+                self.loadUpdateInfo(uiitem)
         elif (item.getStatus() == SUCCEEDED and
               flitem.getStatus() == FAILED and
               fetcher.getCaching() is ALWAYS):
@@ -310,7 +387,8 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
                             "information to acquire needed filelists.\n"
                             "%s: %s") % (flitem.getURL(),
                             flitem.getFailedReason()))
-            return False
+            yield False
+            return
         elif fetcher.getCaching() is NEVER:
             if item.getStatus() == FAILED:
                 faileditem = item
@@ -321,27 +399,39 @@ class RPMMetaDataChannel(PackageChannel, MirrorsChannel):
                        faileditem.getFailedReason())]
             raise Error, "\n".join(lines)
         else:
-            return False
+            yield False
+            return
 
-        uncompressor = fetcher.getUncompressor()
+        # delete uncompressed copies left behind by older versions
+        for url in (primary["url"], filelists["url"]):
+            if stream[url]:
+                path = self.getLocalPath(fetcher, url)
+                handler = uncompressor.getHandler(path)
+                path = handler.getTargetPath(path)
+                if os.path.exists(path):
+                    os.unlink(path)
+                path = getFileListsIndexPath(path)
+                if os.path.exists(path):
+                    os.unlink(path)
 
         # delete any old files, if the new ones have new names
         for type in ["primary", "filelists", "other", 
-                     "primary_lzma", "filelists_lzma", "other_lzma"]:
+                     "primary_lzma", "filelists_lzma", "other_lzma",
+                     "primary_db", "filelists_db"]:
             if type in oldinfo:
                 url = oldinfo[type]["url"]
-                if url and info[type]["url"] != oldinfo[type]["url"]:
+                if url and info.get(type, {}).get("url") != url:
                     path = self.getLocalPath(fetcher, url)
-                    if os.path.exists(path):
-                       os.unlink(path)
                     handler = uncompressor.getHandler(path)
-                    path = handler.getTargetPath(path)
-                    if os.path.exists(path):
-                       os.unlink(path)
+                    for base in (path, handler.getTargetPath(path)):
+                        for path in (base, getFileListsIndexPath(base),
+                                     getTextStorePath(base)):
+                            if os.path.exists(path):
+                               os.unlink(path)
 
         self._digest = digest
 
-        return True
+        yield True
 
 def create(alias, data):
     return RPMMetaDataChannel(data["baseurl"],
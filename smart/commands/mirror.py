@@ -21,6 +21,7 @@
 #
 from smart.option import OptionParser, append_all
 from smart.util.filetools import getFileDigest
+from smart.util.strtools import speedToStr
 from smart.channel import *
 from smart import *
 import textwrap
@@ -202,12 +203,10 @@ def main(ctrl, opts):
                 sysconf.add(("mirrors", origin), mirror, unique=True)
 
     if opts.clear_history is not None:
-        if opts.clear_history:
-            history = sysconf.get("mirrors-history", [])
-            history[:] = [x for x in history if x[0] not in opts.clear_history]
-            sysconf.set("mirrors-history", history)
-        else:
-            history = sysconf.remove("mirrors-history")
+        # Saved with the rest of the configuration.
+        ctrl.reloadMirrors()
+        mirrorsystem = ctrl.getFetcher().getMirrorSystem()
+        mirrorsystem.clearStats(opts.clear_history or None)
 
     if opts.show:
         mirrors = sysconf.get("mirrors", ())
@@ -275,10 +274,21 @@ def main(ctrl, opts):
                 penalities[origin] = 0
             for mirror in mirrors[origin]:
                 if mirror not in penalities:
-                    penalities[origin] = 0
+                    penalities[mirror] = 0
         penalities = [(y, x) for x, y in penalities.items()]
         penalities.sort()
         for penality, url in penalities:
-            print "%s %d" % (url, penality)
+            latency, throughput, failures, last = \
+                mirrorsystem.getEstimates(url)
+            if latency is None:
+                latency = "-"
+            else:
+                latency = "%.2fs" % latency
+            if throughput is None:
+                throughput = "-"
+            else:
+                throughput = speedToStr(throughput)
+            print "%s %.2f (latency: %s, throughput: %s, failures: %d%%)" % \
+                  (url, penality, latency, throughput, failures*100)
 
 # vim:ts=4:sw=4:et
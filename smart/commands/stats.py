@@ -22,6 +22,8 @@
 from smart.util.strtools import sizeToStr
 from smart.option import OptionParser
 from smart import *
+import sys
+import os
 import re
 
 USAGE=_("smart stats")
@@ -46,6 +48,45 @@ def parse_options(argv):
     opts.args = args
     return opts
 
+RELATIONLISTS = ["packages", "provides", "requires", "recommends",
+                 "upgrades", "conflicts", "requiredby", "recommendedby",
+                 "upgradedby", "conflictedby", "providedby"]
+
+def getCacheMemory(cache):
+    # Estimate how much memory the cache objects use. Strings and lists
+    # shared between objects are only counted once.
+    objects = lists = strings = distinct = references = 0
+    seen = {}
+    for objs in (cache.getPackages(), cache.getProvides(),
+                 cache.getRequires(), cache.getRecommends(),
+                 cache.getUpgrades(), cache.getConflicts()):
+        for obj in objs:
+            objects += sys.getsizeof(obj)
+            for attr in ("name", "version", "relation"):
+                value = getattr(obj, attr, None)
+                if type(value) is str:
+                    references += 1
+                    if id(value) not in seen:
+                        seen[id(value)] = True
+                        strings += sys.getsizeof(value)
+                        distinct += 1
+            for attr in RELATIONLISTS:
+                value = getattr(obj, attr, None)
+                if value is not None and id(value) not in seen:
+                    seen[id(value)] = True
+                    lists += sys.getsizeof(value)
+    return objects, lists, strings, distinct, references
+
+def getResidentMemory():
+    try:
+        file = open("/proc/%d/status" % os.getpid())
+    except IOError:
+        return None
+    for line in file:
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1])*1024
+    return None
+
 def main(ctrl, opts, reloadchannels=True):
 
     if reloadchannels:
@@ -61,4 +102,14 @@ def main(ctrl, opts, reloadchannels=True):
     print _("Total Upgrades:"), len(cache.getUpgrades())
     print _("Total Conflicts:"), len(cache.getConflicts())
 
+    if hasattr(sys, "getsizeof"):
+        (objects, lists, strings,
+         distinct, references) = getCacheMemory(cache)
+        print _("Cache Memory:"), sizeToStr(objects+lists+strings)
+        print _("  Objects:"), sizeToStr(objects)
+        print _("  Relation Lists:"), sizeToStr(lists)
+        print _("  Strings:"), sizeToStr(strings)
+        print _("  Distinct Strings:"), "%d/%d" % (distinct, references)
+    print _("Resident Memory:"), sizeToStr(getResidentMemory())
+
 # vim:ts=4:sw=4:et
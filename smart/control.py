@@ -25,8 +25,10 @@ import copy
 import time
 import tempfile
 import tarfile
+import threading
 
 from smart.transaction import ChangeSet, ChangeSetSplitter, INSTALL, REMOVE
+from smart.sorter import ChangeSetSorter
 from smart.util.filetools import compareFiles, setCloseOnExecAll
 from smart.util.objdigest import getObjectDigest
 from smart.util.pathlocks import PathLocks
@@ -36,6 +38,7 @@ from smart.searcher import Searcher
 from smart.media import MediaSet
 from smart.progress import Progress
 from smart.fetcher import Fetcher
+from smart.pkgstore import PackageStore
 from smart.report import Report
 from smart.channel import *
 from smart.cache import *
@@ -64,6 +67,10 @@ class Control(object):
         self._achanset = AvailableChannelSet(self._fetcher)
         self._cachechanged = False
 
+        if sysconf.get("digest-cache", True):
+            digestspath = os.path.join(sysconf.get("data-dir"), "digests")
+            self._fetcher.getDigestCache().load(digestspath)
+
     def getChannels(self):
         return self._channels.values()
 
@@ -188,8 +195,10 @@ class Control(object):
 
     def saveSysConf(self, confpath=None):
         msys = self._fetcher.getMirrorSystem()
-        if msys.getHistoryChanged() and not sysconf.getReadOnly():
-            sysconf.set("mirrors-history", msys.getHistory())
+        if msys.getStatsChanged() and not sysconf.getReadOnly():
+            sysconf.set("mirrors-stats", msys.getStats())
+            if sysconf.has("mirrors-history"):
+                sysconf.remove("mirrors-history")
         if confpath:
             confpath = os.path.expanduser(confpath)
         else:
@@ -205,13 +214,21 @@ class Control(object):
                              self._cache,
                              self._channels,
                              self._sysconfchannels)
-                    cPickle.dump(state, cachefile, 2)
+                    if sysconf.get("disk-cache-format") == "pickle":
+                        cPickle.dump(state, cachefile, 2)
+                    else:
+                        dumpCache(cachefile, self._cache.getPackages(), state)
                     cachefile.close()
                     os.rename(cachepath+".new", cachepath)
                     iface.hideStatus()
                 elif os.path.isfile(cachepath):
                     os.unlink(cachepath)
 
+            digestcache = self._fetcher.getDigestCache()
+            if digestcache.getChanged() and sysconf.get("digest-cache", True):
+                digestspath = os.path.join(sysconf.get("data-dir"), "digests")
+                digestcache.save(digestspath)
+
             if not sysconf.getModified():
                 return
 
@@ -232,8 +249,12 @@ class Control(object):
                         mirrors[origin] = set.keys()
         msys = self._fetcher.getMirrorSystem()
         msys.setMirrors(mirrors)
-        if not msys.getHistory():
-            msys.setHistory(sysconf.get("mirrors-history", []))
+        if not msys.getStats():
+            stats = sysconf.get("mirrors-stats")
+            if stats:
+                msys.setStats(stats)
+            else:
+                msys.importHistory(sysconf.get("mirrors-history", []))
 
     def rebuildSysConfChannels(self):
 
@@ -254,7 +275,12 @@ class Control(object):
                 iface.showStatus(_("Loading cache..."))
                 cachefile = open(cachepath)
                 try:
-                    state = cPickle.load(cachefile)
+                    magic = cachefile.read(len(CACHEMAGIC))
+                    cachefile.seek(0)
+                    if magic == CACHEMAGIC:
+                        state = loadCache(cachefile)
+                    else:
+                        state = cPickle.load(cachefile)
                     if state[0] != self.__stateversion__:
                         raise StateVersionError
                 except:
@@ -368,31 +394,70 @@ class Control(object):
 
         self._fetcher.setForceMountedCopy(True)
 
-        self._cache.reset()
-
-        # Do the real work.
+        # Do the real work. Channels are fetched in stages, and the
+        # files needed by every channel in a given stage are fetched
+        # at once, so that downloads from all of them run together.
+        # The main fetcher runs them, so it must not have anything
+        # left from earlier operations.
+        self._fetcher.reset()
         result = True
+        digests = {}
+        tasks = []
         for channel in channels:
-            digest = channel.getDigest()
+            digests[channel] = channel.getDigest()
+            fetcher = self._fetcher.getSubFetcher()
             if not manual and channel.hasManualUpdate():
-                self._fetcher.setCaching(ALWAYS)
+                fetcher.setCaching(ALWAYS)
+                showtopic = False
             else:
-                self._fetcher.setCaching(caching)
-                if channel.getFetchSteps() > 0:
+                fetcher.setCaching(caching)
+                showtopic = channel.getFetchSteps() > 0
+            fetcher.setForceCopy(channel.isRemovable())
+            fetcher.setSaveValidators(True)
+            fetcher.setLocalPathPrefix(channel.getAlias()+"%%")
+            stages = channel.fetchStages(fetcher, progress)
+            tasks.append((channel, fetcher, stages, showtopic))
+        while tasks:
+            waiting = []
+            for task in tasks:
+                channel, fetcher, stages, showtopic = task
+                if showtopic:
                     progress.setTopic(_("Fetching information for '%s'...") %
                                   (channel.getName() or channel.getAlias()))
                     progress.show()
-            self._fetcher.setForceCopy(channel.isRemovable())
-            self._fetcher.setLocalPathPrefix(channel.getAlias()+"%%")
-            try:
-                if not channel.fetch(self._fetcher, progress):
+                try:
+                    status = stages.next()
+                except StopIteration:
+                    status = True
+                except Error, e:
+                    iface.error(unicode(e))
                     iface.debug(_("Failed fetching channel '%s'") % channel)
                     result = False
-            except Error, e:
-                iface.error(unicode(e))
-                iface.debug(_("Failed fetching channel '%s'") % channel)
-                result = False
-            if (channel.getDigest() != digest and
+                else:
+                    if status is None:
+                        waiting.append(task)
+                    elif not status:
+                        iface.debug(_("Failed fetching channel '%s'") %
+                                    channel)
+                        result = False
+            if len(waiting) > 1:
+                progress.setTopic(_("Fetching information for %d "
+                                    "channels...") % len(waiting))
+                progress.show()
+            if waiting:
+                try:
+                    self._fetcher.run(progress=progress,
+                                      fetchers=[x[1] for x in waiting])
+                except Error, e:
+                    iface.error(unicode(e))
+                    for task in waiting:
+                        iface.debug(_("Failed fetching channel '%s'") %
+                                    task[0])
+                    result = False
+                    waiting = []
+            tasks = waiting
+        for channel in channels:
+            if (channel.getDigest() != digests[channel] and
                 isinstance(channel, PackageChannel)):
                 channel.addLoaders(self._cache)
                 if channel.getAlias() in self._sysconfchannels:
@@ -400,8 +465,6 @@ class Control(object):
         if result and caching is not ALWAYS:
             sysconf.set("last-update", time.time())
         self._fetcher.setForceMountedCopy(False)
-        self._fetcher.setForceCopy(False)
-        self._fetcher.setLocalPathPrefix(None)
 
         # Finish progress.
         progress.setStopped()
@@ -684,6 +747,15 @@ class Control(object):
         if sysconf.get("commit-stepped", False):
             return self.commitChangeSetStepped(changeset, caching, confirm)
 
+        if sysconf.get("commit-pipelined", False):
+            # Removable media may have to be swapped, and only the
+            # code below knows about that.
+            channels = getChannelsWithPackages([x for x in changeset
+                                                if changeset[x] is INSTALL])
+            if not [x for x in channels if x.isRemovable()]:
+                return self.commitChangeSetPipelined(changeset, caching,
+                                                     confirm)
+
         if confirm and not iface.confirmChangeSet(changeset):
             return False
 
@@ -705,7 +777,6 @@ class Control(object):
 
         channels = getChannelsWithPackages([x for x in changeset
                                             if changeset[x] is INSTALL])
-        datadir = sysconf.get("data-dir")
         splitter = ChangeSetSplitter(changeset)
         donecs = ChangeSet(self._cache)
         copypkgpaths = {}
@@ -735,28 +806,7 @@ class Control(object):
                         pkgpaths[pkg] = copypkgpaths[pkg]
                         del copypkgpaths[pkg]
 
-                hooks.call("pre-commit")
-                
-                for pmclass in pmpkgs:
-                    pmcs = ChangeSet(self._cache)
-                    for pkg in pmpkgs[pmclass]:
-                        if pkg in cs:
-                            pmcs[pkg] = cs[pkg]
-                            pmcs.setRequested(pkg, cs.getRequested(pkg))
-                    if sysconf.get("commit", True):
-                        pmcs.markPackagesAutoInstalled()
-                        self.writeCommitLog(pmcs)
-                        pmclass().commit(pmcs, pkgpaths)
-                        self.setPackageOrigins(pmcs, pkgchannels)
-
-                hooks.call("post-commit")
-                
-                if sysconf.get("remove-packages", True):
-                    for pkg in pkgpaths:
-                        for path in pkgpaths[pkg]:
-                            if path.startswith(os.path.join(datadir,
-                                                            "packages")):
-                                os.unlink(path)
+                self._commitPackages(cs, pmpkgs, pkgpaths, pkgchannels)
 
             if donecs == changeset:
                 break
@@ -781,6 +831,155 @@ class Control(object):
 
         return True
 
+    def commitChangeSetPipelined(self, changeset, caching=OPTIONAL,
+                                 confirm=True):
+        if confirm and not iface.confirmChangeSet(changeset):
+            return False
+
+        if not confirm:
+            iface.showChangeSet(changeset)
+
+        if sysconf.get("dry-run"):
+            return True
+
+        setCloseOnExecAll()
+
+        pmpkgs = {}
+        for pkg in changeset:
+            pmpkgs.setdefault(pkg.packagemanager, []).append(pkg)
+
+        # Packages are fetched in the order they'd be installed, and
+        # while they're being fetched, the longest part of that order
+        # which has its files around, along with whatever it needs to
+        # be committed on its own, goes to the package managers.
+        order = [pkg for pkg, op in ChangeSetSorter(changeset).getSorted()]
+        channels = getChannelsWithPackages([x for x in order
+                                            if changeset[x] is INSTALL])
+        self._achanset.setChannels(channels)
+        pkgitems, pkgchannels = \
+            self.enqueuePackages([x for x in order
+                                  if changeset[x] is INSTALL], caching)
+
+        fetcher = self._fetcher
+        fetcher.setProgress(Progress())
+        fetchstate = {"running": True, "error": None}
+        def fetch():
+            try:
+                try:
+                    fetcher.run(what=_("packages"))
+                except Exception, e:
+                    fetchstate["error"] = e
+            finally:
+                fetchstate["running"] = False
+                fetcher.notifyChange()
+        fetchthread = threading.Thread(target=fetch)
+        fetchthread.start()
+
+        def fetched(pkgs, wait=False):
+            # Failed items may still be retried from other mirrors,
+            # so failures are only final once the fetcher is done.
+            waiting = False
+            changes = fetcher.getChangeCount()
+            try:
+                for pkg in pkgs:
+                    for item in pkgitems.get(pkg, ()):
+                        while True:
+                            running = fetchstate["running"]
+                            if item.getStatus() is SUCCEEDED:
+                                break
+                            if not running:
+                                if fetchstate["error"]:
+                                    raise Error, fetchstate["error"]
+                                raise Error, \
+                                      _("Failed to download packages:\n") + \
+                                      u"    %s: %s" % (item.getOriginalURL(),
+                                                      item.getFailedReason())
+                            if not wait:
+                                return False
+                            if not waiting:
+                                iface.showStatus(_("Waiting for packages "
+                                                   "to be downloaded..."))
+                                waiting = True
+                            # With a timeout, so that interrupts are
+                            # still handled while waiting.
+                            changes = fetcher.waitChange(changes, 1)
+            finally:
+                if waiting:
+                    iface.hideStatus()
+            return True
+
+        try:
+            splitter = ChangeSetSplitter(changeset)
+            donecs = ChangeSet(self._cache)
+            pos = 0
+            while pos < len(order):
+                cs = donecs.copy()
+                while pos < len(order):
+                    pkg = order[pos]
+                    if pkg not in cs:
+                        subset = cs.copy()
+                        try:
+                            splitter.include(subset, pkg,
+                                             dict.fromkeys(cs, True))
+                        except Error:
+                            subset = changeset.copy()
+                        if not fetched(subset.difference(cs),
+                                       wait=(len(cs) == len(donecs))):
+                            break
+                        cs = subset
+                    pos += 1
+                cs = changeset.intersect(cs.difference(donecs))
+                donecs.update(cs)
+                pkgpaths = {}
+                csitems = {}
+                for pkg in cs:
+                    if pkg in pkgitems:
+                        pkgpaths[pkg] = [item.getTargetPath()
+                                         for item in pkgitems[pkg]]
+                        csitems[pkg] = pkgitems[pkg]
+                # Files are stored before being committed, since
+                # they may be removed right afterwards.
+                self.storePackages(csitems, cleanup=False)
+                self._commitPackages(cs, pmpkgs, pkgpaths, pkgchannels)
+            store = self.getPackageStore()
+            if store:
+                store.cleanup()
+        finally:
+            if fetchstate["running"]:
+                fetcher.cancel()
+            fetchthread.join()
+            fetcher.setProgress(None)
+
+        self._mediaset.restoreState()
+
+        return True
+
+    def _commitPackages(self, cs, pmpkgs, pkgpaths, pkgchannels):
+        # Hand the changes in cs to their package managers, with the
+        # package files in pkgpaths.
+        hooks.call("pre-commit")
+        
+        for pmclass in pmpkgs:
+            pmcs = ChangeSet(self._cache)
+            for pkg in pmpkgs[pmclass]:
+                if pkg in cs:
+                    pmcs[pkg] = cs[pkg]
+                    pmcs.setRequested(pkg, cs.getRequested(pkg))
+            if sysconf.get("commit", True):
+                pmcs.markPackagesAutoInstalled()
+                self.writeCommitLog(pmcs)
+                pmclass().commit(pmcs, pkgpaths)
+                self.setPackageOrigins(pmcs, pkgchannels)
+
+        hooks.call("post-commit")
+        
+        if sysconf.get("remove-packages", True):
+            packagesdir = os.path.join(sysconf.get("data-dir"), "packages")
+            for pkg in pkgpaths:
+                for path in pkgpaths[pkg]:
+                    if path.startswith(packagesdir):
+                        os.unlink(path)
+
     def commitTransactionStepped(self, trans, caching=OPTIONAL, confirm=True):
         return self.commitChangeSetStepped(trans.getChangeSet(),
                                            caching, confirm)
@@ -816,6 +1015,29 @@ class Control(object):
         return True
 
     def fetchPackages(self, packages, caching=OPTIONAL, targetdir=None, channels=False):
+        fetcher = self._fetcher
+        pkgitems, pkgchannels = self.enqueuePackages(packages, caching,
+                                                     targetdir)
+        if targetdir:
+            fetcher.setForceCopy(True)
+        fetcher.run(what=_("packages"))
+        fetcher.setForceCopy(False)
+        self.storePackages(pkgitems)
+        failed = fetcher.getFailedSet()
+        if failed:
+            raise Error, _("Failed to download packages:\n") + \
+                         "\n".join([u"    %s: %s" % (url, failed[url])
+                                    for url in failed])
+        pkgpaths = {}
+        for pkg in packages:
+            pkgpaths[pkg] = [item.getTargetPath() for item in pkgitems[pkg]]
+        if not channels:
+            return pkgpaths
+        return pkgpaths, pkgchannels
+
+    def enqueuePackages(self, packages, caching=OPTIONAL, targetdir=None):
+        # Prepare the fetcher for fetching the given packages, in the
+        # given order, and return their items and channels.
         fetcher = self._fetcher
         fetcher.reset()
         fetcher.setCaching(caching)
@@ -827,6 +1049,8 @@ class Control(object):
             fetcher.setLocalDir(localdir, mangle=False)
         else:
             fetcher.setLocalDir(targetdir, mangle=False)
+        store = self.getPackageStore()
+        localschemes = Fetcher.getLocalSchemes()
         pkgitems = {}
         pkgchannels = {}
         for pkg in packages:
@@ -844,27 +1068,45 @@ class Control(object):
             pkgitems[pkg] = []
             for url in urls:
                 media = self._achanset.getMedia(channel)
-                pkgitems[pkg].append(fetcher.enqueue(url, media=media,
-                                                     md5=info.getMD5(url),
-                                                     sha=info.getSHA(url),
-                                                     sha256=info.getSHA256(url),
-                                                     size=info.getSize(url),
-                                                     validate=info.validate))
-        if targetdir:
-            fetcher.setForceCopy(True)
-        fetcher.run(what=_("packages"))
-        fetcher.setForceCopy(False)
-        failed = fetcher.getFailedSet()
-        if failed:
-            raise Error, _("Failed to download packages:\n") + \
-                         "\n".join([u"    %s: %s" % (url, failed[url])
-                                    for url in failed])
-        pkgpaths = {}
-        for pkg in packages:
-            pkgpaths[pkg] = [item.getTargetPath() for item in pkgitems[pkg]]
-        if not channels:
-            return pkgpaths
-        return pkgpaths, pkgchannels
+                sha256 = info.getSHA256(url)
+                item = fetcher.enqueue(url, media=media,
+                                       md5=info.getMD5(url),
+                                       sha=info.getSHA(url),
+                                       sha256=sha256,
+                                       size=info.getSize(url),
+                                       validate=info.validate)
+                pkgitems[pkg].append(item)
+                # Files in the store are validated as usual, and
+                # fetched again if they're not good.
+                if (store and sha256 and
+                    item.getURL().scheme not in localschemes):
+                    localpath = fetcher.getLocalPath(item)
+                    if not os.path.exists(localpath):
+                        store.get(sha256, localpath)
+        return pkgitems, pkgchannels
+
+    def getPackageStore(self):
+        path = sysconf.get("package-store")
+        if not path:
+            return None
+        return PackageStore(os.path.expanduser(path),
+                            sysconf.get("package-store-size", 0))
+
+    def storePackages(self, pkgitems, cleanup=True):
+        # Keep the package files just fetched in the package store,
+        # so that other data dirs don't have to fetch them again.
+        store = self.getPackageStore()
+        if not store:
+            return
+        localschemes = Fetcher.getLocalSchemes()
+        for items in pkgitems.values():
+            for item in items:
+                sha256 = item.getInfo("sha256")
+                if (sha256 and item.getStatus() is SUCCEEDED and
+                    item.getURL().scheme not in localschemes):
+                    store.add(sha256, item.getTargetPath())
+        if cleanup:
+            store.cleanup()
 
     def search(self, s, cutoff=1.00, suggestioncutoff=0.70,
                globcutoff=1.00, globsuggestioncutoff=0.95,
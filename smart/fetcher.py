@@ -28,6 +28,7 @@ from smart.const import *
 from smart import *
 import tempfile
 import socket
+import errno
 import urllib
 import string
 import thread
@@ -40,11 +41,143 @@ import threading
 MAXRETRIES = 30
 SPEEDDELAY = 1
 CANCELDELAY = 2
+PARTIALINFO = ("size", "md5", "sha", "sha256")
+VALIDATORS = ("etag", "last-modified")
 MAXACTIVEDOWNLOADS = 10
 SOCKETTIMEOUT = 600
+SEGMENTEDSIZE = 10*1024*1024
 
 class FetcherCancelled(Error): pass
 
+def getProcessorCount():
+    try:
+        count = os.sysconf("SC_NPROCESSORS_ONLN")
+    except (AttributeError, ValueError, OSError):
+        count = 0
+    return max(count, 1)
+
+def getFileDigests(path, kinds):
+    # Compute the hex digests of all the given kinds with a
+    # single read of the file.
+    digests = {}
+    for kind in kinds:
+        if kind == "md5":
+            try:
+                from hashlib import md5
+            except ImportError:
+                from md5 import md5
+            digests[kind] = md5()
+        elif kind == "sha256":
+            try:
+                from hashlib import sha256
+            except ImportError:
+                from smart.util.sha256 import sha256
+            digests[kind] = sha256()
+        elif kind == "sha":
+            try:
+                from hashlib import sha1 as sha
+            except ImportError:
+                from sha import sha
+            digests[kind] = sha()
+    file = open(path)
+    data = file.read(BLOCKSIZE)
+    while data:
+        for digest in digests.values():
+            digest.update(data)
+        data = file.read(BLOCKSIZE)
+    file.close()
+    for kind in digests:
+        digests[kind] = digests[kind].hexdigest()
+    return digests
+
+def getCachedFileDigests(path, kinds, digestcache=None):
+    # Same as getFileDigests(), but digests of files which were already
+    # checked and haven't changed since then are taken from digestcache.
+    if not digestcache:
+        return getFileDigests(path, kinds)
+    digests = digestcache.getDigests(path)
+    missing = [x for x in kinds if x not in digests]
+    if missing:
+        digests.update(getFileDigests(path, missing))
+        digestcache.setDigests(path, digests)
+    return digests
+
+def loadInfoFile(path):
+    # Read the "kind: value" lines saved by saveInfoFile().
+    info = {}
+    try:
+        file = open(path)
+        for line in file:
+            kind, value = line.rstrip("\n").split(": ", 1)
+            info[kind] = value
+        file.close()
+    except (IOError, OSError, ValueError):
+        info = {}
+    return info
+
+def saveInfoFile(path, info):
+    try:
+        file = open(path, "w")
+        for kind in info:
+            file.write("%s: %s\n" % (kind, info[kind]))
+        file.close()
+    except (IOError, OSError):
+        pass
+
+class DigestCache(object):
+
+    def __init__(self):
+        self._digests = {} # path -> (stat, {kind: digest})
+        self._changed = False
+
+    def getChanged(self):
+        return self._changed
+
+    def _getStat(self, path):
+        # The change time can't be set back, so a file rewritten
+        # in place won't keep its entry.
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime, st.st_ctime, st.st_ino)
+
+    def getDigests(self, path):
+        entry = self._digests.get(path)
+        if entry:
+            try:
+                if entry[0] == self._getStat(path):
+                    return entry[1].copy()
+            except OSError:
+                pass
+            self._digests.pop(path, None)
+            self._changed = True
+        return {}
+
+    def setDigests(self, path, digests):
+        self._digests[path] = (self._getStat(path), digests.copy())
+        self._changed = True
+
+    def load(self, path):
+        import cPickle
+        if os.path.isfile(path):
+            try:
+                file = open(path)
+                self._digests = cPickle.load(file)
+                file.close()
+            except:
+                self._digests = {}
+        self._changed = False
+
+    def save(self, path):
+        import cPickle
+        # Forget about files which are gone.
+        for filepath in self._digests.keys():
+            if not os.path.isfile(filepath):
+                del self._digests[filepath]
+        file = open(path+".new", "w")
+        cPickle.dump(self._digests, file, 2)
+        file.close()
+        os.rename(path+".new", path)
+        self._changed = False
+
 class Fetcher(object):
 
     _registry = {}
@@ -62,6 +195,7 @@ class Fetcher(object):
         self._handlers = {}
         self._forcecopy = False
         self._forcemountedcopy = False
+        self._savevalidators = False
         self._localpathprefix = None
         self._cancel = False
         self._speedupdated = 0
@@ -70,10 +204,43 @@ class Fetcher(object):
         self._maxactivedownloads = 0
         self.time = 0
         self._eta = 0
+        self._leader = self
+        self._digestcache = DigestCache()
+        self._changed = {}
+        self._changedcond = threading.Condition()
+        self._changecount = 0
+        self._uncompressqueue = []
+        self._uncompresslock = thread.allocate_lock()
+        self._uncompressworkers = 0
+        self._maxuncompressworkers = 1
+        self._progress = None
 
     def reset(self):
         self._items.clear()
         self._uncompressing = 0
+        # Items which were enqueued but never run are still waiting
+        # in the handlers.
+        for handler in self._handlers.values():
+            del handler.getQueue()[:]
+
+    def getSubFetcher(self):
+        # A new fetcher with the same settings, and sharing mirrors and
+        # medias with this one, but with its own queue. Its items may
+        # be fetched together with the ones of other fetchers, as long
+        # as they're all given to the same run() call.
+        fetcher = Fetcher()
+        fetcher._mediaset = self._mediaset
+        fetcher._mirrorsystem = self._mirrorsystem
+        fetcher._digestcache = self._digestcache
+        fetcher._localdir = self._localdir
+        fetcher._mangle = self._mangle
+        fetcher._caching = self._caching
+        fetcher._forcecopy = self._forcecopy
+        fetcher._forcemountedcopy = self._forcemountedcopy
+        fetcher._savevalidators = self._savevalidators
+        fetcher._localpathprefix = self._localpathprefix
+        fetcher._progress = self._progress
+        return fetcher
 
     def cancel(self):
         self._cancel = True
@@ -107,6 +274,17 @@ class Fetcher(object):
     def getMirrorSystem(self):
         return self._mirrorsystem
 
+    def setProgress(self, progress):
+        # Report to the given progress rather than to the interface's
+        # one, as fetchers running in the background must do.
+        self._progress = progress
+
+    def getSubProgress(self):
+        return self._progress or iface.getSubProgress(self)
+
+    def getDigestCache(self):
+        return self._digestcache
+
     def getCaching(self):
         return self._caching
 
@@ -155,6 +333,12 @@ class Fetcher(object):
     def getForceCopy(self):
         return self._forcecopy
 
+    def setSaveValidators(self, value):
+        self._savevalidators = value
+
+    def getSaveValidators(self):
+        return self._savevalidators
+
     def setForceMountedCopy(self, value):
         self._forcemountedcopy = value
 
@@ -162,22 +346,67 @@ class Fetcher(object):
         return self._forcemountedcopy
 
     def changeActiveDownloads(self, value):
+        # While running with others, the slots of the fetcher
+        # running them are used.
+        leader = self._leader
         result = False
-        self._activedownloadslock.acquire()
-        if self._activedownloads+value <= self._maxactivedownloads:
-            self._activedownloads += value
+        leader._activedownloadslock.acquire()
+        if leader._activedownloads+value <= leader._maxactivedownloads:
+            leader._activedownloads += value
             result = True
-        self._activedownloadslock.release()
+        leader._activedownloadslock.release()
+        if value < 0:
+            # A slot is free for the queued items.
+            self.notifyChange()
         return result
 
     def getActiveDownloads(self):
-        return self._activedownloads
+        return self._leader._activedownloads
+
+    def notifyChange(self, item=None):
+        # Handlers and items call this from any thread to wake up
+        # run() when something changed, instead of having it polling
+        # every item. Items report themselves, so that only those
+        # get checked.
+        leader = self._leader
+        leader._changedcond.acquire()
+        leader._changed[item] = True
+        leader._changecount += 1
+        leader._changedcond.notifyAll()
+        leader._changedcond.release()
+
+    def getChangeCount(self):
+        return self._changecount
+
+    def waitChange(self, count, timeout=None):
+        # Other threads may follow the items of a running fetcher by
+        # checking them after getChangeCount(), and then waiting here
+        # for changes after that count, which is returned updated.
+        self._changedcond.acquire()
+        if self._changecount == count:
+            self._changedcond.wait(timeout)
+        count = self._changecount
+        self._changedcond.release()
+        return count
+
+    def _waitChanges(self, timeout):
+        # Return the items which changed since the last call, waiting
+        # up to timeout seconds for something to happen.
+        self._changedcond.acquire()
+        if not self._changed:
+            self._changedcond.wait(timeout)
+        changed = self._changed
+        self._changed = {}
+        self._changedcond.release()
+        changed.pop(None, None)
+        return changed
 
     def enqueue(self, url, **info):
         if url in self._items:
             raise Error, _("%s is already in the queue") % url
-        mirror = self._mirrorsystem.get(url)
+        mirror = self._mirrorsystem.get(url, info.get("size"))
         item = FetchItem(self, url, mirror)
+        item._order = len(self._items)
         self._items[url] = item
         if info:
             item.setInfo(**info)
@@ -189,7 +418,11 @@ class Fetcher(object):
         for handler in self._handlers.values():
             handler.runLocal()
 
-    def run(self, what=None, progress=None):
+    def run(self, what=None, progress=None, fetchers=()):
+        # Items enqueued in the given fetchers are fetched as well,
+        # sharing the download slots of this one.
+        if not progress:
+            progress = self._progress
         socket.setdefaulttimeout(sysconf.get("socket-timeout", SOCKETTIMEOUT))
         self._cancel = False
         thread_name = threading.currentThread().getName()
@@ -203,13 +436,32 @@ class Fetcher(object):
         self._maxactivedownloads = sysconf.get("max-active-downloads",
                                                MAXACTIVEDOWNLOADS)
         self._maxdownloadrate = sysconf.get("max-download-rate", 0)
+        self._maxuncompressworkers = max(1,
+            sysconf.get("max-uncompress-threads", getProcessorCount()))
         self.time = time.time()
-        handlers = self._handlers.values()
-        total = len(self._items)
-        self.runLocal()
-        local = len([x for x in self._items.values()
-                     if x.getStatus() == SUCCEEDED])
-        if local == total or self._caching is ALWAYS:
+        fetchers = [self]+[x for x in fetchers if x is not self]
+        running = []
+        handlers = []
+        total = local = 0
+        for fetcher in fetchers:
+            fetcher._leader = self
+            fetcher._maxdownloadrate = self._maxdownloadrate
+            fetcher.time = self.time
+            fetcherhandlers = fetcher._handlers.values()
+            fetchertotal = len(fetcher._items)
+            fetcher.runLocal()
+            fetcherlocal = len([x for x in fetcher._items.values()
+                                if x.getStatus() == SUCCEEDED])
+            total += fetchertotal
+            if fetcherlocal == fetchertotal or fetcher._caching is ALWAYS:
+                local += fetchertotal
+            else:
+                local += fetcherlocal
+                running.append(fetcher)
+                handlers.extend(fetcherhandlers)
+        if not running:
+            for fetcher in fetchers:
+                fetcher._leader = fetcher
             if progress:
                 progress.add(total)
             return
@@ -232,12 +484,22 @@ class Fetcher(object):
         for handler in handlers:
             handler.start()
         active = handlers[:]
-        uncomp = self._uncompressor
         uncompchecked = {}
         self._speedupdated = self.time
         cancelledtime = None
-        while active or self._uncompressing:
+        # Everything is checked once, and from then on only the items
+        # reported through notifyChange(). Speed and ETA are only
+        # computed for the ones being downloaded.
+        self._changed = {}
+        changed = {}
+        for fetcher in running:
+            for item in fetcher._items.values():
+                changed[item] = True
+        downloading = {}
+        while active or [x for x in running if x._uncompressing]:
             self.time = time.time()
+            for fetcher in running:
+                fetcher.time = self.time
             if self._cancel:
                 if not cancelledtime:
                     cancelledtime = self.time
@@ -248,14 +510,16 @@ class Fetcher(object):
                         active.remove(handler)
                 # We won't wait for handlers which are not being nice.
                 if time.time() > cancelledtime+CANCELDELAY:
-                    for item in self._items.values():
-                        if item.getStatus() != SUCCEEDED:
-                            item.setCancelled()
-                    # Remove handlers, since we don't know their state.
-                    self._handlers.clear()
+                    for fetcher in running:
+                        for item in fetcher._items.values():
+                            if item.getStatus() != SUCCEEDED:
+                                item.setCancelled()
+                        # Remove handlers, since we don't know their state.
+                        fetcher._handlers.clear()
                     prog.show()
                     break
                 prog.show()
+                self._waitChanges(0.1)
                 continue
             for handler in active[:]:
                 if not handler.tick():
@@ -265,42 +529,47 @@ class Fetcher(object):
                 updatespeed = True
             else:
                 updatespeed = False
-            for url in self._items:
-                item = self._items[url]
+            for item in changed:
+                fetcher = item._fetcher
+                if item.getStatus() is RUNNING:
+                    downloading[item] = True
+                elif item in downloading:
+                    del downloading[item]
                 if item.getStatus() == FAILED:
                     if (item.getRetries() < MAXRETRIES and
                         item.setNextURL()):
                         item.reset()
-                        handler = self.getHandlerInstance(item)
+                        handler = fetcher.getHandlerInstance(item)
                         handler.enqueue(item)
                         if handler not in active:
                             active.append(handler)
                     continue
                 elif (item.getStatus() != SUCCEEDED or
                       not item.getInfo("uncomp")):
-                    if updatespeed:
-                        item.updateSpeed()
-                        item.updateETA()
                     continue
                 localpath = item.getTargetPath()
                 if localpath in uncompchecked:
                     continue
                 uncompchecked[localpath] = True
+                uncomp = fetcher._uncompressor
                 uncomphandler = uncomp.getHandler(localpath)
                 if not uncomphandler:
                     continue
-                uncomppath = uncomphandler.getTargetPath(localpath)
-                if (not self.hasStrongValidate(item, uncomp=True) or
-                    not self.validate(item, uncomppath, uncomp=True)):
-                    self._uncompressing += 1
-                    thread.start_new_thread(self._uncompress,
-                                            (item, localpath, uncomphandler))
-                else:
-                    item.setSucceeded(uncomppath)
+                fetcher._queueUncompress(item, localpath, uncomphandler)
+            if updatespeed:
+                for item in downloading:
+                    item.updateSpeed()
+                    item.updateETA()
             prog.show()
-            time.sleep(0.1)
+            if not active and not [x for x in running if x._uncompressing]:
+                break
+            # Handlers which don't report their changes are still
+            # ticked from time to time.
+            changed = self._waitChanges(SPEEDDELAY)
         for handler in handlers:
             handler.stop()
+        for fetcher in fetchers:
+            fetcher._leader = fetcher
         if not progress:
             prog.stop()
         if thread_name == "MainThread":
@@ -309,20 +578,56 @@ class Fetcher(object):
         if self._cancel:
             raise FetcherCancelled, _("Cancelled")
 
+    def _queueUncompress(self, item, localpath, uncomphandler):
+        # Uncompressing is mostly CPU bound, so it's done in the
+        # background by at most one thread per processor, shared by
+        # all the fetchers running together.
+        leader = self._leader
+        leader._uncompresslock.acquire()
+        self._uncompressing += 1
+        leader._uncompressqueue.append((self, item, localpath,
+                                        uncomphandler))
+        if leader._uncompressworkers < leader._maxuncompressworkers:
+            leader._uncompressworkers += 1
+            thread.start_new_thread(leader._uncompressWorker, ())
+        leader._uncompresslock.release()
+
+    def _uncompressWorker(self):
+        while True:
+            self._uncompresslock.acquire()
+            if not self._uncompressqueue:
+                self._uncompressworkers -= 1
+                self._uncompresslock.release()
+                break
+            fetcher, item, localpath, uncomphandler = \
+                self._uncompressqueue.pop(0)
+            self._uncompresslock.release()
+            try:
+                fetcher._uncompress(item, localpath, uncomphandler)
+            finally:
+                self._uncompresslock.acquire()
+                fetcher._uncompressing -= 1
+                self._uncompresslock.release()
+                self.notifyChange()
+
     def _uncompress(self, item, localpath, uncomphandler):
+        uncomppath = uncomphandler.getTargetPath(localpath)
+        # It may have been uncompressed while being downloaded.
+        if (self.hasStrongValidate(item, uncomp=True) and
+            self.validate(item, uncomppath, uncomp=True)):
+            item.setSucceeded(uncomppath)
+            return
         try:
             uncomphandler.uncompress(localpath)
         except Error, e:
             item.setFailed(unicode(e))
         else:
-            uncomppath = uncomphandler.getTargetPath(localpath)
             valid, reason = self.validate(item, uncomppath,
                                           withreason=True, uncomp=True)
             if not valid:
                 item.setFailed(reason)
             else:
                 item.setSucceeded(uncomppath)
-        self._uncompressing -= 1
 
     def getLocalSchemes(self):
         return self._localschemes
@@ -377,7 +682,8 @@ class Fetcher(object):
             validate = item.getInfo(uncompprefix+"validate")
             if validate:
                 valid, reason = validate(item.getOriginalURL(),
-                                         localpath, withreason=True)
+                                         localpath, withreason=True,
+                                         digestcache=self._digestcache)
                 if valid is not None:
                     if withreason:
                         return valid, reason
@@ -391,56 +697,31 @@ class Fetcher(object):
                     raise Error, _("Unexpected size (expected %d, got %d)") % \
                                  (size, lsize)
 
-            filemd5 = item.getInfo(uncompprefix+"md5")
-            if filemd5:
-                try:
-                    from hashlib import md5
-                except ImportError:
-                    from md5 import md5
-                digest = md5()
-                file = open(localpath)
-                data = file.read(BLOCKSIZE)
-                while data:
-                    digest.update(data)
-                    data = file.read(BLOCKSIZE)
-                lfilemd5 = digest.hexdigest()
-                if lfilemd5 != filemd5:
-                    raise Error, _("Invalid MD5 (expected %s, got %s)") % \
-                                 (filemd5, lfilemd5)
-
-            filesha256 = item.getInfo(uncompprefix+"sha256")
-            if filesha256:
-                try:
-                    from hashlib import sha256
-                except ImportError:
-                    from smart.util.sha256 import sha256
-                digest = sha256()
-                file = open(localpath)
-                data = file.read(BLOCKSIZE)
-                while data:
-                    digest.update(data)
-                    data = file.read(BLOCKSIZE)
-                lfilesha256 = digest.hexdigest()
-                if lfilesha256 != filesha256:
-                   raise Error, _("Invalid SHA256 (expected %s, got %s)") % \
-                                 (filesha256, lfilesha256)
-            else:
-                filesha = item.getInfo(uncompprefix+"sha")
-                if filesha:
-                    try:
-                        from hashlib import sha1 as sha
-                    except ImportError:
-                        from sha import sha
-                    digest = sha()
-                    file = open(localpath)
-                    data = file.read(BLOCKSIZE)
-                    while data:
-                        digest.update(data)
-                        data = file.read(BLOCKSIZE)
-                    lfilesha = digest.hexdigest()
-                    if lfilesha != filesha:
-                        raise Error, _("Invalid SHA (expected %s, got %s)") % \
-                                     (filesha, lfilesha)
+            expected = {}
+            for kind in ("md5", "sha256", "sha"):
+                value = item.getInfo(uncompprefix+kind)
+                if value:
+                    expected[kind] = value
+            if "sha256" in expected and "sha" in expected:
+                del expected["sha"]
+            if expected:
+                digests = getCachedFileDigests(localpath, expected.keys(),
+                                               self._digestcache)
+
+            filemd5 = expected.get("md5")
+            if filemd5 and digests["md5"] != filemd5:
+                raise Error, _("Invalid MD5 (expected %s, got %s)") % \
+                             (filemd5, digests["md5"])
+
+            filesha256 = expected.get("sha256")
+            if filesha256 and digests["sha256"] != filesha256:
+                raise Error, _("Invalid SHA256 (expected %s, got %s)") % \
+                             (filesha256, digests["sha256"])
+
+            filesha = expected.get("sha")
+            if filesha and digests["sha"] != filesha:
+                raise Error, _("Invalid SHA (expected %s, got %s)") % \
+                             (filesha, digests["sha"])
         except Error, reason:
             if withreason:
                 return False, reason
@@ -452,6 +733,8 @@ class Fetcher(object):
 
 class FetchItem(object):
 
+    _order = 0
+
     def __init__(self, fetcher, url, mirror):
         self._fetcher = fetcher
         self._url = url
@@ -459,6 +742,7 @@ class FetchItem(object):
         self._urlobj = URL(mirror.getNext())
         self._retries = 0
         self._starttime = None
+        self._firsttime = None
         self._current = 0
         self._total = 0
         self._speed = 0
@@ -472,13 +756,18 @@ class FetchItem(object):
         self._failedreason = None
         self._targetpath = None
 
-        self._progress = iface.getSubProgress(fetcher)
+        self._progress = fetcher.getSubProgress()
+
+    def __lt__(self, other):
+        # Sort in the order items were enqueued.
+        return self._order < other._order
 
     def reset(self):
         self._status = WAITING
         self._failedreason = None
         self._targetpath = None
         self._starttime = None
+        self._firsttime = None
         self._current = 0
         self._total = 0
         self._speed = 0
@@ -489,6 +778,7 @@ class FetchItem(object):
             self._progress.setSubStopped(url)
             self._progress.show()
             self._progress.resetSub(url)
+        self._fetcher.notifyChange(self)
 
     def getRetries(self):
         return self._retries
@@ -506,6 +796,9 @@ class FetchItem(object):
     def getOriginalURL(self):
         return self._url
 
+    def getAlternativeURLs(self, count):
+        return self._mirror.getAlternatives(count)
+
     def getURL(self):
         return self._urlobj
 
@@ -547,7 +840,7 @@ class FetchItem(object):
     def start(self):
         if self._status is WAITING:
             self._status = RUNNING
-            self._starttime = self._fetcher.time
+            self._starttime = time.time()
             prog = self._progress
             url = self._urlobj.original
             prog.setSubTopic(url, url)
@@ -555,9 +848,12 @@ class FetchItem(object):
                                          r"\1*\2", url))
             prog.setSub(url, 0, self._info.get("size") or 1, 1)
             prog.show()
+            self._fetcher.notifyChange(self)
 
     def progress(self, current, total):
         if self._status is RUNNING:
+            if current and not self._firsttime:
+                self._firsttime = time.time()
             self._current = current
             self._total = total
             if total:
@@ -599,22 +895,30 @@ class FetchItem(object):
             self._targetpath = targetpath
             if self._starttime:
                 if fetchedsize:
-                    now = self._fetcher.time
+                    now = time.time()
                     timedelta = now-self._starttime
+                    info = {"time": timedelta, "size": fetchedsize}
+                    if self._firsttime:
+                        # Time to the first byte.
+                        info["latency"] = self._firsttime-self._starttime
+                    self._mirror.addInfo(**info)
                     if timedelta < 1:
                         timedelta = 1
-                    self._mirror.addInfo(time=timedelta, size=fetchedsize)
                     self._speed = fetchedsize/timedelta
                 self._progress.setSubDone(self._urlobj.original)
                 self._progress.show()
+            self._fetcher.notifyChange(self)
 
     def setFailed(self, reason):
-        self._status = FAILED
         self._failedreason = reason
         if self._starttime:
             self._mirror.addInfo(failed=1)
             self._progress.setSubStopped(self._urlobj.original)
             self._progress.show()
+        # Only now, since a failed item may be moved to another
+        # mirror by the fetcher at any time.
+        self._status = FAILED
+        self._fetcher.notifyChange(self)
 
     def setCancelled(self):
         self.setFailed(_("Cancelled"))
@@ -710,8 +1014,10 @@ class FetcherHandler(object):
         self._queue.remove(item)
 
     def start(self):
-        # Fetcher is starting.
+        # Fetcher is starting. Items are taken from the end of the
+        # queue, so the ones enqueued first go there.
         self._queue.sort()
+        self._queue.reverse()
         self._cancel = False
 
     def stop(self):
@@ -739,6 +1045,123 @@ class FetcherHandler(object):
     def getLocalPath(self, item):
         return self._fetcher.getLocalPath(item)
 
+    def getPartial(self, item, localpath, total=None):
+        # Return the size of what is already in the partial file of
+        # localpath, and the information saved with it. Partial files
+        # which were started for other contents are removed, so that
+        # a download is only resumed, even from another mirror, when
+        # it's for the same file.
+        localpathpart = localpath+".part"
+        if not os.path.isfile(localpathpart):
+            self.removePartial(localpath)
+            return 0, {}
+        partsize = os.path.getsize(localpathpart)
+        partinfo = loadInfoFile(localpathpart+".info")
+        if not total:
+            total = item.getInfo("size")
+        for kind in PARTIALINFO:
+            value = item.getInfo(kind)
+            if value and partinfo.get(kind, str(value)) != str(value):
+                break
+        else:
+            if not total or partsize < total:
+                return partsize, partinfo
+        self.removePartial(localpath)
+        return 0, {}
+
+    def setPartialInfo(self, item, localpath, info):
+        # Save what identifies the contents being fetched into the
+        # partial file of localpath, besides the given information.
+        partinfo = {}
+        for kind in PARTIALINFO:
+            value = item.getInfo(kind)
+            if value:
+                partinfo[kind] = value
+        for kind in info:
+            if info[kind]:
+                partinfo[kind] = info[kind]
+        saveInfoFile(localpath+".part.info", partinfo)
+
+    def removePartial(self, localpath):
+        for path in (localpath+".part", localpath+".part.info"):
+            if os.path.isfile(path):
+                os.unlink(path)
+
+    def getValidators(self, item, localpath):
+        # Return the validators (etag and last-modified) which the
+        # server gave for the local copy of item, so that it's only
+        # transferred again if it changed. They're only good for the
+        # same URL, and the caller must check that the local copy is
+        # still valid.
+        validators = loadInfoFile(localpath+".info")
+        if validators.get("url") != item.getURL().original:
+            return {}
+        del validators["url"]
+        return validators
+
+    def getRequestHeaders(self, item, localpath):
+        # Return the headers asking the server for item only if it
+        # changed since the local copy was fetched, and only for what
+        # is missing from the partial file, with the size of the
+        # partial file.
+        import rfc822
+        headers = []
+        if (os.path.isfile(localpath) and
+            self._fetcher.validate(item, localpath)):
+            # Prefer what the server told about the local copy
+            # to its modification time.
+            validators = self.getValidators(item, localpath)
+            modified = validators.get("last-modified")
+            if not modified:
+                mtime = os.path.getmtime(localpath)
+                modified = rfc822.formatdate(mtime)
+            headers.append(("if-modified-since", modified))
+            if "etag" in validators:
+                headers.append(("if-none-match", validators["etag"]))
+        partsize, partinfo = self.getPartial(item, localpath)
+        if partsize:
+            headers.append(("range", "bytes=%d-" % partsize))
+            # If it changed on the same server, get it all.
+            validator = partinfo.get("etag")
+            if not validator or validator.startswith("W/"):
+                validator = partinfo.get("last-modified")
+            if (validator and
+                partinfo.get("url") == item.getURL().original):
+                headers.append(("if-range", validator))
+        return headers, partsize
+
+    def setValidators(self, item, localpath, info):
+        # Save the validators in info for the local copy of item which
+        # was just fetched, or forget the old ones if there are none.
+        # They're only kept when asked for, since only files such as
+        # channel information are fetched again with caching disabled,
+        # and nothing removes them together with other files.
+        validators = {}
+        if self._fetcher.getSaveValidators():
+            for kind in VALIDATORS:
+                if info.get(kind):
+                    validators[kind] = info[kind]
+        infopath = localpath+".info"
+        if validators:
+            validators["url"] = item.getURL().original
+            saveInfoFile(infopath, validators)
+        elif os.path.isfile(infopath):
+            os.unlink(infopath)
+
+    def getUncompressingFile(self, item, localpath):
+        # Files fetched from the very start may be uncompressed while
+        # being written, so that run() only has to validate the result.
+        # That's only worth it when the result can be strongly validated,
+        # since otherwise it's uncompressed again anyway.
+        fetcher = self._fetcher
+        if (not item.getInfo("uncomp") or
+            not fetcher.hasStrongValidate(item, uncomp=True)):
+            return None
+        try:
+            return fetcher.getUncompressor().stream(localpath)
+        except (IOError, OSError):
+            return None
+
     def runLocal(self, caching=None):
         # That's part of the caching magic.
         fetcher = self._fetcher
@@ -889,6 +1312,7 @@ class FileHandler(FetcherHandler):
             else:
                 item.setFailed(error)
         self._active = False
+        self._fetcher.notifyChange()
 
 Fetcher.setHandler("file", FileHandler, local=True)
 
@@ -1056,15 +1480,16 @@ class FTPHandler(FetcherHandler):
                 not fetcher.validate(item, localpath)):
 
                 localpathpart = localpath+".part"
-                if (os.path.isfile(localpathpart) and
-                    (not total or os.path.getsize(localpathpart) < total)):
-                    rest = os.path.getsize(localpathpart)
+                rest = self.getPartial(item, localpath, total)[0]
+                if rest:
                     openmode = "a"
                     item.current = rest
                 else:
                     rest = None
                     openmode = "w"
                     item.current = 0
+                    self.setPartialInfo(item, localpath,
+                                        {"url": url.original})
 
                 try:
                     local = open(localpathpart, openmode)
@@ -1092,6 +1517,8 @@ class FTPHandler(FetcherHandler):
                     os.utime(localpathpart, (mtime, mtime))
 
                 os.rename(localpathpart, localpath)
+                self.removePartial(localpath)
+                self.setValidators(item, localpath, {})
 
                 valid, reason = fetcher.validate(item, localpath,
                                                  withreason=True)
@@ -1139,15 +1566,158 @@ class FTPHandler(FetcherHandler):
 
 Fetcher.setHandler("ftp", FTPHandler)
 
+class KeepAliveResponse(object):
+    # Give the connection back to its handler once the response
+    # was completely read, so that the next request may use it.
+
+    def __init__(self, handler, url, connection, response):
+        self._handler = handler
+        self._url = url
+        self._connection = connection
+        self._response = response
+        if response.status != 200:
+            self.errcode = response.status
+            self.errmsg = response.reason
+
+    def info(self):
+        return self._response.msg
+
+    def read(self, size=None):
+        if size is None:
+            return self._response.read()
+        return self._response.read(size)
+
+    def close(self):
+        if self._connection:
+            response = self._response
+            if response.isclosed() and not response.will_close:
+                self._handler.putConnection(self._url, self._connection)
+            else:
+                self._connection.close()
+            self._connection = None
+
 class URLLIBHandler(FetcherHandler):
 
     MAXACTIVE = 5
+    MAXINACTIVE = 5
+    MAXREDIRECTS = 10
+    MAXSEGMENTMIRRORS = 4
+    MINSEGMENTSIZE = 1024*1024
+
+    TIMEOUT = 30
+
+    # Connections kept alive are shared by the handlers of all
+    # fetchers, so that they're reused between runs and channels.
+    _inactive = {} # (scheme, host, port) -> [connection, ...]
+    _inactivelock = thread.allocate_lock()
 
     def __init__(self, *args):
         FetcherHandler.__init__(self, *args)
         self._active = 0
         self._lock = thread.allocate_lock()
 
+    def getConnection(self, url):
+        import httplib
+        key = (url.scheme, url.host, url.port)
+        now = time.time()
+        connection = None
+        self._inactivelock.acquire()
+        connections = self._inactive.get(key)
+        while connections:
+            connection = connections.pop()
+            if connection.lasttime+self.TIMEOUT > now:
+                break
+            connection.close()
+            connection = None
+        self._inactivelock.release()
+        if connection:
+            return connection, True
+        port = url.port and int(url.port) or None
+        if url.scheme == "https":
+            connection = httplib.HTTPSConnection(url.host, port)
+        else:
+            connection = httplib.HTTPConnection(url.host, port)
+        return connection, False
+
+    def putConnection(self, url, connection):
+        key = (url.scheme, url.host, url.port)
+        maxinactive = sysconf.get("max-keepalive-connections",
+                                  self.MAXINACTIVE)
+        self._inactivelock.acquire()
+        connections = self._inactive.setdefault(key, [])
+        if len(connections) < maxinactive:
+            connection.lasttime = time.time()
+            connections.append(connection)
+            connection = None
+        self._inactivelock.release()
+        if connection:
+            connection.close()
+
+    def closeConnections(cls):
+        cls._inactivelock.acquire()
+        for connections in cls._inactive.values():
+            for connection in connections:
+                connection.close()
+        cls._inactive.clear()
+        cls._inactivelock.release()
+    closeConnections = classmethod(closeConnections)
+
+    def useKeepAlive(self, url):
+        import httplib
+        if url.scheme == "https":
+            if not hasattr(httplib, "HTTPSConnection"):
+                return False
+        elif url.scheme != "http":
+            return False
+        # Leave proxies with urllib.
+        return not urllib.getproxies().get(url.scheme)
+
+    def open(self, opener, url):
+        # Same as opener.open(url.original), but http and https
+        # requests go through connections which are kept alive.
+        import httplib, base64, urlparse
+        from cStringIO import StringIO
+        for i in range(self.MAXREDIRECTS):
+            if not self.useKeepAlive(url):
+                return opener.open(url.original)
+            selector = urllib.splithost(urllib.splittype(url.original)[1])[1]
+            headers = dict(opener.addheaders)
+            if url.user:
+                userpasswd = "%s:%s" % (url.user, url.passwd)
+                headers["Authorization"] = ("Basic " + base64.encodestring(
+                                            userpasswd).replace("\n", ""))
+            while True:
+                connection, reused = self.getConnection(url)
+                try:
+                    connection.request("GET", selector or "/",
+                                       headers=headers)
+                    response = connection.getresponse()
+                except (socket.error, httplib.HTTPException), e:
+                    connection.close()
+                    if reused:
+                        # The server has closed it meanwhile.
+                        continue
+                    if isinstance(e, socket.error):
+                        raise
+                    raise IOError, ("http error", e.__class__.__name__)
+                break
+            remote = KeepAliveResponse(self, url, connection, response)
+            if response.status in (200, 206):
+                return remote
+            try:
+                fp = StringIO(remote.read())
+            finally:
+                remote.close()
+            location = (response.getheader("location") or
+                        response.getheader("uri"))
+            if response.status not in (301, 302, 303, 307) or not location:
+                break
+            url = URL(urlparse.urljoin(url.original, location))
+        remote = urllib.addinfourl(fp, response.msg, url.original)
+        remote.errcode = response.status
+        remote.errmsg = response.reason
+        return remote
+
     def tick(self):
         self._lock.acquire()
         if self._queue:
@@ -1158,6 +1728,140 @@ class URLLIBHandler(FetcherHandler):
         self._lock.release()
         return bool(self._queue or self._active)
 
+    def getSegmentURLs(self, item, localpath):
+        # Large files are fetched in segments from several mirrors
+        # at once, unless there's something to resume already.
+        size = item.getInfo("size")
+        minsize = sysconf.get("segmented-download-size", SEGMENTEDSIZE)
+        if (not size or not minsize or size < minsize or
+            self._fetcher._maxdownloadrate or
+            self.getPartial(item, localpath)[0]):
+            return []
+        # A valid local copy is checked for changes first.
+        if (os.path.isfile(localpath) and
+            self._fetcher.validate(item, localpath)):
+            return []
+        url = item.getURL()
+        if not self.useKeepAlive(url):
+            return []
+        urls = [url.original]
+        for alternative in item.getAlternativeURLs(self.MAXSEGMENTMIRRORS-1):
+            if self.useKeepAlive(URL(alternative)):
+                urls.append(alternative)
+        if len(urls) < 2:
+            return []
+        return urls
+
+    def fetchSegment(self, url, localpathpart, start, end, progress):
+        opener = urllib.URLopener()
+        opener.addheaders = [("User-Agent", "smart/" + VERSION),
+                             ("range", "bytes=%d-%d" % (start, end))]
+        remote = self.open(opener, url)
+        try:
+            contentrange = remote.info().get("content-range", "")
+            if (getattr(remote, "errcode", None) != 206 or
+                not contentrange.startswith("bytes %d-%d/" % (start, end))):
+                raise Error, _("Server doesn't support byte ranges")
+            local = open(localpathpart, "r+")
+            try:
+                local.seek(start)
+                left = end-start+1
+                while left:
+                    if self._cancel:
+                        raise FetcherCancelled
+                    data = remote.read(min(left, BLOCKSIZE))
+                    if not data:
+                        raise Error, _("Connection closed unexpectedly")
+                    local.write(data)
+                    left -= len(data)
+                    progress(len(data))
+            finally:
+                local.close()
+        finally:
+            remote.close()
+
+    def fetchSegments(self, item, urls, localpath):
+        # Split the file in segments, and have one thread per mirror
+        # picking them up until everything is fetched, so that faster
+        # mirrors end up fetching more. Segments are written in place.
+        size = item.getInfo("size")
+        localpathpart = localpath+".part"
+        local = open(localpathpart, "w")
+        local.truncate(size)
+        local.close()
+        segmentsize = max(self.MINSEGMENTSIZE, size/(len(urls)*4)+1)
+        segments = [(x, min(x+segmentsize, size)-1)
+                    for x in range(0, size, segmentsize)]
+        state = {"current": 0, "running": 1, "error": None}
+        cond = threading.Condition()
+
+        def progress(count):
+            cond.acquire()
+            state["current"] += count
+            current = state["current"]
+            cond.release()
+            item.progress(current, size)
+
+        def worker(url, slot):
+            url = URL(url)
+            try:
+                while not self._cancel:
+                    cond.acquire()
+                    if not segments:
+                        cond.release()
+                        break
+                    start, end = segments.pop(0)
+                    cond.release()
+                    fetched = [0]
+                    def segmentprogress(count):
+                        fetched[0] += count
+                        progress(count)
+                    try:
+                        self.fetchSegment(url, localpathpart, start, end,
+                                          segmentprogress)
+                    except (IOError, OSError, Error, socket.error), e:
+                        # Leave it for the other mirrors.
+                        progress(-fetched[0])
+                        cond.acquire()
+                        segments.insert(0, (start, end))
+                        state["error"] = e
+                        cond.release()
+                        break
+            finally:
+                cond.acquire()
+                state["running"] -= 1
+                cond.notify()
+                cond.release()
+                if slot:
+                    self.changeActiveDownloads(-1)
+
+        for url in urls[1:]:
+            if not self.changeActiveDownloads(+1):
+                break
+            cond.acquire()
+            state["running"] += 1
+            cond.release()
+            thread.start_new_thread(worker, (url, True))
+        worker(urls[0], False)
+        cond.acquire()
+        while state["running"]:
+            cond.wait()
+        cond.release()
+
+        if self._cancel or segments:
+            self.removePartial(localpath)
+            if self._cancel:
+                raise FetcherCancelled
+            raise state["error"]
+
+        os.rename(localpathpart, localpath)
+        self.setValidators(item, localpath, {})
+        valid, reason = self._fetcher.validate(item, localpath,
+                                               withreason=True)
+        if not valid:
+            raise Error, reason
+        item.setSucceeded(localpath, size)
+
     def fetch(self):
         import urllib, rfc822, calendar
         from time import time, sleep
@@ -1211,31 +1915,27 @@ class URLLIBHandler(FetcherHandler):
 
                 size = item.getInfo("size")
 
+                segmenturls = self.getSegmentURLs(item, localpath)
+                if segmenturls:
+                    self.fetchSegments(item, segmenturls, localpath)
+                    continue
+
                 del opener.addheaders[:]
 
                 opener.addheader("User-Agent", "smart/" + VERSION)
 
-                if (os.path.isfile(localpath) and
-                    fetcher.validate(item, localpath)):
-                    mtime = os.path.getmtime(localpath)
-                    opener.addheader("if-modified-since",
-                                     rfc822.formatdate(mtime))
-
                 localpathpart = localpath+".part"
-                if os.path.isfile(localpathpart):
-                    partsize = os.path.getsize(localpathpart)
-                    if not size or partsize < size:
-                        opener.addheader("range", "bytes=%d-" % partsize)
-                else:
-                    partsize = 0
+                headers, partsize = self.getRequestHeaders(item, localpath)
+                for name, value in headers:
+                    opener.addheader(name, value)
 
-                remote = opener.open(url.original)
+                remote = self.open(opener, url)
 
                 if hasattr(remote, "errcode") and remote.errcode == 416:
                     # Range not satisfiable, try again without it.
                     opener.addheaders = [x for x in opener.addheaders
-                                         if x[0] != "range"]
-                    remote = opener.open(url.original)
+                                         if x[0] not in ("range", "if-range")]
+                    remote = self.open(opener, url)
 
                 if hasattr(remote, "errcode") and remote.errcode != 206:
                     # 206 = Partial Content
@@ -1265,17 +1965,30 @@ class URLLIBHandler(FetcherHandler):
                 except (IOError, OSError), e:
                     raise IOError, "%s: %s" % (localpathpart, e)
 
+                uncompressing = None
+                if openmode == "w":
+                    self.setPartialInfo(item, localpath,
+                                        {"url": url.original,
+                                         "etag": info.get("etag"),
+                                         "last-modified":
+                                             info.get("last-modified")})
+                    uncompressing = self.getUncompressingFile(item,
+                                                              localpath)
+
                 rate_limit = self._fetcher._maxdownloadrate
                 if rate_limit:
                     rate_limit /= self._active
                     start = time()
 
+                finished = False
                 try:
                     data = remote.read(BLOCKSIZE)
                     while data:
                         if self._cancel:
                             raise FetcherCancelled
                         local.write(data)
+                        if uncompressing:
+                            uncompressing.write(data)
                         current += len(data)
                         item.progress(current, total)
                         if rate_limit:
@@ -1287,14 +2000,24 @@ class URLLIBHandler(FetcherHandler):
                                 if sleep_time > 0:
                                     sleep(sleep_time)
                         data = remote.read(BLOCKSIZE)
+                    finished = True
                 finally:
                     local.close()
                     remote.close()
+                    if uncompressing and not finished:
+                        uncompressing.abort()
 
                 os.rename(localpathpart, localpath)
+                self.removePartial(localpath)
+                self.setValidators(item, localpath, info)
 
                 valid, reason = fetcher.validate(item, localpath,
                                                  withreason=True)
+                if uncompressing:
+                    if valid:
+                        uncompressing.close()
+                    else:
+                        uncompressing.abort()
                 if not valid:
                     if openmode == "a":
                         # Try again, from the very start.
@@ -1584,11 +2307,13 @@ class PyCurlHandler(FetcherHandler):
                 if (http_code == 404 or
                     handle.getinfo(pycurl.SIZE_DOWNLOAD) == 0):
                     # Not modified or not found
-                    os.unlink(localpath+".part")
+                    self.removePartial(localpath)
                 else:
                     if os.path.isfile(localpath):
                         os.unlink(localpath)
                     os.rename(localpath+".part", localpath)
+                    self.removePartial(localpath)
+                    self.setValidators(item, localpath, {})
                     mtime = handle.getinfo(pycurl.INFO_FILETIME)
                     if mtime != -1:
                         os.utime(localpath, (mtime, mtime))
@@ -1631,7 +2356,7 @@ class PyCurlHandler(FetcherHandler):
                 self._inactive[handle] = userhost
 
                 if handle.partsize and "byte ranges" in errmsg:
-                    os.unlink(localpath+".part")
+                    self.removePartial(localpath)
                     item.reset()
                     self._queue.append(item)
                 elif handle.active and "password" in errmsg:
@@ -1676,12 +2401,7 @@ class PyCurlHandler(FetcherHandler):
 
                         size = item.getInfo("size")
 
-                        if os.path.isfile(localpathpart):
-                            partsize = os.path.getsize(localpathpart)
-                            if size and partsize >= size:
-                                partsize = 0
-                        else:
-                            partsize = 0
+                        partsize = self.getPartial(item, localpath)[0]
                         handle.partsize = partsize
                         if partsize:
                             openmode = "a"
@@ -1699,6 +2419,10 @@ class PyCurlHandler(FetcherHandler):
                             self.changeActiveDownloads(-1)
                             continue
 
+                        if not partsize:
+                            self.setPartialInfo(item, localpath,
+                                                {"url": url.original})
+
                         handle.item = item
                         handle.local = local
                         handle.localpath = localpath
@@ -1758,17 +2482,23 @@ class PyCurlHandler(FetcherHandler):
         import pycurl
         multi = self._multi
         mp = pycurl.E_CALL_MULTI_PERFORM
+        lastnum = 0
         while self._queue or self._active:
             self._lock.acquire()
             res = mp
             while res == mp:
                 res, num = multi.perform()
             self._lock.release()
+            if num < lastnum:
+                # Some transfer is done, and tick() must see it.
+                self._fetcher.notifyChange()
+            lastnum = num
             multi.select(1.0)
         # Keep in mind that even though the while above has exited due to
         # self._active being False, it may actually be true *here* due to
         # race conditions.
         self._running = False
+        self._fetcher.notifyChange()
 
 try:
     import pycurl
@@ -1784,6 +2514,783 @@ def enablePycurl():
 
 hooks.register("enable-pycurl", enablePycurl)
 
+class AsyncHTTPTransfer(object):
+    # The fetching of one item by AsyncHTTPHandler. Connecting, sending
+    # the request and reading the response are split in steps which
+    # never block, run whenever the socket is ready for the direction
+    # given by getWanted(), so that a single thread may run any number
+    # of transfers. Errors are raised out of step() to the handler.
+
+    def __init__(self, handler, item):
+        self._handler = handler
+        self._item = item
+        self._url = item.getURL()
+        self._redirects = 0
+        self._sock = None
+        self._local = None
+        self._uncompressing = None
+        self._state = None
+        self._wanted = None
+        self.host = self._url.host
+        self.lasttime = time.time()
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def getWanted(self):
+        # "r" or "w", for reading and writing, respectively, or "a"
+        # while the address of the host is being looked up.
+        return self._wanted
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+        if self._local:
+            self._local.close()
+            self._local = None
+        if self._uncompressing:
+            self._uncompressing.abort()
+            self._uncompressing = None
+
+    def cancel(self):
+        self.close()
+        self._item.setCancelled()
+        self._handler.finish(self)
+
+    def fail(self, reason):
+        self.close()
+        self._item.setFailed(reason)
+        self._handler.finish(self)
+
+    def connect(self):
+        # Prepare the request for the current URL, and get a connection
+        # for it, reusing one which was kept alive when possible.
+        import base64
+        handler = self._handler
+        item = self._item
+        url = self._url
+        self.lasttime = time.time()
+
+        if url.scheme not in ("http", "https"):
+            raise Error, _("Unsupported scheme: %s") % url.scheme
+        if url.scheme == "https":
+            defaultport = 443
+        else:
+            defaultport = 80
+        port = url.port and int(url.port) or defaultport
+        if port == defaultport:
+            hostport = url.host
+        else:
+            hostport = "%s:%d" % (url.host, port)
+        selector = urllib.splithost(urllib.splittype(url.original)[1])[1]
+        selector = selector or "/"
+
+        self._tunnel = None
+        proxy = urllib.getproxies().get(url.scheme)
+        if proxy and not urllib.proxy_bypass(url.host):
+            proxyurl = URL(proxy)
+            address = (proxyurl.host, int(proxyurl.port or 80))
+            proxyheaders = []
+            if proxyurl.user:
+                userpasswd = "%s:%s" % (proxyurl.user, proxyurl.passwd)
+                proxyheaders.append(("Proxy-Authorization", "Basic " +
+                    base64.encodestring(userpasswd).replace("\n", "")))
+            if url.scheme == "https":
+                # Secure connections are tunneled through the proxy,
+                # and are only good for the same host afterwards.
+                self._tunnel = "\r\n".join(
+                    ["CONNECT %s:%d HTTP/1.1" % (url.host, port),
+                     "Host: %s:%d" % (url.host, port)] +
+                    ["%s: %s" % x for x in proxyheaders]) + "\r\n\r\n"
+                key = (url.scheme, url.host, port, address)
+                proxyheaders = []
+            else:
+                # Any connection to the proxy is good for any host.
+                key = ("proxy", address)
+                selector = "http://%s%s" % (hostport, selector)
+        else:
+            address = (url.host, port)
+            proxyheaders = []
+            key = (url.scheme, url.host, port)
+        self._key = key
+
+        headers = [("Host", hostport),
+                   ("User-Agent", "smart/" + VERSION)] + proxyheaders
+        if url.user:
+            userpasswd = "%s:%s" % (url.user, url.passwd)
+            headers.append(("Authorization", "Basic " +
+                base64.encodestring(userpasswd).replace("\n", "")))
+
+        self._localpath = localpath = handler.getLocalPath(item)
+        conditional, self._partsize = \
+            handler.getRequestHeaders(item, localpath)
+        headers.extend(conditional)
+
+        self._request = "\r\n".join(["GET %s HTTP/1.1" % selector] +
+                                    ["%s: %s" % x for x in headers])
+        self._request += "\r\n\r\n"
+        self._inbuf = ""
+        self._info = None
+        self._gotdata = False
+
+        self._sock = handler.getConnection(key)
+        if self._sock:
+            self._reused = True
+            self._send(self._request)
+        else:
+            self._reused = False
+            self._address = address
+            self._wanted = "a"
+            self.resolve()
+
+    def resolve(self):
+        # Open the connection once the address of the host is known.
+        addrinfo = self._handler.getAddress(self._address)
+        if not addrinfo:
+            return
+        family, socktype, proto, canonname, sockaddr = addrinfo
+        self._sock = socket.socket(family, socktype, proto)
+        self._sock.setblocking(0)
+        err = self._sock.connect_ex(sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error, (err, os.strerror(err))
+        self._state = self._stepConnect
+        self._wanted = "w"
+
+    def step(self):
+        self.lasttime = time.time()
+        try:
+            self._state()
+        except socket.error:
+            if not self._reused or self._gotdata:
+                raise
+            self._retry()
+
+    def _retry(self):
+        # The server has closed the connection kept alive meanwhile,
+        # and probably the other ones kept for it as well.
+        self.close()
+        self._handler.dropConnections(self._key)
+        self.connect()
+
+    def _send(self, data):
+        self._outbuf = data
+        self._state = self._stepSend
+        self._wanted = "w"
+
+    def _stepConnect(self):
+        err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error, (err, os.strerror(err))
+        if self._tunnel:
+            self._send(self._tunnel)
+        else:
+            self._startSecure()
+
+    def _startSecure(self):
+        if self._url.scheme == "https":
+            import ssl
+            if hasattr(ssl, "create_default_context"):
+                context = ssl.create_default_context()
+                self._sock = context.wrap_socket(self._sock,
+                                 server_hostname=self._url.host,
+                                 do_handshake_on_connect=False)
+            else:
+                self._sock = ssl.wrap_socket(self._sock,
+                                 do_handshake_on_connect=False)
+            self._sock.setblocking(0)
+            self._state = self._stepHandshake
+            self._stepHandshake()
+        else:
+            self._send(self._request)
+
+    def _stepHandshake(self):
+        if self._io(self._sock.do_handshake) is not None:
+            self._send(self._request)
+
+    def _io(self, func, *args):
+        # Run the given socket operation, returning None when it
+        # must wait for the socket to be ready in some direction.
+        try:
+            return func(*args) or 0
+        except socket.error, e:
+            if self._url.scheme == "https":
+                import ssl
+                if isinstance(e, ssl.SSLError):
+                    if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                        self._wanted = "r"
+                        return None
+                    if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                        self._wanted = "w"
+                        return None
+                    raise
+            if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                        errno.EINTR):
+                return None
+            raise
+
+    def _stepSend(self):
+        self._wanted = "w"
+        sent = self._io(self._sock.send, self._outbuf)
+        if sent:
+            self._outbuf = self._outbuf[sent:]
+            if not self._outbuf:
+                self._state = self._stepReceive
+                self._wanted = "r"
+
+    def _stepReceive(self):
+        self._wanted = "r"
+        while self._sock:
+            data = self._io(self._sock.recv, BLOCKSIZE)
+            if data is None:
+                break
+            if not data:
+                if self._reused and not self._gotdata:
+                    self._retry()
+                else:
+                    self._closed()
+                break
+            self._gotdata = True
+            self._handler.received(len(data))
+            self._inbuf += data
+            if self._info is None:
+                self._parseHeaders()
+            else:
+                self._parseBody()
+            # Secure sockets may have data buffered already,
+            # which select() won't tell about.
+            if not (self._sock and hasattr(self._sock, "pending") and
+                    self._sock.pending()):
+                break
+
+    def _parseHeaders(self):
+        import httplib
+        from cStringIO import StringIO
+        while self._sock and self._info is None:
+            end = self._inbuf.find("\r\n\r\n")
+            if end == -1:
+                return
+            head = self._inbuf[:end+2]
+            self._inbuf = self._inbuf[end+4:]
+            statusline, head = head.split("\r\n", 1)
+            try:
+                version, status, reason = (statusline.split(None, 2)+[""])[:3]
+                status = int(status)
+            except ValueError:
+                raise Error, _("Invalid server response")
+            if not version.startswith("HTTP/"):
+                raise Error, _("Invalid server response")
+            if 100 <= status < 200:
+                continue
+            info = httplib.HTTPMessage(StringIO(head))
+            if self._tunnel:
+                if status != 200:
+                    raise Error, reason.strip()
+                self._tunnel = None
+                self._startSecure()
+                continue
+            connection = info.get("connection", "").lower()
+            if version == "HTTP/1.1":
+                self._keepalive = "close" not in connection
+            else:
+                self._keepalive = "keep-alive" in connection
+            self._info = info
+            self._response(status, reason.strip(), info)
+        if self._sock and self._inbuf and self._info is not None:
+            self._parseBody()
+
+    def _response(self, status, reason, info):
+        import urlparse
+        handler = self._handler
+        item = self._item
+        localpath = self._localpath
+
+        location = info.get("location") or info.get("uri")
+        if (status in (301, 302, 303, 307) and location and
+            self._redirects < handler.MAXREDIRECTS):
+            self._redirects += 1
+            self.close()
+            self._url = URL(urlparse.urljoin(self._url.original, location))
+            handler.changeHost(self, self._url.host)
+            self.connect()
+            return
+
+        if status == 416 and self._partsize:
+            # Range not satisfiable, try again without it.
+            self.close()
+            handler.removePartial(localpath)
+            self.connect()
+            return
+
+        if status == 304: # Not modified
+            self._finishResponse()
+            item.setSucceeded(localpath)
+            handler.finish(self)
+            return
+        if status == 404:
+            # Use a standard translatable error message.
+            raise Error, _("File not found")
+        if status not in (200, 206):
+            raise Error, reason
+
+        size = item.getInfo("size")
+        total = None
+        if "content-length" in info:
+            total = int(info["content-length"])
+        elif size:
+            total = size
+        if "content-range" in info:
+            openmode = "a"
+            self._current = self._partsize
+            if "content-length" in info:
+                total += self._partsize
+        else:
+            self._partsize = 0
+            self._current = 0
+            openmode = "w"
+        if size and total and size != total:
+            raise Error, _("Server reports unexpected size")
+        self._total = total
+        self._openmode = openmode
+
+        localpathpart = localpath+".part"
+        try:
+            self._local = open(localpathpart, openmode)
+        except (IOError, OSError), e:
+            raise IOError, "%s: %s" % (localpathpart, e)
+        if openmode == "w":
+            handler.setPartialInfo(item, localpath,
+                                   {"url": item.getURL().original,
+                                    "etag": info.get("etag"),
+                                    "last-modified":
+                                        info.get("last-modified")})
+            self._uncompressing = handler.getUncompressingFile(item,
+                                                               localpath)
+
+        # The body is either chunked, of the given length, or goes
+        # until the connection is closed.
+        self._chunked = "chunked" in info.get("transfer-encoding",
+                                              "").lower()
+        self._chunkleft = None
+        if self._chunked:
+            self._remaining = None
+        elif "content-length" in info:
+            self._remaining = int(info["content-length"])
+            if not self._remaining:
+                self._finished()
+        else:
+            self._remaining = None
+            self._keepalive = False
+
+    def _parseBody(self):
+        if not self._chunked:
+            data = self._inbuf
+            self._inbuf = ""
+            if self._remaining is not None:
+                if len(data) > self._remaining:
+                    data = data[:self._remaining]
+                    self._keepalive = False
+                self._remaining -= len(data)
+            self._write(data)
+            if self._remaining == 0:
+                self._finished()
+            return
+        while self._sock:
+            if self._chunkleft is None:
+                end = self._inbuf.find("\r\n")
+                if end == -1:
+                    return
+                try:
+                    self._chunkleft = int(self._inbuf[:end].split(";")[0],
+                                          16)
+                except ValueError:
+                    raise Error, _("Invalid server response")
+                self._inbuf = self._inbuf[end+2:]
+                if not self._chunkleft:
+                    self._chunkleft = -1
+            elif self._chunkleft == -1:
+                # Last chunk, and maybe some trailers.
+                if self._inbuf.startswith("\r\n"):
+                    end = 0
+                else:
+                    end = self._inbuf.find("\r\n\r\n")
+                    if end == -1:
+                        return
+                    end += 2
+                self._inbuf = self._inbuf[end+2:]
+                if self._inbuf:
+                    self._keepalive = False
+                self._finished()
+            elif self._chunkleft:
+                if not self._inbuf:
+                    return
+                data = self._inbuf[:self._chunkleft]
+                self._inbuf = self._inbuf[len(data):]
+                self._chunkleft -= len(data)
+                self._write(data)
+            else:
+                if len(self._inbuf) < 2:
+                    return
+                self._inbuf = self._inbuf[2:]
+                self._chunkleft = None
+
+    def _write(self, data):
+        if not data:
+            return
+        self._local.write(data)
+        if self._uncompressing:
+            self._uncompressing.write(data)
+        self._current += len(data)
+        self._item.progress(self._current, self._total)
+
+    def _closed(self):
+        # The server closed the connection.
+        if (self._info is not None and not self._chunked and
+            self._remaining is None):
+            self._finished()
+        else:
+            raise Error, _("Connection closed by server")
+
+    def _finishResponse(self):
+        # Keep the connection for the next transfer, if possible.
+        sock = self._sock
+        self._sock = None
+        if self._keepalive and not self._inbuf:
+            self._handler.putConnection(self._key, sock)
+        else:
+            sock.close()
+
+    def _finished(self):
+        handler = self._handler
+        fetcher = handler._fetcher
+        item = self._item
+        info = self._info
+        localpath = self._localpath
+        uncompressing = self._uncompressing
+
+        self._finishResponse()
+        self._local.close()
+        self._local = None
+        self._uncompressing = None
+
+        try:
+            os.rename(localpath+".part", localpath)
+            handler.removePartial(localpath)
+            handler.setValidators(item, localpath, info)
+            valid, reason = fetcher.validate(item, localpath,
+                                             withreason=True)
+        except:
+            if uncompressing:
+                uncompressing.abort()
+            raise
+        if uncompressing:
+            if valid:
+                uncompressing.close()
+            else:
+                uncompressing.abort()
+        if not valid:
+            if self._openmode == "a":
+                # Try again, from the very start.
+                item.reset()
+                handler.requeue(item)
+                handler.finish(self)
+                return
+            raise Error, reason
+
+        if "last-modified" in info:
+            import rfc822, calendar
+            mtimet = rfc822.parsedate(info["last-modified"])
+            if mtimet:
+                mtime = calendar.timegm(mtimet)
+                os.utime(localpath, (mtime, mtime))
+        if self._total:
+            fetchedsize = self._total-self._partsize
+        elif not self._partsize:
+            fetchedsize = os.path.getsize(localpath)
+        else:
+            fetchedsize = None
+        item.setSucceeded(localpath, fetchedsize)
+        handler.finish(self)
+
+class AsyncHTTPHandler(FetcherHandler):
+    # Fetch http and https items in a single thread, which drives all
+    # the transfers at once by waiting on their sockets with select(),
+    # so that the number of active downloads isn't bound by the number
+    # of threads. Besides the download slots of the fetcher, the
+    # transfers from the same host are limited, so that the slots are
+    # spread between mirrors.
+
+    MAXPERHOST = 4
+    MAXINACTIVE = 5
+    MAXREDIRECTS = 10
+
+    TIMEOUT = 30
+
+    def __init__(self, *args):
+        FetcherHandler.__init__(self, *args)
+        self._active = []     # [transfer, ...]
+        self._hostactive = {} # host -> num
+        self._inactive = {}   # key -> [(time, socket), ...]
+        self._addresses = {}  # (host, port) -> addrinfo or error
+        self._resolving = {}  # (host, port) -> True
+        self._received = 0
+        self._starttime = 0
+        self._running = False
+        self._wakeup = None
+        self._woken = False
+        self._lock = thread.allocate_lock()
+
+    def stop(self):
+        self._lock.acquire()
+        for connections in self._inactive.values():
+            for lasttime, sock in connections:
+                sock.close()
+        self._inactive.clear()
+        self._lock.release()
+
+    def cancel(self):
+        FetcherHandler.cancel(self)
+        self._lock.acquire()
+        self._wakeUp()
+        self._lock.release()
+
+    def tick(self):
+        self._lock.acquire()
+        if self._queue and not self._cancel:
+            maxperhost = sysconf.get("max-host-downloads", self.MAXPERHOST)
+            started = False
+            for i in range(len(self._queue)-1,-1,-1):
+                item = self._queue[i]
+                host = item.getURL().host
+                if self._hostactive.get(host, 0) >= maxperhost:
+                    continue
+                if not self.changeActiveDownloads(+1):
+                    break
+                del self._queue[i]
+                self._hostactive[host] = self._hostactive.get(host, 0)+1
+                self._active.append(AsyncHTTPTransfer(self, item))
+                item.start()
+                started = True
+            if started:
+                if not self._running:
+                    self._running = True
+                    self._wakeup = os.pipe()
+                    thread.start_new_thread(self.perform, ())
+                else:
+                    self._wakeUp()
+        result = bool(self._queue or self._active)
+        self._lock.release()
+        return result
+
+    def _wakeUp(self):
+        # Must be called with the lock held.
+        if self._running and not self._woken:
+            self._woken = True
+            os.write(self._wakeup[1], "x")
+
+    def finish(self, transfer):
+        # The transfer is over, so its slot is free for the next one.
+        self._lock.acquire()
+        if transfer not in self._active:
+            self._lock.release()
+            return
+        self._active.remove(transfer)
+        self._hostactive[transfer.host] -= 1
+        self._lock.release()
+        self.changeActiveDownloads(-1)
+
+    def changeHost(self, transfer, host):
+        # A redirected transfer counts for the host it was sent to.
+        self._lock.acquire()
+        if transfer in self._active:
+            self._hostactive[transfer.host] -= 1
+            self._hostactive[host] = self._hostactive.get(host, 0)+1
+        transfer.host = host
+        self._lock.release()
+
+    def requeue(self, item):
+        self._lock.acquire()
+        self._queue.append(item)
+        self._lock.release()
+
+    def received(self, size):
+        self._received += size
+
+    def getAddress(self, address):
+        # Looking up a host may take a while, so it's done in another
+        # thread, and None is returned until the answer arrives. Failed
+        # lookups are raised until the transfers are over.
+        self._lock.acquire()
+        addrinfo = self._addresses.get(address)
+        if addrinfo is None and address not in self._resolving:
+            self._resolving[address] = True
+            thread.start_new_thread(self._resolve, (address,))
+        self._lock.release()
+        if isinstance(addrinfo, socket.error):
+            raise addrinfo
+        return addrinfo
+
+    def _resolve(self, address):
+        try:
+            addrinfo = socket.getaddrinfo(address[0], address[1],
+                                          0, socket.SOCK_STREAM)[0]
+        except socket.error, e:
+            addrinfo = e
+        self._lock.acquire()
+        del self._resolving[address]
+        self._addresses[address] = addrinfo
+        self._wakeUp()
+        self._lock.release()
+
+    def getConnection(self, key):
+        now = time.time()
+        sock = None
+        self._lock.acquire()
+        connections = self._inactive.get(key)
+        while connections:
+            lasttime, sock = connections.pop()
+            if lasttime+self.TIMEOUT > now:
+                break
+            sock.close()
+            sock = None
+        self._lock.release()
+        return sock
+
+    def putConnection(self, key, sock):
+        maxinactive = sysconf.get("max-keepalive-connections",
+                                  self.MAXINACTIVE)
+        self._lock.acquire()
+        connections = self._inactive.setdefault(key, [])
+        if len(connections) < maxinactive:
+            connections.append((time.time(), sock))
+            sock = None
+        self._lock.release()
+        if sock:
+            sock.close()
+
+    def dropConnections(self, key):
+        self._lock.acquire()
+        connections = self._inactive.pop(key, [])
+        self._lock.release()
+        for lasttime, sock in connections:
+            sock.close()
+
+    def start(self):
+        FetcherHandler.start(self)
+        self._received = 0
+        self._starttime = time.time()
+
+    def _stopRunning(self):
+        # Must be called with the lock held.
+        self._running = False
+        for fd in self._wakeup:
+            os.close(fd)
+        self._wakeup = None
+        self._woken = False
+        for address, addrinfo in self._addresses.items():
+            if isinstance(addrinfo, socket.error):
+                del self._addresses[address]
+
+    def perform(self):
+        try:
+            self._perform()
+        except:
+            # Don't leave the fetcher waiting on what was running.
+            self._lock.acquire()
+            transfers = self._active[:]
+            self._lock.release()
+            for transfer in transfers:
+                transfer.fail(_("Internal error"))
+            self._lock.acquire()
+            self._stopRunning()
+            self._lock.release()
+            raise
+
+    def _perform(self):
+        import select
+        timeout = sysconf.get("socket-timeout", SOCKETTIMEOUT)
+        ratelimit = self._fetcher._maxdownloadrate
+        while True:
+            self._lock.acquire()
+            if not self._active:
+                self._stopRunning()
+                self._lock.release()
+                break
+            transfers = self._active[:]
+            wakeup = self._wakeup[0]
+            self._lock.release()
+
+            if self._cancel:
+                for transfer in transfers:
+                    transfer.cancel()
+                continue
+
+            # New transfers are connected here rather than in tick(),
+            # and wait here for the address of their host as well.
+            now = time.time()
+            for transfer in transfers:
+                wanted = transfer.getWanted()
+                if wanted is None:
+                    self._step(transfer, transfer.connect)
+                elif transfer.lasttime+timeout < now:
+                    transfer.fail(_("Connection timed out"))
+                elif wanted == "a":
+                    self._step(transfer, transfer.resolve)
+
+            self._lock.acquire()
+            transfers = self._active[:]
+            self._lock.release()
+
+            rlist = [wakeup]
+            wlist = []
+            wait = 1.0
+            if ratelimit:
+                ahead = (self._received/float(ratelimit) -
+                         (now-self._starttime))
+            else:
+                ahead = 0
+            if ahead > 0:
+                # Too fast, so just wait for a while.
+                wait = min(wait, ahead)
+            else:
+                for transfer in transfers:
+                    wanted = transfer.getWanted()
+                    if wanted == "r":
+                        rlist.append(transfer)
+                    elif wanted == "w":
+                        wlist.append(transfer)
+            try:
+                rlist, wlist, xlist = select.select(rlist, wlist, [], wait)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if wakeup in rlist:
+                rlist.remove(wakeup)
+                self._lock.acquire()
+                os.read(wakeup, 1)
+                self._woken = False
+                self._lock.release()
+            for transfer in rlist+wlist:
+                self._step(transfer, transfer.step)
+
+    def _step(self, transfer, func):
+        try:
+            func()
+        except (IOError, OSError, Error, socket.error), e:
+            try:
+                errmsg = unicode(e[1])
+            except IndexError:
+                errmsg = unicode(e)
+            transfer.fail(errmsg)
+
+def enableAsyncHTTP():
+    for scheme in ("http", "https"):
+        Fetcher.setHandler(scheme, AsyncHTTPHandler)
+
+hooks.register("enable-async-http", enableAsyncHTTP)
+
 class SCPHandler(FetcherHandler):
 
     MAXACTIVE = 5
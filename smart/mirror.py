@@ -23,52 +23,133 @@ from smart import *
 import random
 import time
 
-HISTORYPERMIRROR = 20
-HISTORYCUTDELAY = 60
-GRANULARITY = 100
+# Weight of a new sample in the estimates.
+WEIGHT = 0.3
+# Failures are forgotten by half after this many seconds.
+FAILUREHALFLIFE = 24*60*60
+# Transfers smaller than this are dominated by latency.
+SMALLSIZE = 64*1024
+# Size considered when it's not known.
+DEFAULTSIZE = 256*1024
+# A mirror which always fails costs this many times more.
+FAILUREPENALITY = 4
+# Mirrors which are close enough, in seconds, are considered
+# equal to distribute load.
+GRANULARITY = 0.1
 
 class MirrorSystem(object):
 
     def __init__(self):
         self._mirrors = {}
-        self._history = []
-        self._penality = {}
-        self._changed = False
-        self._historychanged = False
-        self._lastcuttime = 0
+        self._stats = {} # mirror -> (latency, throughput, failures, time)
+        self._statschanged = False
 
     def getMirrors(self):
         return self._mirrors
 
     def setMirrors(self, mirrors):
-        self._changed = True
         self._mirrors = mirrors
 
-    def getHistory(self):
-        return self._history
+    def getStats(self):
+        return self._stats
 
-    def setHistory(self, history):
-        self._changed = True
-        self._history = history
-        self._historychanged = False
+    def setStats(self, stats):
+        self._stats = stats
+        self._statschanged = False
 
-    def getHistoryChanged(self):
-        return self._historychanged
+    def getStatsChanged(self):
+        return self._statschanged
+
+    def clearStats(self, mirrors=None):
+        if mirrors is None:
+            self._stats.clear()
+        else:
+            for mirror in mirrors:
+                if mirror in self._stats:
+                    del self._stats[mirror]
+        self._statschanged = True
+
+    def importHistory(self, history):
+        # Build the estimates from the old history format, which
+        # had the most recent information first.
+        history = history[:]
+        history.reverse()
+        for mirror, info in history:
+            self.addInfo(mirror, **info)
 
     def addInfo(self, mirror, **info):
-        if mirror:
-            self._changed = True
-            self._history.insert(0, (mirror, info))
-            self._historychanged = True
-            now = time.time()
-            if now-self._lastcuttime > HISTORYCUTDELAY:
-                self._lastcuttime = now
-                count = 0
-                for origin in self._mirrors:
-                    count += 1+len(self._mirrors[origin])
-                del self._history[count*HISTORYPERMIRROR:]
-
-    def get(self, url): 
+        if not mirror:
+            return
+        now = time.time()
+        latency, throughput, failures, _ = self.getEstimates(mirror, now)
+        if info.get("failed"):
+            failures += (1-failures)*WEIGHT
+        else:
+            failures -= failures*WEIGHT
+            size = info.get("size")
+            elapsed = info.get("time")
+            sample = info.get("latency")
+            if sample is None and size and size < SMALLSIZE:
+                sample = elapsed
+            if sample is not None:
+                if latency is None:
+                    latency = sample
+                else:
+                    latency += (sample-latency)*WEIGHT
+            if size and elapsed and size >= SMALLSIZE:
+                elapsed -= info.get("latency") or 0
+                if elapsed > 0:
+                    sample = size/float(elapsed)
+                    if throughput is None:
+                        throughput = sample
+                    else:
+                        throughput += (sample-throughput)*WEIGHT
+        self._stats[mirror] = (latency, throughput, failures, now)
+        self._statschanged = True
+
+    def getEstimates(self, mirror, now=None):
+        # Return the latency, throughput and failure rate estimated
+        # for the mirror, and when it was last used.
+        stats = self._stats.get(mirror)
+        if not stats:
+            return None, None, 0.0, None
+        latency, throughput, failures, last = stats
+        if failures:
+            if now is None:
+                now = time.time()
+            failures *= 0.5**(max(now-last, 0)/FAILUREHALFLIFE)
+        return latency, throughput, failures, last
+
+    def getCosts(self, size=None):
+        # Return the expected time, in seconds, to fetch a file of the
+        # given size from each mirror with information, penalized by
+        # its failure rate. Mirrors with nothing but failures cost as
+        # much as the worst known one.
+        if not size:
+            size = DEFAULTSIZE
+        now = time.time()
+        costs = {}
+        justerrors = []
+        maxcost = 0
+        for mirror in self._stats:
+            latency, throughput, failures, _ = self.getEstimates(mirror, now)
+            if latency is None and not throughput:
+                justerrors.append((mirror, failures))
+                continue
+            cost = latency or 0
+            if throughput:
+                cost += size/throughput
+            if cost > maxcost:
+                maxcost = cost
+            costs[mirror] = cost*(1+FAILUREPENALITY*failures)
+        for mirror, failures in justerrors:
+            costs[mirror] = (maxcost or 1)*(1+FAILUREPENALITY*failures)
+        return costs
+
+    def getPenalities(self):
+        return self.getCosts()
+
+    def get(self, url, size=None):
         elements = {}
         for origin in self._mirrors:
             if url.startswith(origin):
@@ -79,46 +160,7 @@ class MirrorSystem(object):
             elements = elements.values()
         else:
             elements = [MirrorElement(self, "", "")]
-        return MirrorItem(self, url, elements)
-
-    def getPenalities(self):
-        self.updatePenality()
-        return self._penality
-
-    def updatePenality(self):
-        if not self._changed:
-            return
-        self._changed = False
-        self._penality.clear()
-        data = {}
-        for mirror, info in self._history:
-            if mirror not in data:
-                mirrordata = data.setdefault(mirror, {"size": 0, "time": 0,
-                                                      "failed": 0})
-            else:
-                mirrordata = data[mirror]
-            mirrordata["size"] += info.get("size", 0)
-            mirrordata["time"] += info.get("time", 0)
-            mirrordata["failed"] += info.get("failed", 0)
-        maxpenality = 1
-        justerrors = []
-        for mirror in data:
-            mirrordata = data[mirror]
-            if mirrordata["size"]:
-                penality = (mirrordata["time"]*1000000)/mirrordata["size"]
-                penality += mirrordata["failed"]*(penality*0.1)
-                # Integer division by granularity ensures that mirrors
-                # which are close enough will be considered equal to
-                # distribute load.
-                penality /= GRANULARITY
-                self._penality[mirror] = penality
-                if penality > maxpenality:
-                    maxpenality = penality
-            elif mirrordata["failed"]:
-                justerrors.append(mirror)
-        if justerrors:
-            for mirror in justerrors:
-                self._penality[mirror] = maxpenality
+        return MirrorItem(self, url, elements, size)
 
 class MirrorElement(object):
 
@@ -130,36 +172,43 @@ class MirrorElement(object):
         if origin and mirror and origin[-1] == "/" and mirror[-1] != "/":
             self.mirror += "/"
 
-    def __cmp__(self, other):
-        # Give priority to local files.
-        rc = -cmp(self.mirror.startswith("file://"),
-                  other.mirror.startswith("file://"))
-        if rc == 0:
-            # Otherwise, check penality.
-            pen = self._system._penality
-            rc = cmp(pen.get(self.mirror, 0), pen.get(other.mirror, 0))
-        return rc
-
 class MirrorItem(object):
 
-    def __init__(self, system, url, elements):
+    def __init__(self, system, url, elements, size=None):
         self._system = system
         self._url = url
         self._elements = elements
+        self._size = size
         self._current = None
 
     def addInfo(self, **info):
-        if self._current and hasattr(self._current, 'mirror'):
-            self._system.addInfo(self._current.mirror, **info)
+        current = self._current
+        if current and hasattr(current, 'mirror'):
+            self._system.addInfo(current.mirror, **info)
+
+    def sortElements(self):
+        # Give priority to local files, and otherwise to the mirrors
+        # expected to be faster for the size being fetched.
+        costs = self._system.getCosts(self._size)
+        random.shuffle(self._elements)
+        elements = []
+        for i, elem in enumerate(self._elements):
+            elements.append((not elem.mirror.startswith("file://"),
+                             int(costs.get(elem.mirror, 0)/GRANULARITY),
+                             i, elem))
+        elements.sort()
+        self._elements = [x[-1] for x in elements]
+
+    def getAlternatives(self, count):
+        # URLs of the best mirrors which weren't tried yet, without
+        # using them up.
+        self.sortElements()
+        return [elem.mirror+self._url[len(elem.origin):]
+                for elem in self._elements[:count]]
 
     def getNext(self):
         if self._elements:
-            self._system.updatePenality()
-            random.shuffle(self._elements)
-            self._elements.sort()
-            #for i, item in enumerate(self._elements):
-            #    penality = self._system.getPenalities().get(item.mirror, 0)
-            #    print "%d. %s (%d)" % (i, item.mirror, penality)
+            self.sortElements()
             self._current = elem = self._elements.pop(0)
             return elem.mirror+self._url[len(elem.origin):]
         else:
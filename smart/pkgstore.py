@@ -0,0 +1,128 @@
+#
+# Copyright (c) 2009 Smart Package Manager Team.
+#
+# This file is part of Smart Package Manager.
+#
+# Smart Package Manager is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; either version 2 of the License, or (at
+# your option) any later version.
+#
+# Smart Package Manager is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Smart Package Manager; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+from smart.util.pathlocks import PathLocks
+from smart import *
+import shutil
+import os
+
+class PackageStore(object):
+    # Package files kept by their sha256 digest in a directory which
+    # may be shared by several data dirs, so that each file is only
+    # fetched once. Files are hardlinked between the store and the
+    # data dirs when possible, so that they're only stored once as
+    # well, and the link count tells whether some data dir still has
+    # them. Files nobody else has are removed, the least recently used
+    # ones first, when they take more than maxsize bytes.
+    #
+    # Files are put in place atomically, so getting and adding them
+    # only needs a shared lock on the store. Cleaning it up needs an
+    # exclusive one.
+
+    def __init__(self, path, maxsize=0):
+        self._path = path
+        self._maxsize = maxsize
+        self._pathlocks = PathLocks()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def getPath(self, sha256):
+        return os.path.join(self._path, sha256[:2], sha256)
+
+    def _link(self, path, targetpath):
+        # Put a link to path, or a copy of it if that's not possible,
+        # at targetpath.
+        targetpathtmp = "%s.%d.tmp" % (targetpath, os.getpid())
+        try:
+            os.link(path, targetpathtmp)
+        except OSError:
+            shutil.copyfile(path, targetpathtmp)
+        os.rename(targetpathtmp, targetpath)
+
+    def get(self, sha256, localpath):
+        # Put the file with the given digest at localpath, returning
+        # whether it was in the store.
+        path = self.getPath(sha256)
+        self._pathlocks.lock(self._path, block=True)
+        try:
+            if not os.path.isfile(path):
+                return False
+            try:
+                self._link(path, localpath)
+                os.utime(path, None)
+            except (IOError, OSError), e:
+                iface.debug(_("Can't get %s from the package store: %s")
+                            % (path, e))
+                return False
+        finally:
+            self._pathlocks.unlock(self._path)
+        return True
+
+    def add(self, sha256, localpath):
+        # Keep the file at localpath, which must have been checked
+        # to have the given digest. A previous file with the same
+        # digest is replaced, since it may have been broken.
+        path = self.getPath(sha256)
+        self._pathlocks.lock(self._path, block=True)
+        try:
+            try:
+                if os.path.isfile(path) and os.path.samefile(path,
+                                                             localpath):
+                    os.utime(path, None)
+                    return
+                dirname = os.path.dirname(path)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                self._link(localpath, path)
+            except (IOError, OSError), e:
+                iface.debug(_("Can't add %s to the package store: %s")
+                            % (localpath, e))
+        finally:
+            self._pathlocks.unlock(self._path)
+
+    def cleanup(self):
+        if not self._maxsize:
+            return
+        self._pathlocks.lock(self._path, exclusive=True, block=True)
+        try:
+            unused = []
+            total = 0
+            for dirname, dirnames, filenames in os.walk(self._path):
+                for filename in filenames:
+                    path = os.path.join(dirname, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    if st.st_nlink == 1:
+                        unused.append((st.st_mtime, st.st_size, path))
+                        total += st.st_size
+            unused.sort()
+            for mtime, size, path in unused:
+                if total <= self._maxsize:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+        finally:
+            self._pathlocks.unlock(self._path)
+
+# vim:ts=4:sw=4:et
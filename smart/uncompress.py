@@ -45,6 +45,161 @@ class Uncompressor(object):
         else:
             raise Error, _("Unknown compressed file: %s") % localpath
 
+    def open(self, localpath, digests=()):
+        # Return a file with the uncompressed data of localpath, read
+        # as a stream, or None if its handler can't do that.
+        decompressor = None
+        handler = self.getHandler(localpath)
+        if handler:
+            decompressor = handler.getDecompressor()
+            if not decompressor:
+                return None
+            decompressor = StreamsDecompressor(handler, decompressor)
+        return UncompressedFile(localpath, decompressor, digests)
+    open = classmethod(open)
+
+    def stream(self, localpath):
+        # Return a file into which the compressed data of localpath
+        # may be written as it arrives, uncompressing it on the way,
+        # or None if its handler can't do that.
+        handler = self.getHandler(localpath)
+        if handler:
+            decompressor = handler.getDecompressor()
+            if decompressor:
+                decompressor = StreamsDecompressor(handler, decompressor)
+                return UncompressingFile(handler.getTargetPath(localpath),
+                                         decompressor)
+        return None
+    stream = classmethod(stream)
+
+class StreamsDecompressor(object):
+    # Decompressor going on through concatenated compressed streams,
+    # which gzip and bzip2 files may have, while the decompressors
+    # given by handlers stop after the first one. Trailing zeros,
+    # which gzip files may be padded with, are left alone.
+
+    def __init__(self, handler, decompressor):
+        self._handler = handler
+        self._decompressor = decompressor
+
+    def decompress(self, data):
+        try:
+            result = self._decompressor.decompress(data)
+        except EOFError:
+            # The last stream ended right before this data.
+            self._decompressor = self._handler.getDecompressor()
+            result = self._decompressor.decompress(data)
+        unused = getattr(self._decompressor, "unused_data", "")
+        while unused.strip("\0"):
+            self._decompressor = self._handler.getDecompressor()
+            result += self._decompressor.decompress(unused)
+            unused = getattr(self._decompressor, "unused_data", "")
+        return result
+
+    def flush(self):
+        flush = getattr(self._decompressor, "flush", None)
+        if flush:
+            return flush()
+        return ""
+
+class UncompressedFile(object):
+    # File-like object reading the uncompressed data of a file in
+    # blocks, and feeding it to the given digests on the way. A
+    # decompressor of None reads the file as it is.
+
+    def __init__(self, localpath, decompressor, digests=()):
+        self._localpath = localpath
+        self._file = open(localpath)
+        self._decompressor = decompressor
+        self._digests = digests
+        self._buffer = ""
+        self._offset = 0
+        self._eof = False
+
+    def _fill(self):
+        data = self._file.read(BLOCKSIZE)
+        decompressor = self._decompressor
+        try:
+            if data:
+                if decompressor:
+                    data = decompressor.decompress(data)
+            else:
+                self._eof = True
+                flush = getattr(decompressor, "flush", None)
+                if flush:
+                    data = flush()
+        except Exception, e:
+            # IOError, EOFError, zlib.error, lzma.LZMAError and friends.
+            raise Error, ("%s: %s\nPossibly corrupted channel file.") % \
+                         (self._localpath, e)
+        for digest in self._digests:
+            digest.update(data)
+        self._buffer = self._buffer[self._offset:]+data
+        self._offset = 0
+
+    def read(self, size=-1):
+        while (not self._eof and
+               (size < 0 or len(self._buffer)-self._offset < size)):
+            self._fill()
+        if size < 0:
+            end = len(self._buffer)
+        else:
+            end = self._offset+size
+        data = self._buffer[self._offset:end]
+        self._offset += len(data)
+        return data
+
+    def tell(self):
+        # Position in the compressed file, so that progress based on
+        # its size keeps working.
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+        self._buffer = ""
+        self._offset = 0
+
+class UncompressingFile(object):
+    # File-like object uncompressing the data written into it to a
+    # partial file of targetpath, which is only put in place by a
+    # successful close(). Broken data isn't reported here, but makes
+    # close() return False, so that the file may be uncompressed
+    # again the usual way, which reports the problem.
+
+    def __init__(self, targetpath, decompressor):
+        self._targetpath = targetpath
+        self._targetpathpart = targetpath+".part"
+        self._file = open(self._targetpathpart, "w")
+        self._decompressor = decompressor
+        self._broken = False
+
+    def write(self, data):
+        if not self._broken:
+            try:
+                self._file.write(self._decompressor.decompress(data))
+            except Exception:
+                self._broken = True
+
+    def close(self):
+        if not self._broken:
+            try:
+                flush = getattr(self._decompressor, "flush", None)
+                if flush:
+                    self._file.write(flush())
+                self._file.close()
+                os.rename(self._targetpathpart, self._targetpath)
+                return True
+            except Exception:
+                self._broken = True
+        self.abort()
+        return False
+
+    def abort(self):
+        self._broken = True
+        self._file.close()
+        if os.path.isfile(self._targetpathpart):
+            os.unlink(self._targetpathpart)
+
 class UncompressorHandler(object):
 
     def query(self, localpath):
@@ -56,6 +211,9 @@ class UncompressorHandler(object):
     def uncompress(self, localpath):
         raise Error, _("Unsupported file type")
 
+    def getDecompressor(self):
+        return None
+
 class BZ2Handler(UncompressorHandler):
 
     def query(self, localpath):
@@ -65,6 +223,10 @@ class BZ2Handler(UncompressorHandler):
     def getTargetPath(self, localpath):
         return localpath[:-4]
 
+    def getDecompressor(self):
+        import bz2
+        return bz2.BZ2Decompressor()
+
     def uncompress(self, localpath):
         import bz2
         try:
@@ -91,6 +253,13 @@ class LZMAHandler(UncompressorHandler):
         if localpath.endswith(".lzma"):
             return localpath[:-5]
 
+    def getDecompressor(self):
+        try:
+            import lzma
+        except ImportError:
+            return None
+        return lzma.LZMADecompressor()
+
     def uncompress(self, localpath):
         try:
             import lzma
@@ -126,6 +295,13 @@ class XZHandler(UncompressorHandler):
         if localpath.endswith(".xz"):
             return localpath[:-3]
 
+    def getDecompressor(self):
+        try:
+            import lzma
+        except ImportError:
+            return None
+        return lzma.LZMADecompressor()
+
     def uncompress(self, localpath):
         import lzma
         try:
@@ -151,6 +327,10 @@ class GZipHandler(UncompressorHandler):
     def getTargetPath(self, localpath):
         return localpath[:-3]
 
+    def getDecompressor(self):
+        import zlib
+        return zlib.decompressobj(16+zlib.MAX_WBITS)
+
     def uncompress(self, localpath):
         import gzip
         try:
@@ -0,0 +1,589 @@
+import unittest
+import cPickle
+import os
+
+from smart.backends.deb.base import DebPackage, DebProvides, \
+                                    DebNameProvides, DebRequires, \
+                                    DebOrRequires, DebUpgrades, DebConflicts
+from smart.cache import Cache, Loader, Package, Provides, Requires, \
+                        Upgrades, Conflicts, StateVersionError, \
+                        dumpCache, loadCache
+
+from smart import sysconf
+
+from tests.mocker import MockerTestCase
+
+
+class FakeLoader(Loader):
+
+    def __init__(self, packages=(), pkgclass=Package):
+        Loader.__init__(self)
+        self.fake_packages = packages
+        self.fake_pkgclass = pkgclass
+        self.fake_files = {}
+
+    def load(self):
+        for offset, (name, version, prvargs, reqargs, upgargs, cnfargs) \
+                in enumerate(self.fake_packages):
+            pkg = self.buildPackage((self.fake_pkgclass, name, version),
+                                    prvargs, reqargs, upgargs, cnfargs)
+            pkg.loaders[self] = offset
+
+    def loadFileProvides(self, fndict):
+        for pkg in self._packages:
+            for path in self.fake_files.get(pkg.name, ()):
+                if path in fndict:
+                    self.buildFileProvides(pkg, (Provides, path, None))
+
+
+PACKAGES = [
+    ("foo", "1.0",
+     [(Provides, "foo", "1.0"), (Provides, "libfoo", None)],
+     [(Requires, "bar", None, None)],
+     [(Upgrades, "foo", "<", "1.0")],
+     [(Conflicts, "baz", None, None)]),
+    ("foo", "2.0",
+     [(Provides, "foo", "2.0"), (Provides, "libfoo", None)],
+     [(Requires, "bar", None, None)],
+     [(Upgrades, "foo", "<", "2.0")],
+     None),
+    ("bar", "1.0",
+     [(Provides, "bar", "1.0")],
+     None, None, None),
+]
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = Cache()
+        self.loader = FakeLoader(PACKAGES)
+        self.cache.addLoader(self.loader)
+        self.cache.load()
+
+    def names(self, objs):
+        return sorted([str(obj) for obj in objs])
+
+    def test_getPackages_by_name(self):
+        self.assertEquals(self.names(self.cache.getPackages("foo")),
+                          ["foo-1.0", "foo-2.0"])
+        self.assertEquals(self.names(self.cache.getPackages("bar")),
+                          ["bar-1.0"])
+        self.assertEquals(self.cache.getPackages("missing"), [])
+
+    def test_getPackages_without_name(self):
+        self.assertEquals(len(self.cache.getPackages()), 3)
+        self.assertEquals(len(self.cache.getPackages(None)), 3)
+
+    def test_getPackages_returns_copy(self):
+        self.cache.getPackages("foo").append(None)
+        self.assertEquals(len(self.cache.getPackages("foo")), 2)
+
+    def test_getProvides_by_name(self):
+        self.assertEquals(self.names(self.cache.getProvides("libfoo")),
+                          ["libfoo"])
+        self.assertEquals(self.names(self.cache.getProvides("foo")),
+                          ["foo = 1.0", "foo = 2.0"])
+
+    def test_getRequires_by_name(self):
+        self.assertEquals(self.names(self.cache.getRequires("bar")), ["bar"])
+        self.assertEquals(self.cache.getRequires("foo"), [])
+
+    def test_getUpgrades_by_name(self):
+        self.assertEquals(self.names(self.cache.getUpgrades("foo")),
+                          ["foo < 1.0", "foo < 2.0"])
+
+    def test_getConflicts_by_name(self):
+        self.assertEquals(self.names(self.cache.getConflicts("baz")),
+                          ["baz"])
+
+    def test_reset_clears_indexes(self):
+        self.cache.reset()
+        self.assertEquals(self.cache.getPackages("foo"), [])
+        self.assertEquals(self.cache.getProvides("foo"), [])
+
+    def test_reload_rebuilds_indexes(self):
+        self.cache.reset()
+        self.cache.load()
+        self.assertEquals(self.names(self.cache.getPackages("foo")),
+                          ["foo-1.0", "foo-2.0"])
+        self.assertEquals(self.names(self.cache.getRequires("bar")), ["bar"])
+
+    def test_setstate_rebuilds_indexes(self):
+        cache = cPickle.loads(cPickle.dumps(self.cache, 2))
+        self.assertEquals(self.names(cache.getPackages("foo")),
+                          ["foo-1.0", "foo-2.0"])
+        self.assertEquals(self.names(cache.getProvides("libfoo")),
+                          ["libfoo"])
+
+    def test_names_are_shared(self):
+        pkg = Package("".join(["f", "oo"]), "".join(["1.", "0"]))
+        prv = Provides("".join(["f", "oo"]), "".join(["1.", "0"]))
+        req = Requires("".join(["f", "oo"]), "".join([">", "="]),
+                       "".join(["1.", "0"]))
+        self.assertTrue(pkg.name is prv.name is req.name)
+        self.assertTrue(pkg.version is prv.version is req.version)
+        self.assertTrue(req.relation is intern(">="))
+
+    def test_buildFileProvides_updates_indexes(self):
+        loader = FakeLoader([("qux", "1.0", [(Provides, "qux", "1.0")],
+                              [(Requires, "/bin/qux", None, None)],
+                              None, None)])
+        self.cache.addLoader(loader)
+        self.cache.load()
+        pkg = self.cache.getPackages("qux")[0]
+        self.assertEquals(len(self.cache.getRequires("/bin/qux")), 1)
+        loader.buildFileProvides(pkg, (Provides, "/bin/qux", None))
+        self.assertEquals(self.cache.getRequires("/bin/qux"), [])
+        self.assertEquals(self.names(self.cache.getProvides("/bin/qux")),
+                          ["/bin/qux"])
+
+
+LINKED_PACKAGES = [
+    ("foo", "1.0",
+     [(DebNameProvides, "foo", "1.0"), (DebProvides, "libfoo", None)],
+     [(DebRequires, "bar", None, None)],
+     [(DebUpgrades, "foo", "<", "1.0")],
+     [(DebConflicts, "baz", None, None)]),
+    ("foo", "2.0",
+     [(DebNameProvides, "foo", "2.0"), (DebProvides, "libfoo", None)],
+     [(DebOrRequires, (("bar", ">=", "1.0"), ("baz", None, None)))],
+     [(DebUpgrades, "foo", "<", "2.0")],
+     None),
+    ("bar", "1.0",
+     [(DebNameProvides, "bar", "1.0")],
+     [(DebRequires, "libfoo", None, None)],
+     [(DebUpgrades, "bar", "<", "1.0")],
+     None),
+]
+
+
+class IncrementalLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = Cache()
+        self.loader = FakeLoader(LINKED_PACKAGES, DebPackage)
+        self.cache.addLoader(self.loader)
+        self.cache.load()
+
+    def names(self, objs):
+        return sorted([str(obj) for obj in objs])
+
+    def links(self, cache):
+        # Everything load() computes, in a comparable form.
+        result = []
+        for pkg in cache.getPackages():
+            result.append((str(pkg), pkg.installed))
+        for prv in cache.getProvides():
+            result.append((str(prv), self.names(prv.packages),
+                           self.names(prv.requiredby),
+                           self.names(prv.upgradedby),
+                           self.names(prv.conflictedby)))
+        for attr in ("getRequires", "getUpgrades", "getConflicts"):
+            for dep in getattr(cache, attr)():
+                result.append((attr, str(dep), self.names(dep.packages),
+                               self.names(dep.providedby)))
+        for attr in ("_reqmatchnames", "_recmatchnames",
+                     "_upgmatchnames", "_cnfmatchnames"):
+            for name, deps in getattr(cache, attr).items():
+                result.append((attr, name, self.names(deps)))
+        return sorted(result)
+
+    def assertLinksLike(self, packages):
+        cache = Cache()
+        cache.addLoader(FakeLoader(packages, DebPackage))
+        cache.load()
+        self.assertEquals(self.links(self.cache), self.links(cache))
+
+    def test_add_loader(self):
+        bar = self.cache.getPackages("bar")[0]
+        providedby = bar.requires[0].providedby
+        packages = [("baz", "1.0", [(DebNameProvides, "baz", "1.0")],
+                     [(DebRequires, "foo", ">=", "2.0")], None,
+                     [(DebConflicts, "bar", None, None)])]
+        self.cache.addLoader(FakeLoader(packages, DebPackage))
+        self.cache.load()
+        self.assertTrue(bar.requires[0].providedby is providedby)
+        self.assertEquals(self.names(self.cache.getRequires("foo")[0]
+                                     .providedby), ["foo = 2.0"])
+        foo = sorted(self.cache.getPackages("foo"))
+        self.assertEquals(self.names(foo[0].conflicts[0].providedby),
+                          ["baz = 1.0"])
+        self.assertEquals(self.names(foo[1].requires[0].providedby),
+                          ["bar = 1.0", "baz = 1.0"])
+        self.assertLinksLike(LINKED_PACKAGES+packages)
+
+    def test_remove_loader(self):
+        packages = [("baz", "1.0", [(DebNameProvides, "baz", "1.0")],
+                     [(DebRequires, "foo", ">=", "2.0")], None, None)]
+        loader = FakeLoader(packages, DebPackage)
+        self.cache.addLoader(loader)
+        self.cache.load()
+        self.cache.removeLoader(loader)
+        self.cache.load()
+        self.assertEquals(self.cache.getPackages("baz"), [])
+        self.assertEquals(self.cache.getProvides("baz"), [])
+        self.assertEquals(self.cache.getRequires("foo"), [])
+        self.assertLinksLike(LINKED_PACKAGES)
+
+    def test_replace_loader(self):
+        self.cache.removeLoader(self.loader)
+        packages = LINKED_PACKAGES[1:]+[
+            ("baz", "1.0", [(DebNameProvides, "baz", "1.0")], None,
+             [(DebUpgrades, "foo", "<", "2.0")], None)]
+        self.loader = FakeLoader(packages, DebPackage)
+        self.cache.addLoader(self.loader)
+        self.cache.load()
+        self.assertLinksLike(packages)
+
+    def test_shared_package(self):
+        loader = FakeLoader(LINKED_PACKAGES[2:], DebPackage)
+        loader.setInstalled(True)
+        self.cache.addLoader(loader)
+        self.cache.load()
+        bar = self.cache.getPackages("bar")[0]
+        self.assertEquals(bar.installed, True)
+        self.assertEquals(len(bar.loaders), 2)
+        self.cache.removeLoader(loader)
+        self.cache.load()
+        self.assertTrue(self.cache.getPackages("bar")[0] is bar)
+        self.assertEquals(bar.installed, False)
+        self.assertEquals(bar.loaders, {self.loader: 2})
+        self.assertLinksLike(LINKED_PACKAGES)
+
+    def test_file_provides(self):
+        packages = [("qux", "1.0", None,
+                     [(DebRequires, "/bin/foo", None, None)], None, None)]
+        self.loader.fake_files["foo"] = ["/bin/foo"]
+        self.cache.addLoader(FakeLoader(packages, DebPackage))
+        self.cache.load()
+        self.assertEquals(self.names(self.cache.getRequires("/bin/foo")[0]
+                                     .providedby), ["/bin/foo"])
+
+    def test_reset(self):
+        self.cache.reset()
+        self.cache.load()
+        self.assertLinksLike(LINKED_PACKAGES)
+
+    def freshLinks(self, loaders):
+        cache = Cache()
+        for loader in loaders:
+            fresh = FakeLoader(loader.fake_packages, DebPackage)
+            fresh.fake_files = loader.fake_files
+            cache.addLoader(fresh)
+        cache.load()
+        return self.links(cache)
+
+    def test_file_provides_of_removed_requires(self):
+        self.loader.fake_files["foo"] = ["/bin/foo"]
+        packages = [("qux", "1.0", None,
+                     [(DebRequires, "/bin/foo", None, None)], None,
+                     [(DebConflicts, "/bin/foo", None, None)])]
+        loader = FakeLoader(packages, DebPackage)
+        self.cache.addLoader(loader)
+        self.cache.load()
+        self.assertEquals(self.names(self.cache.getProvides("/bin/foo")),
+                          ["/bin/foo"])
+        self.cache.removeLoader(loader)
+        self.cache.load()
+        self.assertEquals(self.cache.getProvides("/bin/foo"), [])
+        self.assertEquals(self.links(self.cache),
+                          self.freshLinks([self.loader]))
+
+    def test_file_provides_of_satisfied_requires(self):
+        packages = [("qux", "1.0", [(DebNameProvides, "qux", "1.0")],
+                     [(DebRequires, "/bin/qux", None, None)], None, None)]
+        loader = FakeLoader(packages, DebPackage)
+        loader.fake_files["qux"] = ["/bin/qux"]
+        self.cache.addLoader(loader)
+        self.cache.load()
+        # The require is satisfied by qux itself, and dropped.
+        self.assertEquals(self.cache.getRequires("/bin/qux"), [])
+        other = FakeLoader([("quux", "1.0",
+                             [(DebNameProvides, "quux", "1.0")],
+                             None, None, None)], DebPackage)
+        other.fake_files["quux"] = ["/bin/qux"]
+        self.cache.addLoader(other)
+        self.cache.load()
+        self.assertEquals(self.names(self.cache.getProvides("/bin/qux")[0]
+                                     .packages), ["quux_1.0", "qux_1.0"])
+        self.assertEquals(self.links(self.cache),
+                          self.freshLinks([self.loader, loader, other]))
+
+    def test_restored_cache(self):
+        self.loader.fake_files["foo"] = ["/bin/foo"]
+        packages = [("baz", "1.0", [(DebNameProvides, "baz", "1.0")],
+                     [(DebRequires, "/bin/foo", None, None)], None, None)]
+        self.cache.addLoader(FakeLoader(packages, DebPackage))
+        self.cache.load()
+        links = self.links(self.cache)
+        self.cache = cPickle.loads(cPickle.dumps(self.cache, 2))
+        self.assertEquals(self.links(self.cache), links)
+        loader, other = self.cache._loaders
+        bar = self.cache.getPackages("bar")[0]
+        providedby = bar.requires[0].providedby
+        self.cache.removeLoader(other)
+        self.cache.load()
+        # Linked incrementally, rather than from scratch.
+        self.assertTrue(bar.requires[0].providedby is providedby)
+        self.assertEquals(self.cache.getProvides("/bin/foo"), [])
+        self.assertEquals(self.links(self.cache), self.freshLinks([loader]))
+
+    def test_restored_cache_with_removed_loader(self):
+        self.cache.removeLoader(self.loader)
+        self.cache = cPickle.loads(cPickle.dumps(self.cache, 2))
+        self.assertEquals(self.cache._linked, {})
+        self.cache.load()
+        self.assertEquals(self.cache.getPackages(), [])
+
+    def test_file_provides_like_full_load(self):
+        import random
+        paths = ["/bin/a", "/bin/b", "/bin/c"]
+        for seed in range(200):
+            rand = random.Random(seed)
+            loaders = []
+            for i in range(4):
+                packages = []
+                files = {}
+                for j in range(3):
+                    name = "p%d%d" % (i, j)
+                    reqs = [(DebRequires, x, None, None)
+                            for x in rand.sample(paths, rand.randint(0, 2))]
+                    cnfs = [(DebConflicts, x, None, None)
+                            for x in rand.sample(paths, rand.randint(0, 1))]
+                    packages.append((name, "1.0",
+                                     [(DebNameProvides, name, "1.0")],
+                                     reqs, None, cnfs))
+                    files[name] = rand.sample(paths, rand.randint(0, 2))
+                loader = FakeLoader(packages, DebPackage)
+                loader.fake_files = files
+                loaders.append(loader)
+            cache = Cache()
+            active = []
+            for step in range(6):
+                loader = rand.choice(loaders)
+                if loader in active:
+                    cache.removeLoader(loader)
+                    active.remove(loader)
+                    # Removed loaders are loaded again from scratch.
+                    loader.reset()
+                else:
+                    cache.addLoader(loader)
+                    active.append(loader)
+                cache.load()
+                self.assertEquals(self.links(cache),
+                                  self.freshLinks(active),
+                                  "seed %d, step %d" % (seed, step))
+
+    def test_overloaded_matches(self):
+        class AnyRequires(DebRequires):
+            __slots__ = ()
+            def matches(self, prv):
+                return True
+        packages = [("baz", "1.0", None,
+                     [(AnyRequires, "foo", ">=", "3.0")], None, None)]
+        self.cache.addLoader(FakeLoader(packages, DebPackage))
+        self.cache.load()
+        req = self.cache.getPackages("baz")[0].requires[0]
+        self.assertEquals(self.names(req.providedby),
+                          ["foo = 1.0", "foo = 2.0"])
+
+    def test_match_names(self):
+        packages = [("baz", "1.0", [(DebNameProvides, "baz", "1.0")],
+                     [(DebRequires, "qux", None, None)], None, None)]
+        loader = FakeLoader(packages, DebPackage)
+        self.cache.addLoader(loader)
+        self.cache.load()
+        self.assertEquals(self.names(self.cache._reqmatchnames["qux"]),
+                          ["qux"])
+        packages = [("qux", "1.0", [(DebNameProvides, "qux", "1.0")],
+                     None, None, None)]
+        self.cache.addLoader(FakeLoader(packages, DebPackage))
+        self.cache.load()
+        baz = self.cache.getPackages("baz")[0]
+        self.assertEquals(self.names(baz.requires[0].providedby),
+                          ["qux = 1.0"])
+        self.cache.removeLoader(loader)
+        self.cache.load()
+        self.assertFalse("qux" in self.cache._reqmatchnames)
+        self.assertFalse(self.cache.getProvides("qux")[0].requiredby)
+
+
+class SectionLoader(FakeLoader):
+
+    def load(self):
+        # Keeps state keyed by package, like the deb and rpm loaders.
+        self.fake_pid = os.getpid()
+        self.fake_sections = {}
+        for offset, (name, version, prvargs, reqargs, upgargs, cnfargs) \
+                in enumerate(self.fake_packages):
+            pkg = self.buildPackage((self.fake_pkgclass, name, version),
+                                    prvargs, reqargs, upgargs, cnfargs)
+            pkg.loaders[self] = offset
+            self.fake_sections[pkg] = name
+
+
+class WorkerFailingLoader(FakeLoader):
+
+    def load(self):
+        if os.getpid() != PARENT_PID:
+            raise IOError
+        FakeLoader.load(self)
+
+
+PARENT_PID = os.getpid()
+
+
+class ParallelLoadTest(IncrementalLoadTest):
+
+    def setUp(self):
+        sysconf.set("load-workers", 2)
+        IncrementalLoadTest.setUp(self)
+
+    def tearDown(self):
+        sysconf.remove("load-workers")
+
+    def serialLinks(self, loaders):
+        sysconf.remove("load-workers")
+        try:
+            cache = Cache()
+            for loader in loaders:
+                cache.addLoader(FakeLoader(loader.fake_packages, DebPackage))
+            cache.load()
+            return self.links(cache)
+        finally:
+            sysconf.set("load-workers", 2)
+
+    def test_parallel_load(self):
+        packages = [("baz", "1.0", [(DebNameProvides, "baz", "1.0")],
+                     [(DebRequires, "foo", ">=", "2.0")], None, None)]
+        loaders = [SectionLoader(LINKED_PACKAGES[:2], DebPackage),
+                   SectionLoader(packages, DebPackage),
+                   SectionLoader(LINKED_PACKAGES[2:], DebPackage)]
+        cache = Cache()
+        for loader in loaders:
+            cache.addLoader(loader)
+        cache.load()
+        self.assertEquals(self.links(cache), self.serialLinks(loaders))
+        packages = cache.getPackages()
+        for loader in loaders:
+            self.assertNotEquals(loader.fake_pid, os.getpid())
+            for offset, pkg in enumerate(loader.getPackages()):
+                self.assertEquals(pkg.loaders, {loader: offset})
+                self.assertEquals(loader.fake_sections[pkg], pkg.name)
+                self.assertTrue(pkg in packages)
+            self.assertEquals(len(loader.fake_sections),
+                              len(loader.getPackages()))
+
+    def test_parallel_load_linked(self):
+        packages = [("baz", "1.0", [(DebNameProvides, "baz", "1.0")],
+                     [(DebRequires, "foo", ">=", "2.0")], None, None)]
+        loaders = [SectionLoader(packages, DebPackage),
+                   SectionLoader(LINKED_PACKAGES[2:], DebPackage)]
+        for loader in loaders:
+            self.cache.addLoader(loader)
+        self.cache.load()
+        self.assertEquals(self.links(self.cache),
+                          self.serialLinks([self.loader]+loaders))
+
+    def test_worker_failure(self):
+        loaders = [WorkerFailingLoader(LINKED_PACKAGES[:2], DebPackage),
+                   FakeLoader(LINKED_PACKAGES[2:], DebPackage)]
+        cache = Cache()
+        for loader in loaders:
+            cache.addLoader(loader)
+        cache.load()
+        self.assertEquals(self.links(cache), self.serialLinks(loaders))
+
+
+class BinaryCacheTest(MockerTestCase):
+
+    def setUp(self):
+        self.cache = Cache()
+        self.loader = FakeLoader(PACKAGES)
+        self.cache.addLoader(self.loader)
+        self.cache.load()
+
+    def roundtrip(self, state):
+        path = self.makeFile()
+        file = open(path, "w")
+        dumpCache(file, self.cache.getPackages(), state)
+        file.close()
+        return loadCache(open(path))
+
+    def test_roundtrip(self):
+        cache, loader = self.roundtrip((self.cache, self.loader))
+        self.assertEquals(len(cache.getPackages()), 3)
+        self.assertEquals(sorted([str(pkg) for pkg in loader.getPackages()]),
+                          ["bar-1.0", "foo-1.0", "foo-2.0"])
+        foo1, foo2 = sorted(cache.getPackages("foo"))
+        self.assertEquals(foo1.provides, [Provides("foo", "1.0"),
+                                          Provides("libfoo", None)])
+        self.assertEquals(foo1.upgrades, [Upgrades("foo", "<", "1.0")])
+        self.assertEquals(foo2.conflicts, ())
+        self.assertTrue(foo1.provides[1] is foo2.provides[1])
+        self.assertTrue(foo1.requires[0] is foo2.requires[0])
+        self.assertTrue(type(foo1.requires[0]) is Requires)
+        self.assertEquals(foo1.loaders, {loader: 0})
+        self.assertEquals(foo1.requires[0].packages, [foo1, foo2])
+
+    def test_links(self):
+        self.cache = Cache()
+        self.cache.addLoader(FakeLoader(LINKED_PACKAGES, DebPackage))
+        self.cache.load()
+        cache, = self.roundtrip((self.cache,))
+        self.assertEquals(cache._linked.keys(), cache._loaders)
+        foo1, foo2 = sorted(cache.getPackages("foo"))
+        bar = cache.getPackages("bar")[0]
+        self.assertEquals(foo1.requires[0].providedby, bar.provides)
+        self.assertEquals(foo2.requires[0].providedby, bar.provides)
+        self.assertEquals(sorted(bar.provides[0].requiredby),
+                          sorted(foo1.requires+foo2.requires))
+        self.assertEquals(cache.getRequires("bar"), foo1.requires)
+
+    def test_package_attributes(self):
+        pkg = self.cache.getPackages("bar")[0]
+        pkg.installed = True
+        pkg.essential = True
+        pkg.priority = -10
+        cache, = self.roundtrip((self.cache,))
+        pkg = cache.getPackages("bar")[0]
+        self.assertEquals(pkg.installed, True)
+        self.assertEquals(pkg.essential, True)
+        self.assertEquals(pkg.priority, -10)
+        pkg = cache.getPackages("foo")[0]
+        self.assertEquals(pkg.installed, False)
+        self.assertEquals(pkg.priority, 0)
+
+    def test_pickled_relations(self):
+        nrv = (("bar", None, None), ("baz", ">=", "1.0"))
+        loader = FakeLoader([("qux", "1.0", None,
+                              [(DebOrRequires, nrv)], None, None)])
+        self.cache.addLoader(loader)
+        self.cache.load()
+        cache, = self.roundtrip((self.cache,))
+        pkg = cache.getPackages("qux")[0]
+        self.assertTrue(type(pkg.requires[0]) is DebOrRequires)
+        self.assertEquals(pkg.requires[0].getMatchNames(), ["bar", "baz"])
+
+    def test_invalid_version(self):
+        path = self.makeFile()
+        file = open(path, "w")
+        dumpCache(file, self.cache.getPackages(), None)
+        file.close()
+        data = open(path).read()
+        file = open(path, "w")
+        file.write(data[:8]+"\xff"+data[9:])
+        file.close()
+        self.assertRaises(StateVersionError, loadCache, open(path))
+
+    def test_truncated(self):
+        path = self.makeFile()
+        file = open(path, "w")
+        dumpCache(file, self.cache.getPackages(), None)
+        file.close()
+        data = open(path).read()
+        file = open(path, "w")
+        file.write(data[:len(data)/2])
+        file.close()
+        self.assertRaises(ValueError, loadCache, open(path))
@@ -4,8 +4,13 @@ from tests.mocker import MockerTestCase
 
 import smart.backends.deb._base
 
-from smart.backends.deb.base import getArchitecture
+from smart.backends.deb.base import getArchitecture, DebPackage, \
+                                    DebProvides, DebNameProvides, \
+                                    DebRequires, DebUpgrades, DebConflicts
 from smart.backends.deb.debver import splitrelease
+from smart.cache import Cache
+
+from tests.cache import FakeLoader
 
 
 class GetArchitectureTest(MockerTestCase):
@@ -65,3 +70,32 @@ class DebVerSplitTest(MockerTestCase):
         self.assertEquals(version, "1.0")
         self.assertEquals(release, "1_0ubuntu0.10.04")
 
+
+class DebMatchesTest(MockerTestCase):
+
+    def test_linking_agrees_with_matches(self):
+        packages = []
+        versions = [None, "1.0", "1:1.0", "1.0-1", "2.0~rc1", "2.0"]
+        relations = ["=", "<", "<=", ">", ">="]
+        for i, version in enumerate(versions):
+            packages.append(("prv%d" % i, "1.0",
+                             [(DebNameProvides, "name", version),
+                              (DebProvides, "name", version)],
+                             None, None, None))
+            for j, relation in enumerate(relations):
+                packages.append(("dep%d-%d" % (i, j), "1.0", None,
+                                 [(DebRequires, "name", relation, version)],
+                                 [(DebUpgrades, "name", relation, version)],
+                                 [(DebConflicts, "name", relation, version)]))
+        cache = Cache()
+        cache.addLoader(FakeLoader(packages, DebPackage))
+        cache.load()
+        provides = cache.getProvides("name")
+        deps = (cache.getRequires("name")+cache.getUpgrades("name")+
+                cache.getConflicts("name"))
+        self.assertEquals(len(provides), 12)
+        self.assertEquals(len(deps), 90)
+        for dep in deps:
+            for prv in provides:
+                self.assertEquals(prv in (dep.providedby or ()),
+                                  bool(dep.matches(prv)), (dep, prv))
@@ -1,5 +1,7 @@
 import BaseHTTPServer
+import SocketServer
 import threading
+import thread
 import unittest
 import socket
 import signal
@@ -9,8 +11,8 @@ import os
 from smart.progress import Progress
 from smart.interface import Interface
 from smart.fetcher import Fetcher
-from smart.const import VERSION, SUCCEEDED, FAILED
-from smart import fetcher, sysconf, iface
+from smart.const import VERSION, WAITING, SUCCEEDED, FAILED, NEVER
+from smart import fetcher, sysconf, iface, Error
 
 from tests.mocker import MockerTestCase
 
@@ -158,6 +160,7 @@ class FetcherTest(MockerTestCase):
         rate_limit = 10
         
         sysconf.set("max-download-rate", rate_limit, soft=True)
+        self.addCleanup(sysconf.remove, "max-download-rate", soft=True)
 
         def handler(request):
             request.send_header("Content-Length", str(bytes))
@@ -172,3 +175,708 @@ class FetcherTest(MockerTestCase):
         
         self.assertTrue(elapsed_time >= bytes / rate_limit)
     
+
+    def test_run_sub_fetchers(self):
+        filename = self.makeFile("content")
+        url = "file://" + filename
+        first = self.fetcher.getSubFetcher()
+        second = self.fetcher.getSubFetcher()
+        for sub_fetcher in (first, second):
+            sub_fetcher.setForceCopy(True)
+            sub_fetcher.setLocalPathPrefix(self.makeDir() + "/")
+            sub_fetcher.enqueue(url)
+        self.fetcher.run(progress=Progress(), fetchers=[first, second])
+        first_item = first.getItem(url)
+        second_item = second.getItem(url)
+        self.assertEquals(first_item.getStatus(), SUCCEEDED)
+        self.assertEquals(second_item.getStatus(), SUCCEEDED)
+        self.assertNotEquals(first_item.getTargetPath(),
+                             second_item.getTargetPath())
+        self.assertEquals(open(second_item.getTargetPath()).read(),
+                          "content")
+        self.assertEquals(self.fetcher.getItems(), [])
+
+    def test_run_sub_fetchers_share_download_slots(self):
+        sysconf.set("max-active-downloads", 1, soft=True)
+        self.addCleanup(sysconf.remove, "max-active-downloads", soft=True)
+        sub_fetcher = self.fetcher.getSubFetcher()
+        changes = []
+        def handler(request):
+            changes.append(sub_fetcher.changeActiveDownloads(+1))
+            changes.append(self.fetcher.getActiveDownloads())
+            request.send_header("Content-Length", "6")
+            request.wfile.write("Hello!")
+        self.start_server(handler)
+        sub_fetcher.enqueue(URL)
+        self.fetcher.run(progress=Progress(), fetchers=[sub_fetcher])
+        self.assertEquals(sub_fetcher.getItem(URL).getStatus(), SUCCEEDED)
+        self.assertEquals(changes, [False, 1])
+
+    def test_run_sub_fetchers_with_caching_always(self):
+        from smart.const import ALWAYS
+        filename = self.makeFile("content")
+        url = "file://" + filename
+        sub_fetcher = self.fetcher.getSubFetcher()
+        sub_fetcher.setForceCopy(True)
+        sub_fetcher.setCaching(ALWAYS)
+        sub_fetcher.enqueue(url)
+        self.fetcher.run(progress=Progress(), fetchers=[sub_fetcher])
+        self.assertEquals(sub_fetcher.getItem(url).getStatus(), FAILED)
+
+    def test_item_changes_are_reported_to_leader(self):
+        sub_fetcher = self.fetcher.getSubFetcher()
+        sub_fetcher._leader = self.fetcher
+        item = sub_fetcher.enqueue("file:///non-existent")
+        item.setFailed("Failed")
+        self.assertEquals(self.fetcher._waitChanges(0), {item: True})
+        self.assertEquals(self.fetcher._waitChanges(0), {})
+        self.assertEquals(sub_fetcher._waitChanges(0), {})
+
+    def test_reset_drops_queued_items(self):
+        item = self.fetcher.enqueue("file:///non-existent")
+        self.fetcher.reset()
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(item.getStatus(), WAITING)
+
+    def test_wait_change(self):
+        item = self.fetcher.enqueue("file:///non-existent")
+        count = self.fetcher.getChangeCount()
+        self.assertEquals(self.fetcher.waitChange(count, 0), count)
+        changed = []
+        def wait():
+            changed.append(self.fetcher.waitChange(count))
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        item.setFailed("Failed")
+        waiter.join(5)
+        self.assertEquals(changed, [count+1])
+        self.assertEquals(self.fetcher.waitChange(count, 0), count+1)
+        self.assertEquals(self.fetcher._waitChanges(0), {item: True})
+
+    def test_run_wakes_up_on_uncompress(self):
+        import gzip
+        filename = self.makeFile(suffix=".gz")
+        file = gzip.open(filename, "w")
+        file.write("content")
+        file.close()
+        self.fetcher.setForceCopy(True)
+        item = self.fetcher.enqueue("file://" + filename, uncomp=True)
+        start = time.time()
+        self.fetcher.run(progress=Progress())
+        self.assertTrue(time.time() - start < fetcher.SPEEDDELAY)
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(open(item.getTargetPath()).read(), "content")
+
+    def test_uncompress_while_downloading(self):
+        import gzip, StringIO
+        from smart.uncompress import GZipHandler
+        buffer = StringIO.StringIO()
+        file = gzip.GzipFile(fileobj=buffer, mode="w")
+        file.write("content")
+        file.close()
+        data = buffer.getvalue()
+        def handler(request):
+            request.send_response(200)
+            request.send_header("Content-Length", str(len(data)))
+            request.end_headers()
+            request.wfile.write(data)
+        self.start_server(handler)
+        def uncompress(self, localpath):
+            raise Error("Uncompressed after downloading")
+        original = GZipHandler.uncompress
+        GZipHandler.uncompress = uncompress
+        self.addCleanup(setattr, GZipHandler, "uncompress", original)
+        url = "http://127.0.0.1:%d/filename.gz" % PORT
+        md5 = "9a0364b9e99bb480dd25e1f0284c8555"
+        item = self.fetcher.enqueue(url, uncomp=True, uncomp_size=7,
+                                    uncomp_md5=md5)
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(item.getFailedReason(), None)
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(open(item.getTargetPath()).read(), "content")
+        self.assertFalse(os.path.exists(item.getTargetPath() + ".part"))
+
+    def test_uncompress_threads_are_limited(self):
+        import gzip
+        from smart.uncompress import GZipHandler
+        sysconf.set("max-uncompress-threads", 2, soft=True)
+        self.addCleanup(sysconf.remove, "max-uncompress-threads", soft=True)
+        lock = threading.Lock()
+        running = [0, 0]
+        def uncompress(self, localpath):
+            lock.acquire()
+            running[0] += 1
+            running[1] = max(running)
+            lock.release()
+            time.sleep(0.05)
+            original(self, localpath)
+            lock.acquire()
+            running[0] -= 1
+            lock.release()
+        original = GZipHandler.uncompress
+        GZipHandler.uncompress = uncompress
+        self.addCleanup(setattr, GZipHandler, "uncompress", original)
+        self.fetcher.setForceCopy(True)
+        items = []
+        for i in range(6):
+            filename = self.makeFile(suffix=".gz")
+            file = gzip.open(filename, "w")
+            file.write("content %d" % i)
+            file.close()
+            items.append(self.fetcher.enqueue("file://" + filename,
+                                              uncomp=True))
+        self.fetcher.run(progress=Progress())
+        for i, item in enumerate(items):
+            self.assertEquals(item.getStatus(), SUCCEEDED)
+            self.assertEquals(open(item.getTargetPath()).read(),
+                              "content %d" % i)
+        self.assertEquals(running, [0, 2])
+
+    def test_keepalive_connections_are_reused(self):
+        from smart.fetcher import URLLIBHandler
+        self.addCleanup(URLLIBHandler.closeConnections)
+        sysconf.set("max-active-downloads", 1, soft=True)
+        self.addCleanup(sysconf.remove, "max-active-downloads", soft=True)
+        connections = []
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                connections.append(self.client_address)
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "6")
+                self.end_headers()
+                self.wfile.write("Hello!")
+            def log_message(self, format, *args):
+                pass
+        httpd = HTTPServer(("127.0.0.1", PORT+1), Handler)
+        def server():
+            while connections[-1:] != [None]:
+                httpd.handle_request()
+        server_thread = threading.Thread(target=server)
+        server_thread.setDaemon(True)
+        server_thread.start()
+        url = "http://127.0.0.1:%d/" % (PORT+1)
+        for name in "first", "second", "third":
+            self.fetcher.enqueue(url + name)
+        self.fetcher.run(progress=Progress())
+        other_fetcher = Fetcher()
+        other_fetcher.setLocalPathPrefix(self.makeDir() + "/")
+        other_fetcher.enqueue(url + "fourth")
+        other_fetcher.run(progress=Progress())
+        items = self.fetcher.getItems() + other_fetcher.getItems()
+        self.assertEquals([item.getStatus() for item in items],
+                          [SUCCEEDED] * 4)
+        self.assertEquals(open(items[3].getTargetPath()).read(), "Hello!")
+        self.assertEquals(len(connections), 1)
+        connections.append(None)
+        URLLIBHandler.closeConnections()
+        server_thread.join()
+        httpd.server_close()
+
+    def test_resume_partial_download(self):
+        headers = []
+        def handler(request):
+            headers[:] = request.headers.headers
+            request.send_response(206)
+            request.send_header("Content-Range", "bytes 3-5/6")
+            request.send_header("Content-Length", "3")
+            request.end_headers()
+            request.wfile.write("lo!")
+        self.start_server(handler)
+        item = self.fetcher.enqueue(URL, size=6)
+        local_path = self.fetcher.getLocalPath(item)
+        open(local_path + ".part", "w").write("Hel")
+        open(local_path + ".part.info", "w").write("size: 6\n"
+                                                   "url: %s\n"
+                                                   "etag: \"abc\"\n" % URL)
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(open(local_path).read(), "Hello!")
+        self.assertTrue("range: bytes=3-\r\n" in headers)
+        self.assertTrue("if-range: \"abc\"\r\n" in headers)
+        self.assertFalse(os.path.exists(local_path + ".part.info"))
+
+    def test_drop_partial_download_of_other_file(self):
+        headers = []
+        def handler(request):
+            headers[:] = request.headers.headers
+            request.send_response(200)
+            request.send_header("Content-Length", "6")
+            request.send_header("ETag", "\"def\"")
+            request.end_headers()
+            request.wfile.write("Hello!")
+        self.start_server(handler)
+        item = self.fetcher.enqueue(URL, size=6)
+        local_path = self.fetcher.getLocalPath(item)
+        open(local_path + ".part", "w").write("Bye")
+        open(local_path + ".part.info", "w").write("size: 7\n")
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(open(local_path).read(), "Hello!")
+        self.assertEquals([x for x in headers if x.startswith("range")], [])
+
+    def test_keep_partial_download_info(self):
+        from smart.fetcher import URLLIBHandler
+        item = self.fetcher.enqueue(URL, size=6, md5="ABC")
+        handler = URLLIBHandler(self.fetcher)
+        local_path = self.fetcher.getLocalPath(item)
+        open(local_path + ".part", "w").write("Hel")
+        handler.setPartialInfo(item, local_path, {"etag": "\"abc\"",
+                                                  "last-modified": None})
+        self.assertEquals(handler.getPartial(item, local_path),
+                          (3, {"size": "6", "md5": "abc",
+                               "etag": "\"abc\""}))
+        item.setInfo(md5="def")
+        self.assertEquals(handler.getPartial(item, local_path), (0, {}))
+        self.assertFalse(os.path.exists(local_path + ".part"))
+        self.assertFalse(os.path.exists(local_path + ".part.info"))
+
+    def test_conditional_get_with_validators(self):
+        headers = []
+        def handler(request):
+            headers[:] = request.headers.headers
+            if request.headers.get("if-none-match") == "\"abc\"":
+                request.send_response(304)
+                request.end_headers()
+                return
+            request.send_response(200)
+            request.send_header("ETag", "\"abc\"")
+            request.send_header("Last-Modified",
+                                "Sat, 01 Jan 2000 00:00:00 GMT")
+            request.send_header("Content-Length", "6")
+            request.end_headers()
+            request.wfile.write("Hello!")
+        self.start_server(handler)
+        self.fetcher.setSaveValidators(True)
+        item = self.fetcher.enqueue(URL)
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        local_path = item.getTargetPath()
+        self.assertEquals(sorted(open(local_path + ".info")),
+                          ["etag: \"abc\"\n",
+                           "last-modified: Sat, 01 Jan 2000 00:00:00 GMT\n",
+                           "url: %s\n" % URL])
+        self.wait_for_server()
+
+        self.start_server(handler)
+        self.fetcher.reset()
+        self.fetcher.setCaching(NEVER)
+        item = self.fetcher.enqueue(URL)
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(open(local_path).read(), "Hello!")
+        self.assertTrue("if-none-match: \"abc\"\r\n" in headers)
+        self.assertTrue("if-modified-since: "
+                        "Sat, 01 Jan 2000 00:00:00 GMT\r\n" in headers)
+
+    def test_validators_are_only_saved_when_asked(self):
+        def handler(request):
+            request.send_response(200)
+            request.send_header("ETag", "\"abc\"")
+            request.send_header("Content-Length", "6")
+            request.end_headers()
+            request.wfile.write("Hello!")
+        self.start_server(handler)
+        item = self.fetcher.enqueue(URL)
+        local_path = self.fetcher.getLocalPath(item)
+        open(local_path + ".info", "w").write("url: %s\n"
+                                              "etag: \"old\"\n" % URL)
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(open(local_path).read(), "Hello!")
+        self.assertFalse(os.path.exists(local_path + ".info"))
+
+    def test_validators_are_for_the_same_url(self):
+        headers = []
+        def handler(request):
+            headers[:] = request.headers.headers
+            request.send_response(200)
+            request.send_header("Content-Length", "6")
+            request.end_headers()
+            request.wfile.write("Hello!")
+        self.start_server(handler)
+        self.fetcher.setCaching(NEVER)
+        item = self.fetcher.enqueue(URL)
+        local_path = self.fetcher.getLocalPath(item)
+        open(local_path, "w").write("Hello!")
+        open(local_path + ".info", "w").write("url: http://other/\n"
+                                              "etag: \"abc\"\n")
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertFalse([x for x in headers
+                          if x.startswith("if-none-match")])
+        self.assertFalse(os.path.exists(local_path + ".info"))
+
+    def test_validate_uses_digest_cache(self):
+        filename = self.makeFile("content")
+        item = self.fetcher.enqueue("file://" + filename,
+                                    md5="9a0364b9e99bb480dd25e1f0284c8555",
+                                    sha256="ed7002b439e9ac845f22357d822bac14"
+                                           "44730fbdb6016d3ec9432297b9ec9f73")
+        self.assertTrue(self.fetcher.validate(item, filename))
+        digest_cache = self.fetcher.getDigestCache()
+        digests = digest_cache.getDigests(filename)
+        self.assertEquals(sorted(digests.keys()), ["md5", "sha256"])
+        # Cached digests are trusted while the file is unchanged.
+        digests["md5"] = "0" * 32
+        digest_cache.setDigests(filename, digests)
+        self.assertFalse(self.fetcher.validate(item, filename))
+
+    def test_validate_callback_uses_digest_cache(self):
+        from smart.cache import PackageInfo
+        class TestPackageInfo(PackageInfo):
+            def getMD5(self, url):
+                return "9a0364b9e99bb480dd25e1f0284c8555"
+            def getSHA256(self, url):
+                return ("ed7002b439e9ac845f22357d822bac14"
+                        "44730fbdb6016d3ec9432297b9ec9f73")
+        reads = []
+        def getFileDigests(path, kinds):
+            reads.append(sorted(kinds))
+            return get_file_digests(path, kinds)
+        get_file_digests = fetcher.getFileDigests
+        fetcher.getFileDigests = getFileDigests
+        self.addCleanup(setattr, fetcher, "getFileDigests", get_file_digests)
+        filename = self.makeFile("content")
+        info = TestPackageInfo(None)
+        item = self.fetcher.enqueue("file://" + filename,
+                                    validate=info.validate)
+        for i in range(3):
+            self.assertTrue(self.fetcher.validate(item, filename))
+        self.assertEquals(reads, [["md5", "sha256"]])
+        digests = self.fetcher.getDigestCache().getDigests(filename)
+        digests["sha256"] = "0" * 64
+        self.fetcher.getDigestCache().setDigests(filename, digests)
+        valid, reason = self.fetcher.validate(item, filename, withreason=True)
+        self.assertFalse(valid)
+        self.assertTrue("SHA256" in str(reason))
+
+    def test_digest_cache_forgets_changed_files(self):
+        filename = self.makeFile("content")
+        item = self.fetcher.enqueue("file://" + filename,
+                                    md5="9a0364b9e99bb480dd25e1f0284c8555")
+        self.assertTrue(self.fetcher.validate(item, filename))
+        mtime = os.path.getmtime(filename)
+        time.sleep(0.01)
+        open(filename, "r+").write("CONTENT")
+        os.utime(filename, (mtime, mtime))
+        self.assertFalse(self.fetcher.validate(item, filename))
+
+    def test_digest_cache_save_and_load(self):
+        from smart.fetcher import DigestCache
+        filename = self.makeFile("content")
+        gone_filename = self.makeFile("gone")
+        path = self.makeFile()
+        digest_cache = DigestCache()
+        digest_cache.setDigests(filename, {"md5": "abc"})
+        digest_cache.setDigests(gone_filename, {"md5": "def"})
+        os.unlink(gone_filename)
+        self.assertTrue(digest_cache.getChanged())
+        digest_cache.save(path)
+        self.assertFalse(digest_cache.getChanged())
+        digest_cache = DigestCache()
+        digest_cache.load(path)
+        self.assertEquals(digest_cache.getDigests(filename), {"md5": "abc"})
+        self.assertEquals(digest_cache.getDigests(gone_filename), {})
+
+    def start_range_server(self, port, data, ranges=True):
+        requests = []
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def do_GET(self):
+                range = self.headers.get("range")
+                requests.append(range)
+                if ranges and range:
+                    start, end = map(int, range[6:].split("-"))
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes %d-%d/%d" %
+                                     (start, end, len(data)))
+                    body = data[start:end+1]
+                else:
+                    self.send_response(200)
+                    body = data
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        class Server(SocketServer.ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+        httpd = Server(("127.0.0.1", port), Handler)
+        httpd.hide_errors = True
+        server_thread = threading.Thread(target=httpd.serve_forever)
+        server_thread.setDaemon(True)
+        server_thread.start()
+        def stop():
+            fetcher.URLLIBHandler.closeConnections()
+            httpd.shutdown()
+            httpd.server_close()
+        self.addCleanup(stop)
+        return requests
+
+    def set_min_segment_size(self, size):
+        handler = fetcher.URLLIBHandler
+        def reset(size=handler.MINSEGMENTSIZE):
+            handler.MINSEGMENTSIZE = size
+        handler.MINSEGMENTSIZE = size
+        self.addCleanup(reset)
+
+    def test_segmented_download(self):
+        data = "".join([chr(i % 256) for i in range(1000)])
+        sysconf.set("segmented-download-size", 500, soft=True)
+        self.addCleanup(sysconf.remove, "segmented-download-size", soft=True)
+        self.set_min_segment_size(100)
+        first_requests = self.start_range_server(PORT+2, data)
+        second_requests = self.start_range_server(PORT+3, data)
+        first_url = "http://127.0.0.1:%d/" % (PORT+2)
+        second_url = "http://127.0.0.1:%d/" % (PORT+3)
+        self.fetcher.getMirrorSystem().setMirrors({first_url: [second_url]})
+        item = self.fetcher.enqueue(first_url + "filename.pkg", size=1000)
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(open(item.getTargetPath()).read(), data)
+        self.assertTrue(first_requests)
+        self.assertTrue(second_requests)
+        self.assertEquals(len(first_requests) + len(second_requests), 8)
+
+    def test_segmented_download_without_ranges_on_mirror(self):
+        data = "".join([chr(i % 256) for i in range(1000)])
+        sysconf.set("segmented-download-size", 500, soft=True)
+        self.addCleanup(sysconf.remove, "segmented-download-size", soft=True)
+        self.set_min_segment_size(100)
+        self.start_range_server(PORT+2, data)
+        self.start_range_server(PORT+3, data, ranges=False)
+        first_url = "http://127.0.0.1:%d/" % (PORT+2)
+        second_url = "http://127.0.0.1:%d/" % (PORT+3)
+        self.fetcher.getMirrorSystem().setMirrors({first_url: [second_url]})
+        item = self.fetcher.enqueue(first_url + "filename.pkg", size=1000)
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(open(item.getTargetPath()).read(), data)
+
+    def enable_async_http(self):
+        registry = Fetcher._registry.copy()
+        def restore():
+            Fetcher._registry.clear()
+            Fetcher._registry.update(registry)
+        self.addCleanup(restore)
+        fetcher.enableAsyncHTTP()
+
+    def start_threading_server(self, port, handler):
+        connections = []
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                connections.append(self.client_address)
+            def do_GET(self):
+                return handler(self)
+            def log_message(self, format, *args):
+                pass
+        class Server(SocketServer.ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+        httpd = Server(("127.0.0.1", port), Handler)
+        httpd.hide_errors = True
+        server_thread = threading.Thread(target=httpd.serve_forever)
+        server_thread.setDaemon(True)
+        server_thread.start()
+        def stop():
+            httpd.shutdown()
+            httpd.server_close()
+        self.addCleanup(stop)
+        return connections
+
+    def send_body(self, request, body, status=200):
+        request.send_response(status)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def test_async_http_resumes_partial_download(self):
+        self.enable_async_http()
+        self.test_resume_partial_download()
+
+    def test_async_http_conditional_get_with_validators(self):
+        self.enable_async_http()
+        self.test_conditional_get_with_validators()
+
+    def test_async_http_runs_downloads_at_once(self):
+        self.enable_async_http()
+        threads = {}
+        progress = fetcher.FetchItem.__dict__["progress"]
+        def record_progress(item, current, total):
+            threads[thread.get_ident()] = True
+            progress(item, current, total)
+        fetcher.FetchItem.progress = record_progress
+        self.addCleanup(setattr, fetcher.FetchItem, "progress", progress)
+        condition = threading.Condition()
+        paths = []
+        def handler(request):
+            # Only answer once every request has arrived.
+            condition.acquire()
+            paths.append(request.path)
+            condition.notifyAll()
+            deadline = time.time() + 10
+            while len(paths) < 3 and time.time() < deadline:
+                condition.wait(1)
+            condition.release()
+            self.send_body(request, "Hello %s!" % request.path[1:])
+        self.start_threading_server(PORT+4, handler)
+        url = "http://127.0.0.1:%d/" % (PORT+4)
+        items = [self.fetcher.enqueue(url + name)
+                 for name in ("first", "second", "third")]
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(len(paths), 3)
+        for item in items:
+            self.assertEquals(item.getStatus(), SUCCEEDED)
+            self.assertEquals(open(item.getTargetPath()).read(),
+                              "Hello %s!" % item.getURL().path[1:])
+        self.assertEquals(len(threads), 1)
+
+    def test_async_http_limits_downloads_per_host(self):
+        self.enable_async_http()
+        sysconf.set("max-host-downloads", 2, soft=True)
+        self.addCleanup(sysconf.remove, "max-host-downloads", soft=True)
+        lock = threading.Lock()
+        running = [0, 0]
+        def handler(request):
+            lock.acquire()
+            running[0] += 1
+            running[1] = max(running)
+            lock.release()
+            time.sleep(0.2)
+            lock.acquire()
+            running[0] -= 1
+            lock.release()
+            self.send_body(request, "Hello!")
+        self.start_threading_server(PORT+4, handler)
+        url = "http://127.0.0.1:%d/" % (PORT+4)
+        items = [self.fetcher.enqueue(url + str(i)) for i in range(5)]
+        self.fetcher.run(progress=Progress())
+        self.assertEquals([item.getStatus() for item in items],
+                          [SUCCEEDED] * 5)
+        self.assertEquals(running[1], 2)
+
+    def test_async_http_chunked_with_keepalive(self):
+        self.enable_async_http()
+        sysconf.set("max-active-downloads", 1, soft=True)
+        self.addCleanup(sysconf.remove, "max-active-downloads", soft=True)
+        def handler(request):
+            request.send_response(200)
+            request.send_header("Transfer-Encoding", "chunked")
+            request.end_headers()
+            for chunk in ("Hello ", request.path[1:], "!", ""):
+                request.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+        connections = self.start_threading_server(PORT+4, handler)
+        url = "http://127.0.0.1:%d/" % (PORT+4)
+        items = [self.fetcher.enqueue(url + name)
+                 for name in ("first", "second", "third")]
+        self.fetcher.run(progress=Progress())
+        for item in items:
+            self.assertEquals(item.getStatus(), SUCCEEDED)
+            self.assertEquals(open(item.getTargetPath()).read(),
+                              "Hello %s!" % item.getURL().path[1:])
+        self.assertEquals(len(connections), 1)
+
+    def fake_getaddrinfo(self, func):
+        getaddrinfo = socket.getaddrinfo
+        def wrapper(host, *args):
+            return getaddrinfo(func(host), *args)
+        socket.getaddrinfo = wrapper
+        self.addCleanup(setattr, socket, "getaddrinfo", getaddrinfo)
+
+    def test_async_http_looks_up_hosts_in_background(self):
+        self.enable_async_http()
+        served = threading.Event()
+        def lookup(host):
+            if host == "slow.test":
+                # Only answer once the other download is over.
+                served.wait(10)
+                return "127.0.0.1"
+            if host == "missing.test":
+                raise socket.gaierror(socket.EAI_NONAME, "Unknown host")
+            return host
+        self.fake_getaddrinfo(lookup)
+        def handler(request):
+            self.send_body(request, "Hello!")
+            if request.path == "/fast":
+                served.set()
+        self.start_threading_server(PORT+4, handler)
+        slow_item = self.fetcher.enqueue("http://slow.test:%d/slow"
+                                         % (PORT+4))
+        missing_item = self.fetcher.enqueue("http://missing.test:%d/missing"
+                                            % (PORT+4))
+        fast_item = self.fetcher.enqueue("http://127.0.0.1:%d/fast"
+                                         % (PORT+4))
+        start = time.time()
+        self.fetcher.run(progress=Progress())
+        self.assertTrue(time.time() - start < 5)
+        self.assertEquals(slow_item.getStatus(), SUCCEEDED)
+        self.assertEquals(fast_item.getStatus(), SUCCEEDED)
+        self.assertEquals(missing_item.getFailedReason(), u"Unknown host")
+        # Failed lookups are tried again on the next run.
+        handler = self.fetcher.getHandlerInstance(fast_item)
+        self.assertFalse(("missing.test", PORT+4) in handler._addresses)
+
+    def test_async_http_redirect_counts_for_new_host(self):
+        self.enable_async_http()
+        sysconf.set("max-host-downloads", 1, soft=True)
+        self.addCleanup(sysconf.remove, "max-host-downloads", soft=True)
+        self.fake_getaddrinfo(lambda host: host.replace("mirror.test",
+                                                        "127.0.0.1"))
+        condition = threading.Condition()
+        paths = []
+        def handler(request):
+            if request.path == "/old":
+                request.send_response(302)
+                request.send_header("Location", "http://mirror.test:%d/new"
+                                                % (PORT+4))
+                request.send_header("Content-Length", "0")
+                request.end_headers()
+                return
+            # Tell whether the other download runs at the same time.
+            condition.acquire()
+            paths.append(request.path)
+            condition.notifyAll()
+            deadline = time.time() + 3
+            while len(paths) < 2 and time.time() < deadline:
+                condition.wait(1)
+            condition.release()
+            self.send_body(request, "Hello %d!" % len(paths))
+        self.start_threading_server(PORT+4, handler)
+        url = "http://127.0.0.1:%d/" % (PORT+4)
+        items = [self.fetcher.enqueue(url + name)
+                 for name in ("old", "other")]
+        self.fetcher.run(progress=Progress())
+        for item in items:
+            self.assertEquals(item.getStatus(), SUCCEEDED)
+            self.assertEquals(open(item.getTargetPath()).read(), "Hello 2!")
+        handler = self.fetcher.getHandlerInstance(items[0])
+        self.assertEquals(handler._hostactive,
+                          {"127.0.0.1": 0, "mirror.test": 0})
+
+    def test_async_http_redirect_and_not_found(self):
+        self.enable_async_http()
+        headers = []
+        def handler(request):
+            headers.append(request.headers.get("user-agent"))
+            if request.path == "/old":
+                request.send_response(302)
+                request.send_header("Location", "/new")
+                request.send_header("Content-Length", "0")
+                request.end_headers()
+            elif request.path == "/new":
+                self.send_body(request, "Hello!")
+            else:
+                self.send_body(request, "Not here", 404)
+        self.start_threading_server(PORT+4, handler)
+        url = "http://127.0.0.1:%d/" % (PORT+4)
+        item = self.fetcher.enqueue(url + "old")
+        missing_item = self.fetcher.enqueue(url + "missing")
+        self.fetcher.run(progress=Progress())
+        self.assertEquals(item.getStatus(), SUCCEEDED)
+        self.assertEquals(open(item.getTargetPath()).read(), "Hello!")
+        self.assertEquals(missing_item.getFailedReason(), u"File not found")
+        self.assertEquals(headers[0], "smart/%s" % VERSION)
@@ -0,0 +1,118 @@
+import unittest
+import time
+
+from smart.mirror import MirrorSystem, FAILUREHALFLIFE
+from smart import sysconf
+
+
+ORIGIN = "http://origin/"
+NEAR = "http://near/"
+FAST = "http://fast/"
+
+
+class MirrorSystemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.system = MirrorSystem()
+        self.system.setMirrors({ORIGIN: [NEAR, FAST]})
+        # NEAR answers quickly but is slow on bulk transfers, while
+        # FAST takes a while to answer but then transfers quickly.
+        for i in range(5):
+            self.system.addInfo(NEAR, time=2.05, size=1000000, latency=0.05)
+            self.system.addInfo(FAST, time=1.2, size=10000000, latency=1.0)
+
+    def test_estimates(self):
+        latency, throughput, failures, last = \
+            self.system.getEstimates(NEAR)
+        self.assertAlmostEquals(latency, 0.05)
+        self.assertAlmostEquals(throughput, 500000)
+        self.assertEquals(failures, 0)
+        self.assertTrue(time.time() - last < 10)
+        self.assertEquals(self.system.getEstimates(ORIGIN),
+                          (None, None, 0, None))
+
+    def test_small_files_from_low_latency_mirror(self):
+        # Mirrors without information would be tried as well.
+        self.system.addInfo(ORIGIN, time=0.5, size=1000)
+        item = self.system.get(ORIGIN + "small.rpm", 10000)
+        self.assertEquals(item.getNext(), NEAR + "small.rpm")
+        self.assertEquals(item.getNext(), ORIGIN + "small.rpm")
+        self.assertEquals(item.getNext(), FAST + "small.rpm")
+
+    def test_large_files_from_high_throughput_mirror(self):
+        item = self.system.get(ORIGIN + "large.rpm", 100000000)
+        self.assertEquals(item.getNext(), ORIGIN + "large.rpm")
+        self.assertEquals(item.getNext(), FAST + "large.rpm")
+        self.assertEquals(item.getNext(), NEAR + "large.rpm")
+        self.assertEquals(item.getNext(), None)
+
+    def test_failures_penalize(self):
+        costs = self.system.getCosts()
+        for i in range(3):
+            self.system.addInfo(NEAR, failed=1)
+        self.assertTrue(self.system.getCosts()[NEAR] > 2 * costs[NEAR])
+        self.assertEquals(self.system.getCosts()[FAST], costs[FAST])
+
+    def test_failures_are_forgotten(self):
+        self.system.addInfo(NEAR, failed=1)
+        latency, throughput, failures, last = \
+            self.system.getEstimates(NEAR)
+        self.assertAlmostEquals(failures, 0.3)
+        latency, throughput, failures, last = \
+            self.system.getEstimates(NEAR, last + FAILUREHALFLIFE)
+        self.assertAlmostEquals(failures, 0.15)
+
+    def test_just_failures_cost_as_much_as_the_worst(self):
+        self.system.addInfo(ORIGIN, failed=1)
+        costs = self.system.getCosts()
+        worst = max(costs[NEAR], costs[FAST])
+        self.assertAlmostEquals(costs[ORIGIN], worst * (1 + 4 * 0.3))
+
+    def test_stats_changed(self):
+        system = MirrorSystem()
+        system.setStats(self.system.getStats())
+        self.assertFalse(system.getStatsChanged())
+        system.clearStats([NEAR])
+        self.assertTrue(system.getStatsChanged())
+        self.assertEquals(system.getStats().keys(), [FAST])
+
+    def test_import_history(self):
+        system = MirrorSystem()
+        system.importHistory([(NEAR, {"failed": 1}),
+                              (NEAR, {"time": 0.5, "size": 1000})])
+        latency, throughput, failures, last = system.getEstimates(NEAR)
+        self.assertEquals(latency, 0.5)
+        self.assertEquals(throughput, None)
+        self.assertAlmostEquals(failures, 0.3)
+        self.assertTrue(system.getStatsChanged())
+
+
+class MirrorCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        import tests
+        self.ctrl = tests.ctrl
+        self.system = self.ctrl.getFetcher().getMirrorSystem()
+        self.system.setStats({})
+        sysconf.set("mirrors-stats", {NEAR: (0.05, None, 0.0, 0),
+                                      FAST: (1.0, None, 0.0, 0)})
+
+    def tearDown(self):
+        self.system.setStats({})
+        sysconf.remove("mirrors-stats")
+
+    def clear_history(self, *urls):
+        from smart.commands import mirror
+        opts = mirror.parse_options(["--clear-history"] + list(urls))
+        mirror.main(self.ctrl, opts)
+        self.ctrl.saveSysConf()
+
+    def test_clear_history_of_mirror(self):
+        self.clear_history(NEAR)
+        self.assertEquals(self.system.getStats().keys(), [FAST])
+        self.assertEquals(sysconf.get("mirrors-stats").keys(), [FAST])
+
+    def test_clear_all_history(self):
+        self.clear_history()
+        self.assertEquals(self.system.getStats(), {})
+        self.assertEquals(sysconf.get("mirrors-stats"), {})
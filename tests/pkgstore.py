@@ -0,0 +1,65 @@
+import os
+
+from smart.pkgstore import PackageStore
+
+from tests.mocker import MockerTestCase
+
+
+SHA256 = "a" * 64
+OTHER_SHA256 = "b" * 64
+
+
+class PackageStoreTest(MockerTestCase):
+
+    def setUp(self):
+        self.store_path = self.makeDir()
+        self.store = PackageStore(self.store_path)
+
+    def test_get_missing(self):
+        local_path = os.path.join(self.makeDir(), "package.rpm")
+        self.assertFalse(self.store.get(SHA256, local_path))
+        self.assertFalse(os.path.exists(local_path))
+
+    def test_add_and_get(self):
+        path = self.makeFile("content")
+        self.store.add(SHA256, path)
+        self.assertEquals(self.store.getPath(SHA256),
+                          os.path.join(self.store_path, "aa", SHA256))
+        local_path = os.path.join(self.makeDir(), "package.rpm")
+        self.assertTrue(self.store.get(SHA256, local_path))
+        self.assertEquals(open(local_path).read(), "content")
+        # Files are shared, rather than copied.
+        self.assertTrue(os.path.samefile(path, local_path))
+        self.assertEquals(os.stat(path).st_nlink, 3)
+
+    def test_add_replaces_other_file(self):
+        self.store.add(SHA256, self.makeFile("broken"))
+        path = self.makeFile("content")
+        self.store.add(SHA256, path)
+        self.assertTrue(os.path.samefile(path, self.store.getPath(SHA256)))
+        self.assertEquals(os.listdir(os.path.join(self.store_path, "aa")),
+                          [SHA256])
+
+    def test_cleanup_without_limit_keeps_everything(self):
+        path = self.makeFile("content")
+        self.store.add(SHA256, path)
+        os.unlink(path)
+        self.store.cleanup()
+        self.assertTrue(os.path.isfile(self.store.getPath(SHA256)))
+
+    def test_cleanup_removes_least_recently_used(self):
+        store = PackageStore(self.store_path, 10)
+        used_path = self.makeFile("used content")
+        store.add(SHA256, used_path)
+        for sha256, atime in (("c" * 64, 1000), ("d" * 64, 2000),
+                              ("e" * 64, 3000)):
+            path = self.makeFile("12345")
+            store.add(sha256, path)
+            os.unlink(path)
+            os.utime(store.getPath(sha256), (atime, atime))
+        store.cleanup()
+        # Files still used elsewhere don't count, and are kept.
+        self.assertTrue(os.path.isfile(store.getPath(SHA256)))
+        self.assertFalse(os.path.isfile(store.getPath("c" * 64)))
+        self.assertTrue(os.path.isfile(store.getPath("d" * 64)))
+        self.assertTrue(os.path.isfile(store.getPath("e" * 64)))
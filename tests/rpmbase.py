@@ -5,10 +5,15 @@ import rpm
 from mocker import MockerTestCase
 
 from smart.backends.rpm.base import RPMPackage, Package, Requires, Provides, \
-                                    getTS, collapse_libc_requires
+                                    getTS, collapse_libc_requires, \
+                                    RPMProvides, RPMNameProvides, \
+                                    RPMRequires, RPMObsoletes
 from smart.backends.rpm.rpmver import checkver, splitarch, splitrelease
+from smart.cache import Cache
 from smart import sysconf
 
+from tests.cache import FakeLoader
+
 
 class getTSTest(MockerTestCase):
 
@@ -126,3 +131,32 @@ class RPMVerSplitTest(MockerTestCase):
         self.assertEquals(version, "1.0")
         self.assertEquals(release, "1")
 
+class RPMMatchesTest(MockerTestCase):
+
+    def test_linking_agrees_with_matches(self):
+        packages = []
+        versions = ["1.0-1", "1.0-1@i586", "1.0-1@x86_64", "1.0-1@noarch",
+                    "1:1.0-1@i586", "2.0-1@x86_64"]
+        relations = ["=", "<", "<=", ">", ">="]
+        for i, version in enumerate(versions):
+            packages.append(("prv%d" % i, "1.0-1@i586",
+                             [(RPMNameProvides, "name", version),
+                              (RPMProvides, "name", version)],
+                             None, None, None))
+            for j, relation in enumerate(relations):
+                packages.append(("dep%d-%d" % (i, j), "1.0-1@i586", None,
+                                 [(RPMRequires, "name", relation, version)],
+                                 [(RPMObsoletes, "name", relation, version)],
+                                 None))
+        cache = Cache()
+        cache.addLoader(FakeLoader(packages, RPMPackage))
+        cache.load()
+        provides = cache.getProvides("name")
+        deps = cache.getRequires("name")+cache.getUpgrades("name")
+        self.assertEquals(len(provides), 12)
+        self.assertEquals(len(deps), 60)
+        for dep in deps:
+            for prv in provides:
+                self.assertEquals(prv in (dep.providedby or ()),
+                                  bool(dep.matches(prv)), (dep, prv))
+
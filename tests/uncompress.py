@@ -44,3 +44,65 @@ class UncompressorTest(unittest.TestCase):
     def test_7zip(self):
         self.uncompress_file("%s/uncompress/test.7z" % TESTDATADIR)
 
+
+    def open_file(self, file):
+        from hashlib import md5
+        digest = md5()
+        input = Uncompressor.open(file, (digest,))
+        data = input.read(10)+input.read()
+        self.assertEquals(input.read(), "")
+        input.close()
+        orig = open("%s/uncompress/test.txt" % TESTDATADIR).read()
+        self.assertEquals(data, orig)
+        self.assertEquals(digest.hexdigest(), md5(orig).hexdigest())
+
+    def test_open_gzip(self):
+        self.open_file("%s/uncompress/test.gz" % TESTDATADIR)
+
+    def test_open_bzip2(self):
+        self.open_file("%s/uncompress/test.bz2" % TESTDATADIR)
+
+    def test_open_plain(self):
+        self.open_file("%s/uncompress/test.txt" % TESTDATADIR)
+
+    def open_streams(self, suffix, compress):
+        import tempfile
+        from smart import uncompress
+        first = compress("Hello ")
+        data = first+compress("world!")
+        if suffix == ".gz":
+            data += "\0"*8
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.write(fd, data)
+        os.close(fd)
+        try:
+            self.assertEquals(Uncompressor.open(path).read(),
+                              "Hello world!")
+            # A stream may end right at the end of a block as well.
+            blocksize = uncompress.BLOCKSIZE
+            uncompress.BLOCKSIZE = len(first)
+            try:
+                self.assertEquals(Uncompressor.open(path).read(),
+                                  "Hello world!")
+            finally:
+                uncompress.BLOCKSIZE = blocksize
+        finally:
+            os.unlink(path)
+
+    def test_open_gzip_members(self):
+        import gzip, StringIO
+        def compress(data):
+            file = StringIO.StringIO()
+            output = gzip.GzipFile(fileobj=file, mode="w")
+            output.write(data)
+            output.close()
+            return file.getvalue()
+        self.open_streams(".gz", compress)
+
+    def test_open_bzip2_streams(self):
+        import bz2
+        self.open_streams(".bz2", bz2.compress)
+
+    def test_open_unsupported(self):
+        self.assertEquals(Uncompressor.open("%s/uncompress/test.zip" %
+                                            TESTDATADIR), None)
@@ -92,3 +92,98 @@ class YumRpmChannelTest(MockerTestCase):
         except AttributeError, error:
              # AttributeError: 'ExpatError' object has no attribute 'split'
              self.fail(error)
+
+    def make_repository(self):
+        repository_dir = self.makeDir()
+        shutil.rmtree(repository_dir)
+        shutil.copytree(os.path.join(TESTDATADIR, "yumrpm"), repository_dir)
+        return repository_dir
+
+    def touch_repomd(self, repository_dir):
+        # Change repomd.xml without changing primary or filelists,
+        # as a new updateinfo or other.xml would.
+        repomd_path = os.path.join(repository_dir, "repodata/repomd.xml")
+        repomd = open(repomd_path).read()
+        open(repomd_path, "w").write(repomd.replace("1236003182",
+                                                    "1236003183", 1))
+
+    def test_fetch_reuses_unchanged_loader(self):
+        repository_dir = self.make_repository()
+        channel = createChannel("alias",
+                                {"type": "rpm-md",
+                                 "baseurl": "file://%s" % repository_dir})
+        self.check_channel(channel)
+        loader = channel.getLoaders()[0]
+        digest = channel.getDigest()
+
+        self.touch_repomd(repository_dir)
+        self.assertEquals(channel.fetch(self.fetcher, self.progress), True)
+        self.assertNotEquals(channel.getDigest(), digest)
+        self.assertEquals(channel.getLoaders(), [loader])
+        self.assertEquals(loader.getCache(), self.cache)
+        self.assertEquals(len(loader._packages), 2)
+
+    def test_fetch_replaces_changed_loader(self):
+        repository_dir = self.make_repository()
+        channel = createChannel("alias",
+                                {"type": "rpm-md",
+                                 "baseurl": "file://%s" % repository_dir})
+        self.check_channel(channel)
+        loader = channel.getLoaders()[0]
+
+        # Going from the sqlite databases to the XML files changes
+        # what primary is loaded from.
+        self.touch_repomd(repository_dir)
+        sysconf.set("rpm-md-sqlite", False)
+        try:
+            self.assertEquals(channel.fetch(self.fetcher, self.progress),
+                              True)
+        finally:
+            sysconf.remove("rpm-md-sqlite")
+        self.assertEquals(len(channel.getLoaders()), 1)
+        self.assertNotEquals(channel.getLoaders()[0], loader)
+        self.assertEquals(loader.getCache(), None)
+
+    def test_fetch_checks_streamed_primary(self):
+        from smart.util.filetools import getFileDigest
+        repository_dir = self.make_repository()
+        repomd_path = os.path.join(repository_dir, "repodata/repomd.xml")
+        repomd = open(repomd_path).read()
+        open(repomd_path, "w").write(repomd.replace(
+            "b1d7af13dd98baa36a9d2c8757d0cceb95e9de16a8120600c692e8d1551988cc",
+            "0"*64))
+        channel = createChannel("alias",
+                                {"type": "rpm-md",
+                                 "baseurl": "file://%s" % repository_dir})
+        sysconf.set("rpm-md-sqlite", False)
+        self.addCleanup(sysconf.remove, "rpm-md-sqlite")
+        self.assertRaises(Error, channel.fetch, self.fetcher, self.progress)
+        self.assertEquals(channel.getLoaders(), [])
+        self.assertNotEquals(channel.getDigest(), getFileDigest(repomd_path))
+
+        # The channel is fetched again once the repository is fixed.
+        open(repomd_path, "w").write(repomd)
+        self.check_channel(channel)
+
+    def test_load_in_workers(self):
+        from smart.cache import _loadInWorkers
+        channel = createChannel("alias",
+                                {"type": "rpm-md",
+                                 "baseurl": "file://%s/yumrpm" % TESTDATADIR})
+        self.assertEquals(channel.fetch(self.fetcher, self.progress), True)
+        loader = channel.getLoaders()[0]
+        self.cache.addLoader(loader)
+        # Counting steps must not leave a database open for the worker
+        # to inherit, and it must be usable once results are merged.
+        self.assertEquals(loader.getLoadSteps(), 2)
+        self.assertEquals(loader._db, None)
+        saved = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            _loadInWorkers([loader], 2)
+        finally:
+            sys.stdout = saved
+        packages = sorted(loader.getPackages())
+        self.assertEquals([pkg.name for pkg in packages], ["name1", "name2"])
+        info = loader.getInfo(packages[1])
+        self.assertEquals(info.getSummary(), "Summary2")